@@ -0,0 +1,103 @@
+"""
+Throughput of a chunked batch spread over several backends (sg_backends) against one backend.
+
+Every stand-in backend generates one request at a time (``--seconds-per-image`` per image, like a single GPU) and
+answers with the requested number of PNGs and their seeds. The batch is planned and sent the way the plug-in
+does it: at least one chunk per backend, chunks running side by side, results read in seed order.
+
+    python benchmarks/bench_backend_pool.py --images 32 --seconds-per-image 0.1 --backends 1 2 4
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import json
+import os
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_worker import make_pixels
+from fake_backend import FakeBackend
+
+from sg_backends import BackendPool
+from sg_batch import BatchPlanner
+from sg_payload import PAYLOAD_POLICY
+
+ENDPOINT = "/sdapi/v1/txt2img"
+SIZE = 512
+
+
+def make_handler(image: str, seconds_per_image: float) -> Any:
+    gpu = threading.Lock()
+
+    def generate(request: dict[str, Any]) -> dict[str, Any]:
+        count = request["batch_size"] * request.get("n_iter", 1)
+        with gpu:
+            time.sleep(seconds_per_image * count)
+        seeds = [request["seed"] + index for index in range(count)]
+        info = {"all_seeds": seeds, "infotexts": [""] * count, "width": request["width"], "height": request["height"]}
+        return {"images": [image] * count, "info": json.dumps(info)}
+
+    return generate
+
+
+def run(pool: BackendPool, data: dict[str, Any], planner: BatchPlanner) -> tuple[float, list[int]]:
+    start = time.perf_counter()
+    chunks = planner.plan(data["batch_size"], data["seed"], SIZE, SIZE, data["steps"], min_chunks=len(pool))
+    seeds: list[int] = []
+    with ThreadPoolExecutor(min(len(chunks), len(pool))) as executor:
+        futures = [executor.submit(pool.post_stream, ENDPOINT, chunk.apply(data)) for chunk in chunks]
+        for future in futures:
+            response = future.result()
+            for _ in response.images():
+                pass
+            seeds.extend(json.loads(response["info"])["all_seeds"])
+    return time.perf_counter() - start, seeds
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=32)
+    parser.add_argument("--seconds-per-image", type=float, default=0.1)
+    parser.add_argument("--chunk-seconds", type=float, default=1.0)
+    parser.add_argument("--backends", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    image = base64.b64encode(PAYLOAD_POLICY.encode(make_pixels(SIZE), SIZE, SIZE, 3, "png").data).decode()
+    data = {"prompt": "benchmark", "seed": 1000, "batch_size": args.images, "steps": 20, "width": SIZE, "height": SIZE}
+    expected = list(range(1000, 1000 + args.images))
+    planner = BatchPlanner(
+        chunk_seconds=args.chunk_seconds,
+        seconds_per_megapixel_step=args.seconds_per_image / (SIZE * SIZE / 1e6 * data["steps"]),
+    )
+
+    servers = [
+        FakeBackend(handlers={ENDPOINT: make_handler(image, args.seconds_per_image)}).start()
+        for _ in range(max(args.backends))
+    ]
+    try:
+        baseline = None
+        for count in args.backends:
+            pool = BackendPool.fromUrls([server.base_url for server in servers[:count]])
+            seconds, seeds = run(pool, data, planner)
+            baseline = baseline or seconds * count
+            requests = ", ".join(str(backend.requests) for backend in pool.backends)
+            print(
+                f"{count} backends: {args.images} images in {seconds:6.2f} s, {args.images / seconds:6.1f} images/s, "
+                f"speed-up {baseline / seconds:4.2f}x, requests per backend [{requests}], "
+                f"seed order ok: {seeds == expected}",
+            )
+    finally:
+        for server in servers:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Time to the first inserted image and to the whole batch, with and without chunking (sg_batch).
+
+The stand-in backend takes ``--seconds-per-image`` per generated image plus ``--request-overhead`` per request
+(model warm-up, VAE decode, encoding the response), and answers with the requested number of PNGs and their
+seeds. Unchunked, the whole batch comes back in one response; chunked, the client reads each chunk's images
+while the plug-in would insert them. Before timing, the plans of every image count up to ``--images`` are checked
+over chunk durations, image sizes and backend counts: no empty chunk, images adding up, seeds contiguous.
+
+    python benchmarks/bench_batch_chunks.py --images 40 --seconds-per-image 0.25 --chunk-seconds 2 5
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+
+from typing import Any
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_worker import make_pixels
+from fake_backend import FakeBackend
+
+from sg_api import ApiClient
+from sg_batch import BatchPlanner
+from sg_payload import PAYLOAD_POLICY
+
+ENDPOINT = "/sdapi/v1/txt2img"
+
+
+def make_handler(image: str, seconds_per_image: float, request_overhead: float) -> Any:
+    def generate(request: dict[str, Any]) -> dict[str, Any]:
+        count = request["batch_size"] * request.get("n_iter", 1)
+        time.sleep(request_overhead + seconds_per_image * count)
+        seeds = [request["seed"] + index for index in range(count)]
+        info = {"all_seeds": seeds, "infotexts": [""] * count, "width": request["width"], "height": request["height"]}
+        return {"images": [image] * count, "info": json.dumps(info)}
+
+    return generate
+
+
+def check_plans(max_images: int, chunk_seconds: list[float]) -> list[str]:
+    """Plans breaking the planner's promises, described"""
+    problems = []
+    for seconds in [0.0, *chunk_seconds]:
+        planner = BatchPlanner(chunk_seconds=seconds)
+        for count, size, min_chunks, steps in itertools.product(
+            range(1, max_images + 1),
+            (512, 1024, 2048),
+            range(1, 6),
+            (1, 20, 200),
+        ):
+            chunks = planner.plan(count, 1000, size, size, steps, min_chunks)
+            seeds = [chunk.seed + index for chunk in chunks for index in range(chunk.count)]
+            if any(chunk.count <= 0 for chunk in chunks) or seeds != list(range(1000, 1000 + count)):
+                problems.append(f"{count} images at {size} px, {steps} steps, {min_chunks} backends: {chunks}")
+    return problems
+
+
+def run(client: ApiClient, data: dict[str, Any], planner: BatchPlanner | None) -> tuple[float, float, list[int]]:
+    start = time.perf_counter()
+    first = None
+    seeds: list[int] = []
+    chunks = [None] if planner is None else planner.plan(data["batch_size"], data["seed"], 512, 512, data["steps"])
+    for chunk in chunks:
+        response = client.post_stream(ENDPOINT, data if chunk is None else chunk.apply(data))
+        for _ in response.images():
+            if first is None:
+                first = time.perf_counter() - start
+        seeds.extend(json.loads(response["info"])["all_seeds"])
+    return first or 0.0, time.perf_counter() - start, seeds
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=40)
+    parser.add_argument("--seconds-per-image", type=float, default=0.25)
+    parser.add_argument("--request-overhead", type=float, default=0.2)
+    parser.add_argument("--chunk-seconds", type=float, nargs="+", default=[2.0, 5.0])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    problems = check_plans(args.images, args.chunk_seconds)
+    print(f"plans checked up to {args.images} images: {len(problems)} broken")
+    if problems:
+        sys.exit("\n".join(problems[:10]))
+
+    size = 512
+    image = base64.b64encode(PAYLOAD_POLICY.encode(make_pixels(size), size, size, 3, "png").data).decode()
+    handler = make_handler(image, args.seconds_per_image, args.request_overhead)
+    data = {"prompt": "benchmark", "seed": 1000, "batch_size": args.images, "steps": 20, "width": size, "height": size}
+    expected = list(range(1000, 1000 + args.images))
+
+    with FakeBackend(handlers={ENDPOINT: handler}) as backend:
+        client = ApiClient(backend.base_url)
+        first, total, seeds = run(client, data, None)
+        print(f"{'one request':<18} first image {first:6.2f} s, all {args.images} images {total:6.2f} s")
+
+        for chunk_seconds in args.chunk_seconds:
+            # measured throughput, as a plug-in run would have it from earlier chunks
+            seconds_per_mp_step = args.seconds_per_image / (size * size / 1e6 * data["steps"])
+            planner = BatchPlanner(chunk_seconds=chunk_seconds, seconds_per_megapixel_step=seconds_per_mp_step)
+            first, total, seeds = run(client, data, planner)
+            chunks = len(planner.plan(args.images, 1000, size, size, data["steps"]))
+            print(
+                f"{f'chunks of {chunk_seconds:g} s':<18} first image {first:6.2f} s, all {args.images} images "
+                f"{total:6.2f} s ({chunks} requests, seeds contiguous: {seeds == expected})",
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Payload of an inpainting request for a small selection, whole canvas vs. cropped to the selection (sg_region).
+
+The whole-canvas request encodes the full layer and a full-canvas mask; the cropped one reads only the selection
+bounds plus ``--padding`` from the buffer, aligned to 8 (64 with ControlNet), for the init image and the mask. The
+pixels are a smooth gradient with some noise, roughly as hard to compress as a photo. Requests are POSTed to the
+stand-in backend to include the upload.
+
+    python benchmarks/bench_crop_region.py --canvas 6000 4000 --selections 128 512 1024 --padding 32
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_backend import FakeBackend
+
+from sg_api import ApiClient
+from sg_payload import PAYLOAD_POLICY, EncodedImage
+from sg_region import CONTROLNET_MULTIPLE, SIZE_MULTIPLE, CropRegion, crop_region
+
+ENDPOINT = "/sdapi/v1/img2img"
+
+
+def make_canvas(width: int, height: int) -> np.ndarray:
+    rng = np.random.default_rng(1)
+    y, x = np.mgrid[0:height, 0:width]
+    canvas = np.dstack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)]).astype(np.int16)
+    return np.clip(canvas + rng.integers(-6, 7, canvas.shape), 0, 255).astype(np.uint8)
+
+
+def encode(pixels: np.ndarray, image_format: str) -> EncodedImage:
+    height, width = pixels.shape[:2]
+    channels = pixels.shape[2] if pixels.ndim == 3 else 1
+    return PAYLOAD_POLICY.encode(np.ascontiguousarray(pixels).tobytes(), width, height, channels, image_format)
+
+
+def request(
+    client: ApiClient,
+    canvas: np.ndarray,
+    mask: np.ndarray,
+    region: CropRegion | None,
+) -> tuple[float, float, int, int]:
+    start = time.perf_counter()
+    if region is not None:
+        rows = slice(region.y, region.y + region.height)
+        columns = slice(region.x, region.x + region.width)
+        canvas, mask = canvas[rows, columns], mask[rows, columns]
+    init_image, mask_image = encode(canvas, "png"), encode(mask, "png")
+    encoded = time.perf_counter() - start
+    client.post_stream(ENDPOINT, {"init_images": [init_image], "mask": mask_image}).close()
+    total = time.perf_counter() - start
+    return encoded, total, len(init_image) + len(mask_image), canvas.shape[0] * canvas.shape[1]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--canvas", type=int, nargs=2, default=[6000, 4000])
+    parser.add_argument("--selections", type=int, nargs="+", default=[128, 512, 1024])
+    parser.add_argument("--padding", type=int, default=32)
+    parser.add_argument("--controlnet", action="store_true", help="align the region to 64 pixels")
+    args = parser.parse_args()
+
+    width, height = args.canvas
+    canvas = make_canvas(width, height)
+    with FakeBackend(handlers={ENDPOINT: lambda _request: {"images": [], "info": "{}"}}) as backend:
+        client = ApiClient(backend.base_url)
+        for side in args.selections:
+            x1, y1 = (width - side) // 3, (height - side) // 3
+            mask = np.zeros((height, width), dtype=np.uint8)
+            mask[y1 : y1 + side, x1 : x1 + side] = 255
+            multiple = CONTROLNET_MULTIPLE if args.controlnet else SIZE_MULTIPLE
+            region = crop_region((x1, y1, x1 + side, y1 + side), (width, height), args.padding, multiple)
+            for label, crop in (("whole canvas", None), ("cropped", region)):
+                encoded, total, size, pixels = request(client, canvas, mask, crop)
+                print(
+                    f"selection {side:>4}px, {label:<12} {pixels / 1e6:6.2f} MP, payload {size / 1e6:7.2f} MB, "
+                    f"encoded in {encoded * 1000:7.1f} ms, sent in {total * 1000:7.1f} ms",
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+"""
+End-to-end timings of the plug-in's hot paths outside GIMP, compared against a saved baseline.
+
+GIMP is replaced by the in-process stand-in of fake_gimp (NumPy-backed images and layers) and the backend by
+fake_backend.SimulatedBackend with no generation time, so what is timed is the plug-in's own work plus the local
+transfer. The stand-in backend runs in the same process and its share (parsing requests, sending images) is
+included in the request scenarios. Scenarios, over the matrix of ``--canvas`` sizes, ``--batch`` sizes and
+``--units`` ControlNet unit counts:
+
+    to_base64/<canvas>/cold, /warm     Layer.toBase64 of the init layer, encode cache cleared / hit
+    controlnet/<canvas>/units<n>       getControlNetParams of n ControlNet layers (n > 0)
+    response_layers/<canvas>/batch<b>  ResponseLayers of an already received response: decode, create, name layers
+    img2img/<canvas>/batch<b>/units<n> encode the init layer and ControlNet units, POST, insert the response layers
+    shelf_save                         MyShelf.save of settings holding a backend options snapshot
+    startup/first_launch, /cached      importing the plug-in and registering its procedures in a fresh process, like
+                                       GIMP starting it, without and with a cached options snapshot
+
+Every scenario runs ``--repeats`` times (startup ``--startup-runs`` times), the median is compared. Results are
+written as JSON with ``--output``; ``--save-baseline`` stores them as the baseline, otherwise a run is compared
+with the baseline and exits with 1 if a median is more than ``--threshold`` (relative) plus ``--slack-ms`` slower.
+Baselines hold machine-specific timings: save one on the machine that compares against it.
+
+    python benchmarks/bench_end_to_end.py --canvas 512 1024 2048 --batch 1 4 --units 0 1 2
+    python benchmarks/bench_end_to_end.py --save-baseline benchmarks/baselines/end_to_end.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections.abc import Callable
+from typing import Any
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import fake_gimp
+
+Gimp = fake_gimp.install()
+
+from fake_backend import SimulatedBackend
+
+from sg_api import ApiClient
+from sg_backend_options import OPTIONS_FETCHED_AT, fetch_stablediffusion_options
+from sg_constants import SETTINGS_FILE, STABLE_GIMPFUSION_DEFAULT_SETTINGS
+from sg_generation import add_controlnet_units, build_base_data_dict
+from sg_stream import StreamedResponse
+from sg_structures import Layer, MyShelf, ResponseLayers, getControlNetParams
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baselines", "end_to_end.json")
+BASELINE_VERSION = 1
+ENDPOINT = "/sdapi/v1/img2img"
+PLUGIN_FILE = "stable-gimpfusion3.py"
+# Plug-in startup in a fresh interpreter, the way GIMP runs every procedure
+STARTUP_SCRIPT = """
+import json, runpy, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {bench_dir!r})
+import fake_gimp
+fake_gimp.install()
+runpy.run_path({plugin!r}, run_name="__main__")
+print(json.dumps({{"procedures": len(fake_gimp.procedures), "seconds": time.perf_counter() - start}}))
+"""
+
+
+def measure(run: Callable[[], Any], repeats: int, setup: Callable[[], Any] | None = None) -> dict[str, float]:
+    """Median and fastest of ``repeats`` runs in milliseconds, ``setup`` runs untimed before each"""
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        times.append((time.perf_counter() - start) * 1000)
+    return summarize(times)
+
+
+def summarize(times: list[float]) -> dict[str, float]:
+    return {"median_ms": round(statistics.median(times), 2), "min_ms": round(min(times), 2)}
+
+
+def new_image(canvas: int, units: int) -> tuple[Any, Any, list[Any]]:
+    """Image with an init layer and ``units`` ControlNet layers, every other one with a layer mask"""
+    image = Gimp.Image.new(canvas, canvas, Gimp.ImageBaseType.RGB)
+    cn_layers = []
+    for index in range(units):
+        # ControlNet layers are rarely multiples of 64, they are scaled to them
+        layer = fake_gimp.noise_layer(image, f"ControlNet {index}", canvas - 24, canvas - 24, seed=10 + index)
+        Layer(layer).saveData({"module": "canny", "model": "control_v11p_sd15_canny [d14c016b]"})
+        if index % 2:
+            image.select_rectangle(Gimp.ChannelOps.REPLACE, canvas // 4, canvas // 4, canvas // 2, canvas // 2)
+            layer.add_mask(layer.create_mask(Gimp.AddMaskType.SELECTION))
+            image.select_rectangle(Gimp.ChannelOps.REPLACE, 0, 0, 0, 0)
+        cn_layers.append(layer)
+    init = fake_gimp.noise_layer(image, "Background", canvas, canvas)
+    return image, init, cn_layers
+
+
+def request_data(canvas: int, batch: int) -> dict[str, Any]:
+    return build_base_data_dict(
+        STABLE_GIMPFUSION_DEFAULT_SETTINGS,
+        prompt="benchmark",
+        negative_prompt="",
+        seed=1000,
+        batch_size=batch,
+        steps=20,
+        cfg_scale=7.0,
+        width=canvas,
+        height=canvas,
+        restore_faces=False,
+        tiling=False,
+        denoising_strength=0.75,
+        sampler_index="Euler a",
+    )
+
+
+def layer_scenarios(args: argparse.Namespace, api: ApiClient) -> dict[str, dict[str, float]]:
+    results: dict[str, dict[str, float]] = {}
+    for canvas in args.canvas:
+        image, init, _cn_layers = new_image(canvas, 0)
+        to_base64 = Layer(init).toBase64
+        results[f"to_base64/{canvas}/cold"] = measure(to_base64, args.repeats, Layer.clear_toBase64_cache)
+        results[f"to_base64/{canvas}/warm"] = measure(to_base64, args.repeats)
+
+        for units in (count for count in args.units if count):
+            image, init, cn_layers = new_image(canvas, units)
+            results[f"controlnet/{canvas}/units{units}"] = measure(
+                lambda cn_layers=cn_layers: [getControlNetParams(layer) for layer in cn_layers],
+                args.repeats,
+                Layer.clear_toBase64_cache,
+            )
+
+        for batch in args.batch:
+            response = api.post(ENDPOINT, {**request_data(canvas, batch), "init_images": [Layer(init).encode()]})
+
+            def insert(response: dict[str, Any] = response, canvas: int = canvas) -> None:
+                target = Gimp.Image.new(canvas, canvas, Gimp.ImageBaseType.RGB)
+                ResponseLayers(target, StreamedResponse.from_dict(response))
+
+            results[f"response_layers/{canvas}/batch{batch}"] = measure(insert, args.repeats)
+
+            for units in args.units:
+                image, init, cn_layers = new_image(canvas, units)
+
+                def img2img(
+                    image: Any = image,
+                    init: Any = init,
+                    cn_layers: list[Any] = cn_layers,
+                    canvas: int = canvas,
+                    batch: int = batch,
+                ) -> None:
+                    data = {**request_data(canvas, batch), "init_images": [Layer(init).encode()]}
+                    add_controlnet_units(data, [getControlNetParams(layer) for layer in cn_layers])
+                    layers = ResponseLayers(image, api.post_stream(ENDPOINT, data)).layers
+                    if len(layers) != batch:
+                        raise RuntimeError(f"{len(layers)} layers inserted for a batch of {batch}")
+                    for layer in layers:
+                        image.remove_layer(layer)
+
+                results[f"img2img/{canvas}/batch{batch}/units{units}"] = measure(
+                    img2img,
+                    args.repeats,
+                    Layer.clear_toBase64_cache,
+                )
+    return results
+
+
+def shelf_scenario(args: argparse.Namespace, options: dict[str, Any], directory: str) -> dict[str, float]:
+    shelf = MyShelf(dict(STABLE_GIMPFUSION_DEFAULT_SETTINGS))
+    shelf.file_path = os.path.join(directory, SETTINGS_FILE)
+    return measure(lambda: shelf.save({**options, OPTIONS_FETCHED_AT: time.time()}), args.repeats)
+
+
+def startup_scenarios(args: argparse.Namespace, base_url: str, options: dict[str, Any]) -> dict[str, dict[str, float]]:
+    """
+    Plug-in registration in fresh processes, from a copy of the plug-in with its own settings file. Timed inside
+    the process, from the stand-in's install to the registered procedures: starting the interpreter adds a fixed
+    share that varies more between runs than the plug-in's own startup.
+    """
+    results: dict[str, dict[str, float]] = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name in os.listdir(REPO_DIR):
+            path = os.path.join(REPO_DIR, name)
+            if name.endswith(".py"):
+                shutil.copy(path, directory)
+            elif name in ("sg_plugins", "locale"):
+                shutil.copytree(path, os.path.join(directory, name), ignore=shutil.ignore_patterns("__pycache__"))
+        settings_path = os.path.join(directory, SETTINGS_FILE)
+        script = STARTUP_SCRIPT.format(bench_dir=BENCH_DIR, plugin=os.path.join(directory, PLUGIN_FILE))
+        snapshots = {
+            "first_launch": {"api_base": base_url},
+            "cached": {"api_base": base_url, **options, OPTIONS_FETCHED_AT: time.time()},
+        }
+        for name, settings in snapshots.items():
+            times = []
+            for _ in range(args.startup_runs):
+                with open(settings_path, "w") as f:
+                    json.dump(settings, f)
+                output = subprocess.run(  # noqa: S603 the plug-in copy with the running interpreter
+                    [sys.executable, "-c", script],
+                    cwd=directory,
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                ).stdout
+                startup = json.loads(output.splitlines()[-1])
+                if not startup["procedures"]:
+                    raise RuntimeError("The plug-in registered no procedures")
+                times.append(startup["seconds"] * 1000)
+            results[f"startup/{name}"] = summarize(times)
+    return results
+
+
+def compare(
+    results: dict[str, dict[str, float]],
+    baseline: dict[str, Any],
+    threshold: float,
+    slack_ms: float,
+) -> list[str]:
+    """Print every scenario against the baseline, returns the regressed ones"""
+    regressions = []
+    print(f"{'scenario':<36} {'median ms':>10} {'baseline':>10} {'change':>8}")
+    for name, result in results.items():
+        reference = baseline.get("results", {}).get(name)
+        if reference is None:
+            print(f"{name:<36} {result['median_ms']:10.2f} {'-':>10} {'new':>8}")
+            continue
+        change = result["median_ms"] / max(reference["median_ms"], 1e-6) - 1
+        regressed = result["median_ms"] > reference["median_ms"] * (1 + threshold) + slack_ms
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{name:<36} {result['median_ms']:10.2f} {reference['median_ms']:10.2f} {change:+8.0%}{flag}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--canvas", type=int, nargs="+", default=[512, 1024, 2048])
+    parser.add_argument("--batch", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--units", type=int, nargs="+", default=[0, 1, 2])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--startup-runs", type=int, default=5)
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline to compare with")
+    parser.add_argument("--save-baseline", metavar="PATH", help="save the results as baseline instead of comparing")
+    parser.add_argument("--threshold", type=float, default=0.25, help="relative slowdown reported as regression")
+    parser.add_argument("--slack-ms", type=float, default=5.0, help="absolute slowdown always tolerated")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    with SimulatedBackend(seconds_per_step=0, request_seconds=0) as backend, tempfile.TemporaryDirectory() as tmp:
+        backend.prepare_images([(canvas, canvas) for canvas in args.canvas])
+        api = ApiClient(backend.base_url)
+        options = fetch_stablediffusion_options(api)
+        results = layer_scenarios(args, api)
+        results["shelf_save"] = shelf_scenario(args, options, tmp)
+        results.update(startup_scenarios(args, backend.base_url, options))
+
+    report = {
+        "version": BASELINE_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "parameters": {key: getattr(args, key) for key in ("canvas", "batch", "units", "repeats", "startup_runs")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, "w") as f:
+            json.dump({**report, "threshold": args.threshold, "slack_ms": args.slack_ms}, f, indent=2)
+            f.write("\n")
+        print(f"Saved {len(results)} scenarios to {args.save_baseline}")
+        return
+
+    baseline: dict[str, Any] = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("version") != BASELINE_VERSION:
+            sys.exit(f"Baseline {args.baseline} has version {baseline.get('version')}, expected {BASELINE_VERSION}")
+    regressions = compare(results, baseline, args.threshold, args.slack_ms)
+    if regressions:
+        names = ", ".join(regressions)
+        print(f"{len(regressions)} regressions over {args.threshold:.0%} + {args.slack_ms} ms: {names}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Headless batch runs (sg_headless): sustained images per minute against one or more stand-in backends.
+
+A manifest of ``--jobs`` img2img jobs over PNG files of ``--size`` pixels is run with one worker (one job after the
+other, as a script calling the API in a loop would) and with the runner's pool of ``WORKERS_PER_BACKEND`` workers
+per backend. Every stand-in backend generates one request at a time, taking ``--request-seconds`` plus
+``--seconds-per-image`` per image, and answers with ``batch_size`` PNGs and their seeds. The resume check stops a
+run after half the jobs, leaves a torn line at the end of the checkpoint as a killed run would, and runs the
+manifest again.
+
+    python benchmarks/bench_headless.py --jobs 24 --batch 2 --size 512 --request-seconds 0.3 --seconds-per-image 0.4
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from typing import Any
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_crop_region import make_canvas
+from fake_backend import FakeBackend
+
+from sg_backends import BackendPool
+from sg_headless import CHECKPOINT_FILE, WORKERS_PER_BACKEND, HeadlessRunner, HeadlessSettings, read_jobs
+from sg_payload import PAYLOAD_POLICY
+
+ENDPOINT = "/sdapi/v1/img2img"
+
+
+def make_handler(image: str, request_seconds: float, seconds_per_image: float) -> Any:
+    gpu = threading.Lock()
+
+    def img2img(request: dict[str, Any]) -> dict[str, Any]:
+        count = request["batch_size"]
+        with gpu:
+            time.sleep(request_seconds + seconds_per_image * count)
+        seeds = [request["seed"] + index for index in range(count)]
+        info = {
+            "all_seeds": seeds,
+            "infotexts": [f"{request['prompt']}\nSeed: {seed}" for seed in seeds],
+            "width": request["width"],
+            "height": request["height"],
+        }
+        return {"images": [image] * count, "info": json.dumps(info)}
+
+    return img2img
+
+
+def write_inputs(directory: str, jobs: int, size: int, batch: int) -> str:
+    canvas = make_canvas(size, size)
+    encoded = PAYLOAD_POLICY.encode(canvas.tobytes(), size, size, 3, "png").data
+    with open(os.path.join(directory, "input.png"), "wb") as f:
+        f.write(encoded)
+    manifest = os.path.join(directory, "jobs.jsonl")
+    with open(manifest, "w") as f:
+        for index in range(jobs):
+            line = {"id": f"job-{index:03d}", "init_image": "input.png", "seed": 1000 * index, "batch_size": batch}
+            f.write(json.dumps(line) + "\n")
+    return manifest
+
+
+def run(pool: BackendPool, manifest: str, out_dir: str, workers: int, limit: int | None = None) -> dict[str, Any]:
+    settings = HeadlessSettings(os.devnull, {"batch_chunk_seconds": 0})
+    runner = HeadlessRunner(pool, settings, out_dir, {"prompt": "benchmark"}, workers, report_seconds=60)
+    return runner.run(itertools.islice(read_jobs(manifest), limit))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=24)
+    parser.add_argument("--batch", type=int, default=2)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--request-seconds", type=float, default=0.3)
+    parser.add_argument("--seconds-per-image", type=float, default=0.4)
+    parser.add_argument("--backends", type=int, nargs="+", default=[1, 2])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    canvas = make_canvas(args.size, args.size)
+    image = base64.b64encode(PAYLOAD_POLICY.encode(canvas.tobytes(), args.size, args.size, 3, "png").data).decode()
+    servers = [
+        FakeBackend(handlers={ENDPOINT: make_handler(image, args.request_seconds, args.seconds_per_image)}).start()
+        for _ in range(max(args.backends))
+    ]
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            manifest = write_inputs(directory, args.jobs, args.size, args.batch)
+            baseline = None
+            for count in args.backends:
+                pool = BackendPool.fromUrls([server.base_url for server in servers[:count]])
+                for workers in (1, WORKERS_PER_BACKEND * count):
+                    if count > 1 and workers == 1:
+                        continue
+                    summary = run(pool, manifest, os.path.join(directory, f"out-{count}-{workers}"), workers)
+                    rate = summary["images_per_minute"]
+                    baseline = baseline or rate
+                    print(
+                        f"{count} backend{'s' if count > 1 else ' '}, {workers} worker{'s' if workers > 1 else ' '}: "
+                        f"{summary['images']} images in {summary['seconds']:5.1f} s, {rate:6.1f} images/min, "
+                        f"{rate / baseline:4.2f}x",
+                    )
+
+            pool = BackendPool.fromUrls([servers[0].base_url])
+            out_dir = os.path.join(directory, "resumed")
+            first = run(pool, manifest, out_dir, WORKERS_PER_BACKEND, limit=args.jobs // 2)
+            with open(os.path.join(out_dir, CHECKPOINT_FILE), "a") as f:
+                f.write('{"id": "job-')
+            second = run(pool, manifest, out_dir, WORKERS_PER_BACKEND)
+            written = len([name for name in os.listdir(out_dir) if name.endswith(".png")])
+            print(
+                f"interrupted after {first['done']} jobs, resumed: {second['skipped']} skipped, "
+                f"{second['done']} run, {written} images on disk for {args.jobs * args.batch} expected",
+            )
+    finally:
+        for server in servers:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Per-request latency of /sdapi/v1/progress polling: one connection per request vs pooled keep-alive ApiClient.
+
+    python benchmarks/bench_http_pool.py --requests 200 --handshake-delay 0.02
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+from collections.abc import Callable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+
+from fake_backend import FakeBackend
+
+from sg_api import ApiClient
+
+ENDPOINT = "/sdapi/v1/progress"
+
+
+def measure(call: Callable[[], object], count: int) -> list[float]:
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(name: str, timings: list[float], connections: int) -> None:
+    timings_ms = sorted(t * 1000 for t in timings)
+    p95 = timings_ms[int(len(timings_ms) * 0.95) - 1]
+    print(
+        f"{name:<12} mean {statistics.mean(timings_ms):7.3f} ms  median {statistics.median(timings_ms):7.3f} ms  "
+        f"p95 {p95:7.3f} ms  connections {connections}",
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--handshake-delay", type=float, default=0.02, help="seconds paid per new connection")
+    parser.add_argument("--pool-size", type=int, default=4)
+    args = parser.parse_args()
+
+    with FakeBackend(handshake_delay=args.handshake_delay) as backend:
+        url = backend.base_url + ENDPOINT
+        params = {"skip_current_image": "true"}
+        timings = measure(lambda: requests.get(url, params=params, timeout=10).json(), args.requests)
+        report("unpooled", timings, backend.connections)
+
+    with FakeBackend(handshake_delay=args.handshake_delay) as backend:
+        api = ApiClient(backend.base_url, pool_size=args.pool_size)
+        timings = measure(lambda: api.get(ENDPOINT, params={"skip_current_image": "true"}), args.requests)
+        report("pooled", timings, backend.connections)
+        api.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+How long a plug-in run blocks GIMP when it queues its generation (sg_jobs) instead of waiting for it.
+
+A batch of img2img requests is sent once synchronously, one after another as plug-in runs would, and once
+submitted to the worker's job queue; for the queue, the time until every result can be collected is reported next
+to the time the submitting runs were blocked.
+
+    python benchmarks/bench_job_queue.py --jobs 5 --generation-seconds 1 --size 1024 --concurrency 1 2
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_worker import make_pixels
+from fake_backend import FakeBackend
+
+from sg_api import ApiClient
+from sg_jobs import PENDING_STATES
+from sg_payload import PAYLOAD_POLICY
+from sg_worker import WorkerClient, WorkerServer
+
+ENDPOINT = "/sdapi/v1/img2img"
+
+
+def run_queue(base_url: str, encoded: object, jobs: int, concurrency: int) -> tuple[list[float], float]:
+    tempdir = tempfile.mkdtemp()
+    socket_path = os.path.join(tempdir, "worker.sock")
+    server = WorkerServer(socket_path, jobs_dir=os.path.join(tempdir, "jobs"))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        start = time.perf_counter()
+        blocked = []
+        for index in range(jobs):
+            submit_start = time.perf_counter()
+            client = WorkerClient(base_url, socket_path)
+            client.submit_job(ENDPOINT, {"init_images": [encoded], "prompt": f"job {index}"}, concurrency=concurrency)
+            blocked.append(time.perf_counter() - submit_start)
+        while any(job["status"] in PENDING_STATES for job in client.jobs()):
+            time.sleep(0.01)
+        for job in client.jobs():
+            sum(1 for _ in client.collect_job(job["job_id"]).images())
+            client.forget_job(job["job_id"])
+        return blocked, time.perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=5)
+    parser.add_argument("--generation-seconds", type=float, default=1.0)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2])
+    args = parser.parse_args()
+
+    encoded = PAYLOAD_POLICY.encode(make_pixels(args.size), args.size, args.size, 3, "png")
+    response = {"images": [base64.b64encode(encoded.data).decode()], "info": "{}"}
+    with FakeBackend(routes={ENDPOINT: response}, route_latency={ENDPOINT: args.generation_seconds}) as backend:
+        start = time.perf_counter()
+        blocked = []
+        for index in range(args.jobs):
+            request_start = time.perf_counter()
+            ApiClient(backend.base_url).post(ENDPOINT, {"init_images": [encoded], "prompt": f"job {index}"})
+            blocked.append(time.perf_counter() - request_start)
+        total = time.perf_counter() - start
+        print(f"{'sync':<14} blocked per run {statistics.median(blocked) * 1000:8.1f} ms, all results {total:6.2f} s")
+
+        for concurrency in args.concurrency:
+            blocked, total = run_queue(backend.base_url, encoded, args.jobs, concurrency)
+            print(
+                f"{f'queue x{concurrency}':<14} blocked per run {statistics.median(blocked) * 1000:8.1f} ms, "
+                f"all results {total:6.2f} s",
+            )
+
+
+if __name__ == "__main__":
+    main()
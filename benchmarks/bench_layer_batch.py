@@ -0,0 +1,123 @@
+"""
+Img2img of several selected layers: one request per layer after the other vs. the multi-layer run (sg_batch).
+
+The stand-in backend generates one request at a time, taking ``--request-seconds`` per request (sampler setup,
+VAE and model overhead) plus ``--seconds-per-image`` per image, and returns one PNG per init image. The baseline
+encodes a layer, sends it and waits, like running the plug-in once per layer. The multi-layer run plans the layers
+with ``BatchPlanner.plan_layers``, so layers of the same size share a request, and encodes the next request in a
+worker thread while the current one is generated. Layers are photo-like noise of ``--size`` pixels; ``--odd``
+layers have another size and get requests of their own.
+
+    python benchmarks/bench_layer_batch.py --layers 8 --odd 2 --size 1024 --request-seconds 0.5 --seconds-per-image 1
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import os
+import sys
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_crop_region import make_canvas
+from fake_backend import FakeBackend
+
+from sg_api import ApiClient
+from sg_batch import LAYER_CHUNKS_IN_FLIGHT_PER_BACKEND, BatchPlanner, LayerChunk
+from sg_payload import PAYLOAD_POLICY
+
+ENDPOINT = "/sdapi/v1/img2img"
+
+
+def make_handler(image: str, request_seconds: float, seconds_per_image: float) -> Any:
+    gpu = threading.Lock()
+
+    def img2img(request: dict[str, Any]) -> dict[str, Any]:
+        count = len(request["init_images"])
+        with gpu:
+            time.sleep(request_seconds + seconds_per_image * count)
+        return {"images": [image] * count, "info": "{}"}
+
+    return img2img
+
+
+def read_images(client: ApiClient, data: dict[str, Any]) -> int:
+    response = client.post_stream(ENDPOINT, data)
+    try:
+        return sum(1 for _ in response.images())
+    finally:
+        response.close()
+
+
+def one_by_one(client: ApiClient, layers: list[np.ndarray], data: dict[str, Any]) -> tuple[float, int]:
+    start = time.perf_counter()
+    images = 0
+    for pixels in layers:
+        height, width = pixels.shape[:2]
+        encoded = PAYLOAD_POLICY.encode(pixels.tobytes(), width, height, 3, "png")
+        images += read_images(client, {**data, "batch_size": 1, "init_images": [encoded]})
+    return time.perf_counter() - start, images
+
+
+def multi_layer(client: ApiClient, layers: list[np.ndarray], data: dict[str, Any]) -> tuple[float, int, int]:
+    start = time.perf_counter()
+    sizes = [(pixels.shape[1], pixels.shape[0]) for pixels in layers]
+    chunks = BatchPlanner(chunk_seconds=0).plan_layers(sizes, 1, 1000, data["width"], data["height"], data["steps"])
+
+    def send(chunk: LayerChunk) -> int:
+        init_images = [
+            PAYLOAD_POLICY.encode(layers[source].tobytes(), *sizes[source], 3, "png") for source in chunk.sources
+        ]
+        return read_images(client, {**chunk.apply(data), "init_images": init_images})
+
+    images = 0
+    pending = iter(chunks)
+    futures: deque[Future] = deque()
+    with ThreadPoolExecutor(LAYER_CHUNKS_IN_FLIGHT_PER_BACKEND) as executor:
+        for chunk in pending:
+            futures.append(executor.submit(send, chunk))
+            if len(futures) == LAYER_CHUNKS_IN_FLIGHT_PER_BACKEND:
+                images += futures.popleft().result()
+        while futures:
+            images += futures.popleft().result()
+    return time.perf_counter() - start, images, len(chunks)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--layers", type=int, default=8)
+    parser.add_argument("--odd", type=int, default=2)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--request-seconds", type=float, default=0.5)
+    parser.add_argument("--seconds-per-image", type=float, default=1.0)
+    args = parser.parse_args()
+
+    canvas = make_canvas(args.size, args.size)
+    layers = [np.ascontiguousarray(canvas[:, ::-1] if index % 2 else canvas) for index in range(args.layers)]
+    layers += [np.ascontiguousarray(canvas[: args.size // 2]) for _ in range(args.odd)]
+    image = base64.b64encode(PAYLOAD_POLICY.encode(layers[0].tobytes(), args.size, args.size, 3, "png").data).decode()
+    data = {"prompt": "benchmark", "seed": 1000, "steps": 20, "width": args.size, "height": args.size}
+
+    handler = make_handler(image, args.request_seconds, args.seconds_per_image)
+    with FakeBackend(handlers={ENDPOINT: handler}) as backend:
+        client = ApiClient(backend.base_url)
+        seconds, images = one_by_one(client, layers, data)
+        print(f"one request per layer:   {images} images in {seconds:6.2f} s, {len(layers)} requests")
+        multi_seconds, images, requests = multi_layer(client, layers, data)
+        print(
+            f"multi-layer, pipelined:  {images} images in {multi_seconds:6.2f} s, {requests} requests, "
+            f"speed-up {seconds / multi_seconds:4.2f}x",
+        )
+
+
+if __name__ == "__main__":
+    main()
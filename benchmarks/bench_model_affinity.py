@@ -0,0 +1,112 @@
+"""
+Model switches and total time of a queue of jobs alternating between checkpoints (sg_affinity).
+
+Every stand-in backend keeps one model loaded: POSTing another ``sd_model_checkpoint`` to ``/sdapi/v1/options``
+takes ``--load-seconds``, generating takes ``--generation-seconds`` and reports the model it ran on. Jobs for
+models A, B, A, B, ... are submitted to the worker's queue untagged (what the queue did before, every job runs on
+whatever is loaded), tagged in submission order (``--max-skips 0``) and tagged with checkpoint affinity.
+
+    python benchmarks/bench_model_affinity.py --jobs 12 --load-seconds 1 --generation-seconds 0.2 --backends 1 2
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from typing import Any
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_backend import FakeBackend
+
+from sg_jobs import PENDING_STATES
+from sg_worker import WorkerClient, WorkerServer
+
+ENDPOINT = "/sdapi/v1/txt2img"
+MODELS = ["model-a.safetensors", "model-b.safetensors"]
+
+
+def make_backend(load_seconds: float, generation_seconds: float) -> FakeBackend:
+    state = {"model": MODELS[0]}
+    gpu = threading.Lock()
+
+    def options(request: dict[str, Any] | None) -> Any:
+        if not request:
+            return {"sd_model_checkpoint": state["model"]}
+        with gpu:
+            if request["sd_model_checkpoint"] != state["model"]:
+                time.sleep(load_seconds)
+                state["model"] = request["sd_model_checkpoint"]
+        return None
+
+    def generate(request: dict[str, Any]) -> dict[str, Any]:
+        with gpu:
+            time.sleep(generation_seconds)
+            return {"images": [], "info": json.dumps({"sd_model_name": state["model"]})}
+
+    return FakeBackend(handlers={"/sdapi/v1/options": options, ENDPOINT: generate}).start()
+
+
+def run(urls: list[str], jobs: int, tagged: bool, max_skips: int) -> tuple[float, int, float, int]:
+    tempdir = tempfile.mkdtemp()
+    socket_path = os.path.join(tempdir, "worker.sock")
+    server = WorkerServer(socket_path, jobs_dir=os.path.join(tempdir, "jobs"))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = WorkerClient(urls[0], socket_path, backends=urls)
+        start = time.perf_counter()
+        for index in range(jobs):
+            model = {"sd_model_checkpoint": MODELS[index % len(MODELS)]} if tagged else None
+            client.submit_job(ENDPOINT, {"prompt": f"job {index}"}, model=model, max_skips=max_skips)
+        while any(job["status"] in PENDING_STATES for job in client.jobs()):
+            time.sleep(0.01)
+        total = time.perf_counter() - start
+
+        wrong = 0
+        for index, job in enumerate(client.jobs()):
+            response = client.collect_job(job["job_id"])
+            wrong += json.loads(response["info"])["sd_model_name"] != MODELS[index % len(MODELS)]
+            response.close()
+        models = server.jobs.stats()
+        return total, models["switches"], models["load_seconds"], wrong
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=12)
+    parser.add_argument("--load-seconds", type=float, default=1.0)
+    parser.add_argument("--generation-seconds", type=float, default=0.2)
+    parser.add_argument("--max-skips", type=int, default=4)
+    parser.add_argument("--backends", type=int, nargs="+", default=[1, 2])
+    args = parser.parse_args()
+
+    for count in args.backends:
+        backends = [make_backend(args.load_seconds, args.generation_seconds) for _ in range(count)]
+        urls = [backend.base_url for backend in backends]
+        try:
+            for name, tagged, max_skips in (
+                ("untagged", False, 0),
+                ("in order", True, 0),
+                (f"affinity {args.max_skips}", True, args.max_skips),
+            ):
+                total, switches, load_seconds, wrong = run(urls, args.jobs, tagged, max_skips)
+                print(
+                    f"{count} backends, {name:<11} {args.jobs} jobs in {total:6.2f} s, {switches:3d} model loads "
+                    f"({load_seconds:6.2f} s), jobs on the wrong model: {wrong}",
+                )
+        finally:
+            for backend in backends:
+                backend.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Cold-start capability fetch: endpoints one after another vs fetch_stablediffusion_options (concurrent).
+
+Every capability endpoint gets its own latency; the concurrent wall time should approach the slowest one.
+
+    python benchmarks/bench_options_fetch.py --rounds 5 --slow-endpoint /sdapi/v1/sd-models=1.5
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_backend import FakeBackend
+
+from sg_api import ApiClient
+from sg_backend_options import CAPABILITY_ENDPOINTS, fetch_stablediffusion_options
+
+
+def fetch_sequentially(api: ApiClient) -> None:
+    for endpoint in CAPABILITY_ENDPOINTS.values():
+        api.get(endpoint)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--min-latency", type=float, default=0.05)
+    parser.add_argument("--max-latency", type=float, default=0.4)
+    parser.add_argument("--slow-endpoint", action="append", default=[], help="ENDPOINT=SECONDS, may be repeated")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    route_latency = {
+        endpoint: rng.uniform(args.min_latency, args.max_latency) for endpoint in CAPABILITY_ENDPOINTS.values()
+    }
+    for item in args.slow_endpoint:
+        endpoint, seconds = item.split("=", 1)
+        route_latency[endpoint] = float(seconds)
+
+    for endpoint, seconds in route_latency.items():
+        print(f"{endpoint:<28} {seconds * 1000:7.1f} ms")
+    print(f"{'sum':<28} {sum(route_latency.values()) * 1000:7.1f} ms")
+    print(f"{'max':<28} {max(route_latency.values()) * 1000:7.1f} ms")
+
+    with FakeBackend(route_latency=route_latency) as backend:
+        api = ApiClient(backend.base_url)
+        for name, fetch in (("sequential", fetch_sequentially), ("concurrent", fetch_stablediffusion_options)):
+            timings = []
+            for _ in range(args.rounds):
+                api.close()  # cold start: no warm connections
+                start = time.perf_counter()
+                fetch(api)
+                timings.append(time.perf_counter() - start)
+            print(f"{name:<12} best {min(timings) * 1000:8.1f} ms  worst {max(timings) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
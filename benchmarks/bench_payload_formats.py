@@ -0,0 +1,63 @@
+"""
+Size and encode time of the payload image formats (sg_payload.PayloadPolicy) over a range of canvas sizes.
+
+Also prints the estimated encode + upload time for the given link speed and the format ``auto`` would pick.
+WebP and Pillow-backed JPEG are skipped when Pillow is not installed.
+
+    python benchmarks/bench_payload_formats.py --sizes 512 1024 2048 --link-mbps 20 100 1000
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_png_encode import synthetic_rgba
+
+from sg_payload import PAYLOAD_INIT, PayloadPolicy
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024, 2048])
+    parser.add_argument("--link-mbps", type=float, nargs="+", default=[20, 100, 1000])
+    parser.add_argument("--jpeg-quality", type=int, default=95)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    policy = PayloadPolicy()
+    policy.jpeg_quality = args.jpeg_quality
+    policy.payload_format = "auto"
+    formats = policy.available_formats()
+    print(f"available formats: {', '.join(formats)}")
+
+    print(f"{'size':>10} {'format':>6} {'best ms':>9} {'MB':>7} {'ratio':>6}")
+    for size in args.sizes:
+        pixels = synthetic_rgba(size)
+        for image_format in formats:
+            timings = []
+            for _ in range(args.rounds):
+                start = time.perf_counter()
+                encoded = policy.encode(pixels, size, size, 4, image_format)
+                timings.append(time.perf_counter() - start)
+            print(
+                f"{size:>5}x{size:<4} {image_format:>6} {min(timings) * 1000:9.1f} "
+                f"{len(encoded) / 1e6:7.2f} {len(encoded) / len(pixels):6.2f}",
+            )
+
+    # estimates now come from the measurements above
+    print()
+    print(f"{'size':>10} {'Mbit/s':>7} " + " ".join(f"{name + ' s':>8}" for name in formats) + f" {'auto':>6}")
+    for size in args.sizes:
+        for mbps in args.link_mbps:
+            policy.link.bytes_per_second = mbps * 125_000
+            estimates = " ".join(f"{policy.estimate_seconds(name, size, size):8.3f}" for name in formats)
+            print(f"{size:>5}x{size:<4} {mbps:7.0f} {estimates} {policy.choose(PAYLOAD_INIT, size, size):>6}")
+
+
+if __name__ == "__main__":
+    main()
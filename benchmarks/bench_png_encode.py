@@ -0,0 +1,58 @@
+"""
+In-memory PNG encoding (sg_png.encode_png) over a range of canvas sizes, compression levels and row filters.
+
+Pixels are a synthetic photo-like RGBA image (smooth gradients plus noise), packed like GEGL "R'G'B'A u8".
+
+    python benchmarks/bench_png_encode.py --sizes 512 1024 2048 4096 --levels 1 6 --filters none up adaptive
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from sg_png import PNG_FILTERS, encode_png
+
+
+def synthetic_rgba(size: int, seed: int = 0) -> bytes:
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    rgb = np.stack([x, y, (x + y) / 2], axis=2) * 200 + rng.normal(0, 6, (size, size, 3))
+    alpha = np.full((size, size, 1), 255, dtype=np.float32)
+    return np.clip(np.concatenate([rgb, alpha], axis=2), 0, 255).astype(np.uint8).tobytes()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024, 2048, 4096])
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 6])
+    parser.add_argument("--filters", nargs="+", default=["none", "up", "paeth", "adaptive"], choices=PNG_FILTERS)
+    parser.add_argument("--strategy", default="default")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'size':>10} {'level':>5} {'filter':>9} {'best ms':>9} {'MP/s':>7} {'PNG MB':>8} {'ratio':>6}")
+    for size in args.sizes:
+        pixels = synthetic_rgba(size)
+        for level in args.levels:
+            for png_filter in args.filters:
+                timings = []
+                for _ in range(args.rounds):
+                    start = time.perf_counter()
+                    png = encode_png(pixels, size, size, 4, level=level, png_filter=png_filter, strategy=args.strategy)
+                    timings.append(time.perf_counter() - start)
+                best = min(timings)
+                print(
+                    f"{size:>5}x{size:<4} {level:>5} {png_filter:>9} {best * 1000:9.1f} "
+                    f"{size * size / best / 1e6:7.1f} {len(png) / 1e6:8.2f} {len(png) / len(pixels):6.2f}",
+                )
+
+
+if __name__ == "__main__":
+    main()
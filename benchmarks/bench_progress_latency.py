@@ -0,0 +1,92 @@
+"""
+Delay between a generation finishing on the backend and the plug-in getting the result, plus the number of
+progress requests: the old fixed 2 s polling thread (joined after the request) vs sg_progress.ProgressTracker.
+
+    python benchmarks/bench_progress_latency.py --jobs 0.3 1 3 8
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_backend import FakeBackend
+
+from sg_api import ApiClient
+from sg_progress import ProgressTracker
+
+ENDPOINT = "/sdapi/v1/txt2img"
+
+
+class Job:
+    def __init__(self) -> None:
+        self.start = 0.0
+        self.duration = 0.0
+
+    def progress(self) -> dict:
+        elapsed = time.monotonic() - self.start
+        progress = min(1.0, elapsed / self.duration) if self.duration else 1.0
+        done = progress >= 1.0
+        return {
+            "progress": 0.0 if done else progress,
+            "eta_relative": 0.0 if done else self.duration - elapsed,
+            "state": {"job_count": 0 if done else 1},
+            "current_image": None,
+        }
+
+
+def fixed_polling(api: ApiClient) -> int:
+    """What get_progress_at_background did: sleep 2 s between polls, joined after the request returned"""
+    polls = 0
+
+    def poll() -> None:
+        nonlocal polls
+        progress, job_count = 0, -1
+        while progress < 1 and job_count != 0:
+            time.sleep(2)
+            result = api.get("/sdapi/v1/progress", params={"skip_current_image": "true"})
+            polls += 1
+            progress = result.get("progress", 0)
+            job_count = result.get("state", {}).get("job_count", 0)
+
+    thread = threading.Thread(target=poll, daemon=True)
+    thread.start()
+    api.post(ENDPOINT, {})
+    thread.join()
+    return polls
+
+
+def adaptive_polling(api: ApiClient) -> int:
+    tracker = ProgressTracker(api)
+    tracker.run(lambda: api.post(ENDPOINT, {}))
+    return tracker.polls
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=float, nargs="+", default=[0.3, 1, 3, 8], help="job durations in seconds")
+    args = parser.parse_args()
+
+    job = Job()
+    backend = FakeBackend(routes={"/sdapi/v1/progress": job.progress, ENDPOINT: {"images": [], "info": "{}"}})
+    with backend:
+        api = ApiClient(backend.base_url)
+        print(f"{'job s':>6} {'mode':>8} {'delay ms':>9} {'polls':>6}")
+        for duration in args.jobs:
+            backend.route_latency[ENDPOINT] = duration
+            for mode, run in (("fixed", fixed_polling), ("adaptive", adaptive_polling)):
+                job.start, job.duration = time.monotonic(), duration
+                start = time.perf_counter()
+                polls = run(api)
+                delay = time.perf_counter() - start - duration
+                print(f"{duration:6.1f} {mode:>8} {delay * 1000:9.0f} {polls:6d}")
+        api.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Peak Python heap (tracemalloc) while sending an img2img-like payload: one init image plus two ControlNet units
+with image and mask.
+
+``json`` serializes the payload the way ``requests.post(json=...)`` does, with base64 strings in the dict;
+``stream`` sends it with sg_stream.StreamingJsonBody, which base64 encodes the raw image bytes chunk by chunk.
+Encoded image bytes exist in both cases and are not counted.
+
+    python benchmarks/bench_request_body.py --image-mb 8 16 32
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+
+from fake_backend import FakeBackend
+
+from sg_api import ApiClient
+from sg_payload import EncodedImage
+
+ENDPOINT = "/sdapi/v1/img2img"
+
+
+def make_payload(image_mb: float) -> dict:
+    size = int(image_mb * 1e6)
+    images = [EncodedImage(os.urandom(size), "png", 2048, 2048) for _ in range(5)]
+    return {
+        "prompt": "a photo of a cat",
+        "steps": 20,
+        "init_images": [images[0]],
+        "alwayson_scripts": {
+            "controlnet": {
+                "args": [
+                    {"input_image": images[1], "mask": images[2], "module": "canny"},
+                    {"input_image": images[3], "mask": images[4], "module": "depth"},
+                ],
+            },
+        },
+    }
+
+
+def send_json(base_url: str, payload: dict) -> None:
+    def to_base64(obj):
+        if isinstance(obj, EncodedImage):
+            return obj.to_base64()
+        if isinstance(obj, dict):
+            return {key: to_base64(value) for key, value in obj.items()}
+        if isinstance(obj, list):
+            return [to_base64(value) for value in obj]
+        return obj
+
+    # what the plug-in did before: base64 strings in the dict, then requests serializes the dict
+    requests.post(base_url + ENDPOINT, json=to_base64(payload), timeout=60).json()
+
+
+def send_stream(base_url: str, payload: dict) -> None:
+    api = ApiClient(base_url)
+    api.post(ENDPOINT, payload)
+    api.close()
+
+
+def measure(send, base_url: str, payload: dict) -> tuple[float, float]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    send(base_url, payload)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, seconds
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image-mb", type=float, nargs="+", default=[4, 8, 16])
+    args = parser.parse_args()
+
+    with FakeBackend(routes={ENDPOINT: {"images": [], "info": json.dumps({})}}) as backend:
+        print(f"{'image MB':>8} {'raw MB':>7} {'mode':>6} {'peak MB':>8} {'peak/raw':>8} {'seconds':>8}")
+        for image_mb in args.image_mb:
+            payload = make_payload(image_mb)
+            raw = 5 * image_mb * 1e6
+            for mode, send in (("json", send_json), ("stream", send_stream)):
+                backend.body_bytes = 0
+                peak, seconds = measure(send, backend.base_url, payload)
+                print(f"{image_mb:8.1f} {raw / 1e6:7.1f} {mode:>6} {peak / 1e6:8.1f} {peak / raw:8.2f} {seconds:8.3f}")
+                if backend.body_bytes <= raw:
+                    raise RuntimeError("backend did not receive the whole body")
+
+
+if __name__ == "__main__":
+    main()
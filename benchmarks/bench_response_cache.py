@@ -0,0 +1,131 @@
+"""
+Repeating a generation with a fixed seed from the response cache (sg_response_cache).
+
+The stand-in backend takes ``--seconds-per-image`` per image of an img2img request. The same request (fixed seed,
+init image of ``--size`` pixels) is generated ``--repeats`` times through the cache: the first run goes to the
+backend and stores the response, the others are read from disk the way ResponseLayers consumes them. A request
+with seed -1 is never answered from the cache. Then a cache of ``--max-mb`` is filled with distinct seeds to show
+its size staying bounded.
+
+    python benchmarks/bench_response_cache.py --batch 4 --seconds-per-image 0.5 --repeats 5 --max-mb 64
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from typing import Any
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_backend import FakeBackend
+
+from sg_api import ApiClient
+from sg_payload import PAYLOAD_POLICY
+from sg_response_cache import ResponseCache, response_key
+from sg_stream import StreamedResponse
+
+ENDPOINT = "/sdapi/v1/img2img"
+MODEL = {"sd_model_checkpoint": "model-a.safetensors"}
+
+
+def make_handler(image: str, seconds_per_image: float) -> Any:
+    def generate(request: dict[str, Any]) -> dict[str, Any]:
+        count = request["batch_size"]
+        time.sleep(seconds_per_image * count)
+        seeds = [request["seed"] + index for index in range(count)]
+        info = {"all_seeds": seeds, "infotexts": [""] * count, "width": request["width"], "height": request["height"]}
+        return {"images": [image] * count, "parameters": {}, "info": json.dumps(info)}
+
+    return generate
+
+
+def consume(response: StreamedResponse) -> int:
+    """What ResponseLayers reads: the images, then ``info``"""
+    try:
+        images = sum(1 for _ in response.images())
+        json.loads(response["info"])
+        return images
+    finally:
+        response.close()
+
+
+def generate(client: ApiClient, cache: ResponseCache, data: dict[str, Any]) -> tuple[float, int, bool]:
+    start = time.perf_counter()
+    key = response_key(ENDPOINT, data, MODEL)
+    response = cache.get(key) if key is not None else None
+    hit = response is not None
+    if response is None:
+        response = client.post_stream(ENDPOINT, data)
+        if key is not None:
+            response = cache.store(key, response)
+    images = consume(response)
+    return time.perf_counter() - start, images, hit
+
+
+def directory_mb(path: str) -> float:
+    sizes = [os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names]
+    return sum(sizes) / (1 << 20)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", type=int, default=4)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--seconds-per-image", type=float, default=0.5)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--max-mb", type=float, default=64)
+    parser.add_argument("--fill", type=int, default=20)
+    args = parser.parse_args()
+
+    # noise, so the PNGs have the size of real generations
+    encoded = PAYLOAD_POLICY.encode(os.urandom(args.size * args.size * 3), args.size, args.size, 3, "png")
+    image = base64.b64encode(encoded.data).decode()
+    data = {
+        "prompt": "benchmark",
+        "init_images": [encoded],
+        "seed": 1234,
+        "batch_size": args.batch,
+        "width": args.size,
+        "height": args.size,
+    }
+    directory = tempfile.mkdtemp()
+    try:
+        with FakeBackend(handlers={ENDPOINT: make_handler(image, args.seconds_per_image)}) as backend:
+            client = ApiClient(backend.base_url)
+            cache = ResponseCache(directory, max_bytes=int(args.max_mb * (1 << 20)))
+
+            start = time.perf_counter()
+            for _ in range(100):
+                response_key(ENDPOINT, data, MODEL)
+            key_ms = (time.perf_counter() - start) * 10
+            print(f"cache key of a request with a {len(encoded.data) / 1e6:.1f} MB init image: {key_ms:6.2f} ms")
+
+            for label, seed in (("fixed seed", 1234), ("seed -1", -1)):
+                for repeat in range(args.repeats):
+                    seconds, images, hit = generate(client, cache, {**data, "seed": seed})
+                    print(
+                        f"{label:<10} run {repeat + 1}: {images} images in {seconds * 1000:8.1f} ms "
+                        f"({'cache hit' if hit else 'backend'})",
+                    )
+
+            for seed in range(args.fill):
+                generate(client, cache, {**data, "seed": 10_000 + seed * args.batch})
+            entries = len(os.listdir(directory))
+            print(
+                f"{args.fill} more seeds: {entries} entries, {directory_mb(directory):5.1f} MB on disk "
+                f"(limit {args.max_mb:g} MB)",
+            )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Decoding a batch of generated PNGs: one after another vs sg_decode.decode_in_order (thread pool).
+
+Needs Pillow (or GdkPixbuf). The speedup is bounded by the number of CPU cores.
+
+    python benchmarks/bench_response_decode.py --batch 20 --size 1024 --workers 1 2 4
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_png_encode import synthetic_rgba
+
+from sg_decode import decode_image, decode_in_order
+from sg_png import encode_png
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch", type=int, default=20)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    png = encode_png(synthetic_rgba(args.size), args.size, args.size, 4, level=6, png_filter="paeth")
+    images = [png] * args.batch
+    print(f"{args.batch} x {args.size}x{args.size} PNG ({len(png) / 1e6:.1f} MB each), {os.cpu_count()} CPUs")
+
+    start = time.perf_counter()
+    for data in images:
+        decode_image(data)
+    sequential = time.perf_counter() - start
+    print(f"{'sequential':>12} {sequential:7.3f}s")
+
+    for workers in args.workers:
+        start = time.perf_counter()
+        decoded = [result for _, result in decode_in_order(images, workers=workers)]
+        seconds = time.perf_counter() - start
+        if any(result is None for result in decoded):
+            raise RuntimeError("decoding failed")
+        print(f"{f'{workers} workers':>12} {seconds:7.3f}s  x{sequential / seconds:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Peak Python heap (tracemalloc) while reading a txt2img-like response with a batch of images.
+
+``json`` is ``response.json()`` followed by decoding every image, the way ResponseLayers used to;
+``stream`` is ApiClient.post_stream, which decodes each image while it is read off the socket. Every decoded
+image is dropped right away, like layer creation hands it over to GIMP.
+
+    python benchmarks/bench_response_parse.py --batch 20 --image-mb 4
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_backend import FakeBackend
+
+from sg_api import ApiClient
+
+ENDPOINT = "/sdapi/v1/txt2img"
+
+
+def make_body(batch: int, image_mb: float) -> bytes:
+    image = base64.b64encode(os.urandom(int(image_mb * 1e6))).decode()
+    seeds = list(range(batch))
+    info = {"infotexts": ["a photo of a cat"] * batch, "all_seeds": seeds, "width": 2048, "height": 2048}
+    response = {"images": [image] * batch, "parameters": {"batch_size": batch}, "info": json.dumps(info)}
+    return json.dumps(response).encode()
+
+
+def read_json(api: ApiClient) -> int:
+    response = api.post(ENDPOINT, {})
+    count = 0
+    for image in response["images"]:
+        base64.b64decode(image)
+        count += 1
+    json.loads(response["info"])
+    return count
+
+
+def read_stream(api: ApiClient) -> int:
+    response = api.post_stream(ENDPOINT, {})
+    count = sum(1 for _ in response.images())
+    json.loads(response["info"])
+    return count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch", type=int, default=20)
+    parser.add_argument("--image-mb", type=float, nargs="+", default=[1, 4])
+    args = parser.parse_args()
+
+    print(f"{'image MB':>8} {'batch':>5} {'mode':>6} {'peak MB':>8} {'peak/image':>10} {'seconds':>8}")
+    for image_mb in args.image_mb:
+        body = make_body(args.batch, image_mb)
+        with FakeBackend(routes={ENDPOINT: body}) as backend:
+            api = ApiClient(backend.base_url)
+            for mode, read in (("json", read_json), ("stream", read_stream)):
+                tracemalloc.start()
+                start = time.perf_counter()
+                count = read(api)
+                seconds = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                if count != args.batch:
+                    raise RuntimeError(f"expected {args.batch} images, got {count}")
+                print(
+                    f"{image_mb:8.1f} {args.batch:>5} {mode:>6} {peak / 1e6:8.1f} "
+                    f"{peak / (image_mb * 1e6):10.2f} {seconds:8.3f}",
+                )
+            api.close()
+
+
+if __name__ == "__main__":
+    main()
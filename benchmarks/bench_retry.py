@@ -0,0 +1,109 @@
+"""
+Generations surviving a flaky backend, and the cost of calling a backend that is down (sg_retry).
+
+The stand-in backend answers a share of img2img requests with 502 (a reverse proxy losing its upstream) or 500
+OutOfMemoryError. Each generation sends one encoded init image; the bytes the backend received show that retries
+send the encoded payload again instead of encoding the layer anew. Then the backend is stopped and requests to it
+are timed with and without the circuit breaker.
+
+    python benchmarks/bench_retry.py --generations 40 --bad-gateway 0.3 --out-of-memory 0.1
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import contextlib
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+from typing import Any
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_worker import make_pixels
+from fake_backend import FakeBackend
+
+from sg_api import ApiClient
+from sg_payload import PAYLOAD_POLICY
+from sg_retry import RetryPolicy
+
+ENDPOINT = "/sdapi/v1/img2img"
+SIZE = 512
+
+
+def make_handler(image: str, bad_gateway: float, out_of_memory: float, seed: int) -> Any:
+    rng = random.Random(seed)
+
+    def generate(request: dict[str, Any]) -> Any:
+        roll = rng.random()
+        if roll < bad_gateway:
+            return 502, {"error": "Bad Gateway"}
+        if roll < bad_gateway + out_of_memory:
+            return 500, {"error": "OutOfMemoryError", "detail": "CUDA out of memory"}
+        return {"images": [image], "info": json.dumps({"seed": request.get("seed")})}
+
+    return generate
+
+
+def run_flaky(args: argparse.Namespace, retries: int) -> None:
+    encoded = PAYLOAD_POLICY.encode(make_pixels(SIZE), SIZE, SIZE, 3, "png")
+    image = base64.b64encode(encoded.data).decode()
+    handler = make_handler(image, args.bad_gateway, args.out_of_memory, args.seed)
+    with FakeBackend(handlers={ENDPOINT: handler}) as backend:
+        client = ApiClient(backend.base_url, retry=RetryPolicy(retries=retries, backoff=0.05, breaker_threshold=0))
+        start = time.perf_counter()
+        ok = 0
+        for index in range(args.generations):
+            response = client.post_stream(ENDPOINT, {"init_images": [encoded], "seed": index})
+            if not isinstance(response, dict):
+                ok += sum(1 for _ in response.images())
+        seconds = time.perf_counter() - start
+        uploads = backend.body_bytes / (len(encoded.data) * 4 / 3) / args.generations
+        print(
+            f"flaky, {retries} retries: {ok}/{args.generations} generations done in {seconds:5.2f} s, "
+            f"init image uploaded {uploads:4.2f}x per generation",
+        )
+
+
+def run_down(args: argparse.Namespace, threshold: int) -> None:
+    backend = FakeBackend().start()
+    base_url = backend.base_url
+    backend.stop()
+    client = ApiClient(base_url, retry=RetryPolicy(retries=2, backoff=0.25, breaker_threshold=threshold))
+    durations = []
+    for _ in range(args.calls):
+        start = time.perf_counter()
+        with contextlib.suppress(requests.exceptions.ConnectionError):
+            client.get("/sdapi/v1/options", log_errors=False)
+        durations.append(time.perf_counter() - start)
+    label = f"breaker after {threshold}" if threshold else "no breaker"
+    print(
+        f"backend down, {label:<16} {args.calls} calls in {sum(durations):5.2f} s, "
+        f"median {statistics.median(durations) * 1000:7.1f} ms per call",
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--generations", type=int, default=40)
+    parser.add_argument("--bad-gateway", type=float, default=0.3)
+    parser.add_argument("--out-of-memory", type=float, default=0.1)
+    parser.add_argument("--calls", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    for retries in (0, 2, 4):
+        run_flaky(args, retries)
+    for threshold in (0, 5):
+        run_down(args, threshold)
+
+
+if __name__ == "__main__":
+    main()
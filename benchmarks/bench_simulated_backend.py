@@ -0,0 +1,119 @@
+"""
+The plug-in's client code against the simulated backend (fake_backend.SimulatedBackend), no GPU needed.
+
+Runs what a plug-in session does and checks the answers are shaped like a real backend's: the capability fetch of
+the settings dialog, batches of txt2img with progress polling (generation time against the simulated one, polls,
+seeds and infotexts parsed by ResponseInfo, ControlNet annotator images after the generated ones), an interrupted
+generation (time from the cancel to the result) and generations with injected failures retried by the client.
+
+    python benchmarks/bench_simulated_backend.py --batch 1 4 --steps 20 --seconds-per-step 0.02 --failure-rate 0.2
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import logging
+import os
+import sys
+import threading
+import time
+
+from typing import Any
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_backend import REFERENCE_PIXELS, SimulatedBackend
+
+from sg_api import ApiClient
+from sg_backend_options import fetch_stablediffusion_options
+from sg_generation import ResponseInfo, controlnet_unit
+from sg_progress import ProgressTracker
+from sg_retry import RetryPolicy
+
+ENDPOINT = "/sdapi/v1/txt2img"
+SIZE = 1024
+
+
+def generate(api: ApiClient, data: dict[str, Any]) -> tuple[int, ResponseInfo]:
+    response = api.post_stream(ENDPOINT, data)
+    if isinstance(response, dict):
+        raise RuntimeError(f"{response.get('error')}: {response.get('errors') or response.get('detail')}")
+    try:
+        images = sum(1 for _ in response.images())
+        return images, ResponseInfo.parse(response["info"])
+    finally:
+        response.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--seconds-per-step", type=float, default=0.02)
+    parser.add_argument("--request-seconds", type=float, default=0.2)
+    parser.add_argument("--interrupt-after", type=float, default=0.5)
+    parser.add_argument("--failure-rate", type=float, default=0.2)
+    parser.add_argument("--generations", type=int, default=20)
+    args = parser.parse_args()
+    # the retries of injected failures are counted below instead of logged
+    logging.basicConfig(level=logging.ERROR)
+
+    data = {"prompt": "benchmark", "seed": 1000, "steps": args.steps, "width": SIZE, "height": SIZE}
+    step_seconds = args.seconds_per_step * SIZE * SIZE / REFERENCE_PIXELS
+
+    with SimulatedBackend(seconds_per_step=args.seconds_per_step, request_seconds=args.request_seconds) as backend:
+        backend.prepare_images([(SIZE, SIZE), (backend.preview_size, backend.preview_size)])
+        api = ApiClient(backend.base_url)
+        start = time.perf_counter()
+        options = fetch_stablediffusion_options(api)
+        print(
+            f"capability fetch: {(time.perf_counter() - start) * 1000:5.1f} ms, checkpoint "
+            f"{options['sd_model_checkpoint']}, {len(options['models'])} models, {len(options['cn_models'])} "
+            "ControlNet models",
+        )
+
+        for batch in args.batch:
+            expected = args.request_seconds + args.steps * batch * step_seconds
+            tracker = ProgressTracker(api)
+            start = time.perf_counter()
+            images, info = tracker.run(lambda batch=batch: generate(api, {**data, "batch_size": batch}))
+            seconds = time.perf_counter() - start
+            print(
+                f"batch {batch}: {images} images in {seconds:5.2f} s (simulated {expected:5.2f} s), "
+                f"{tracker.polls} progress polls, seeds {info.seeds}, infotext {info.infotexts[0].splitlines()[-1]!r}",
+            )
+
+        unit = controlnet_unit({"module": "canny", "model": "control_v11p_sd15_canny [d14c016b]"}, "")
+        images, info = generate(api, {**data, "steps": 1, "alwayson_scripts": {"controlnet": {"args": [unit]}}})
+        print(f"ControlNet: {images} images, {len(info)} generated and {images - len(info)} annotator image")
+
+        cancel_at: list[float] = []
+
+        def interrupt() -> None:
+            time.sleep(args.interrupt_after)
+            cancel_at.append(time.perf_counter())
+            api.interrupt()
+
+        threading.Thread(target=interrupt, daemon=True).start()
+        images, info = generate(api, {**data, "batch_size": 1, "n_iter": 4})
+        print(
+            f"interrupted after {args.interrupt_after} s of 4 iterations: {images} images returned "
+            f"{(time.perf_counter() - cancel_at[0]) * 1000:5.1f} ms after the interrupt",
+        )
+
+    failures = {"bad_gateway": args.failure_rate / 2, "out_of_memory": args.failure_rate / 2}
+    with SimulatedBackend(seconds_per_step=0, request_seconds=0.01, failures=failures, seed=1) as backend:
+        api = ApiClient(backend.base_url, retry=RetryPolicy(retries=3, backoff=0.01, breaker_threshold=0))
+        done = 0
+        for index in range(args.generations):
+            with contextlib.suppress(RuntimeError):
+                done += generate(api, {**data, "seed": index, "steps": 1})[0]
+        print(
+            f"{args.failure_rate:.0%} failures injected: {done}/{args.generations} generations done, "
+            f"{backend.failures_injected} failures retried",
+        )
+
+
+if __name__ == "__main__":
+    main()
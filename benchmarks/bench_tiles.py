@@ -0,0 +1,173 @@
+"""
+Tiled img2img of a large area (sg_tiles), tiles sent one after another vs. pipelined over one or more backends.
+
+Every stand-in backend generates one tile at a time (``--seconds-per-tile``, like a single GPU) and returns the
+init image with its brightness shifted by up to ``--shift``, as diffusion shifts the colours of each tile a little.
+The plug-in's pipeline is reproduced without GIMP: tiles are cut from the canvas on the main thread, encoded and
+sent by worker threads, ``TILES_IN_FLIGHT_PER_BACKEND`` per backend, and decoded and blended into the output in
+order. Sequential runs send the next tile only once the previous one is blended.
+
+The seam check compares the largest jump between neighbouring pixels of ``output - canvas`` for tiles pasted as
+they are and for feathered tiles; the memory check traces the peak allocations of a run besides the output, the
+stand-in backends run in the same process and are included.
+
+    python benchmarks/bench_tiles.py --area 3072 2048 --tile 1024 --overlap 64 --seconds-per-tile 2 --backends 1 2
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_crop_region import make_canvas
+from fake_backend import FakeBackend
+
+from sg_backends import BackendPool
+from sg_decode import decode_image
+from sg_payload import PAYLOAD_POLICY
+from sg_tiles import TILES_IN_FLIGHT_PER_BACKEND, Tile, TileGrid, blend_tile
+
+ENDPOINT = "/sdapi/v1/img2img"
+
+
+def make_handler(seconds_per_tile: float, shift: int) -> Any:
+    gpu = threading.Lock()
+    rng = random.Random(1)
+
+    def img2img(request: dict[str, Any]) -> dict[str, Any]:
+        decoded = decode_image(base64.b64decode(request["init_images"][0]))
+        pixels = np.frombuffer(decoded.pixels, dtype=np.uint8).reshape(decoded.height, decoded.width, -1)[:, :, :3]
+        with gpu:
+            offset = rng.randint(-shift, shift)
+            time.sleep(seconds_per_tile)
+        shifted = np.clip(pixels.astype(np.int16) + offset, 0, 255).astype(np.uint8)
+        encoded = PAYLOAD_POLICY.encode(shifted.tobytes(), decoded.width, decoded.height, 3, "png")
+        return {"images": [base64.b64encode(encoded.data).decode()], "info": "{}"}
+
+    return img2img
+
+
+def run(
+    pool: BackendPool,
+    canvas: np.ndarray,
+    grid: TileGrid,
+    pipelined: bool,
+) -> tuple[float, np.ndarray, np.ndarray]:
+    """Seconds for the whole area, the feathered output and the output with tiles pasted as they are"""
+    start = time.perf_counter()
+    output = np.zeros((grid.height, grid.width, 4), dtype=np.uint8)
+    pasted = np.zeros((grid.height, grid.width, 3), dtype=np.uint8)
+
+    def send(tile: Tile, pixels: bytes) -> Any:
+        encoded = PAYLOAD_POLICY.encode(pixels, tile.width, tile.height, 3, "png")
+        return pool.post_stream(ENDPOINT, {**tile.apply({"seed": 1234}), "init_images": [encoded]})
+
+    in_flight = TILES_IN_FLIGHT_PER_BACKEND * len(pool) if pipelined else 1
+    pending = iter(grid)
+    futures: deque[Future] = deque()
+
+    def submit_next(executor: ThreadPoolExecutor) -> None:
+        tile = next(pending, None)
+        if tile is not None:
+            pixels = np.ascontiguousarray(canvas[tile.y : tile.y + tile.height, tile.x : tile.x + tile.width])
+            futures.append(executor.submit(send, tile, pixels.tobytes()))
+
+    with ThreadPoolExecutor(in_flight) as executor:
+        for _tile in range(in_flight):
+            submit_next(executor)
+        for tile in grid:
+            response = futures.popleft().result()
+            if pipelined:
+                submit_next(executor)
+            try:
+                decoded = decode_image(next(iter(response.images())))
+            finally:
+                response.close()
+            width, height = grid.visible(tile)
+            rows, columns = slice(tile.y, tile.y + height), slice(tile.x, tile.x + width)
+            written = output[rows, columns].tobytes() if tile.overlap_left or tile.overlap_top else None
+            blended = blend_tile(grid, tile, decoded.pixels, decoded.channels, written)
+            output[rows, columns] = np.frombuffer(blended, dtype=np.uint8).reshape(height, width, 4)
+            new = np.frombuffer(decoded.pixels, dtype=np.uint8).reshape(tile.height, tile.width, decoded.channels)
+            pasted[rows, columns] = new[:height, :width, :3]
+            if not pipelined:
+                submit_next(executor)
+    return time.perf_counter() - start, output[:, :, :3], pasted
+
+
+def largest_jump(result: np.ndarray, canvas: np.ndarray) -> int:
+    """Largest step between neighbouring pixels of what the backend changed"""
+    diff = result.astype(np.int16) - canvas[: result.shape[0], : result.shape[1]]
+    return int(max(np.abs(np.diff(diff, axis=0)).max(), np.abs(np.diff(diff, axis=1)).max()))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--area", type=int, nargs=2, default=[3072, 2048])
+    parser.add_argument("--tile", type=int, default=1024)
+    parser.add_argument("--overlap", type=int, default=64)
+    parser.add_argument("--seconds-per-tile", type=float, default=2.0)
+    parser.add_argument("--shift", type=int, default=8)
+    parser.add_argument("--backends", type=int, nargs="+", default=[1, 2])
+    args = parser.parse_args()
+
+    width, height = args.area
+    grid = TileGrid(width, height, args.tile, args.overlap)
+    # tiles of areas smaller than a tile reach beyond the area, the plug-in sends the image around it
+    extent_x = max(tile.x + tile.width for tile in grid)
+    extent_y = max(tile.y + tile.height for tile in grid)
+    # kept clear of 0 and 255, so shifted tiles are not clipped
+    canvas = make_canvas(max(width, extent_x), max(height, extent_y)) // 2 + 64
+    print(f"{grid}, {width * height * 3 / 1e6:.1f} MB of RGB pixels in the area")
+
+    servers = [
+        FakeBackend(handlers={ENDPOINT: make_handler(args.seconds_per_tile, args.shift)}).start()
+        for _ in range(max(args.backends))
+    ]
+    try:
+        baseline = None
+        for count in args.backends:
+            pool = BackendPool.fromUrls([server.base_url for server in servers[:count]])
+            for pipelined in (False, True):
+                if count > 1 and not pipelined:
+                    continue
+                seconds, output, pasted = run(pool, canvas, grid, pipelined)
+                baseline = baseline or seconds
+                label = f"{count} backend{'s' if count > 1 else ''}, {'pipelined' if pipelined else 'sequential'}"
+                print(
+                    f"{label:<24} {seconds:6.2f} s, {len(grid) / seconds:5.2f} tiles/s, speed-up "
+                    f"{baseline / seconds:4.2f}x, largest jump pasted {largest_jump(pasted, canvas):3d}, "
+                    f"feathered {largest_jump(output, canvas):3d}",
+                )
+
+        pool = BackendPool.fromUrls([servers[0].base_url])
+        tracemalloc.start()
+        run(pool, canvas, grid, pipelined=True)
+        _current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        outputs = width * height * (4 + 3)
+        print(
+            f"peak allocations besides the outputs: {(peak - outputs) / 1e6:.1f} MB "
+            f"({TILES_IN_FLIGHT_PER_BACKEND} tiles of {grid.tiles[0].width}x{grid.tiles[0].height} in flight)",
+        )
+    finally:
+        for server in servers:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
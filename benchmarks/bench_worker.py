@@ -0,0 +1,99 @@
+"""
+Per-invocation cost of a plug-in run with and without the background worker (sg_worker).
+
+Every "invocation" starts with a fresh client, as a new plug-in process would, then fetches the backend
+capabilities, encodes an init image and sends a generation request. Without the worker each run pays a new
+connection to the backend, all capability requests and the encoding; with it, the worker's pool, snapshot and
+encode cache are reused.
+
+    python benchmarks/bench_worker.py --runs 10 --size 1024 --handshake-delay 0.05
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_backend import FakeBackend
+
+from sg_api import ApiClient
+from sg_backend_options import fetch_stablediffusion_options
+from sg_payload import PAYLOAD_POLICY
+from sg_worker import WorkerClient, WorkerServer
+
+ENDPOINT = "/sdapi/v1/img2img"
+
+
+def make_pixels(size: int) -> bytes:
+    row = bytes((x * 7 + (x >> 4)) % 256 for x in range(size * 3))
+    return b"".join(row[y % 97 :] + row[: y % 97] for y in range(size))
+
+
+def invocation(client: ApiClient | WorkerClient, pixels: bytes, size: int) -> dict[str, float]:
+    timings = {}
+    start = time.perf_counter()
+    fetch_stablediffusion_options(client)
+    timings["options"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    key = f"{hashlib.blake2b(pixels, digest_size=20).hexdigest()}:{PAYLOAD_POLICY.format_key('png')}"
+    encoded = client.get_encoded(key) if isinstance(client, WorkerClient) else None
+    if encoded is None:
+        encoded = PAYLOAD_POLICY.encode(pixels, size, size, 3, "png")
+        if isinstance(client, WorkerClient):
+            client.put_encoded(key, encoded)
+    timings["encode"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    client.post(ENDPOINT, {"init_images": [encoded], "prompt": "benchmark"})
+    timings["request"] = time.perf_counter() - start
+    timings["total"] = sum(timings.values())
+    return timings
+
+
+def report(name: str, runs: list[dict[str, float]]) -> None:
+    # the first run of the worker fills its caches, report it separately
+    first, rest = runs[0], runs[1:] or runs
+    parts = [f"{key} {statistics.median(run[key] for run in rest) * 1000:7.1f}" for key in first]
+    print(f"{name:<8} first run {first['total'] * 1000:7.1f} ms | median of the rest (ms): {', '.join(parts)}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--handshake-delay", type=float, default=0.05)
+    args = parser.parse_args()
+
+    pixels = make_pixels(args.size)
+    with FakeBackend(handshake_delay=args.handshake_delay, routes={ENDPOINT: {"images": [], "info": "{}"}}) as backend:
+        direct = [invocation(ApiClient(backend.base_url), pixels, args.size) for _ in range(args.runs)]
+        report("direct", direct)
+        direct_connections = backend.connections
+
+        tempdir = tempfile.mkdtemp()
+        socket_path = os.path.join(tempdir, "worker.sock")
+        server = WorkerServer(socket_path, jobs_dir=os.path.join(tempdir, "jobs"))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            worker = [
+                invocation(WorkerClient(backend.base_url, socket_path, snapshot_ttl=600), pixels, args.size)
+                for _ in range(args.runs)
+            ]
+        finally:
+            server.shutdown()
+            server.server_close()
+        report("worker", worker)
+        print(f"backend connections: direct {direct_connections}, worker {backend.connections - direct_connections}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,607 @@
+"""
+Local stand-in for the Stable Diffusion WebUI API used by the benchmarks.
+
+Serves canned JSON (or the result of a callable route) over keep-alive HTTP/1.1. ``handshake_delay`` is paid
+once per new TCP connection and models the TLS handshake / reverse proxy cost of remote render boxes;
+``route_latency`` adds a per-endpoint delay on top of the global ``latency``. ``handlers`` build responses from
+the parsed request JSON (the body is held in memory, meant for small requests); a ``(status, payload)`` tuple
+answers with another status than 200, ``DISCONNECT`` closes the connection without an answer. GET requests with a
+query string pass the query parameters to their handler instead of the (empty) body. ``link_mbps`` caps the speed
+responses are sent at, like a remote render box behind a slow uplink.
+
+``SimulatedBackend`` implements the endpoints the plug-in uses the way Forge / A1111 does: generations run one at a
+time, take ``request_seconds`` plus ``seconds_per_step`` per sampling step of a 1024x1024 image, report their
+progress, can be interrupted or skipped, and return synthetic PNGs with the ``info`` of a real backend (seeds,
+infotexts, ControlNet annotator images after the generated ones). Failures are injected at random. Run as a script
+it serves a backend the plug-in can be pointed at:
+
+    python benchmarks/fake_backend.py --port 7860 --seconds-per-step 0.02 --failure out_of_memory=0.05
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+from collections.abc import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+from urllib.parse import parse_qsl
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sg_png import encode_png
+
+# Result of a handler dropping the connection without an answer, like a crashed backend or a proxy timing out
+DISCONNECT = object()
+
+DEFAULT_ROUTES: dict[str, Any] = {
+    "/sdapi/v1/progress": {
+        "progress": 0.0,
+        "eta_relative": 0.0,
+        "state": {"job_count": 0},
+        "current_image": None,
+    },
+    "/sdapi/v1/options": {"sd_model_checkpoint": "fake-model"},
+    "/sdapi/v1/sd-models": [{"title": "fake-model [0123456789]", "hash": "0123456789"}],
+    "/sdapi/v1/sd-modules": [{"filename": "/models/VAE/ae.safetensors"}],
+    "/controlnet/model_list": {"model_list": ["none", "control_canny"]},
+    "/sdapi/v1/samplers": [{"name": "Euler a"}, {"name": "Euler"}, {"name": "DPM++ 2M"}],
+    "/sdapi/v1/schedulers": [{"name": "automatic"}, {"name": "karras"}],
+    "/sdapi/v1/upscalers": [{"name": "None"}, {"name": "Lanczos"}],
+    "/sdapi/v1/scripts": {"txt2img": [], "img2img": []},
+    "/sdapi/v1/script-info": [{"name": "controlnet"}],
+}
+
+
+class FakeBackendHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: FakeBackend
+
+    def setup(self) -> None:
+        super().setup()
+        # uvicorn disables Nagle as well; without it keep-alive requests stall on delayed ACKs
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.count_connection()
+        if self.server.handshake_delay:
+            time.sleep(self.server.handshake_delay)
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+        pass
+
+    def _send_json(self, payload: Any, status: int = 200) -> None:
+        # bytes are sent as they are: large canned bodies can be serialized once, up front
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not self.server.link_mbps:
+            self.wfile.write(body)
+            return
+        chunk_size = 1 << 16
+        seconds_per_chunk = chunk_size * 8 / (self.server.link_mbps * 1e6)
+        for offset in range(0, len(body), chunk_size):
+            self.wfile.write(body[offset : offset + chunk_size])
+            time.sleep(seconds_per_chunk)
+
+    def _drain_body(self) -> None:
+        # read in chunks so the server side does not distort memory measurements of the client
+        remaining = int(self.headers.get("Content-Length") or 0)
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 1 << 16))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            self.server.count_body_bytes(len(chunk))
+
+    def _handle(self) -> None:
+        path, _, query = self.path.partition("?")
+        delay = self.server.latency + self.server.route_latency.get(path, 0.0)
+        if path in self.server.handlers:
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            self.server.count_body_bytes(len(body))
+            if delay:
+                time.sleep(delay)
+            request = dict(parse_qsl(query)) if query and self.command == "GET" else json.loads(body or b"null")
+            result = self.server.handlers[path](request)
+            if result is DISCONNECT:
+                self.close_connection = True
+                return
+            status, payload = result if isinstance(result, tuple) else (200, result)
+            self._send_json(payload, status)
+            return
+        self._drain_body()
+        if path not in self.server.routes:
+            self._send_json({"detail": "Not Found"}, status=404)
+            return
+        if delay:
+            time.sleep(delay)
+        payload = self.server.routes[path]
+        # callables build dynamic responses, e.g. progress of a simulated job
+        self._send_json(payload() if callable(payload) else payload)
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+class FakeBackend(ThreadingHTTPServer):
+    daemon_threads = True
+    # uvicorn's backlog is 2048, the default of 5 refuses connections of concurrent clients
+    request_queue_size = 128
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        handshake_delay: float = 0.0,
+        routes: dict[str, Any] | None = None,
+        route_latency: dict[str, float] | None = None,
+        handlers: dict[str, Callable[[Any], Any]] | None = None,
+        link_mbps: float = 0.0,
+    ) -> None:
+        super().__init__((host, port), FakeBackendHandler)
+        self.latency = latency
+        self.link_mbps = link_mbps
+        self.handshake_delay = handshake_delay
+        self.routes = {**DEFAULT_ROUTES, **(routes or {})}
+        self.route_latency = route_latency or {}
+        self.handlers = handlers or {}
+        self.connections = 0
+        self.body_bytes = 0
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count_connection(self) -> None:
+        with self._lock:
+            self.connections += 1
+
+    def count_body_bytes(self, size: int) -> None:
+        with self._lock:
+            self.body_bytes += size
+
+    def start(self) -> FakeBackend:
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> FakeBackend:
+        return self.start()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stop()
+
+
+GENERATION_ENDPOINTS = ("/sdapi/v1/txt2img", "/sdapi/v1/img2img")
+# Error answers of a real backend or the proxy in front of it, by the name used in ``failures``
+FAILURES: dict[str, Any] = {
+    "bad_gateway": (502, {"detail": "Bad Gateway"}),
+    "unavailable": (503, {"detail": "Service Unavailable"}),
+    "out_of_memory": (
+        500,
+        {
+            "error": "OutOfMemoryError",
+            "detail": "",
+            "body": "",
+            "errors": "CUDA out of memory. Tried to allocate 2.00 GiB. GPU 0 has a total capacity of 11.99 GiB",
+        },
+    ),
+    "server_error": (500, {"error": "RuntimeError", "detail": "", "body": "", "errors": "Sizes of tensors must match"}),
+    "disconnect": DISCONNECT,
+}
+DEFAULT_MODELS = ["sd_xl_base_1.0.safetensors", "flux1-dev-bnb-nf4-v2.safetensors"]
+DEFAULT_CN_MODELS = ["none", "control_v11p_sd15_canny [d14c016b]", "control_v11f1p_sd15_depth [cfd03158]"]
+VERSION = "f2.0.1v1.10.1-previous-fake"
+# Pixels ``seconds_per_step`` is given for
+REFERENCE_PIXELS = 1024 * 1024
+# Distinct images per size, generating and encoding one per seed would make the stand-in the bottleneck
+IMAGE_VARIANTS = 4
+NO_PROGRESS = {
+    "progress": 0.0,
+    "eta_relative": 0.0,
+    "state": {
+        "skipped": False,
+        "interrupted": False,
+        "job": "",
+        "job_count": 0,
+        "job_timestamp": "0",
+        "job_no": 0,
+        "sampling_step": 0,
+        "sampling_steps": 0,
+    },
+    "current_image": None,
+    "textinfo": None,
+    "current_task": None,
+}
+
+
+def model_hash(name: str) -> str:
+    return hashlib.sha256(name.encode()).hexdigest()[:10]
+
+
+class SimulatedJob:
+    """The generation running on a SimulatedBackend, what ``/sdapi/v1/progress`` reports"""
+
+    def __init__(self, task: str, iterations: int, steps: int, step_seconds: float) -> None:
+        self.task = task
+        self.iterations = iterations
+        self.steps = steps
+        self.step_seconds = step_seconds
+        self.start = time.monotonic()
+        self.timestamp = time.strftime("%Y%m%d%H%M%S")
+        self.iteration = 0
+        self.step = 0
+        self.interrupted = False
+        self.skipped = False
+
+    def progress(self) -> float:
+        return min(1.0, (self.iteration + self.step / self.steps) / self.iterations)
+
+
+class SimulatedBackend(FakeBackend):
+    """
+    FakeBackend generating like Forge / A1111: one generation at a time, with progress, interrupt and skip.
+
+    Args:
+        seconds_per_step: one sampling step of one 1024x1024 image, scaled by the pixels of the batch
+        request_seconds: per request, e.g. text encoders and VAE decoding
+        model_load_seconds: loading another checkpoint POSTed to ``/sdapi/v1/options``
+        failures: probability of each FAILURES answer to a generation request
+        noise: noise amplitude of the synthetic images, 0 gives small PNGs, 128 and more incompressible ones
+        preview_size: side of the live preview, 0 never sends one
+        seed: seed of the random seeds and failures, None for a random one
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        seconds_per_step: float = 0.01,
+        request_seconds: float = 0.05,
+        model_load_seconds: float = 0.0,
+        models: list[str] | None = None,
+        cn_models: list[str] | None = None,
+        failures: dict[str, float] | None = None,
+        noise: int = 6,
+        preview_size: int = 256,
+        seed: int | None = None,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(host, port, **kwargs)
+        unknown = set(failures or {}) - set(FAILURES)
+        if unknown:
+            raise ValueError(f"Unknown failures {', '.join(sorted(unknown))}, expected some of {', '.join(FAILURES)}")
+        self.seconds_per_step = seconds_per_step
+        self.request_seconds = request_seconds
+        self.model_load_seconds = model_load_seconds
+        self.models = models or DEFAULT_MODELS
+        self.failures = failures or {}
+        self.noise = noise
+        self.preview_size = preview_size
+        self.options: dict[str, Any] = {
+            "sd_model_checkpoint": f"{self.models[0]} [{model_hash(self.models[0])}]",
+            "forge_additional_modules": [],
+            "samples_format": "png",
+        }
+        self.routes.update(
+            {
+                "/sdapi/v1/sd-models": [
+                    {
+                        "title": f"{name} [{model_hash(name)}]",
+                        "model_name": os.path.splitext(name)[0],
+                        "hash": model_hash(name),
+                        "filename": f"/models/Stable-diffusion/{name}",
+                    }
+                    for name in self.models
+                ],
+                "/controlnet/model_list": {"model_list": cn_models or DEFAULT_CN_MODELS},
+            },
+        )
+        self.handlers = {
+            "/sdapi/v1/txt2img": self._txt2img,
+            "/sdapi/v1/img2img": self._img2img,
+            "/sdapi/v1/progress": self._progress,
+            "/sdapi/v1/interrupt": self._interrupt,
+            "/sdapi/v1/skip": self._skip,
+            "/sdapi/v1/options": self._options,
+            **self.handlers,
+        }
+        # counters, read by benchmarks
+        self.generations = 0
+        self.images_generated = 0
+        self.failures_injected = 0
+        self.interrupts = 0
+        self.model_loads = 0
+        self.progress_polls = 0
+        self._rng = random.Random(seed)
+        self._gpu = threading.Lock()
+        self._state = threading.Lock()
+        self._job: SimulatedJob | None = None
+        self._interrupted = threading.Event()
+        self._skipped = threading.Event()
+        self._images: dict[tuple[int, int, int], str] = {}
+
+    def _image(self, width: int, height: int, variant: int) -> str:
+        """Base64 PNG of a noisy gradient, ``variant`` shifts its colours"""
+        key = (width, height, variant % IMAGE_VARIANTS)
+        with self._state:
+            if key in self._images:
+                return self._images[key]
+        # only the simulated backend needs NumPy
+        import numpy as np
+
+        rng = np.random.default_rng(key[2])
+        y, x = np.mgrid[0:height, 0:width]
+        gradient = np.dstack([x * 255 // width, y * 255 // height, np.full_like(x, 64 * key[2])]).astype(np.int16)
+        noise = rng.integers(-self.noise, self.noise + 1, gradient.shape) if self.noise else 0
+        pixels = np.clip(gradient + noise, 0, 255).astype(np.uint8)
+        image = base64.b64encode(encode_png(pixels.tobytes(), width, height, 3, level=1)).decode()
+        with self._state:
+            self._images[key] = image
+        return image
+
+    def prepare_images(self, sizes: list[tuple[int, int]]) -> None:
+        """Render the images of these sizes up front, so the first generations are not slowed down by it"""
+        for width, height in sizes:
+            for variant in range(IMAGE_VARIANTS):
+                self._image(width, height, variant)
+
+    def _draw_failure(self) -> Any:
+        with self._state:
+            draw = self._rng.random()
+            for name, probability in self.failures.items():
+                draw -= probability
+                if draw < 0:
+                    self.failures_injected += 1
+                    return FAILURES[name]
+        return None
+
+    def _txt2img(self, request: dict[str, Any]) -> Any:
+        return self._generate(request, "txt2img")
+
+    def _img2img(self, request: dict[str, Any]) -> Any:
+        return self._generate(request, "img2img")
+
+    def _generate(self, request: dict[str, Any], mode: str) -> Any:
+        failure = self._draw_failure()
+        if failure is not None:
+            return failure
+        width, height = int(request.get("width", 512)), int(request.get("height", 512))
+        batch_size = max(1, int(request.get("batch_size", 1)))
+        iterations = max(1, int(request.get("n_iter", 1)))
+        steps = max(1, int(request.get("steps", 20)))
+        if mode == "img2img":
+            # like A1111, img2img runs the denoised part of the schedule only
+            steps = max(1, int(steps * min(1.0, float(request.get("denoising_strength", 0.75)))))
+        step_seconds = self.seconds_per_step * batch_size * width * height / REFERENCE_PIXELS
+
+        seed = int(request.get("seed", -1))
+        if seed < 0:
+            seed = self._rng.randrange(2**32 - batch_size * iterations)
+        units = (request.get("alwayson_scripts") or {}).get("controlnet", {}).get("args", [])
+        annotators = [unit for unit in units if unit.get("enabled", True) and unit.get("module") not in (None, "none")]
+
+        with self._gpu:
+            self._interrupted.clear()
+            self._skipped.clear()
+            job = SimulatedJob(f"task({self._rng.getrandbits(48):012x})", iterations, steps, step_seconds)
+            with self._state:
+                self._job = job
+                self.generations += 1
+            try:
+                # rendered within the simulated time, so the stand-in's own encoding does not add to it
+                images = [self._image(width, height, seed + index) for index in range(batch_size * iterations)]
+                annotator = self._image(width, height, IMAGE_VARIANTS - 1) if annotators else None
+                done = self._sample(job)
+            finally:
+                with self._state:
+                    self._job = None
+            count = done * batch_size
+            with self._state:
+                self.images_generated += count
+
+        seeds = [seed + index for index in range(count)]
+        images = images[:count] + [annotator] * len(annotators)
+        parameters = {**request, "init_images": None, "mask": None} if mode == "img2img" else request
+        return {"images": images, "parameters": parameters, "info": json.dumps(self._info(request, seeds, job))}
+
+    def _sample(self, job: SimulatedJob) -> int:
+        """Sleep through the sampling steps, returns the iterations whose images are returned"""
+        if self._interrupted.wait(max(0.0, self.request_seconds - (time.monotonic() - job.start))):
+            job.interrupted = True
+            return 0
+        for iteration in range(job.iterations):
+            job.iteration = iteration
+            for step in range(job.steps):
+                job.step = step
+                if self._interrupted.wait(job.step_seconds):
+                    # A1111 decodes what was sampled so far
+                    job.interrupted = True
+                    return iteration + 1
+                if self._skipped.is_set():
+                    self._skipped.clear()
+                    job.skipped = True
+                    break
+            job.step = job.steps
+        return job.iterations
+
+    def _info(self, request: dict[str, Any], seeds: list[int], job: SimulatedJob) -> dict[str, Any]:
+        checkpoint = self.options["sd_model_checkpoint"]
+        model, _, hashed = checkpoint.rpartition(" [")
+        prompt = request.get("prompt", "")
+        negative_prompt = request.get("negative_prompt", "")
+        sampler = request.get("sampler_name") or request.get("sampler_index") or "Euler a"
+        width, height = request.get("width", 512), request.get("height", 512)
+        parameters = [
+            f"Steps: {request.get('steps', 20)}",
+            f"Sampler: {sampler}",
+            f"Schedule type: {str(request.get('scheduler') or 'automatic').capitalize()}",
+            f"CFG scale: {request.get('cfg_scale', 7)}",
+            "Seed: ",
+            f"Size: {width}x{height}",
+            f"Model hash: {hashed.rstrip(']')}",
+            f"Model: {os.path.splitext(model)[0]}",
+        ]
+        if "init_images" in request:
+            parameters.append(f"Denoising strength: {request.get('denoising_strength', 0.75)}")
+        parameters.append(f"Version: {VERSION}")
+
+        def infotext(seed: int) -> str:
+            text = ", ".join(f"{item}{seed}" if item == "Seed: " else item for item in parameters)
+            return f"{prompt}\nNegative prompt: {negative_prompt}\n{text}"
+
+        return {
+            "prompt": prompt,
+            "all_prompts": [prompt] * len(seeds),
+            "negative_prompt": negative_prompt,
+            "all_negative_prompts": [negative_prompt] * len(seeds),
+            "seed": seeds[0] if seeds else -1,
+            "all_seeds": seeds,
+            "subseed": -1,
+            "all_subseeds": [-1] * len(seeds),
+            "subseed_strength": request.get("subseed_strength", 0),
+            "width": width,
+            "height": height,
+            "sampler_name": sampler,
+            "cfg_scale": request.get("cfg_scale", 7),
+            "steps": request.get("steps", 20),
+            "batch_size": request.get("batch_size", 1),
+            "restore_faces": request.get("restore_faces", False),
+            "face_restoration_model": None,
+            "sd_model_name": os.path.splitext(model)[0],
+            "sd_model_hash": hashed.rstrip("]"),
+            "sd_vae_name": None,
+            "sd_vae_hash": None,
+            "seed_resize_from_w": -1,
+            "seed_resize_from_h": -1,
+            "denoising_strength": request.get("denoising_strength"),
+            "extra_generation_params": {},
+            "index_of_first_image": 0,
+            "infotexts": [infotext(seed) for seed in seeds],
+            "styles": request.get("styles", []),
+            "job_timestamp": job.timestamp,
+            "clip_skip": 1,
+            "is_using_inpainting_conditioning": False,
+            "version": VERSION,
+        }
+
+    def _progress(self, request: dict[str, Any] | None) -> dict[str, Any]:
+        with self._state:
+            self.progress_polls += 1
+            job = self._job
+        if job is None:
+            return NO_PROGRESS
+        progress = job.progress()
+        elapsed = time.monotonic() - job.start
+        want_preview = (request or {}).get("skip_current_image", "false") != "true"
+        return {
+            "progress": progress,
+            "eta_relative": elapsed / progress - elapsed if progress else 0.0,
+            "state": {
+                "skipped": job.skipped,
+                "interrupted": job.interrupted,
+                "job": f"Batch {job.iteration + 1} out of {job.iterations}",
+                "job_count": job.iterations,
+                "job_timestamp": job.timestamp,
+                "job_no": job.iteration,
+                "sampling_step": job.step,
+                "sampling_steps": job.steps,
+            },
+            "current_image": (
+                self._image(self.preview_size, self.preview_size, 0)
+                if want_preview and self.preview_size and job.step
+                else None
+            ),
+            "textinfo": None,
+            "current_task": job.task,
+        }
+
+    def _interrupt(self, _request: Any) -> dict[str, Any]:
+        with self._state:
+            if self._job is not None:
+                self.interrupts += 1
+                self._interrupted.set()
+        return {}
+
+    def _skip(self, _request: Any) -> dict[str, Any]:
+        with self._state:
+            if self._job is not None:
+                self._skipped.set()
+        return {}
+
+    def _options(self, request: dict[str, Any] | None) -> Any:
+        if not request:
+            return self.options
+        checkpoint = request.get("sd_model_checkpoint")
+        if checkpoint and checkpoint.split(" [")[0] != self.options["sd_model_checkpoint"].split(" [")[0]:
+            name = checkpoint.split(" [")[0]
+            if name not in self.models:
+                return 500, {"error": "RuntimeError", "detail": "", "body": "", "errors": f"model {name!r} not found"}
+            with self._gpu:
+                time.sleep(self.model_load_seconds)
+                self.model_loads += 1
+                request = {**request, "sd_model_checkpoint": f"{name} [{model_hash(name)}]"}
+        self.options.update(request)
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Stand-in Stable Diffusion WebUI API for benchmarks and tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7860)
+    parser.add_argument("--seconds-per-step", type=float, default=0.02, help="per step of a 1024x1024 image")
+    parser.add_argument("--request-seconds", type=float, default=0.2)
+    parser.add_argument("--model-load-seconds", type=float, default=2.0)
+    parser.add_argument("--latency", type=float, default=0.0, help="added to every request")
+    parser.add_argument("--handshake-delay", type=float, default=0.0, help="per new connection")
+    parser.add_argument("--link-mbps", type=float, default=0.0, help="response speed, 0 for no limit")
+    parser.add_argument("--noise", type=int, default=6, help="noise of the images, higher is larger PNGs")
+    parser.add_argument(
+        "--failure",
+        action="append",
+        default=[],
+        metavar="NAME=PROBABILITY",
+        help=f"inject failures of generation requests, NAME is one of {', '.join(FAILURES)}",
+    )
+    args = parser.parse_args()
+
+    failures = {name: float(probability) for name, _, probability in (item.partition("=") for item in args.failure)}
+    backend = SimulatedBackend(
+        args.host,
+        args.port,
+        seconds_per_step=args.seconds_per_step,
+        request_seconds=args.request_seconds,
+        model_load_seconds=args.model_load_seconds,
+        failures=failures,
+        noise=args.noise,
+        latency=args.latency,
+        handshake_delay=args.handshake_delay,
+        link_mbps=args.link_mbps,
+    )
+    print(f"Serving a simulated backend at {backend.base_url}")
+    try:
+        backend.serve_forever()
+    except KeyboardInterrupt:
+        backend.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,681 @@
+"""
+In-process stand-in for the parts of GIMP's Python bindings the plug-in calls, for benchmarks outside GIMP.
+
+``install()`` registers fake ``gi`` and ``gi.repository`` modules, so sg_structures, sg_plugins and the plug-in
+entry point import as they do in GIMP. Gimp, Gegl and Gio implement what the plug-in uses: images, layers, layer
+masks, the selection and parasites, with pixels in NumPy arrays read and written through GEGL buffers and format
+strings, plus procedure registration (``Gimp.main`` instantiates the plug-in and creates every procedure like
+GIMP's query run). Everything else, GimpUi, Gtk, GLib, GObject and unimplemented members, is a permissive stub:
+enough to import and register procedures, not to show dialogs.
+
+    import fake_gimp
+
+    fake_gimp.install()
+    from gi.repository import Gimp
+
+    image = Gimp.Image.new(1024, 1024, Gimp.ImageBaseType.RGB)
+    layer = fake_gimp.noise_layer(image, "init", 1024, 1024)
+"""
+
+from __future__ import annotations
+
+import enum
+import itertools
+import sys
+import types
+import weakref
+
+from typing import Any
+
+import numpy as np
+
+# GEGL format -> channels of the packed 8-bit pixels
+FORMAT_CHANNELS = {"R'G'B'A u8": 4, "R'G'B' u8": 3, "Y'A u8": 2, "Y' u8": 1}
+# Rec. 709 luma weights, what GEGL uses for Y'
+LUMA = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+
+
+class Stub:
+    """Any attribute, call or flag combination of a binding the stand-in does not implement"""
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+
+    def __getattr__(self, name: str) -> Stub:
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return Stub(f"{self._name}.{name}")
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Stub:
+        return Stub(f"{self._name}()")
+
+    def __or__(self, other: Any) -> Stub:
+        return self
+
+    __ror__ = __or__
+
+    def __mro_entries__(self, bases: tuple[Any, ...]) -> tuple[type, ...]:
+        return (object,)
+
+    def __repr__(self) -> str:
+        return f"<stub {self._name}>"
+
+
+class StubModule(types.ModuleType):
+    """Module returning stubs for the members it does not define"""
+
+    def __getattr__(self, name: str) -> Stub:
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return Stub(f"{self.__name__}.{name}")
+
+
+def convert(pixels: np.ndarray, channels: int) -> np.ndarray:
+    """HxWxC uint8 pixels converted to ``channels`` the way GEGL converts between u8 formats"""
+    source = pixels.shape[2]
+    if source == channels:
+        return pixels
+    color, alpha = (pixels[:, :, :3], source == 4) if source >= 3 else (pixels[:, :, :1], source == 2)
+    if channels >= 3:
+        color = np.repeat(color, 3, axis=2) if color.shape[2] == 1 else color
+    elif color.shape[2] == 3:
+        color = (color.astype(np.float32) @ LUMA + 0.5).astype(np.uint8)[:, :, None]
+    if channels in (2, 4):
+        opacity = pixels[:, :, -1:] if alpha else np.full(color.shape[:2] + (1,), 255, dtype=np.uint8)
+        return np.concatenate([color, opacity], axis=2)
+    return np.ascontiguousarray(color)
+
+
+# --- Gegl ---
+
+
+class Rectangle:
+    def __init__(self, x: int, y: int, width: int, height: int) -> None:
+        self.x, self.y, self.width, self.height = x, y, width, height
+
+    @classmethod
+    def new(cls, x: int, y: int, width: int, height: int) -> Rectangle:
+        return cls(x, y, width, height)
+
+
+class AbyssPolicy(enum.IntEnum):
+    NONE = 0
+    CLAMP = 1
+
+
+class Color:
+    def __init__(self, spec: str) -> None:
+        self.spec = spec
+
+    @classmethod
+    def new(cls, spec: str) -> Color:
+        return cls(spec)
+
+
+class Buffer:
+    """The GEGL buffer of a drawable, reading and writing its NumPy pixels"""
+
+    def __init__(self, drawable: Drawable) -> None:
+        self.drawable = drawable
+
+    def get(self, rect: Rectangle, scale: float, image_format: str, abyss: AbyssPolicy = AbyssPolicy.NONE) -> bytes:
+        pixels = self.drawable.pixels
+        height, width = pixels.shape[:2]
+        if rect.x >= 0 and rect.y >= 0 and rect.x + rect.width <= width and rect.y + rect.height <= height:
+            region = pixels[rect.y : rect.y + rect.height, rect.x : rect.x + rect.width]
+        else:
+            rows = np.arange(rect.y, rect.y + rect.height)
+            columns = np.arange(rect.x, rect.x + rect.width)
+            region = pixels[np.clip(rows, 0, height - 1)[:, None], np.clip(columns, 0, width - 1)[None, :]]
+            if abyss != AbyssPolicy.CLAMP:
+                outside = ((rows < 0) | (rows >= height))[:, None] | ((columns < 0) | (columns >= width))[None, :]
+                region = np.where(outside[:, :, None], 0, region).astype(np.uint8)
+        return convert(region, FORMAT_CHANNELS[image_format]).tobytes()
+
+    def set(self, rect: Rectangle, image_format: str, data: bytes) -> None:
+        pixels = self.drawable.pixels
+        new = np.frombuffer(data, dtype=np.uint8).reshape(rect.height, rect.width, FORMAT_CHANNELS[image_format])
+        x0, y0 = max(0, rect.x), max(0, rect.y)
+        x1, y1 = min(pixels.shape[1], rect.x + rect.width), min(pixels.shape[0], rect.y + rect.height)
+        if x1 > x0 and y1 > y0:
+            part = new[y0 - rect.y : y1 - rect.y, x0 - rect.x : x1 - rect.x]
+            pixels[y0:y1, x0:x1] = convert(part, pixels.shape[2])
+
+    def flush(self) -> None:
+        pass
+
+
+# --- Gimp ---
+
+
+class ImageBaseType(enum.IntEnum):
+    RGB = 0
+    GRAY = 1
+    INDEXED = 2
+
+
+class ImageType(enum.IntEnum):
+    RGB_IMAGE = 0
+    RGBA_IMAGE = 1
+    GRAY_IMAGE = 2
+    GRAYA_IMAGE = 3
+    INDEXED_IMAGE = 4
+    INDEXEDA_IMAGE = 5
+
+
+IMAGE_TYPE_CHANNELS = {
+    ImageType.RGB_IMAGE: 3,
+    ImageType.RGBA_IMAGE: 4,
+    ImageType.GRAY_IMAGE: 1,
+    ImageType.GRAYA_IMAGE: 2,
+}
+
+
+class LayerMode(enum.IntEnum):
+    NORMAL = 28
+
+
+class AddMaskType(enum.IntEnum):
+    WHITE = 0
+    BLACK = 1
+    ALPHA = 2
+    ALPHA_TRANSFER = 3
+    SELECTION = 4
+
+
+class ChannelOps(enum.IntEnum):
+    ADD = 0
+    SUBTRACT = 1
+    REPLACE = 2
+    INTERSECT = 3
+
+
+class RunMode(enum.IntEnum):
+    INTERACTIVE = 0
+    NONINTERACTIVE = 1
+    WITH_LAST_VALS = 2
+
+
+class PDBProcType(enum.IntEnum):
+    INTERNAL = 0
+    PLUGIN = 1
+    PERSISTENT = 2
+    TEMPORARY = 3
+
+
+class ProcedureSensitivityMask(enum.IntFlag):
+    DRAWABLE = 1 << 0
+    DRAWABLES = 1 << 2
+    NO_DRAWABLES = 1 << 3
+    NO_IMAGE = 1 << 4
+    ALWAYS = 0x7FFFFFFF
+
+
+PARASITE_PERSISTENT = 1
+
+
+class Parasite:
+    def __init__(self, name: str, flags: int, data: bytes) -> None:
+        self.name, self.flags, self.data = name, flags, bytes(data)
+
+    @classmethod
+    def new(cls, name: str, flags: int, data: bytes) -> Parasite:
+        return cls(name, flags, data)
+
+    def get_data(self) -> list[int]:
+        # PyGObject hands the parasite data over as a list of ints
+        return list(self.data)
+
+
+_ids = itertools.count(1)
+_items: weakref.WeakValueDictionary[int, Item] = weakref.WeakValueDictionary()
+
+
+class Item:
+    def __init__(self, name: str = "") -> None:
+        self.id = next(_ids)
+        self.name = name
+        self.image: Image | None = None
+        self.parent: GroupLayer | None = None
+        self.parasites: dict[str, Parasite] = {}
+        self.valid = True
+        _items[self.id] = self
+
+    @classmethod
+    def get_by_id(cls, item_id: int) -> Any:
+        item = _items.get(item_id)
+        return item if isinstance(item, cls) and item.valid else None
+
+    def get_id(self) -> int:
+        return self.id
+
+    def get_name(self) -> str:
+        return self.name
+
+    def set_name(self, name: str) -> bool:
+        self.name = name
+        return True
+
+    def get_image(self) -> Image | None:
+        return self.image
+
+    def get_parent(self) -> GroupLayer | None:
+        return self.parent
+
+    def is_group(self) -> bool:
+        return False
+
+    def is_valid(self) -> bool:
+        return self.valid
+
+    def delete(self) -> None:
+        self.valid = False
+
+    def get_parasite(self, name: str) -> Parasite | None:
+        return self.parasites.get(name)
+
+    def attach_parasite(self, parasite: Parasite) -> bool:
+        self.parasites[parasite.name] = parasite
+        return True
+
+
+class Drawable(Item):
+    def __init__(self, image: Image | None, name: str, pixels: np.ndarray) -> None:
+        super().__init__(name)
+        self.image = image
+        self.pixels = pixels
+        self.offset_x = 0
+        self.offset_y = 0
+        self.updates = 0
+
+    @property
+    def width(self) -> int:
+        return self.pixels.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.pixels.shape[0]
+
+    def get_width(self) -> int:
+        return self.width
+
+    def get_height(self) -> int:
+        return self.height
+
+    def get_offsets(self) -> tuple[bool, int, int]:
+        return True, self.offset_x, self.offset_y
+
+    def set_offsets(self, x: int, y: int) -> bool:
+        self.offset_x, self.offset_y = x, y
+        return True
+
+    def get_buffer(self) -> Buffer:
+        return Buffer(self)
+
+    def has_alpha(self) -> bool:
+        return self.pixels.shape[2] in (2, 4)
+
+    def update(self, x: int, y: int, width: int, height: int) -> bool:
+        self.updates += 1
+        return True
+
+    def scale(self, width: int, height: int, local_origin: bool) -> bool:
+        """Nearest neighbour, GIMP interpolates but costs about the same per pixel"""
+        rows = np.arange(height) * self.height // max(1, height)
+        columns = np.arange(width) * self.width // max(1, width)
+        self.pixels = np.ascontiguousarray(self.pixels[rows[:, None], columns[None, :]])
+        return True
+
+
+class Channel(Drawable):
+    def __init__(self, image: Image | None, name: str, width: int, height: int, value: int = 0) -> None:
+        super().__init__(image, name, np.full((height, width, 1), value, dtype=np.uint8))
+
+    def copy(self) -> Channel:
+        channel = type(self)(self.image, self.name, self.width, self.height)
+        channel.pixels = self.pixels.copy()
+        return channel
+
+
+class LayerMask(Channel):
+    pass
+
+
+class Layer(Drawable):
+    def __init__(self, image: Image | None, name: str, pixels: np.ndarray) -> None:
+        super().__init__(image, name, pixels)
+        self.opacity = 100.0
+        self.mask: LayerMask | None = None
+
+    @classmethod
+    def new(
+        cls,
+        image: Image,
+        name: str,
+        width: int,
+        height: int,
+        image_type: ImageType,
+        opacity: float,
+        mode: LayerMode,
+    ) -> Layer:
+        layer = cls(image, name, np.zeros((height, width, IMAGE_TYPE_CHANNELS[image_type]), dtype=np.uint8))
+        layer.opacity = opacity
+        return layer
+
+    @classmethod
+    def new_from_drawable(cls, drawable: Drawable, image: Image) -> Layer:
+        layer = cls(image, drawable.name, drawable.pixels.copy())
+        layer.set_offsets(drawable.offset_x, drawable.offset_y)
+        return layer
+
+    def copy(self) -> Layer:
+        layer = Layer.new_from_drawable(self, self.image)
+        layer.opacity = self.opacity
+        layer.parasites = dict(self.parasites)
+        if self.mask is not None:
+            layer.mask = self.mask.copy()
+        return layer
+
+    def scale(self, width: int, height: int, local_origin: bool) -> bool:
+        if self.mask is not None:
+            self.mask.scale(width, height, local_origin)
+        return super().scale(width, height, local_origin)
+
+    def get_opacity(self) -> float:
+        return self.opacity
+
+    def get_mask(self) -> LayerMask | None:
+        return self.mask
+
+    def create_mask(self, mask_type: AddMaskType) -> LayerMask:
+        mask = LayerMask(self.image, f"{self.name} mask", self.width, self.height, 255)
+        if mask_type == AddMaskType.SELECTION and self.image is not None:
+            selection = self.image.selection.get_buffer()
+            rect = Rectangle(self.offset_x, self.offset_y, self.width, self.height)
+            pixels = selection.get(rect, 1.0, "Y' u8")
+            mask.get_buffer().set(Rectangle(0, 0, self.width, self.height), "Y' u8", pixels)
+        elif mask_type == AddMaskType.BLACK:
+            mask.pixels[:] = 0
+        return mask
+
+    def add_mask(self, mask: LayerMask) -> bool:
+        self.mask = mask
+        return True
+
+
+class GroupLayer(Layer):
+    def __init__(self, image: Image, name: str = "Group") -> None:
+        super().__init__(image, name, np.zeros((image.height, image.width, 4), dtype=np.uint8))
+        self.children: list[Layer] = []
+
+    def is_group(self) -> bool:
+        return True
+
+    def get_children(self) -> list[Layer]:
+        return list(self.children)
+
+
+class Image:
+    def __init__(self, width: int, height: int, base_type: ImageBaseType) -> None:
+        self.width = width
+        self.height = height
+        self.base_type = base_type
+        self.layers: list[Layer] = []
+        self.selected: list[Layer] = []
+        self.selection = Channel(self, "Selection Mask", width, height)
+        self.undo_frozen = 0
+        self.undo_groups = 0
+
+    @classmethod
+    def new(cls, width: int, height: int, base_type: ImageBaseType) -> Image:
+        return cls(width, height, base_type)
+
+    def get_width(self) -> int:
+        return self.width
+
+    def get_height(self) -> int:
+        return self.height
+
+    def get_base_type(self) -> ImageBaseType:
+        return self.base_type
+
+    def get_layers(self) -> list[Layer]:
+        return list(self.layers)
+
+    def get_selected_layers(self) -> list[Layer]:
+        return list(self.selected)
+
+    def set_selected_layers(self, layers: list[Layer]) -> bool:
+        self.selected = list(layers)
+        return True
+
+    def get_selection(self) -> Channel:
+        return self.selection
+
+    def _siblings(self, parent: GroupLayer | None) -> list[Layer]:
+        return parent.children if parent is not None else self.layers
+
+    def insert_layer(self, layer: Layer, parent: GroupLayer | None, position: int) -> bool:
+        """Insert at ``position`` of the stack of ``parent`` (the image if None), 0 and -1 on top"""
+        layer.image, layer.parent = self, parent
+        self._siblings(parent).insert(max(0, position), layer)
+        self.selected = [layer]
+        return True
+
+    def get_item_position(self, item: Layer) -> int:
+        return self._siblings(item.parent).index(item)
+
+    def remove_layer(self, layer: Layer) -> bool:
+        self._siblings(layer.parent).remove(layer)
+        self.selected = [item for item in self.selected if item is not layer]
+        layer.delete()
+        return True
+
+    def select_rectangle(self, operation: ChannelOps, x: int, y: int, width: int, height: int) -> bool:
+        if operation == ChannelOps.REPLACE:
+            self.selection.pixels[:] = 0
+        self.selection.pixels[max(0, y) : y + height, max(0, x) : x + width] = 255
+        return True
+
+    def undo_freeze(self) -> bool:
+        self.undo_frozen += 1
+        return True
+
+    def undo_thaw(self) -> bool:
+        self.undo_frozen -= 1
+        return True
+
+    def undo_group_start(self) -> bool:
+        self.undo_groups += 1
+        return True
+
+    def undo_group_end(self) -> bool:
+        return True
+
+    def delete(self) -> bool:
+        for layer in self.layers:
+            layer.delete()
+        self.layers = []
+        return True
+
+
+class Selection:
+    @staticmethod
+    def bounds(image: Image) -> tuple[bool, bool, int, int, int, int]:
+        rows = np.flatnonzero(image.selection.pixels[:, :, 0].any(axis=1))
+        if not len(rows):
+            return True, False, 0, 0, image.width, image.height
+        columns = np.flatnonzero(image.selection.pixels[:, :, 0].any(axis=0))
+        return True, True, int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1
+
+
+class Procedure:
+    """A registered procedure, recording the arguments and metadata the plug-in sets on it"""
+
+    def __init__(self, plugin: Any, name: str, proc_type: PDBProcType, run: Any, data: Any) -> None:
+        self.plugin, self.name, self.proc_type, self.run = plugin, name, proc_type, run
+        self.arguments: list[str] = []
+        self.calls = 0
+
+    @classmethod
+    def new(cls, plugin: Any, name: str, proc_type: PDBProcType, run: Any, data: Any) -> Procedure:
+        return cls(plugin, name, proc_type, run, data)
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("__"):
+            raise AttributeError(name)
+
+        def record(*args: Any, **kwargs: Any) -> bool:
+            self.calls += 1
+            if name.startswith("add_") and name.endswith("argument") and args:
+                self.arguments.append(args[0])
+            return True
+
+        return record
+
+
+class PlugIn:
+    def __init_subclass__(cls, **kwargs: Any) -> None:
+        super().__init_subclass__(**kwargs)
+        # PyGObject registers a GType per subclass, Gimp.main takes it to instantiate the plug-in
+        cls.__gtype__ = cls
+
+
+# Plug-in and procedures of the last Gimp.main call
+plugin: PlugIn | None = None
+procedures: dict[str, Procedure] = {}
+_foreground = Color("#000000")
+
+
+def main(gtype: type, argv: list[str]) -> int:
+    """GIMP's query run: instantiate the plug-in and create every procedure it declares"""
+    global plugin
+    plugin = gtype()
+    procedures.clear()
+    for name in plugin.do_query_procedures():
+        procedures[name] = plugin.do_create_procedure(name)
+    return 0
+
+
+def context_get_foreground() -> Color:
+    return _foreground
+
+
+def context_set_foreground(color: Color) -> bool:
+    global _foreground
+    _foreground = color
+    return True
+
+
+def displays_flush() -> None:
+    pass
+
+
+def file_load_layer(run_mode: RunMode, image: Image, file: File) -> Layer:
+    from sg_decode import decode_image
+
+    with open(file.get_path(), "rb") as f:
+        decoded = decode_image(f.read())
+    pixels = np.frombuffer(decoded.pixels, dtype=np.uint8).reshape(decoded.height, decoded.width, decoded.channels)
+    return Layer(image, "Loaded", pixels.copy())
+
+
+def file_save(run_mode: RunMode, image: Image, file: File, options: Any) -> bool:
+    from sg_png import encode_png
+
+    layer = image.layers[0]
+    with open(file.get_path(), "wb") as f:
+        f.write(encode_png(layer.pixels.tobytes(), layer.width, layer.height, layer.pixels.shape[2]))
+    return True
+
+
+# --- Gio ---
+
+
+class File:
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    @classmethod
+    def new_for_path(cls, path: str) -> File:
+        return cls(path)
+
+    def get_path(self) -> str:
+        return self.path
+
+
+def _module(name: str, members: dict[str, Any]) -> StubModule:
+    module = StubModule(name)
+    module.__dict__.update(members)
+    return module
+
+
+def install() -> types.ModuleType:
+    """Register the stand-in as ``gi``, replacing the real bindings if they were importable; returns Gimp"""
+    if "gi.repository.Gimp" in sys.modules and isinstance(sys.modules["gi.repository.Gimp"], StubModule):
+        return sys.modules["gi.repository.Gimp"]
+    this = sys.modules[__name__]
+    gimp_names = [
+        "AddMaskType",
+        "Channel",
+        "ChannelOps",
+        "Drawable",
+        "GroupLayer",
+        "Image",
+        "ImageBaseType",
+        "ImageType",
+        "Item",
+        "Layer",
+        "LayerMask",
+        "LayerMode",
+        "PARASITE_PERSISTENT",
+        "PDBProcType",
+        "Parasite",
+        "PlugIn",
+        "ProcedureSensitivityMask",
+        "RunMode",
+        "Selection",
+        "context_get_foreground",
+        "context_set_foreground",
+        "displays_flush",
+        "file_load_layer",
+        "file_save",
+        "main",
+    ]
+    modules = {
+        "Gimp": _module(
+            "gi.repository.Gimp",
+            {
+                **{name: getattr(this, name) for name in gimp_names},
+                "ImageProcedure": Procedure,
+                "Procedure": Procedure,
+            },
+        ),
+        "Gegl": _module(
+            "gi.repository.Gegl",
+            {"AbyssPolicy": AbyssPolicy, "Buffer": Buffer, "Color": Color, "Rectangle": Rectangle},
+        ),
+        "Gio": _module("gi.repository.Gio", {"File": File}),
+        "GimpUi": _module("gi.repository.GimpUi", {}),
+        "GLib": _module("gi.repository.GLib", {}),
+        "GObject": _module("gi.repository.GObject", {}),
+        "Gtk": _module("gi.repository.Gtk", {}),
+    }
+    repository = _module("gi.repository", modules)
+    gi = _module("gi", {"repository": repository, "require_version": lambda namespace, version: None})
+    sys.modules["gi"] = gi
+    sys.modules["gi.repository"] = repository
+    for name, module in modules.items():
+        sys.modules[f"gi.repository.{name}"] = module
+    return modules["Gimp"]
+
+
+def noise_layer(image: Image, name: str, width: int, height: int, seed: int = 1) -> Layer:
+    """Opaque RGBA layer of photo-like pixels (a gradient with mild noise), inserted on top of ``image``"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    rgb = np.dstack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)]).astype(np.int16)
+    rgb = np.clip(rgb + rng.integers(-6, 7, rgb.shape), 0, 255).astype(np.uint8)
+    layer = Layer(image, name, np.dstack([rgb, np.full((height, width), 255, dtype=np.uint8)]))
+    image.insert_layer(layer, None, 0)
+    return layer
@@ -0,0 +1,203 @@
+"""
+Checkpoint affinity for the job queue.
+
+Switching checkpoints POSTs ``sd_model_checkpoint`` (and on Forge ``forge_additional_modules``) to
+``/sdapi/v1/options``, which reloads gigabytes of weights. Every queued job is tagged with the model it was
+submitted for; the queue loads that model on the backend before running the job and otherwise lets queued jobs
+share what is loaded:
+
+- a backend takes jobs for the model it has loaded first, so jobs for one model run back to back;
+- a backend switches models only once nothing waiting needs its current model, and with several backends each
+  model stays on the backend that has it loaded as long as that one keeps up with its jobs;
+- no job is passed over more than ``max_skips`` times, after that it runs next whatever it needs.
+
+Kept free of GIMP imports.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import threading
+import time
+
+from collections.abc import Callable
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from sg_api import ApiClient
+    from sg_jobs import Job
+
+OPTIONS_ENDPOINT = "/sdapi/v1/options"
+MODEL_OPTIONS = ("sd_model_checkpoint", "forge_additional_modules")
+
+# Times a queued job may be overtaken by jobs for an already loaded model, 0 runs jobs in submission order
+DEFAULT_AFFINITY_MAX_SKIPS = 4
+
+
+def model_requirement(settings: Any) -> dict[str, Any] | None:
+    """Model options a job submitted now needs, None if the checkpoint is not known"""
+    if not settings.get("sd_model_checkpoint"):
+        return None
+    return {key: settings.get(key) for key in MODEL_OPTIONS if settings.get(key) is not None}
+
+
+def model_key(model: dict[str, Any] | None) -> str | None:
+    """Comparable form of the model options, None for jobs that run on whatever is loaded"""
+    if not model:
+        return None
+    return json.dumps({key: model[key] for key in MODEL_OPTIONS if key in model}, sort_keys=True)
+
+
+class ModelAffinity:
+    """
+    Tracks the model loaded on each backend and picks which queued job runs next, and where.
+
+    Args:
+        max_skips: times a job may be overtaken before it runs next regardless of its model
+        on_load: called with the backend URL after the queue switched its model
+    """
+
+    def __init__(
+        self,
+        max_skips: int = DEFAULT_AFFINITY_MAX_SKIPS,
+        on_load: Callable[[str], None] | None = None,
+    ) -> None:
+        self.max_skips = max(0, int(max_skips))
+        self.on_load = on_load
+        # model each backend has, or will have once the load started for a picked job finishes
+        self._target: dict[str, str | None] = {}
+        # model each backend is known to have loaded
+        self._loaded: dict[str, str | None] = {}
+        self._locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.switches = 0
+        self.load_seconds = 0.0
+
+    def pick(
+        self,
+        queued: list[Job],
+        running: dict[str, int],
+        eligible: dict[str, list[str]],
+    ) -> tuple[Job, str] | None:
+        """
+        Next job to start and the backend to run it on, None if nothing should start now.
+
+        Args:
+            queued: queued jobs, oldest first
+            running: jobs running on each backend that has a free slot
+            eligible: backends each job may run on, by job id
+        """
+        options: list[tuple[Job, list[str]]] = []
+        for job in queued:
+            backends = [url for url in eligible[job.id] if url in running]
+            if job.skipped >= self.max_skips:
+                # waited long enough, it runs next
+                if not backends:
+                    return None
+                return self._take(queued, job, self._backend_for(job, backends, queued, running))
+            options.append((job, backends))
+
+        # a job for a model that is loaded on a free backend
+        for job, backends in options:
+            for url in backends:
+                if self._matches(job, url):
+                    return self._take(queued, job, url)
+
+        # otherwise a backend switches models, unless a job still runs on it with the current one
+        waiting = self._waiting(queued)
+        for job, backends in options:
+            idle = [url for url in backends if not running[url]]
+            if not idle:
+                continue
+            key = model_key(job.model)
+            holders = sum(target == key for target in self._target.values())
+            if holders and waiting[key] <= holders:
+                # pinned: the backend that has this model loaded takes the job once it is free
+                continue
+            return self._take(queued, job, self._backend_for(job, idle, queued, running))
+        return None
+
+    def _matches(self, job: Job, url: str) -> bool:
+        return job.model is None or self._target.get(url) == model_key(job.model)
+
+    def _waiting(self, queued: list[Job]) -> dict[str | None, int]:
+        waiting: dict[str | None, int] = {}
+        for job in queued:
+            key = model_key(job.model)
+            waiting[key] = waiting.get(key, 0) + 1
+        return waiting
+
+    def _backend_for(self, job: Job, backends: list[str], queued: list[Job], running: dict[str, int]) -> str:
+        """Free backend to load the job's model on: one that has it, else one whose model nobody waits for"""
+        matching = [url for url in backends if self._matches(job, url)]
+        if matching:
+            return matching[0]
+        waiting = self._waiting(queued)
+        return min(backends, key=lambda url: (running[url], waiting.get(self._target.get(url), 0)))
+
+    def _take(self, queued: list[Job], job: Job, url: str) -> tuple[Job, str]:
+        for older in queued[: queued.index(job)]:
+            older.skipped += 1
+        if job.model is not None:
+            self._target[url] = model_key(job.model)
+        return job, url
+
+    def ensure_loaded(self, client: ApiClient, url: str, model: dict[str, Any] | None) -> float:
+        """
+        Load ``model`` on the backend unless it is loaded already.
+
+        Returns:
+            Seconds the switch took, 0 if none was needed
+        """
+        key = model_key(model)
+        if key is None:
+            return 0.0
+        with self._lock:
+            lock = self._locks.setdefault(url, threading.Lock())
+        # jobs picked for the same backend and model wait for the load instead of racing it
+        with lock:
+            if self._loaded.get(url) == key:
+                return 0.0
+            start = time.perf_counter()
+            try:
+                result = client.post(OPTIONS_ENDPOINT, data=json.loads(key))
+                if isinstance(result, dict) and ("error" in result or "detail" in result):
+                    raise ValueError(f"Loading {model} failed: {result.get('error') or result.get('detail')}")
+            except Exception:
+                self.invalidate(url)
+                raise
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self._loaded[url] = key
+                self.switches += 1
+                self.load_seconds += seconds
+        logging.info(f"Loaded {model} on {url} in {seconds:.1f}s")
+        if self.on_load is not None:
+            self.on_load(url)
+        return seconds
+
+    def observe(self, url: str, options: dict[str, Any] | None) -> None:
+        """Options POSTed to a backend by somebody else, e.g. a model change from the plug-in"""
+        if not isinstance(options, dict) or not any(key in options for key in MODEL_OPTIONS):
+            return
+        with self._lock:
+            if "sd_model_checkpoint" in options:
+                self._target[url] = self._loaded[url] = model_key(options)
+            else:
+                self._target.pop(url, None)
+                self._loaded.pop(url, None)
+
+    def invalidate(self, url: str) -> None:
+        """The model loaded on the backend is unknown, the next tagged job loads its model again"""
+        with self._lock:
+            self._target.pop(url, None)
+            self._loaded.pop(url, None)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "switches": self.switches,
+                "load_seconds": self.load_seconds,
+                "loaded": {url: json.loads(key) if key else None for url, key in self._loaded.items()},
+            }
@@ -0,0 +1,302 @@
+"""
+HTTP client for the Stable Diffusion WebUI API.
+
+Kept free of GIMP imports so that it can be used (and benchmarked) outside of GIMP.
+"""
+
+from __future__ import annotations
+
+import logging
+import socket
+import threading
+import weakref
+
+from collections.abc import Callable
+from typing import Any
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from sg_payload import PAYLOAD_POLICY
+from sg_retry import CircuitBreaker, RetryPolicy, circuit_breaker
+from sg_stream import RESPONSE_CHUNK_SIZE, StreamedResponse, StreamingJsonBody, iter_response
+
+DEFAULT_TIMEOUT = 300
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_POOL_SIZE = 10
+
+DEFAULT_HEADERS = {"Content-Type": "application/json", "Accept": "application/json"}
+
+# (connect, read) timeouts for endpoints that should never wait as long as a generation request,
+# None means "use the client default". Keys are either "METHOD /endpoint" or "/endpoint" for any method.
+DEFAULT_ENDPOINT_TIMEOUTS: dict[str, tuple[float | None, float | None]] = {
+    "/sdapi/v1/progress": (None, 10.0),
+    "/sdapi/v1/interrupt": (None, 10.0),
+    "/sdapi/v1/skip": (None, 10.0),
+    "GET /sdapi/v1/options": (None, 30.0),
+    "GET /sdapi/v1/sd-models": (None, 30.0),
+    "GET /sdapi/v1/sd-modules": (None, 30.0),
+    "GET /controlnet/model_list": (None, 30.0),
+}
+
+
+def _tracking_pool(pool_cls: type[HTTPConnectionPool], track: Any) -> type[HTTPConnectionPool]:
+    class TrackingConnection(pool_cls.ConnectionCls):
+        def connect(self) -> None:
+            super().connect()
+            track(self)
+
+    return type(pool_cls.__name__, (pool_cls,), {"ConnectionCls": TrackingConnection})
+
+
+class AbortableAdapter(HTTPAdapter):
+    """HTTPAdapter that keeps track of its open connections, so that requests in flight can be torn down"""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        self.connections: weakref.WeakSet = weakref.WeakSet()
+        self._connections_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, connections: int, maxsize: int, block: bool = False, **pool_kwargs: Any) -> None:
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _tracking_pool(HTTPConnectionPool, self._track),
+            "https": _tracking_pool(HTTPSConnectionPool, self._track),
+        }
+
+    def _track(self, connection: Any) -> None:
+        with self._connections_lock:
+            self.connections.add(connection)
+
+    def abort(self) -> int:
+        """Shut down every open socket; blocked reads in other threads fail right away. Returns the count."""
+        with self._connections_lock:
+            connections = list(self.connections)
+        aborted = 0
+        for connection in connections:
+            sock = getattr(connection, "sock", None)
+            if sock is None:
+                continue
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+                aborted += 1
+            except OSError:
+                pass
+        return aborted
+
+
+class ApiClient:
+    """Simple API client used to interface with StableDiffusion JSON endpoints
+
+    Requests go through one pooled keep-alive session, so the progress polling thread and the main
+    generation request reuse already established TCP/TLS connections instead of opening a new one per call.
+    The session is created lazily under a lock; the underlying urllib3 pool is thread-safe and holds up to
+    ``pool_size`` idle connections per host. Transient failures are retried as ``retry`` allows (sg_retry).
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        timeout: float = DEFAULT_TIMEOUT,
+        pool_size: int | None = None,
+        connect_timeout: float | None = None,
+        endpoint_timeouts: dict[str, tuple[float | None, float | None]] | None = None,
+        retry: RetryPolicy | None = None,
+    ) -> None:
+        self.setBaseUrl(base_url)
+        self.timeout = timeout
+        self.pool_size = max(1, int(pool_size or DEFAULT_POOL_SIZE))
+        self.connect_timeout = float(connect_timeout or DEFAULT_CONNECT_TIMEOUT)
+        self.endpoint_timeouts = {**DEFAULT_ENDPOINT_TIMEOUTS, **(endpoint_timeouts or {})}
+        self.link = PAYLOAD_POLICY.link
+        self.retry = retry or RetryPolicy()
+        self._session: requests.Session | None = None
+        self._adapter: AbortableAdapter | None = None
+        self._session_lock = threading.Lock()
+        # set by abort(), stops retries of the requests in flight
+        self._aborted = threading.Event()
+
+    def setBaseUrl(self, base_url: str) -> None:
+        self.base_url = base_url.strip("/")
+
+    @property
+    def breaker(self) -> CircuitBreaker:
+        return circuit_breaker(self.base_url, self.retry.breaker_threshold, self.retry.breaker_reset)
+
+    @property
+    def session(self) -> requests.Session:
+        with self._session_lock:
+            if self._session is None:
+                self._session = self._create_session()
+            return self._session
+
+    def _create_session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = AbortableAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        self._adapter = adapter
+        session.headers.update(DEFAULT_HEADERS)
+        logging.debug(f"ApiClient: created HTTP session with pool size {self.pool_size}")
+        return session
+
+    def close(self) -> None:
+        """Close pooled connections. The next request transparently opens a new session."""
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+                self._adapter = None
+
+    def abort(self) -> None:
+        """Tear down all connections, including those of requests in flight, which then raise ConnectionError"""
+        with self._session_lock:
+            adapter = self._adapter
+            aborted, self._aborted = self._aborted, threading.Event()
+        aborted.set()
+        if adapter is not None:
+            logging.debug(f"ApiClient: aborted {adapter.abort()} connections")
+
+    def interrupt(self, timeout: float | None = None) -> None:
+        """Ask the backend to stop the current generation, images finished so far are returned"""
+        self.post("/sdapi/v1/interrupt", timeout=timeout)
+
+    def skip(self, timeout: float | None = None) -> None:
+        """Ask the backend to skip the image of the batch being generated"""
+        self.post("/sdapi/v1/skip", timeout=timeout)
+
+    def getTimeout(self, endpoint: str, method: str = "GET", read_timeout: float | None = None) -> tuple[float, float]:
+        """(connect, read) timeout tuple for the endpoint, ``read_timeout`` caps the configured one"""
+        connect_timeout, endpoint_read_timeout = self.endpoint_timeouts.get(
+            f"{method} {endpoint}",
+            self.endpoint_timeouts.get(endpoint, (None, None)),
+        )
+        endpoint_read_timeout = endpoint_read_timeout or self.timeout
+        if read_timeout is not None:
+            endpoint_read_timeout = min(endpoint_read_timeout, read_timeout)
+        return connect_timeout or self.connect_timeout, endpoint_read_timeout
+
+    def _send(self, method: str, endpoint: str, send: Callable[[], requests.Response]) -> requests.Response:
+        with self._session_lock:
+            aborted = self._aborted
+        return self.retry.call(method, endpoint, send, self.breaker, aborted)
+
+    def post(self, endpoint, data=None, params=None, headers=None, timeout=None):
+        try:
+            url = self.base_url + endpoint
+
+            logging.debug(f"POST {url}, data {data.keys() if data else None}")
+
+            # images in the payload are EncodedImage objects, base64 encoded chunk by chunk while sending;
+            # a retry sends them again without encoding the layers anew
+            response = self._send(
+                "POST",
+                endpoint,
+                lambda: self.session.post(
+                    url=url,
+                    params=params,
+                    headers=headers,
+                    data=StreamingJsonBody(data, self.link) if data is not None else None,
+                    timeout=self.getTimeout(endpoint, "POST", timeout),
+                ),
+            )
+
+            data = response.json()
+            # response.raise_for_status()
+            return data
+        except requests.exceptions.Timeout:
+            logging.error(f"Timeout while POSTing to {endpoint}")
+            raise
+        except requests.exceptions.RequestException as ex:
+            logging.exception(f"ERROR: ApiClient.post to {endpoint}: {ex}")
+            raise
+        except Exception as ex:
+            logging.exception(f"ERROR: ApiClient.post unexpected error to {endpoint}: {ex}")
+            raise
+
+    def post_stream(
+        self,
+        endpoint: str,
+        data: dict[str, Any] | None = None,
+        params: dict[str, Any] | None = None,
+        headers: dict[str, str] | None = None,
+        timeout: float | None = None,
+    ) -> StreamedResponse | dict[str, Any]:
+        """
+        POST and parse the response while it is read, for endpoints returning many images.
+
+        Returns:
+            StreamedResponse for a successful call, the parsed error body as a dict otherwise
+        """
+        try:
+            url = self.base_url + endpoint
+
+            logging.debug(f"POST {url} (streamed response), data {data.keys() if data else None}")
+
+            response = self._send(
+                "POST",
+                endpoint,
+                lambda: self.session.post(
+                    url=url,
+                    params=params,
+                    headers=headers,
+                    data=StreamingJsonBody(data, self.link) if data is not None else None,
+                    timeout=self.getTimeout(endpoint, "POST", timeout),
+                    stream=True,
+                ),
+            )
+            if not response.ok:
+                # error bodies are small
+                with response:
+                    return response.json()
+            return StreamedResponse(iter_response(response.iter_content(RESPONSE_CHUNK_SIZE)), close=response.close)
+        except requests.exceptions.Timeout:
+            logging.error(f"Timeout while POSTing to {endpoint}")
+            raise
+        except requests.exceptions.RequestException as ex:
+            logging.exception(f"ERROR: ApiClient.post_stream to {endpoint}: {ex}")
+            raise
+        except Exception as ex:
+            logging.exception(f"ERROR: ApiClient.post_stream unexpected error to {endpoint}: {ex}")
+            raise
+
+    def get(self, endpoint, params=None, headers=None, timeout=None, log_errors=True):
+        try:
+            url = self.base_url + endpoint
+            logging.debug(f"GET {url}")
+
+            response = self._send(
+                "GET",
+                endpoint,
+                lambda: self.session.get(
+                    url=url,
+                    params=params,
+                    headers=headers,
+                    timeout=self.getTimeout(endpoint, "GET", timeout),
+                ),
+            )
+            # response.raise_for_status()
+            return response.json()
+        except requests.exceptions.Timeout:
+            if log_errors:
+                logging.error(f"Timeout while GETting {endpoint}")
+            raise
+        except requests.exceptions.RequestException as ex:
+            if log_errors:
+                logging.exception(f"ERROR: ApiClient.get from {endpoint}: {ex}")
+            raise
+        except Exception as ex:
+            if log_errors:
+                logging.exception(f"ERROR: ApiClient.get unexpected error to {endpoint}: {ex}")
+            raise
+
+    @classmethod
+    def fromSettings(cls, settings: Any) -> ApiClient:
+        return cls(
+            settings.get("api_base"),
+            pool_size=settings.get("http_pool_size"),
+            connect_timeout=settings.get("http_connect_timeout"),
+            retry=RetryPolicy.fromSettings(settings),
+        )
@@ -0,0 +1,245 @@
+"""
+Backend capabilities (checkpoints, modules, ControlNet models) and their persistent cache.
+
+The snapshot lives in the settings shelf next to the user settings, so plug-in processes started by GIMP for
+menu registration or a procedure run can build their dialogs without talking to the backend.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+
+from collections.abc import Callable
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from sg_api import ApiClient
+    from sg_structures import MyShelf
+
+DEFAULT_OPTIONS_CACHE_TTL = 600
+DEFAULT_FETCH_DEADLINE = 30.0
+
+# Settings key holding the unix time of the last successful fetch
+OPTIONS_FETCHED_AT = "options_fetched_at"
+
+
+# Capability endpoints fetched on start-up, keyed by the name used in per-endpoint results
+CAPABILITY_ENDPOINTS: dict[str, str] = {
+    "options": "/sdapi/v1/options",
+    "sd_models": "/sdapi/v1/sd-models",
+    "cn_models": "/controlnet/model_list",
+    "sd_modules": "/sdapi/v1/sd-modules",
+    "samplers": "/sdapi/v1/samplers",
+    "schedulers": "/sdapi/v1/schedulers",
+    "upscalers": "/sdapi/v1/upscalers",
+    "scripts": "/sdapi/v1/scripts",
+    "script_info": "/sdapi/v1/script-info",
+}
+
+
+class EndpointResult:
+    """Outcome of a single capability request"""
+
+    def __init__(self, endpoint: str, data: Any = None, error: str | None = None, elapsed: float = 0.0) -> None:
+        self.endpoint = endpoint
+        self.data = data
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self) -> str:
+        status = "ok" if self.ok else self.error
+        return f"EndpointResult({self.endpoint}, {status}, {self.elapsed:.3f}s)"
+
+
+def fetch_endpoints(
+    api: ApiClient,
+    endpoints: dict[str, str],
+    deadline: float = DEFAULT_FETCH_DEADLINE,
+) -> dict[str, EndpointResult]:
+    """
+    GET all endpoints concurrently with one overall deadline.
+
+    Every endpoint gets its own daemon thread, so a hung endpoint neither delays the others nor keeps the
+    plug-in process alive on exit. Endpoints still running at the deadline are reported as timed out.
+
+    Returns:
+        Dictionary mapping endpoint names to their results
+    """
+    results: dict[str, EndpointResult] = {}
+    done = threading.Condition()
+    started = time.perf_counter()
+
+    def worker(name: str, endpoint: str) -> None:
+        start = time.perf_counter()
+        try:
+            result = EndpointResult(endpoint, data=api.get(endpoint, timeout=deadline, log_errors=False))
+        except Exception as ex:
+            result = EndpointResult(endpoint, error=f"{type(ex).__name__}: {ex}")
+        result.elapsed = time.perf_counter() - start
+        with done:
+            results[name] = result
+            done.notify()
+
+    for name, endpoint in endpoints.items():
+        threading.Thread(target=worker, args=(name, endpoint), name=f"fetch-{name}", daemon=True).start()
+
+    with done:
+        done.wait_for(lambda: len(results) == len(endpoints), timeout=deadline)
+        for name, endpoint in endpoints.items():
+            if name not in results:
+                results[name] = EndpointResult(endpoint, error="deadline exceeded", elapsed=deadline)
+        results = dict(results)
+
+    logging.debug(f"fetch_endpoints: {len(endpoints)} endpoints in {time.perf_counter() - started:.3f}s {results}")
+    return results
+
+
+def _parse_checkpoint(data: dict[str, Any]) -> dict[str, Any]:
+    return {"sd_model_checkpoint": data.get("sd_model_checkpoint")}
+
+
+def _parse_models(data: list[dict[str, Any]]) -> dict[str, Any]:
+    return {"models": [x["title"].removesuffix(f" [{x.get('hash')}]") for x in data or []]}
+
+
+def _parse_cn_models(data: dict[str, Any]) -> dict[str, Any]:
+    return {"cn_models": (data or {}).get("model_list", [])}
+
+
+def _parse_sd_modules(data: list[dict[str, Any]]) -> dict[str, Any]:
+    return {"sd_modules": [x["filename"] for x in data or []]}
+
+
+def _parse_names(key: str) -> Callable[[list[dict[str, Any]]], dict[str, Any]]:
+    return lambda data: {key: [x["name"] for x in data or []]}
+
+
+def _parse_scripts(data: dict[str, Any]) -> dict[str, Any]:
+    return {"scripts": {"txt2img": list(data["txt2img"]), "img2img": list(data["img2img"])}}
+
+
+def _parse_script_info(data: list[dict[str, Any]]) -> dict[str, Any]:
+    return {"script_names": sorted({x["name"] for x in data or [] if x.get("name")})}
+
+
+# Turn each endpoint response into shelf keys, raising on unexpected payloads
+CAPABILITY_PARSERS: dict[str, Callable[[Any], dict[str, Any]]] = {
+    "options": _parse_checkpoint,
+    "sd_models": _parse_models,
+    "cn_models": _parse_cn_models,
+    "sd_modules": _parse_sd_modules,
+    "samplers": _parse_names("samplers"),
+    "schedulers": _parse_names("schedulers"),
+    "upscalers": _parse_names("upscalers"),
+    "scripts": _parse_scripts,
+    "script_info": _parse_script_info,
+}
+
+
+def fetch_stablediffusion_options(api: ApiClient, deadline: float = DEFAULT_FETCH_DEADLINE) -> dict[str, Any]:
+    """
+    Get the StableDiffusion data needed for dynamic gimpfu.PF_OPTION lists.
+
+    Endpoints are fetched concurrently. Keys of failed endpoints are left out of the result, so saving it
+    into the shelf keeps the previously cached values for them; ``endpoint_status`` tells which ones failed.
+
+    Raises:
+        ConnectionError: if no endpoint answered at all
+    """
+    results = fetch_endpoints(api, CAPABILITY_ENDPOINTS, deadline=deadline)
+    if not any(result.ok for result in results.values()):
+        raise ConnectionError(f"Backend {api.base_url} is not reachable: {results['options'].error}")
+
+    options: dict[str, Any] = {"is_server_running": True}
+    for name, parse in CAPABILITY_PARSERS.items():
+        result = results[name]
+        if result.ok:
+            try:
+                if isinstance(result.data, dict) and ("detail" in result.data or "error" in result.data):
+                    raise ValueError(result.data.get("detail") or result.data.get("error"))
+                options.update(parse(result.data))
+            except Exception as ex:
+                result.error = f"unexpected response: {ex!r}"
+        if not result.ok:
+            logging.warning(f"{result.endpoint} is not available on SD instance: {result.error}")
+
+    options["has_sd_modules_support"] = results["sd_modules"].ok
+    options["endpoint_status"] = {name: "ok" if result.ok else result.error for name, result in results.items()}
+    return options
+
+
+class OptionsCache:
+    """Backend options snapshot stored in the shelf with a TTL
+
+    ``ensure`` never blocks when any snapshot exists and stale-while-revalidate is enabled: a stale snapshot
+    is served as is and refreshed in a background thread. Only the very first launch (no snapshot at all)
+    or a disabled stale-while-revalidate mode fetches synchronously.
+    """
+
+    _refresh_lock = threading.Lock()
+
+    def __init__(
+        self,
+        api: ApiClient,
+        settings: MyShelf,
+        ttl: float | None = None,
+        stale_while_revalidate: bool | None = None,
+    ) -> None:
+        self.api = api
+        self.settings = settings
+        self.ttl = float(ttl if ttl is not None else settings.get("options_cache_ttl", DEFAULT_OPTIONS_CACHE_TTL))
+        if stale_while_revalidate is None:
+            stale_while_revalidate = settings.get("options_stale_while_revalidate", True)
+        self.stale_while_revalidate = bool(stale_while_revalidate)
+
+    def age(self) -> float | None:
+        fetched_at = self.settings.get(OPTIONS_FETCHED_AT)
+        if fetched_at is None:
+            return None
+        return max(0.0, time.time() - float(fetched_at))
+
+    def has_snapshot(self) -> bool:
+        return self.settings.get(OPTIONS_FETCHED_AT) is not None or bool(self.settings.get("models"))
+
+    def is_fresh(self) -> bool:
+        age = self.age()
+        return age is not None and age < self.ttl
+
+    def invalidate(self) -> None:
+        """Mark the snapshot as stale, the next plug-in launch revalidates it"""
+        logging.debug("OptionsCache: invalidated")
+        self.settings.save({OPTIONS_FETCHED_AT: None})
+
+    def refresh(self) -> dict[str, Any]:
+        """Fetch options from the backend and store them with the current timestamp"""
+        with self._refresh_lock:
+            try:
+                options = fetch_stablediffusion_options(api=self.api)
+            except Exception:
+                logging.exception("ERROR: OptionsCache.refresh")
+                # keep the previous lists, they are still the best guess for building dialogs
+                self.settings.save({"is_server_running": False})
+                return {}
+            self.settings.save({**options, OPTIONS_FETCHED_AT: time.time()})
+            return options
+
+    def refresh_in_background(self) -> threading.Thread:
+        thread = threading.Thread(target=self.refresh, name="options-refresh", daemon=True)
+        thread.start()
+        return thread
+
+    def ensure(self) -> None:
+        if self.is_fresh():
+            logging.debug(f"OptionsCache: using fresh snapshot ({self.age():.0f}s old)")
+            return
+        if self.has_snapshot() and self.stale_while_revalidate:
+            logging.debug("OptionsCache: serving stale snapshot, revalidating in background")
+            self.refresh_in_background()
+            return
+        self.refresh()
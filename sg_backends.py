@@ -0,0 +1,314 @@
+"""
+Several backends behind one client.
+
+``BackendPool`` stands in for ApiClient when more than one backend is configured. Generation requests go to the
+least loaded backend that can run them: it answers ``/sdapi/v1/progress``, has the same checkpoint loaded as the
+primary backend (the ``api_base`` setting) and knows every ControlNet model the request uses. Everything else
+(capability lists, option changes) goes to the primary backend, so the dialogs describe the backend the pool is
+kept compatible with.
+
+Load is counted per backend: requests of this pool in flight, plus one if the backend is busy with somebody
+else's job. A backend is free again once the response headers arrive, the backend has finished generating by then.
+
+Kept free of GIMP imports.
+"""
+
+from __future__ import annotations
+
+import logging
+import re
+import threading
+import time
+
+from typing import Any
+
+import requests
+
+from sg_api import DEFAULT_TIMEOUT, ApiClient
+from sg_backend_options import fetch_endpoints
+from sg_retry import RetryPolicy
+from sg_stream import StreamedResponse
+
+GENERATION_ENDPOINTS = ("/sdapi/v1/txt2img", "/sdapi/v1/img2img")
+PROGRESS_ENDPOINT = "/sdapi/v1/progress"
+OPTIONS_ENDPOINT = "/sdapi/v1/options"
+CN_MODELS_ENDPOINT = "/controlnet/model_list"
+
+# Seconds a health / load reading is trusted
+HEALTH_TTL = 5.0
+# Seconds the checkpoint and ControlNet models of a backend are trusted
+CAPABILITY_TTL = 60.0
+# A backend that does not answer within this time is skipped until the next check
+HEALTH_TIMEOUT = 3.0
+
+
+def backend_urls(settings: Any) -> list[str]:
+    """The primary backend followed by the additional ones, without duplicates"""
+    urls = [settings.get("api_base") or ""]
+    urls.extend(re.split(r"[\s,;]+", settings.get("api_backends") or ""))
+    unique = []
+    for url in urls:
+        url = url.strip().strip("/")
+        if url and url not in unique:
+            unique.append(url)
+    return unique
+
+
+def controlnet_models(data: dict[str, Any] | None) -> set[str]:
+    """ControlNet models a request payload uses"""
+    scripts = (data or {}).get("alwayson_scripts") or {}
+    units = (scripts.get("controlnet") or {}).get("args") or []
+    return {unit["model"] for unit in units if isinstance(unit, dict) and unit.get("model") not in (None, "", "none")}
+
+
+class Backend:
+    """One backend of the pool with its health, load and what it can run"""
+
+    def __init__(self, client: ApiClient) -> None:
+        self.client = client
+        self.healthy = True
+        self.busy_elsewhere = False
+        self.in_flight = 0
+        self.requests = 0
+        self.checked = 0.0
+        self.checkpoint: str | None = None
+        self.controlnet_models: set[str] | None = None
+        self.capabilities_checked = 0.0
+        self._checking = threading.Lock()
+
+    def __repr__(self) -> str:
+        state = "up" if self.healthy else "down"
+        return f"Backend({self.client.base_url}, {state}, load {self.load}, {self.checkpoint})"
+
+    @property
+    def load(self) -> int:
+        return self.in_flight + (1 if self.busy_elsewhere and not self.in_flight else 0)
+
+    def check(self) -> None:
+        """Refresh health and load, and the checkpoint and ControlNet models once they are outdated"""
+        if not self._checking.acquire(blocking=False):
+            # requests starting together share one check
+            with self._checking:
+                return
+        try:
+            self._check()
+        finally:
+            self._checking.release()
+
+    def _check(self) -> None:
+        endpoints = {"progress": PROGRESS_ENDPOINT}
+        refresh_capabilities = time.monotonic() - self.capabilities_checked > CAPABILITY_TTL
+        if refresh_capabilities:
+            endpoints.update({"options": OPTIONS_ENDPOINT, "cn_models": CN_MODELS_ENDPOINT})
+        results = fetch_endpoints(self.client, endpoints, deadline=HEALTH_TIMEOUT)
+
+        progress = results["progress"]
+        self.healthy = progress.ok and isinstance(progress.data, dict)
+        if self.healthy:
+            state = progress.data.get("state") or {}
+            self.busy_elsewhere = bool(state.get("job") or progress.data.get("progress"))
+        if refresh_capabilities and results["options"].ok and isinstance(results["options"].data, dict):
+            self.checkpoint = results["options"].data.get("sd_model_checkpoint")
+            cn_models = results["cn_models"]
+            # no ControlNet extension: requests without ControlNet units still run
+            self.controlnet_models = set((cn_models.data or {}).get("model_list") or []) if cn_models.ok else set()
+            self.capabilities_checked = time.monotonic()
+        self.checked = time.monotonic()
+        logging.debug(f"Checked {self}")
+
+
+class BackendPool:
+    """
+    ApiClient stand-in spreading generation requests over several backends.
+
+    Args:
+        clients: one client per backend, the first one is the primary backend
+    """
+
+    def __init__(self, clients: list[ApiClient]) -> None:
+        if not clients:
+            raise ValueError("BackendPool needs at least one backend")
+        self.backends = [Backend(client) for client in clients]
+        self.primary = self.backends[0]
+        # backends with a request of this pool in flight, oldest first; progress is reported for the first one
+        self._running: list[Backend] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.backends)
+
+    # ApiClient attributes, describing the primary backend
+    @property
+    def base_url(self) -> str:
+        return self.primary.client.base_url
+
+    def setBaseUrl(self, base_url: str) -> None:
+        self.primary.client.setBaseUrl(base_url)
+        self.primary.capabilities_checked = 0.0
+
+    @property
+    def timeout(self) -> float:
+        return self.primary.client.timeout
+
+    @property
+    def pool_size(self) -> int:
+        return self.primary.client.pool_size
+
+    @property
+    def connect_timeout(self) -> float:
+        return self.primary.client.connect_timeout
+
+    @property
+    def retry(self) -> RetryPolicy:
+        return self.primary.client.retry
+
+    @property
+    def link(self) -> Any:
+        return self.primary.client.link
+
+    def getTimeout(self, endpoint: str, method: str = "GET", read_timeout: float | None = None) -> tuple[float, float]:
+        return self.primary.client.getTimeout(endpoint, method, read_timeout)
+
+    def refresh(self, force: bool = False) -> None:
+        """Check the backends whose last reading is outdated, all at once"""
+        now = time.monotonic()
+        stale = [backend for backend in self.backends if force or now - backend.checked > HEALTH_TTL]
+        threads = [threading.Thread(target=backend.check, daemon=True) for backend in stale]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(HEALTH_TIMEOUT + 1)
+
+    def compatible(self, backend: Backend, data: dict[str, Any] | None) -> bool:
+        """Whether ``backend`` produces the same images as the primary one for this request"""
+        if backend is self.primary:
+            return True
+        if self.primary.checkpoint is not None and backend.checkpoint != self.primary.checkpoint:
+            return False
+        return self.has_controlnet_models(backend, controlnet_models(data))
+
+    def has_controlnet_models(self, backend: Backend, models: set[str]) -> bool:
+        return backend is self.primary or (
+            backend.controlnet_models is not None and models <= backend.controlnet_models
+        )
+
+    def candidates(self, data: dict[str, Any] | None = None) -> list[Backend]:
+        """Healthy backends able to run the request, the primary one first"""
+        self.refresh()
+        return [backend for backend in self.backends if backend.healthy and self.compatible(backend, data)]
+
+    def acquire(self, data: dict[str, Any] | None = None) -> Backend:
+        candidates = self.candidates(data) or [self.primary]
+        with self._lock:
+            backend = min(candidates, key=lambda backend: backend.load)
+            backend.in_flight += 1
+            backend.requests += 1
+            self._running.append(backend)
+        logging.debug(f"Routing request to {backend}")
+        return backend
+
+    def release(self, backend: Backend) -> None:
+        with self._lock:
+            backend.in_flight -= 1
+            self._running.remove(backend)
+
+    def _route(self, endpoint: str, data: dict[str, Any] | None, request: Any) -> Any:
+        if endpoint not in GENERATION_ENDPOINTS:
+            if endpoint == OPTIONS_ENDPOINT:
+                # e.g. a checkpoint change, compatibility has to be checked again
+                self.primary.capabilities_checked = 0.0
+            return request(self.primary.client)
+        backend = self.acquire(data)
+        try:
+            return request(backend.client)
+        except requests.exceptions.ConnectionError:
+            backend.healthy = False
+            raise
+        finally:
+            self.release(backend)
+
+    def post(self, endpoint, data=None, params=None, headers=None, timeout=None):
+        return self._route(
+            endpoint,
+            data,
+            lambda client: client.post(endpoint, data=data, params=params, headers=headers, timeout=timeout),
+        )
+
+    def post_stream(
+        self,
+        endpoint: str,
+        data: dict[str, Any] | None = None,
+        params: dict[str, Any] | None = None,
+        headers: dict[str, str] | None = None,
+        timeout: float | None = None,
+    ) -> StreamedResponse | dict[str, Any]:
+        return self._route(
+            endpoint,
+            data,
+            lambda client: client.post_stream(endpoint, data=data, params=params, headers=headers, timeout=timeout),
+        )
+
+    def progress_client(self) -> ApiClient:
+        """Client of the backend running the oldest request in flight, the primary one if there is none"""
+        with self._lock:
+            return self._running[0].client if self._running else self.primary.client
+
+    def get(self, endpoint, params=None, headers=None, timeout=None, log_errors=True):
+        client = self.progress_client() if endpoint == PROGRESS_ENDPOINT else self.primary.client
+        return client.get(endpoint, params=params, headers=headers, timeout=timeout, log_errors=log_errors)
+
+    def interrupt(self, timeout: float | None = None) -> None:
+        """Interrupt every backend running a request of this pool"""
+        with self._lock:
+            busy = list(dict.fromkeys(self._running)) or [self.primary]
+        for backend in busy:
+            backend.client.interrupt(timeout=timeout)
+
+    def skip(self, timeout: float | None = None) -> None:
+        """Skip the image shown in the progress, the one of the oldest request in flight"""
+        self.progress_client().skip(timeout=timeout)
+
+    def abort(self) -> None:
+        for backend in self.backends:
+            backend.client.abort()
+
+    def close(self) -> None:
+        for backend in self.backends:
+            backend.client.close()
+
+    def stats(self) -> list[dict[str, Any]]:
+        return [
+            {
+                "base_url": backend.client.base_url,
+                "healthy": backend.healthy,
+                "load": backend.load,
+                "requests": backend.requests,
+                "checkpoint": backend.checkpoint,
+            }
+            for backend in self.backends
+        ]
+
+    @classmethod
+    def fromUrls(
+        cls,
+        urls: list[str],
+        timeout: float = DEFAULT_TIMEOUT,
+        pool_size: int | None = None,
+        connect_timeout: float | None = None,
+        retry: RetryPolicy | None = None,
+    ) -> BackendPool:
+        return cls(
+            [
+                ApiClient(url, timeout=timeout, pool_size=pool_size, connect_timeout=connect_timeout, retry=retry)
+                for url in urls
+            ],
+        )
+
+    @classmethod
+    def fromSettings(cls, settings: Any) -> BackendPool:
+        return cls.fromUrls(
+            backend_urls(settings),
+            pool_size=settings.get("http_pool_size"),
+            connect_timeout=settings.get("http_connect_timeout"),
+            retry=RetryPolicy.fromSettings(settings),
+        )
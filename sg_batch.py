@@ -0,0 +1,243 @@
+"""
+Splitting large batches into chunks.
+
+A requested number of images is generated as a series of requests of ``batch_size`` x ``n_iter`` images each.
+``batch_size`` (images denoised in parallel) is bounded by the pixels the backend is allowed to hold at once, so
+large images don't run out of VRAM; the images per request follow the measured throughput of the backend, so each
+chunk takes about ``chunk_seconds`` and its layers are inserted while the next one is generated.
+
+Seeds stay contiguous: the backend gives the images of a request the seeds ``seed, seed + 1, ...``, each chunk
+starts where the previous one ended, and a random seed is drawn once for the whole batch. Every image gets the seed
+it would have had in a single request of the whole batch.
+
+Kept free of GIMP imports.
+"""
+
+from __future__ import annotations
+
+import logging
+import random
+import threading
+
+from typing import Any
+
+from sg_constants import MAX_BATCH_SIZE
+
+DEFAULT_CHUNK_SECONDS = 15.0
+# Pixels denoised in parallel by one request, 4 x 1024² by default
+DEFAULT_BATCH_MAX_MEGAPIXELS = 4.2
+# Starting estimate of the generation time until measurements arrive
+DEFAULT_SECONDS_PER_MEGAPIXEL_STEP = 0.1
+
+# Highest seed the backend accepts
+MAX_SEED = 4294967294
+# Weight of a new measurement in the moving average
+EMA_WEIGHT = 0.3
+# Chunks of a multi-layer run in flight per backend: one generating, the next one encoding and uploading
+LAYER_CHUNKS_IN_FLIGHT_PER_BACKEND = 2
+
+
+class BatchChunk:
+    """One request of a chunked batch: ``batch_size`` x ``n_iter`` images starting at ``seed``"""
+
+    def __init__(self, index: int, seed: int, batch_size: int, n_iter: int) -> None:
+        self.index = index
+        self.seed = seed
+        self.batch_size = batch_size
+        self.n_iter = n_iter
+
+    def __repr__(self) -> str:
+        return f"BatchChunk({self.index}, seed {self.seed}, {self.batch_size}x{self.n_iter})"
+
+    @property
+    def count(self) -> int:
+        return self.batch_size * self.n_iter
+
+    def apply(self, data: dict[str, Any]) -> dict[str, Any]:
+        """Request payload of this chunk, ``data`` itself is left unchanged"""
+        return {**data, "seed": self.seed, "batch_size": self.batch_size, "n_iter": self.n_iter}
+
+
+class LayerChunk(BatchChunk):
+    """
+    Chunk of a multi-layer run, sending the init images of ``sources`` (indexes of the layers).
+
+    With one source every image of the chunk is generated from it; with several, ``batch_size`` equals their number
+    and the backend pairs the n-th init image with the n-th image of the batch.
+    """
+
+    def __init__(self, index: int, seed: int, batch_size: int, n_iter: int, sources: list[int]) -> None:
+        super().__init__(index, seed, batch_size, n_iter)
+        self.sources = sources
+
+    def __repr__(self) -> str:
+        return f"LayerChunk({self.index}, seed {self.seed}, {self.batch_size}x{self.n_iter}, layers {self.sources})"
+
+    def targets(self) -> list[int]:
+        """Source of every generated image, in the order of the response"""
+        if len(self.sources) == 1:
+            return self.sources * self.count
+        return list(self.sources)
+
+
+class BatchPlanner:
+    """
+    Plans the chunks of a batch and learns the backend throughput from finished chunks.
+
+    Args:
+        chunk_seconds: target duration of one chunk, 0 sends the whole batch as one chunk
+        max_batch_megapixels: pixels the backend may denoise in parallel
+        seconds_per_megapixel_step: generation time estimate, updated by ``record``
+    """
+
+    def __init__(
+        self,
+        chunk_seconds: float = DEFAULT_CHUNK_SECONDS,
+        max_batch_megapixels: float = DEFAULT_BATCH_MAX_MEGAPIXELS,
+        seconds_per_megapixel_step: float = DEFAULT_SECONDS_PER_MEGAPIXEL_STEP,
+    ) -> None:
+        self.chunk_seconds = chunk_seconds
+        self.max_batch_megapixels = max_batch_megapixels
+        self.seconds_per_megapixel_step = seconds_per_megapixel_step
+        self._lock = threading.Lock()
+
+    @classmethod
+    def fromSettings(cls, settings: Any) -> BatchPlanner:
+        chunk_seconds = settings.get("batch_chunk_seconds")
+        return cls(
+            chunk_seconds=DEFAULT_CHUNK_SECONDS if chunk_seconds is None else float(chunk_seconds),
+            max_batch_megapixels=float(settings.get("batch_max_megapixels") or DEFAULT_BATCH_MAX_MEGAPIXELS),
+            seconds_per_megapixel_step=float(
+                settings.get("batch_seconds_per_megapixel_step") or DEFAULT_SECONDS_PER_MEGAPIXEL_STEP,
+            ),
+        )
+
+    def export_stats(self) -> dict[str, Any]:
+        """Measurements to persist in settings, so the next plug-in process starts from them"""
+        with self._lock:
+            return {"batch_seconds_per_megapixel_step": self.seconds_per_megapixel_step}
+
+    def batch_size(self, width: int, height: int) -> int:
+        """Images denoised in parallel, as many as fit into ``max_batch_megapixels``"""
+        return max(1, min(MAX_BATCH_SIZE, int(self.max_batch_megapixels * 1e6 // max(1, width * height))))
+
+    def estimate_seconds(self, count: int, width: int, height: int, steps: int) -> float:
+        return self.seconds_per_megapixel_step * count * width * height / 1e6 * max(1, steps)
+
+    def chunk_size(self, width: int, height: int, steps: int) -> int:
+        """Images per chunk, as many as the backend generates in ``chunk_seconds``; 0 if chunking is off"""
+        if self.chunk_seconds <= 0:
+            return 0
+        return max(1, int(self.chunk_seconds / max(self.estimate_seconds(1, width, height, steps), 1e-6) + 1e-6))
+
+    def plan(
+        self,
+        count: int,
+        seed: int,
+        width: int,
+        height: int,
+        steps: int,
+        min_chunks: int = 1,
+    ) -> list[BatchChunk]:
+        """
+        Chunks generating ``count`` images with seeds ``seed .. seed + count - 1``.
+
+        Args:
+            seed: first seed, -1 (or any negative value) draws a random one
+            min_chunks: split into at least this many chunks if there are enough images, e.g. one per backend
+
+        Returns:
+            The chunks in generation order, their counts add up to ``count``
+        """
+        count = max(1, int(count))
+        if seed is None or seed < 0:
+            seed = random.randrange(MAX_SEED - count)
+        chunk_count = -(-count // (self.chunk_size(width, height, steps) or count))
+        # a multiple of ``min_chunks``, so backends working side by side finish together, but no empty chunks
+        min_chunks = max(1, min(min_chunks, count))
+        chunk_count = min(count, -(-chunk_count // min_chunks) * min_chunks)
+        chunk_size = -(-count // chunk_count)
+        batch_size = min(chunk_size, self.batch_size(width, height))
+
+        chunks: list[BatchChunk] = []
+        offset = 0
+        if chunk_size <= batch_size:
+            # one batch per chunk: spread the images evenly, sizes differ by one at most
+            for index in range(chunk_count):
+                size = count // chunk_count + (1 if index < count % chunk_count else 0)
+                chunks.append(BatchChunk(index, seed + offset, size, 1))
+                offset += size
+        while offset < count:
+            size = min(chunk_size, count - offset)
+            if size >= batch_size:
+                chunk = BatchChunk(len(chunks), seed + offset, batch_size, size // batch_size)
+            else:
+                # the remainder of the last chunk
+                chunk = BatchChunk(len(chunks), seed + offset, size, 1)
+            chunks.append(chunk)
+            offset += chunk.count
+
+        logging.info(f"Batch of {count} images at {width}x{height} in {len(chunks)} chunks: {chunks}")
+        return chunks
+
+    def plan_layers(
+        self,
+        sizes: list[tuple[int, int]],
+        images_per_layer: int,
+        seed: int,
+        width: int,
+        height: int,
+        steps: int,
+        min_chunks: int = 1,
+    ) -> list[LayerChunk]:
+        """
+        Chunks generating ``images_per_layer`` images from each of several init images, e.g. the selected layers.
+
+        With one image per layer, init images of the same size share chunks of up to ``batch_size`` of them, each
+        chunk one batch; otherwise every layer gets the chunks ``plan`` makes for its images. Seeds continue from
+        chunk to chunk over all layers, as in one batch of all images.
+
+        Args:
+            sizes: (width, height) of each init image, chunks refer to them by index
+            seed: first seed, -1 (or any negative value) draws a random one
+            min_chunks: see ``plan``
+
+        Returns:
+            The chunks in generation order
+        """
+        images_per_layer = max(1, int(images_per_layer))
+        count = len(sizes) * images_per_layer
+        if seed is None or seed < 0:
+            seed = random.randrange(MAX_SEED - count)
+
+        chunks: list[LayerChunk] = []
+        if images_per_layer > 1:
+            for source in range(len(sizes)):
+                first_seed = seed + source * images_per_layer
+                for chunk in self.plan(images_per_layer, first_seed, width, height, steps, min_chunks):
+                    chunks.append(LayerChunk(len(chunks), chunk.seed, chunk.batch_size, chunk.n_iter, [source]))
+            return chunks
+
+        groups: dict[tuple[int, int], list[int]] = {}
+        for source, size in enumerate(sizes):
+            groups.setdefault(tuple(size), []).append(source)
+        limit = min(self.batch_size(width, height), self.chunk_size(width, height, steps) or MAX_BATCH_SIZE)
+        offset = 0
+        for sources in groups.values():
+            parts = max(-(-len(sources) // limit), min(min_chunks, len(sources)))
+            for part in range(parts):
+                part_sources = sources[part * len(sources) // parts : (part + 1) * len(sources) // parts]
+                chunks.append(LayerChunk(len(chunks), seed + offset, len(part_sources), 1, part_sources))
+                offset += len(part_sources)
+
+        logging.info(f"{len(sizes)} layers in {len(groups)} sizes, {len(chunks)} chunks: {chunks}")
+        return chunks
+
+    def record(self, count: int, width: int, height: int, steps: int, seconds: float) -> None:
+        """Feed the wall time of a finished chunk into the throughput estimate"""
+        work = count * width * height / 1e6 * max(1, steps)
+        if work <= 0 or seconds <= 0:
+            return
+        with self._lock:
+            self.seconds_per_megapixel_step += EMA_WEIGHT * (seconds / work - self.seconds_per_megapixel_step)
+        logging.debug(f"Chunk of {count} images in {seconds:.2f}s, {self.seconds_per_megapixel_step:.4f} s/MP/step")
@@ -0,0 +1,107 @@
+"""
+In-process caches shared by the plug-in code.
+"""
+
+from __future__ import annotations
+
+import threading
+
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from typing import Any
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache bounded by entry count and by total size in bytes.
+
+    The size of a value is measured with ``sizeof`` (``len`` by default, i.e. bytes for ``bytes`` values).
+    A value larger than the whole byte budget is not stored at all.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int | None = None,
+        max_entries: int | None = None,
+        sizeof: Callable[[Any], int] = len,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.sizeof = sizeof
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def record_miss(self) -> None:
+        """Count a miss decided outside of ``get``, e.g. by a cheaper pre-check"""
+        with self._lock:
+            self.misses += 1
+
+    def put(self, key: Hashable, value: Any) -> bool:
+        """Store the value as most recently used, returns False if it does not fit into the budget"""
+        size = self.sizeof(value)
+        with self._lock:
+            self.pop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return False
+            self._data[key] = (value, size)
+            self.current_bytes += size
+            self._evict()
+            return True
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return default
+            self.current_bytes -= item[1]
+            return item[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.current_bytes = 0
+
+    def resize(self, max_bytes: int | None = None, max_entries: int | None = None) -> None:
+        with self._lock:
+            self.max_bytes = max_bytes
+            self.max_entries = max_entries
+            self._evict()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "bytes": self.current_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _evict(self) -> None:
+        while self._data and (
+            (self.max_entries is not None and len(self._data) > self.max_entries)
+            or (self.max_bytes is not None and self.current_bytes > self.max_bytes)
+        ):
+            _, (_, size) = self._data.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
@@ -4,7 +4,17 @@
 
 AUTHOR = "SHSMAD"
 
+# Settings of the plug-in, next to its modules; read by the headless runner too
+SETTINGS_FILE = "stable_gimpfusion.json"
+
+# Images generated in parallel by one request
 MAX_BATCH_SIZE = 20
+# Images one plug-in run may ask for, generated in chunks (sg_batch)
+MAX_BATCH_IMAGES = 200
+
+# Default limits of the in-process cache of encoded layers
+TOBASE64_CACHE_MAX_MB = 256
+TOBASE64_CACHE_MAX_ENTRIES = 32
 
 STABLE_GIMPFUSION_DEFAULT_SETTINGS = {
     "sampler_name": "Euler a",
@@ -19,11 +29,43 @@ STABLE_GIMPFUSION_DEFAULT_SETTINGS = {
     "mask_blur": 4,
     "seed": -1,
     "api_base": "http://127.0.0.1:7860",
+    "api_backends": "",
     "model": "",
     "models": [],
     "cn_models": [],
     "sd_model_checkpoint": None,
+    "forge_additional_modules": None,
     "is_server_running": False,
+    "http_pool_size": 10,
+    "http_connect_timeout": 5.0,
+    "http_retries": 2,
+    "http_retry_backoff": 0.5,
+    "breaker_threshold": 5,
+    "breaker_reset": 30.0,
+    "options_cache_ttl": 600,
+    "options_stale_while_revalidate": True,
+    "tobase64_cache_max_mb": 256,
+    "tobase64_cache_max_entries": 32,
+    "png_compress_level": 6,
+    "png_filter": "up",
+    "png_strategy": "default",
+    "payload_format": "png",
+    "jpeg_quality": 95,
+    "link_mbps": 100,
+    "progress_min_interval": 0.25,
+    "progress_max_interval": 2.0,
+    "progress_previews": False,
+    "preview_interval": 1.0,
+    "preview_max_kbps": 4000,
+    "preview_max_size": 512,
+    "worker_enabled": False,
+    "worker_idle_timeout": 1800,
+    "queue_concurrency": 1,
+    "queue_affinity_max_skips": 4,
+    "batch_chunk_seconds": 15.0,
+    "batch_max_megapixels": 4.2,
+    "response_cache_enabled": False,
+    "response_cache_max_mb": 1024,
 }
 
 RESIZE_MODES = [
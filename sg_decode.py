@@ -0,0 +1,135 @@
+"""
+Decoding of images returned by the backend into packed 8-bit pixel buffers.
+
+Runs off the main thread: Pillow and GdkPixbuf both release the GIL while decoding, so a batch of images is
+decoded in parallel and only the GIMP layer creation is left to the main thread. Without either library images
+are loaded through GIMP instead.
+"""
+
+from __future__ import annotations
+
+import io
+import logging
+import os
+
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+from sg_payload import gdk_pixbuf
+
+try:
+    from PIL import Image as PILImage
+except ImportError:  # pragma: no cover - Pillow is usually not part of GIMP's Python
+    PILImage = None
+
+DEFAULT_DECODE_WORKERS = min(4, os.cpu_count() or 1)
+
+# channels -> GEGL format of the packed pixels
+GEGL_FORMATS = {3: "R'G'B' u8", 4: "R'G'B'A u8"}
+
+
+class DecodedImage:
+    """Packed 8-bit RGB(A) pixels"""
+
+    def __init__(self, pixels: bytes, width: int, height: int, channels: int) -> None:
+        self.pixels = pixels
+        self.width = width
+        self.height = height
+        self.channels = channels
+
+    def __repr__(self) -> str:
+        return f"DecodedImage({self.width}x{self.height}x{self.channels})"
+
+    @property
+    def gegl_format(self) -> str:
+        return GEGL_FORMATS[self.channels]
+
+
+def has_decoder() -> bool:
+    return PILImage is not None or gdk_pixbuf() is not None
+
+
+def decode_image(data: bytes, max_side: int | None = None) -> DecodedImage:
+    """
+    Decode PNG, JPEG or WebP data.
+
+    Args:
+        data: encoded image
+        max_side: downscale (keeping the aspect ratio) so that neither side exceeds it, e.g. for previews
+
+    Raises:
+        RuntimeError: no decoder library is available
+    """
+    if PILImage is not None:
+        return _decode_pil(data, max_side)
+    if gdk_pixbuf() is not None:
+        return _decode_gdk_pixbuf(data, max_side)
+    raise RuntimeError("Neither Pillow nor GdkPixbuf is available to decode images")
+
+
+def _decode_pil(data: bytes, max_side: int | None = None) -> DecodedImage:
+    with PILImage.open(io.BytesIO(data)) as image:
+        mode = "RGBA" if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info else "RGB"
+        if image.mode != mode:
+            image = image.convert(mode)
+        if max_side and max(image.size) > max_side:
+            image.thumbnail((max_side, max_side), PILImage.Resampling.BILINEAR)
+        return DecodedImage(image.tobytes(), image.width, image.height, len(mode))
+
+
+def _decode_gdk_pixbuf(data: bytes, max_side: int | None = None) -> DecodedImage:
+    GdkPixbuf, GLib = gdk_pixbuf()
+    loader = GdkPixbuf.PixbufLoader()
+    loader.write_bytes(GLib.Bytes.new(data))
+    loader.close()
+    pixbuf = loader.get_pixbuf()
+    if max_side and max(pixbuf.get_width(), pixbuf.get_height()) > max_side:
+        scale = max_side / max(pixbuf.get_width(), pixbuf.get_height())
+        pixbuf = pixbuf.scale_simple(
+            max(1, round(pixbuf.get_width() * scale)),
+            max(1, round(pixbuf.get_height() * scale)),
+            GdkPixbuf.InterpType.BILINEAR,
+        )
+    width, height, channels = pixbuf.get_width(), pixbuf.get_height(), pixbuf.get_n_channels()
+    rowstride = pixbuf.get_rowstride()
+    pixels = pixbuf.read_pixel_bytes().get_data()
+    stride = width * channels
+    if rowstride != stride:
+        # rows are padded, the last one is not
+        view = memoryview(pixels)
+        pixels = b"".join(view[y * rowstride : y * rowstride + stride] for y in range(height))
+    return DecodedImage(bytes(pixels), width, height, channels)
+
+
+def decode_in_order(
+    images: Iterable[bytes],
+    workers: int = DEFAULT_DECODE_WORKERS,
+    decoder: Callable[[bytes], Any] = decode_image,
+) -> Iterator[tuple[bytes, Any | None]]:
+    """
+    Decode images in a thread pool while more of them are still being read, keeping the input order.
+
+    At most ``2 * workers`` images are in flight, so memory stays bounded however long the input is.
+
+    Yields:
+        ``(data, decoded)`` per input image; ``decoded`` is None when decoding failed
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="sg-decode") as pool:
+        pending: deque[tuple[bytes, Future]] = deque()
+        for data in images:
+            pending.append((data, pool.submit(decoder, data)))
+            # hand over everything already decoded, and wait for the oldest one once enough are in flight
+            while pending and (pending[0][1].done() or len(pending) > 2 * workers):
+                yield _result(*pending.popleft())
+        while pending:
+            yield _result(*pending.popleft())
+
+
+def _result(data: bytes, future: Future) -> tuple[bytes, Any | None]:
+    try:
+        return data, future.result()
+    except Exception as e:
+        logging.warning(f"Decoding a response image failed: {e}")
+        return data, None
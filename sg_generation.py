@@ -0,0 +1,127 @@
+"""
+Request payloads and response metadata of the generation procedures.
+
+Shared by the plug-ins (sg_plugins/generation_base.py) and the headless runner (sg_headless.py), so a request
+built from a dialog and one built from a manifest line are the same.
+
+Kept free of GIMP imports.
+"""
+
+from __future__ import annotations
+
+import json
+
+from typing import Any
+
+from sg_constants import CONTROLNET_DEFAULT_SETTINGS, MAX_BATCH_IMAGES, SAMPLERS
+from sg_payload import EncodedImage
+
+
+def _round_to(value: float, multiple: int) -> int:
+    return multiple * round(float(value) / multiple)
+
+
+def available_samplers(settings: Any) -> list[str]:
+    """Samplers reported by the backend, falling back to the built-in list"""
+    return settings.get("samplers") or SAMPLERS
+
+
+def build_base_data_dict(
+    settings: Any,
+    prompt: str,
+    negative_prompt: str,
+    seed: int,
+    batch_size: int,
+    steps: int,
+    cfg_scale: float,
+    width: int,
+    height: int,
+    restore_faces: bool,
+    tiling: bool,
+    denoising_strength: float,
+    sampler_index: str,
+) -> dict[str, Any]:
+    """
+    Build base data dictionary with common parameters.
+
+    The prompts from settings are appended to the given ones, the size is rounded to multiples of 8.
+
+    Returns:
+        Dictionary with common API parameters
+    """
+    samplers = available_samplers(settings)
+    return {
+        "prompt": f"{prompt} {settings.get('prompt')}".strip(),
+        "negative_prompt": f"{negative_prompt} {settings.get('negative_prompt')}".strip(),
+        "seed": seed or -1,
+        # images in total, split into requests by generate()
+        "batch_size": min(MAX_BATCH_IMAGES, max(1, batch_size)),
+        "steps": int(steps),
+        "cfg_scale": float(cfg_scale),
+        "width": _round_to(width, 8),
+        "height": _round_to(height, 8),
+        "restore_faces": restore_faces,
+        "tiling": tiling,
+        "denoising_strength": float(denoising_strength),
+        "sampler_index": sampler_index if sampler_index in samplers else samplers[0],
+    }
+
+
+def controlnet_unit(
+    options: dict[str, Any],
+    input_image: EncodedImage,
+    mask: EncodedImage | None = None,
+) -> dict[str, Any]:
+    """
+    ControlNet unit of a request.
+
+    Args:
+        options: module, model, weight etc., the defaults fill in the rest
+        input_image: the control image, sized to multiples of 64
+        mask: optional mask of the control image
+    """
+    unit = {**CONTROLNET_DEFAULT_SETTINGS, **options, "input_image": input_image}
+    if mask is not None:
+        unit["mask"] = mask
+    return unit
+
+
+def add_controlnet_units(data: dict[str, Any], controlnet_units: list[dict[str, Any]]) -> None:
+    """
+    Add ControlNet units to data dictionary.
+
+    Args:
+        data: Data dictionary to modify
+        controlnet_units: List of ControlNet unit dictionaries
+    """
+    if controlnet_units:
+        data["alwayson_scripts"] = {
+            "controlnet": {
+                "args": controlnet_units,
+            },
+        }
+
+
+class ResponseInfo:
+    """
+    The ``info`` member of a generation response.
+
+    Images beyond ``len()`` are ControlNet annotator images, they have no seed of their own.
+    """
+
+    def __init__(self, info: dict[str, Any]) -> None:
+        self.infotexts = info["infotexts"]
+        self.seeds = info["all_seeds"]
+        self.width = info["width"]
+        self.height = info["height"]
+
+    @classmethod
+    def parse(cls, text: str) -> ResponseInfo:
+        return cls(json.loads(text))
+
+    def __len__(self) -> int:
+        return len(self.seeds)
+
+    def image_data(self, index: int) -> dict[str, Any]:
+        """What is stored with a generated image: its infotext and seed"""
+        return {"info": self.infotexts[index], "seed": self.seeds[index]}
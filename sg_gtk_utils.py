@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+from typing import TYPE_CHECKING, Any
+
 import gi
 
 gi.require_version("GimpUi", "3.0")
@@ -8,6 +10,9 @@ from gi.repository import Gimp, GimpUi, Gio, GLib, Gtk
 
 from sg_i18n import _
 
+if TYPE_CHECKING:
+    from sg_progress import CancelToken
+
 
 def set_visibility_of(elements: list[Gtk.Widget], visible: bool = True) -> None:
     for element in elements:
@@ -114,3 +119,40 @@ class MemFile:
         Retrieve the entire contents of the stream.
         """
         return self.stream.steal_as_bytes().get_data()
+
+
+class GenerationControls:
+    """Small non-modal window with Skip / Cancel buttons for a running generation"""
+
+    RESPONSE_SKIP = 1
+
+    def __init__(self, token: CancelToken, title: str = "") -> None:
+        self.token = token
+        self.dialog = Gtk.Dialog(title=title or _("Generating"))
+        self.dialog.add_button(_("Skip image"), self.RESPONSE_SKIP)
+        self.dialog.add_button(_("Cancel"), Gtk.ResponseType.CANCEL)
+        self.dialog.set_keep_above(True)
+        self.dialog.connect("response", self._on_response)
+        self.dialog.connect("delete-event", self._on_delete)
+        self.dialog.show_all()
+
+    def _on_response(self, dialog: Gtk.Dialog, response_id: int) -> None:
+        if response_id == self.RESPONSE_SKIP:
+            self.token.skip()
+        elif response_id == Gtk.ResponseType.CANCEL:
+            self.token.cancel()
+            dialog.set_response_sensitive(self.RESPONSE_SKIP, False)
+            dialog.set_response_sensitive(Gtk.ResponseType.CANCEL, False)
+
+    def _on_delete(self, dialog: Gtk.Dialog, event: Any) -> bool:
+        self.token.cancel()
+        return True
+
+    def pump(self) -> None:
+        """Process pending UI events, the main loop is not running while the plug-in waits for the backend"""
+        while Gtk.events_pending():
+            Gtk.main_iteration_do(False)
+
+    def destroy(self) -> None:
+        self.dialog.destroy()
+        self.pump()
@@ -0,0 +1,530 @@
+"""
+Headless batch runs of txt2img and img2img, without GIMP.
+
+Jobs come from a directory of images (img2img, one job per image) or a JSON Lines manifest. They are streamed
+through a bounded pool of workers to the configured backend(s), and every generated image is written with a JSON
+sidecar holding its seed, infotext and request. Requests are built the way the plug-in builds them (sg_generation)
+from the plug-in settings, overridden by the command line and then by each manifest line; large batches are split
+into chunks like in the plug-in (sg_batch).
+
+A job is appended to ``checkpoint.jsonl`` in the output directory once all its files are in place, and a rerun
+skips the jobs listed there, so an interrupted run continues where it stopped. Failed jobs are appended to
+``failed.jsonl`` and run again by the next run.
+
+Kept free of GIMP imports:
+
+    python sg_headless.py INPUT_DIR OUT_DIR --prompt "oil painting" --denoising-strength 0.5
+    python sg_headless.py jobs.jsonl OUT_DIR --workers 4
+
+A manifest line is an object with an optional ``id`` (the line number by default), ``mode`` (txt2img, or img2img
+if it has an ``init_image``), image paths relative to the manifest and any payload fields:
+
+    {"id": "cat-1", "prompt": "a cat", "seed": 42, "width": 768, "height": 512}
+    {"init_image": "in/dog.png", "prompt": "a dog", "controlnet": [{"image": "in/dog-depth.png", "model": "..."}]}
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any
+
+from sg_backends import backend_urls
+from sg_batch import BatchPlanner
+from sg_constants import SETTINGS_FILE, STABLE_GIMPFUSION_DEFAULT_SETTINGS
+from sg_decode import decode_image
+from sg_generation import ResponseInfo, build_base_data_dict, controlnet_unit
+from sg_payload import EncodedImage
+from sg_stream import StreamedResponse
+from sg_worker import connect_api
+
+MODES = ("txt2img", "img2img")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+CHECKPOINT_FILE = "checkpoint.jsonl"
+FAILED_FILE = "failed.jsonl"
+DEFAULT_REPORT_SECONDS = 30.0
+# Workers per backend: one request generating, the next one uploading or its images being written
+WORKERS_PER_BACKEND = 2
+# Jobs submitted ahead per worker, enough to keep the workers busy without reading the whole manifest
+QUEUED_PER_WORKER = 2
+# Window of the sustained throughput
+RATE_WINDOW_SECONDS = 300.0
+
+# Payload fields build_base_data_dict takes, every other manifest field goes into the payload as it is
+BASE_FIELDS = (
+    "prompt",
+    "negative_prompt",
+    "seed",
+    "batch_size",
+    "steps",
+    "cfg_scale",
+    "width",
+    "height",
+    "restore_faces",
+    "tiling",
+    "denoising_strength",
+    "sampler_index",
+)
+
+_MAGIC = ((b"\x89PNG\r\n\x1a\n", "png"), (b"\xff\xd8\xff", "jpeg"), (b"RIFF", "webp"))
+_EXTENSIONS = {"png": "png", "jpeg": "jpg", "webp": "webp"}
+
+
+def default_settings_path() -> str:
+    return os.path.join(os.path.dirname(os.path.realpath(__file__)), SETTINGS_FILE)
+
+
+def image_format(data: bytes) -> str | None:
+    """png, jpeg or webp from the signature of encoded image data, None for anything else"""
+    for magic, name in _MAGIC:
+        if data.startswith(magic) and (name != "webp" or data[8:12] == b"WEBP"):
+            return name
+    return None
+
+
+def load_image(path: str) -> EncodedImage:
+    """An image file as it is, for a request payload; the backend decodes it"""
+    with open(path, "rb") as f:
+        data = f.read()
+    name = image_format(data)
+    if name is None:
+        raise ValueError(f"{path} is not a PNG, JPEG or WebP image")
+    if name == "png":
+        width, height = struct.unpack(">II", data[16:24])
+    else:
+        decoded = decode_image(data)
+        width, height = decoded.width, decoded.height
+    return EncodedImage(data, name, width, height)
+
+
+class HeadlessSettings:
+    """The plug-in settings from its JSON file, what a run measures (e.g. throughput) stays in memory"""
+
+    def __init__(self, path: str | None = None, overrides: dict[str, Any] | None = None) -> None:
+        self.data = dict(STABLE_GIMPFUSION_DEFAULT_SETTINGS)
+        path = path or default_settings_path()
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.data.update(json.load(f))
+        self.data.update(overrides or {})
+
+    def get(self, name: str, default_value: Any = None) -> Any:
+        return self.data.get(name, default_value)
+
+    def save(self, data: dict[str, Any] | None = None) -> None:
+        self.data.update(data or {})
+
+
+class HeadlessJob:
+    """
+    One input image or manifest line.
+
+    Args:
+        job_id: names the output files, may contain directories
+        fields: payload fields of the job, over the defaults of the run
+        init_image: path of the init image, img2img only
+        controlnet: ControlNet units, options plus ``image`` and optional ``mask`` paths
+    """
+
+    def __init__(
+        self,
+        job_id: str,
+        mode: str,
+        fields: dict[str, Any],
+        init_image: str | None = None,
+        controlnet: list[dict[str, Any]] | None = None,
+    ) -> None:
+        if mode not in MODES:
+            raise ValueError(f"Job {job_id}: unknown mode {mode!r}, expected one of {', '.join(MODES)}")
+        self.job_id = job_id
+        self.mode = mode
+        self.fields = fields
+        self.init_image = init_image
+        self.controlnet = controlnet or []
+
+    def __repr__(self) -> str:
+        return f"HeadlessJob({self.job_id}, {self.mode})"
+
+
+def read_jobs(source: str, mode: str | None = None) -> Iterator[HeadlessJob]:
+    """Jobs of a directory of images (img2img by default) or of a manifest, read as they are consumed"""
+    if os.path.isdir(source):
+        for root, dirs, names in os.walk(source):
+            dirs.sort()
+            for name in sorted(names):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    path = os.path.join(root, name)
+                    job_id = os.path.splitext(os.path.relpath(path, source))[0]
+                    yield HeadlessJob(job_id, mode or "img2img", {}, path)
+        return
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+
+    def resolve(path: str | None) -> str | None:
+        return os.path.join(base_dir, path) if path else None
+
+    with open(source) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = json.loads(line)
+            init_image = resolve(fields.pop("init_image", None))
+            controlnet = [
+                {**unit, "image": resolve(unit["image"]), "mask": resolve(unit.get("mask"))}
+                for unit in fields.pop("controlnet", None) or []
+            ]
+            job_mode = fields.pop("mode", None) or mode or ("img2img" if init_image else "txt2img")
+            yield HeadlessJob(str(fields.pop("id", number)), job_mode, fields, init_image, controlnet)
+
+
+class Checkpoint:
+    """Ids of finished jobs, appended one JSON line each and synced to disk as jobs finish"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.done: set[str] = set()
+        self._lock = threading.Lock()
+        torn = False
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    torn = not line.endswith("\n")
+                    try:
+                        self.done.add(json.loads(line)["id"])
+                    except (ValueError, KeyError):
+                        # the last line of a run killed while writing it, that job runs again
+                        continue
+        self._file = open(path, "a")  # noqa: SIM115 kept open for the whole run
+        if torn:
+            self._file.write("\n")
+
+    def __contains__(self, job_id: str) -> bool:
+        return job_id in self.done
+
+    def __len__(self) -> int:
+        return len(self.done)
+
+    def add(self, job_id: str, images: int) -> None:
+        with self._lock:
+            self._file.write(json.dumps({"id": job_id, "images": images, "time": time.time()}) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.done.add(job_id)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class Throughput:
+    """Images per minute since the start, and sustained over the last ``window`` seconds"""
+
+    def __init__(self, window: float = RATE_WINDOW_SECONDS, clock: Callable[[], float] = time.monotonic) -> None:
+        self.window = window
+        self.clock = clock
+        self.start = clock()
+        self.images = 0
+        self._recent: deque[tuple[float, int]] = deque()
+
+    def record(self, images: int) -> None:
+        now = self.clock()
+        self.images += images
+        self._recent.append((now, images))
+        while self._recent and self._recent[0][0] < now - self.window:
+            self._recent.popleft()
+
+    def per_minute(self) -> float:
+        return self.images * 60 / max(1e-6, self.clock() - self.start)
+
+    def sustained_per_minute(self) -> float:
+        now = self.clock()
+        images = sum(count for when, count in self._recent if when >= now - self.window)
+        return images * 60 / max(1e-6, min(self.window, now - self.start))
+
+
+def _describe(obj: Any) -> Any:
+    """``obj`` for a sidecar, images replaced by their format and size"""
+    if isinstance(obj, EncodedImage):
+        return f"<{obj.format} {obj.width}x{obj.height}>"
+    if isinstance(obj, dict):
+        return {key: _describe(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_describe(value) for value in obj]
+    return obj
+
+
+def _write_json(path: str, data: Any) -> None:
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+class HeadlessRunner:
+    """
+    Runs jobs against the backend(s) and writes their images to ``out_dir``.
+
+    Args:
+        api: ApiClient or BackendPool
+        defaults: payload fields of every job, e.g. from the command line
+        workers: jobs running at once
+        keep_annotators: also write the ControlNet annotator images
+    """
+
+    def __init__(
+        self,
+        api: Any,
+        settings: Any,
+        out_dir: str,
+        defaults: dict[str, Any] | None = None,
+        workers: int = WORKERS_PER_BACKEND,
+        report_seconds: float = DEFAULT_REPORT_SECONDS,
+        keep_annotators: bool = False,
+    ) -> None:
+        self.api = api
+        self.settings = settings
+        self.out_dir = out_dir
+        self.defaults = defaults or {}
+        self.workers = max(1, workers)
+        self.report_seconds = report_seconds
+        self.keep_annotators = keep_annotators
+        self.planner = BatchPlanner.fromSettings(settings)
+        self.throughput = Throughput()
+        self.counts = {"done": 0, "skipped": 0, "failed": 0}
+        os.makedirs(out_dir, exist_ok=True)
+
+    def build_request(self, job: HeadlessJob) -> tuple[str, dict[str, Any]]:
+        """Endpoint and payload of a job"""
+        fields = {**self.defaults, **job.fields}
+        init_image = load_image(job.init_image) if job.init_image else None
+        if job.mode == "img2img" and init_image is None:
+            raise ValueError(f"Job {job.job_id}: img2img needs an init_image")
+        settings = self.settings
+        data = build_base_data_dict(
+            settings,
+            prompt=fields.get("prompt", ""),
+            negative_prompt=fields.get("negative_prompt", ""),
+            seed=int(fields.get("seed", -1)),
+            batch_size=int(fields.get("batch_size", 1)),
+            steps=fields.get("steps", settings.get("steps")),
+            cfg_scale=fields.get("cfg_scale", settings.get("cfg_scale")),
+            # img2img keeps the size of the init image unless told otherwise
+            width=fields.get("width") or (init_image.width if init_image else settings.get("width")),
+            height=fields.get("height") or (init_image.height if init_image else settings.get("height")),
+            restore_faces=bool(fields.get("restore_faces", False)),
+            tiling=bool(fields.get("tiling", False)),
+            denoising_strength=fields.get("denoising_strength", settings.get("denoising_strength")),
+            sampler_index=fields.get("sampler_index", settings.get("sampler_name")),
+        )
+        data.update({key: value for key, value in fields.items() if key not in BASE_FIELDS})
+        if init_image is not None:
+            data["init_images"] = [init_image]
+        elif job.mode == "txt2img":
+            data.setdefault("enable_hr", False)
+        units = [
+            controlnet_unit(
+                {key: value for key, value in unit.items() if key not in ("image", "mask")},
+                load_image(unit["image"]),
+                load_image(unit["mask"]) if unit.get("mask") else None,
+            )
+            for unit in job.controlnet
+        ]
+        if units:
+            data["alwayson_scripts"] = {**data.get("alwayson_scripts", {}), "controlnet": {"args": units}}
+        return f"/sdapi/v1/{job.mode}", data
+
+    def run_job(self, job: HeadlessJob) -> int:
+        """
+        Generate the images of a job and write them with their sidecars.
+
+        Returns:
+            Number of images written
+        """
+        endpoint, data = self.build_request(job)
+        steps = max(1, round(data["steps"] * data["denoising_strength"])) if job.init_image else data["steps"]
+        chunks = self.planner.plan(data["batch_size"], data["seed"], data["width"], data["height"], steps)
+        stem = os.path.join(self.out_dir, job.job_id)
+        os.makedirs(os.path.dirname(stem), exist_ok=True)
+        images = 0
+        for chunk in chunks:
+            request = chunk.apply(data)
+            start = time.perf_counter()
+            response = self.api.post_stream(endpoint, request)
+            if not isinstance(response, StreamedResponse):
+                raise RuntimeError(f"{response.get('error')}: {response.get('message', '')}")
+            self.planner.record(chunk.count, data["width"], data["height"], steps, time.perf_counter() - start)
+            images += self._write_response(job, stem, images, response, request)
+        return images
+
+    def _write_response(
+        self,
+        job: HeadlessJob,
+        stem: str,
+        first: int,
+        response: StreamedResponse,
+        request: dict[str, Any],
+    ) -> int:
+        # images come before "info": they are written to temporary files and named once the seeds are known
+        written: list[tuple[str, str]] = []
+        try:
+            try:
+                for image in response.images():
+                    path = f"{stem}-{first + len(written)}.tmp"
+                    with open(path, "wb") as f:
+                        f.write(image)
+                    written.append((path, _EXTENSIONS.get(image_format(image) or "png", "png")))
+                info = ResponseInfo.parse(response["info"])
+            finally:
+                response.close()
+
+            images = 0
+            for index, (path, extension) in enumerate(written):
+                if index >= len(info):
+                    if self.keep_annotators:
+                        os.replace(path, f"{stem}-{first}-annotator-{index - len(info)}.{extension}")
+                    continue
+                name = f"{stem}-{first + index}"
+                os.replace(path, f"{name}.{extension}")
+                sidecar = {
+                    "id": job.job_id,
+                    **info.image_data(index),
+                    "init_image": job.init_image,
+                    "request": _describe({key: value for key, value in request.items() if key != "init_images"}),
+                }
+                _write_json(f"{name}.json", sidecar)
+                images += 1
+            return images
+        finally:
+            for path, _extension in written:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _collect(self, futures: Iterable[Future], running: dict[Future, HeadlessJob], checkpoint: Checkpoint) -> None:
+        for future in futures:
+            job = running.pop(future)
+            try:
+                images = future.result()
+            except Exception as ex:
+                logging.error(f"Job {job.job_id} failed: {ex}")
+                self.counts["failed"] += 1
+                with open(os.path.join(self.out_dir, FAILED_FILE), "a") as f:
+                    f.write(json.dumps({"id": job.job_id, "error": str(ex), "time": time.time()}) + "\n")
+                continue
+            checkpoint.add(job.job_id, images)
+            self.counts["done"] += 1
+            self.throughput.record(images)
+
+    def report(self) -> dict[str, Any]:
+        summary = {
+            **self.counts,
+            "images": self.throughput.images,
+            "seconds": round(self.throughput.clock() - self.throughput.start, 1),
+            "images_per_minute": round(self.throughput.per_minute(), 2),
+            "sustained_images_per_minute": round(self.throughput.sustained_per_minute(), 2),
+        }
+        logging.info(
+            f"{summary['done']} jobs done, {summary['skipped']} skipped, {summary['failed']} failed, "
+            f"{summary['images']} images, {summary['images_per_minute']:.1f} images/min, "
+            f"{summary['sustained_images_per_minute']:.1f} over the last {self.throughput.window:g}s",
+        )
+        return summary
+
+    def run(self, jobs: Iterable[HeadlessJob]) -> dict[str, Any]:
+        """
+        Run the jobs not checkpointed yet, ``workers`` at a time.
+
+        Returns:
+            Summary: jobs done, skipped and failed, images and images per minute
+        """
+        checkpoint = Checkpoint(os.path.join(self.out_dir, CHECKPOINT_FILE))
+        if len(checkpoint):
+            logging.info(f"Resuming, {len(checkpoint)} jobs are done already")
+        executor = ThreadPoolExecutor(self.workers, thread_name_prefix="headless")
+        running: dict[Future, HeadlessJob] = {}
+        next_report = time.monotonic() + self.report_seconds
+
+        def drain(limit: int) -> None:
+            nonlocal next_report
+            while len(running) > limit:
+                done, _pending = wait(running, timeout=self.report_seconds, return_when=FIRST_COMPLETED)
+                self._collect(done, running, checkpoint)
+                if time.monotonic() >= next_report:
+                    self.report()
+                    next_report = time.monotonic() + self.report_seconds
+
+        try:
+            for job in jobs:
+                if job.job_id in checkpoint:
+                    self.counts["skipped"] += 1
+                    continue
+                drain(self.workers * QUEUED_PER_WORKER - 1)
+                running[executor.submit(self.run_job, job)] = job
+            drain(0)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            checkpoint.close()
+        return self.report()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run GimpFusion generations over a directory or manifest")
+    parser.add_argument("source", help="directory of init images or JSON Lines manifest")
+    parser.add_argument("out_dir", help="output directory, also holds the checkpoint")
+    parser.add_argument("--mode", choices=MODES, help="txt2img or img2img, img2img for directories")
+    parser.add_argument("--prompt")
+    parser.add_argument("--negative-prompt")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--batch-size", type=int, help="images per job")
+    parser.add_argument("--steps", type=int)
+    parser.add_argument("--cfg-scale", type=float)
+    parser.add_argument("--width", type=int)
+    parser.add_argument("--height", type=int)
+    parser.add_argument("--denoising-strength", type=float)
+    parser.add_argument("--sampler", dest="sampler_index")
+    parser.add_argument("--settings", default=default_settings_path(), help="plug-in settings file")
+    parser.add_argument("--backend", action="append", help="backend URL, repeat for several (default: settings)")
+    parser.add_argument("--workers", type=int, help=f"jobs at a time, {WORKERS_PER_BACKEND} per backend by default")
+    parser.add_argument("--report-seconds", type=float, default=DEFAULT_REPORT_SECONDS)
+    parser.add_argument("--annotators", action="store_true", help="also write ControlNet annotator images")
+    parser.add_argument("--debug", action="store_true", help="debug logging")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+    # requests go straight to the backends, the background worker serves plug-in processes
+    overrides: dict[str, Any] = {"worker_enabled": False}
+    if args.backend:
+        overrides.update({"api_base": args.backend[0], "api_backends": " ".join(args.backend[1:])})
+    settings = HeadlessSettings(args.settings, overrides)
+    defaults = {key: value for key, value in vars(args).items() if key in BASE_FIELDS and value is not None}
+    runner = HeadlessRunner(
+        connect_api(settings),
+        settings,
+        args.out_dir,
+        defaults,
+        workers=args.workers or WORKERS_PER_BACKEND * len(backend_urls(settings)),
+        report_seconds=args.report_seconds,
+        keep_annotators=args.annotators,
+    )
+    try:
+        summary = runner.run(read_jobs(args.source, args.mode))
+    except KeyboardInterrupt:
+        logging.warning("Interrupted, finished jobs are in the checkpoint and are skipped by the next run")
+        sys.exit(130)
+    print(json.dumps(summary, indent=2))  # noqa: T201
+    sys.exit(1 if summary["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
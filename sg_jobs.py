@@ -0,0 +1,423 @@
+"""
+Queue of generation jobs run by the background worker.
+
+A plug-in run submits its request and returns right away; the worker sends queued jobs to the backend one after
+another (or ``queue_concurrency`` at a time) and keeps the results until a plug-in run collects them into the
+originating image. Jobs live on disk, one directory each: the request JSON with its images stored next to it as
+raw encoded files, and once finished the response images plus the other response members. Only the small job
+records stay in memory, so dozens of queued jobs with init images don't pin RAM, and jobs survive a restart of
+the worker.
+
+Each job is tagged with the model it was submitted for; the queue loads it before running the job and groups jobs
+by the model a backend has loaded (sg_affinity), so alternating submissions don't reload checkpoints every job.
+
+Kept free of GIMP imports.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import itertools
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from collections.abc import Callable, Iterator
+from typing import TYPE_CHECKING, Any
+
+from sg_affinity import DEFAULT_AFFINITY_MAX_SKIPS, ModelAffinity
+from sg_backends import controlnet_models
+from sg_payload import EncodedImage
+from sg_stream import StreamedResponse
+
+if TYPE_CHECKING:
+    from sg_api import ApiClient
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+PENDING_STATES = (JOB_QUEUED, JOB_RUNNING)
+FINISHED_STATES = (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+DEFAULT_QUEUE_CONCURRENCY = 1
+CANCEL_REQUEST_TIMEOUT = 2.0
+
+_JOB_FILE = "job.json"
+_REQUEST_FILE = "request.json"
+_RESULT_FILE = "result.json"
+
+
+def default_jobs_dir() -> str:
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "gimpfusion", "jobs")
+
+
+def job_backends(job: Job) -> list[str]:
+    """Backends the job was submitted for, the primary one first"""
+    return job.api.get("backends") or [job.api["base_url"]]
+
+
+class Job:
+    """
+    Record of one queued generation.
+
+    Args:
+        endpoint: API endpoint the request is POSTed to
+        api: connection settings of the submitting plug-in (base URL, timeouts, pool size)
+        meta: opaque data for the plug-in collecting the result, e.g. the image id and layer placement
+        model: model options the job needs loaded (sg_affinity), None runs it on whatever is loaded
+        controlnet_models: ControlNet models the request uses, a backend running the job must have them
+        backend: URL of the backend the job ran on
+        model_load_seconds: time spent switching the backend to ``model`` before the job ran
+        skipped: times jobs submitted later ran first
+    """
+
+    def __init__(
+        self,
+        job_id: str,
+        endpoint: str,
+        api: dict[str, Any],
+        meta: dict[str, Any] | None = None,
+        status: str = JOB_QUEUED,
+        created: float | None = None,
+        started: float | None = None,
+        finished: float | None = None,
+        error: str | None = None,
+        images: int = 0,
+        model: dict[str, Any] | None = None,
+        controlnet_models: list[str] | None = None,
+        backend: str | None = None,
+        model_load_seconds: float | None = None,
+        skipped: int = 0,
+    ) -> None:
+        self.id = job_id
+        self.endpoint = endpoint
+        self.api = api
+        self.meta = meta or {}
+        self.status = status
+        self.created = time.time() if created is None else created
+        self.started = started
+        self.finished = finished
+        self.error = error
+        self.images = images
+        self.model = model
+        self.controlnet_models = controlnet_models or []
+        self.backend = backend
+        self.model_load_seconds = model_load_seconds
+        self.skipped = skipped
+
+    def __repr__(self) -> str:
+        return f"Job({self.id}, {self.endpoint}, {self.status})"
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "endpoint": self.endpoint,
+            "api": self.api,
+            "meta": self.meta,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "error": self.error,
+            "images": self.images,
+            "model": self.model,
+            "controlnet_models": self.controlnet_models,
+            "backend": self.backend,
+            "model_load_seconds": self.model_load_seconds,
+            "skipped": self.skipped,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> Job:
+        return cls(**data)
+
+
+class JobStore:
+    """One directory per job holding its record, request and result"""
+
+    def __init__(self, directory: str | None = None) -> None:
+        self.directory = directory or default_jobs_dir()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, job_id: str, name: str = "") -> str:
+        return os.path.join(self.directory, job_id, name)
+
+    def _write_json(self, path: str, data: Any) -> None:
+        # write-then-rename, a crash never leaves a truncated record behind
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def load_all(self) -> list[Job]:
+        jobs = []
+        for job_id in os.listdir(self.directory):
+            try:
+                with open(self._path(job_id, _JOB_FILE)) as f:
+                    jobs.append(Job.from_dict(json.load(f)))
+            except (OSError, ValueError, TypeError) as ex:
+                logging.warning(f"Dropping unreadable job {job_id}: {ex}")
+                self.delete(job_id)
+        return sorted(jobs, key=lambda job: job.created)
+
+    def save_job(self, job: Job) -> None:
+        self._write_json(self._path(job.id, _JOB_FILE), job.to_dict())
+
+    def save_request(self, job: Job, data: Any) -> None:
+        """Create the job directory, images of the payload go into files of their own"""
+        os.makedirs(self._path(job.id), exist_ok=True)
+        counter = itertools.count()
+
+        def externalize(obj: Any) -> Any:
+            if isinstance(obj, EncodedImage):
+                name = f"input-{next(counter)}.{obj.format}"
+                with open(self._path(job.id, name), "wb") as f:
+                    f.write(obj.data)
+                return {"$file": name, "format": obj.format, "width": obj.width, "height": obj.height}
+            if isinstance(obj, dict):
+                return {key: externalize(value) for key, value in obj.items()}
+            if isinstance(obj, (list, tuple)):
+                return [externalize(value) for value in obj]
+            return obj
+
+        self._write_json(self._path(job.id, _REQUEST_FILE), externalize(data))
+        self.save_job(job)
+
+    def load_request(self, job: Job) -> Any:
+        with open(self._path(job.id, _REQUEST_FILE)) as f:
+            data = json.load(f)
+
+        def internalize(obj: Any) -> Any:
+            if isinstance(obj, dict):
+                if "$file" in obj:
+                    with open(self._path(job.id, obj["$file"]), "rb") as f:
+                        return EncodedImage(f.read(), obj["format"], obj["width"], obj["height"])
+                return {key: internalize(value) for key, value in obj.items()}
+            if isinstance(obj, list):
+                return [internalize(value) for value in obj]
+            return obj
+
+        return internalize(data)
+
+    def save_result(self, job: Job, response: StreamedResponse) -> int:
+        """Write the response while it is read: each image to a file, the other members to one JSON file"""
+        fields: dict[str, Any] = {}
+        images = 0
+        for key, value in response.events():
+            if key == "image":
+                with open(self._path(job.id, f"result-{images}"), "wb") as f:
+                    f.write(value)
+                images += 1
+            else:
+                fields[key] = value
+        self._write_json(self._path(job.id, _RESULT_FILE), {"images": images, "fields": fields})
+        return images
+
+    def load_result(self, job: Job) -> StreamedResponse:
+        """The stored response, images are read from disk one at a time as they are consumed"""
+        with open(self._path(job.id, _RESULT_FILE)) as f:
+            result = json.load(f)
+
+        def events() -> Iterator[tuple[str, Any]]:
+            for index in range(result["images"]):
+                with open(self._path(job.id, f"result-{index}"), "rb") as f:
+                    yield "image", f.read()
+            yield from result["fields"].items()
+
+        return StreamedResponse(events())
+
+    def delete_result(self, job: Job) -> None:
+        for name in os.listdir(self._path(job.id)):
+            if name.startswith("result"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(self._path(job.id, name))
+
+    def delete(self, job_id: str) -> None:
+        shutil.rmtree(self._path(job_id), ignore_errors=True)
+
+
+class JobQueue:
+    """
+    Runs stored jobs against their backends, at most ``concurrency`` at a time on each backend.
+
+    Jobs start oldest first, except that a backend takes jobs for the model it has loaded before others (see
+    ModelAffinity). Jobs found running when the queue is created (the worker stopped in the middle of them) are
+    queued again.
+
+    Args:
+        api_for: client for the connection settings of a job; with ``base_url`` set and no ``backends`` it has to
+            talk to that one backend
+        eligible: backends a job may run on now, by default all it was submitted for
+        max_skips: see ModelAffinity
+        on_model_load: called with the backend URL after the queue switched its model
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        api_for: Callable[[dict[str, Any]], ApiClient],
+        concurrency: int = DEFAULT_QUEUE_CONCURRENCY,
+        eligible: Callable[[Job], list[str]] = job_backends,
+        max_skips: int = DEFAULT_AFFINITY_MAX_SKIPS,
+        on_model_load: Callable[[str], None] | None = None,
+    ) -> None:
+        self.store = store
+        self.api_for = api_for
+        self.concurrency = max(1, int(concurrency))
+        self.eligible = eligible
+        self.affinity = ModelAffinity(max_skips, on_load=on_model_load)
+        self._jobs: dict[str, Job] = {}
+        # jobs running per backend URL
+        self._running: dict[str, int] = {}
+        self._lock = threading.Lock()
+        for job in store.load_all():
+            if job.status == JOB_RUNNING:
+                job.status, job.started = JOB_QUEUED, None
+                store.save_job(job)
+            self._jobs[job.id] = job
+        self._dispatch()
+
+    def submit(
+        self,
+        endpoint: str,
+        data: Any,
+        api: dict[str, Any],
+        meta: dict[str, Any] | None = None,
+        model: dict[str, Any] | None = None,
+    ) -> Job:
+        job = Job(uuid.uuid4().hex, endpoint, api, meta, model=model, controlnet_models=sorted(controlnet_models(data)))
+        self.store.save_request(job, data)
+        with self._lock:
+            self._jobs[job.id] = job
+        checkpoint = (model or {}).get("sd_model_checkpoint")
+        logging.info(f"Queued job {job.id} ({endpoint}, {checkpoint}), {self.pending()} pending")
+        self._dispatch()
+        return job
+
+    def set_concurrency(self, concurrency: int) -> None:
+        with self._lock:
+            self.concurrency = max(1, int(concurrency))
+        self._dispatch()
+
+    def set_max_skips(self, max_skips: int) -> None:
+        with self._lock:
+            self.affinity.max_skips = max(0, int(max_skips))
+        self._dispatch()
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self, image_id: int | None = None) -> list[Job]:
+        with self._lock:
+            jobs = sorted(self._jobs.values(), key=lambda job: job.created)
+        return [job for job in jobs if image_id is None or job.meta.get("image_id") == image_id]
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(job.status in PENDING_STATES for job in self._jobs.values())
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            loads = [job.model_load_seconds for job in self._jobs.values() if job.model_load_seconds is not None]
+        return {**self.affinity.stats(), "jobs_with_model_load": sum(seconds > 0 for seconds in loads)}
+
+    def cancel(self, job_id: str) -> bool:
+        """Drop a queued job or interrupt a running one on the backend; False if it already finished"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED_STATES:
+                return False
+            was_running = job.status == JOB_RUNNING
+            job.status, job.finished = JOB_CANCELLED, time.time()
+        self.store.save_job(job)
+        if was_running:
+            # the backend returns what it has so far, the runner throws it away
+            try:
+                self._client(job).interrupt(timeout=CANCEL_REQUEST_TIMEOUT)
+            except Exception as ex:
+                logging.warning(f"Interrupting job {job.id} failed: {ex}")
+        logging.info(f"Cancelled job {job.id}")
+        return True
+
+    def result(self, job_id: str) -> StreamedResponse:
+        job = self.get(job_id)
+        if job is None or job.status != JOB_DONE:
+            raise KeyError(f"Job {job_id} has no result")
+        return self.store.load_result(job)
+
+    def forget(self, job_id: str) -> None:
+        """Delete a job and its files, cancelling it first if it is still pending"""
+        self.cancel(job_id)
+        with self._lock:
+            self._jobs.pop(job_id, None)
+        self.store.delete(job_id)
+
+    def _client(self, job: Job) -> ApiClient:
+        """Client talking to the backend the job runs on"""
+        return self.api_for({**job.api, "base_url": job.backend or job.api["base_url"], "backends": None})
+
+    def _dispatch(self) -> None:
+        while True:
+            with self._lock:
+                queued = [job for job in self._jobs.values() if job.status == JOB_QUEUED]
+            if not queued:
+                return
+            # may check the backends over the network, so outside the lock
+            backends = {job.id: self.eligible(job) for job in queued}
+            with self._lock:
+                queued = [job for job in queued if job.status == JOB_QUEUED]
+                urls = {url for job in queued for url in backends[job.id]}
+                running = {url: self._running.get(url, 0) for url in urls}
+                free = {url: count for url, count in running.items() if count < self.concurrency}
+                picked = self.affinity.pick(queued, free, backends)
+                if picked is None:
+                    return
+                job, url = picked
+                job.status, job.started, job.backend = JOB_RUNNING, time.time(), url
+                self._running[url] = running[url] + 1
+            threading.Thread(target=self._run, args=(job,), name=f"job-{job.id[:8]}", daemon=True).start()
+
+    def _run(self, job: Job) -> None:
+        self.store.save_job(job)
+        try:
+            client = self._client(job)
+            job.model_load_seconds = self.affinity.ensure_loaded(client, job.backend, job.model)
+            if job.status == JOB_CANCELLED:
+                return
+            response = client.post_stream(job.endpoint, self.store.load_request(job))
+            if isinstance(response, StreamedResponse):
+                images = self.store.save_result(job, response)
+                self._finish(job, JOB_DONE, images=images)
+            else:
+                self._finish(job, JOB_FAILED, error=f"{response.get('error')}: {response.get('detail') or ''}")
+        except Exception as ex:
+            logging.warning(f"Job {job.id} failed: {ex}")
+            self._finish(job, JOB_FAILED, error=f"{type(ex).__name__}: {ex}")
+        finally:
+            with self._lock:
+                self._running[job.backend] -= 1
+            self._dispatch()
+
+    def _finish(self, job: Job, status: str, images: int = 0, error: str | None = None) -> None:
+        with self._lock:
+            if job.id not in self._jobs:
+                # forgotten while running, its directory is gone
+                return
+            cancelled = job.status == JOB_CANCELLED
+            if not cancelled:
+                job.status, job.images, job.error, job.finished = status, images, error, time.time()
+        if cancelled:
+            self.store.delete_result(job)
+        self.store.save_job(job)
+        seconds = time.time() - (job.started or job.created)
+        load = f", model load {job.model_load_seconds:.1f}s" if job.model_load_seconds else ""
+        logging.info(f"Job {job.id} {job.status} on {job.backend} after {seconds:.1f}s{load}")
@@ -0,0 +1,254 @@
+"""
+Wire format of images embedded in request payloads.
+
+Init images may be sent as PNG, lossless WebP or high quality JPEG; everything else (ControlNet inputs, masks)
+is always lossless. In ``auto`` mode the format with the lowest estimated encode + upload time is picked from
+measured encode cost, compressed size and link throughput.
+"""
+
+from __future__ import annotations
+
+import base64
+import io
+import logging
+import threading
+import time
+
+from typing import Any
+
+from sg_png import DEFAULT_PNG_COMPRESS_LEVEL, DEFAULT_PNG_FILTER, DEFAULT_ZLIB_STRATEGY, encode_png
+
+try:
+    from PIL import Image as PILImage
+except ImportError:  # pragma: no cover - Pillow is usually not part of GIMP's Python
+    PILImage = None
+
+# What an encoded image is used for
+PAYLOAD_INIT = "init"  # lossy formats allowed
+PAYLOAD_LOSSLESS = "lossless"
+
+PAYLOAD_FORMATS = ["png", "webp", "jpeg", "auto"]
+LOSSLESS_FORMATS = ("png", "webp")
+
+MIME_TYPES = {"png": "image/png", "webp": "image/webp", "jpeg": "image/jpeg"}
+
+DEFAULT_JPEG_QUALITY = 95
+DEFAULT_LINK_MBPS = 100.0
+
+# Starting estimates per format until real measurements arrive
+DEFAULT_ENCODE_STATS = {
+    "png": {"seconds_per_mp": 0.5, "bytes_per_pixel": 2.2},
+    "webp": {"seconds_per_mp": 1.5, "bytes_per_pixel": 1.7},
+    "jpeg": {"seconds_per_mp": 0.05, "bytes_per_pixel": 0.6},
+}
+
+# Weight of a new measurement in the moving averages
+EMA_WEIGHT = 0.3
+# Bodies smaller than this say nothing about link throughput
+MIN_THROUGHPUT_SAMPLE_BYTES = 1 << 20
+
+
+class EncodedImage:
+    """Encoded image bytes plus what is needed to embed them into a JSON payload"""
+
+    def __init__(self, data: bytes, image_format: str, width: int, height: int, encode_seconds: float = 0.0) -> None:
+        self.data = data
+        self.format = image_format
+        self.width = width
+        self.height = height
+        self.encode_seconds = encode_seconds
+        # key in the background worker's cache, lets a request reference the image instead of carrying it
+        self.cache_key: str | None = None
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __repr__(self) -> str:
+        return f"EncodedImage({self.format}, {self.width}x{self.height}, {len(self.data)} bytes)"
+
+    @property
+    def mime(self) -> str:
+        return MIME_TYPES[self.format]
+
+    def to_base64(self) -> str:
+        return base64.b64encode(self.data).decode()
+
+
+class LinkStats:
+    """Moving average of the upload throughput to the backend, fed by ApiClient"""
+
+    def __init__(self, bytes_per_second: float = DEFAULT_LINK_MBPS * 125_000) -> None:
+        self.bytes_per_second = bytes_per_second
+        self._lock = threading.Lock()
+
+    def record_upload(self, size: int, seconds: float) -> None:
+        if size < MIN_THROUGHPUT_SAMPLE_BYTES or seconds <= 0:
+            return
+        with self._lock:
+            self.bytes_per_second += EMA_WEIGHT * (size / seconds - self.bytes_per_second)
+        logging.debug(f"Upload of {size} bytes in {seconds:.3f}s, link estimate {self.bytes_per_second / 1e6:.1f} MB/s")
+
+
+class PayloadPolicy:
+    """Chooses and runs the encoder for payload images, configured from settings"""
+
+    def __init__(self, link: LinkStats | None = None) -> None:
+        self.link = link or LinkStats()
+        self.payload_format = "png"
+        self.jpeg_quality = DEFAULT_JPEG_QUALITY
+        self.png_options: dict[str, Any] = {
+            "level": DEFAULT_PNG_COMPRESS_LEVEL,
+            "png_filter": DEFAULT_PNG_FILTER,
+            "strategy": DEFAULT_ZLIB_STRATEGY,
+        }
+        self.stats = {name: dict(values) for name, values in DEFAULT_ENCODE_STATS.items()}
+        self._lock = threading.Lock()
+
+    def configure(self, settings: Any) -> None:
+        self.payload_format = settings.get("payload_format") or "png"
+        self.jpeg_quality = int(settings.get("jpeg_quality") or DEFAULT_JPEG_QUALITY)
+        self.png_options = {
+            "level": settings.get("png_compress_level", DEFAULT_PNG_COMPRESS_LEVEL),
+            "png_filter": settings.get("png_filter", DEFAULT_PNG_FILTER),
+            "strategy": settings.get("png_strategy", DEFAULT_ZLIB_STRATEGY),
+        }
+        for name, values in (settings.get("payload_stats") or {}).items():
+            if name in self.stats:
+                self.stats[name].update(values)
+        if settings.get("link_bytes_per_second"):
+            self.link.bytes_per_second = float(settings.get("link_bytes_per_second"))
+        elif settings.get("link_mbps"):
+            self.link.bytes_per_second = float(settings.get("link_mbps")) * 125_000
+
+    def export_stats(self) -> dict[str, Any]:
+        """Measurements to persist in settings, so the next plug-in process starts from them"""
+        with self._lock:
+            return {
+                "payload_stats": {name: dict(values) for name, values in self.stats.items()},
+                "link_bytes_per_second": self.link.bytes_per_second,
+            }
+
+    @staticmethod
+    def available_formats() -> list[str]:
+        formats = ["png"]
+        if PILImage is not None:
+            formats.append("webp")
+        if PILImage is not None or gdk_pixbuf() is not None:
+            formats.append("jpeg")
+        return formats
+
+    def format_key(self, image_format: str) -> str:
+        """Identifies the encoder settings, encoded images are cached per key"""
+        if image_format == "png":
+            return "png:{level}:{png_filter}:{strategy}".format(**self.png_options)
+        if image_format == "jpeg":
+            return f"jpeg:{self.jpeg_quality}"
+        return image_format
+
+    def estimate_seconds(self, image_format: str, width: int, height: int) -> float:
+        """Estimated encode time plus upload time of the base64 text"""
+        stats = self.stats[image_format]
+        pixels = width * height
+        upload_bytes = stats["bytes_per_pixel"] * pixels * 4 / 3
+        return stats["seconds_per_mp"] * pixels / 1e6 + upload_bytes / self.link.bytes_per_second
+
+    def choose(self, kind: str, width: int, height: int) -> str:
+        allowed = [name for name in self.available_formats() if kind == PAYLOAD_INIT or name in LOSSLESS_FORMATS]
+        if self.payload_format != "auto":
+            return self.payload_format if self.payload_format in allowed else "png"
+        estimates = {name: self.estimate_seconds(name, width, height) for name in allowed}
+        chosen = min(estimates, key=estimates.__getitem__)
+        logging.debug(f"Payload format for {kind} {width}x{height}: {chosen}, estimates {estimates}")
+        return chosen
+
+    def encode(self, pixels: bytes, width: int, height: int, channels: int, image_format: str) -> EncodedImage:
+        start = time.perf_counter()
+        if image_format == "png":
+            data = encode_png(pixels, width, height, channels, **self.png_options)
+        elif image_format == "webp":
+            data = self._encode_pil(pixels, width, height, channels, "WEBP", lossless=True, method=2)
+        elif image_format == "jpeg":
+            data = self._encode_jpeg(pixels, width, height, channels)
+        else:
+            raise ValueError(f"Unknown payload image format {image_format}")
+        seconds = time.perf_counter() - start
+        self._record(image_format, width * height, len(data), seconds)
+        logging.info(
+            f"Encoded {width}x{height} as {image_format}: {len(data)} bytes "
+            f"({len(data) / max(1, len(pixels)):.2f} of raw) in {seconds:.3f}s",
+        )
+        return EncodedImage(data, image_format, width, height, seconds)
+
+    def _record(self, image_format: str, pixels: int, size: int, seconds: float) -> None:
+        if pixels < 64 * 64:
+            return
+        with self._lock:
+            stats = self.stats[image_format]
+            stats["seconds_per_mp"] += EMA_WEIGHT * (seconds * 1e6 / pixels - stats["seconds_per_mp"])
+            stats["bytes_per_pixel"] += EMA_WEIGHT * (size / pixels - stats["bytes_per_pixel"])
+
+    def _encode_jpeg(self, pixels: bytes, width: int, height: int, channels: int) -> bytes:
+        if PILImage is not None:
+            return self._encode_pil(pixels, width, height, channels, "JPEG", quality=self.jpeg_quality)
+        # JPEG has no alpha: drop it, the backend converts init images to RGB anyway
+        rgb = _to_rgb(pixels, width * height, channels)
+        GdkPixbuf, GLib = gdk_pixbuf()
+        pixbuf = GdkPixbuf.Pixbuf.new_from_bytes(
+            GLib.Bytes.new(rgb),
+            GdkPixbuf.Colorspace.RGB,
+            False,
+            8,
+            width,
+            height,
+            width * 3,
+        )
+        success, data = pixbuf.save_to_bufferv("jpeg", ["quality"], [str(self.jpeg_quality)])
+        if not success:
+            raise RuntimeError("GdkPixbuf failed to encode JPEG")
+        return bytes(data)
+
+    @staticmethod
+    def _encode_pil(
+        pixels: bytes,
+        width: int,
+        height: int,
+        channels: int,
+        pil_format: str,
+        **options: Any,
+    ) -> bytes:
+        mode = {1: "L", 2: "LA", 3: "RGB", 4: "RGBA"}[channels]
+        image = PILImage.frombuffer(mode, (width, height), pixels, "raw", mode, 0, 1)
+        if pil_format == "JPEG" and mode != "RGB":
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, pil_format, **options)
+        return output.getvalue()
+
+
+def _to_rgb(pixels: bytes, count: int, channels: int) -> bytes:
+    if channels == 3:
+        return pixels
+    rgb = bytearray(count * 3)
+    if channels in (1, 2):
+        for offset in range(3):
+            rgb[offset::3] = pixels[0::channels]
+    else:
+        for offset in range(3):
+            rgb[offset::3] = pixels[offset::channels]
+    return bytes(rgb)
+
+
+def gdk_pixbuf() -> tuple[Any, Any] | None:
+    """GdkPixbuf and GLib modules, None outside of a GTK environment"""
+    try:
+        import gi
+
+        gi.require_version("GdkPixbuf", "2.0")
+        from gi.repository import GdkPixbuf, GLib
+    except (ImportError, ValueError):
+        return None
+    return GdkPixbuf, GLib
+
+
+# Shared by Layer (encoding) and ApiClient (upload throughput)
+PAYLOAD_POLICY = PayloadPolicy()
@@ -6,10 +6,13 @@ from typing import Any
 
 import gi
 
+from sg_backend_options import OptionsCache
 from sg_gtk_utils import add_textarea_to_container
 from sg_i18n import _
+from sg_payload import PAYLOAD_FORMATS
 from sg_plugins import PluginBase
-from sg_utils import set_logging_dest
+from sg_png import PNG_FILTERS, ZLIB_STRATEGIES
+from sg_utils import make_choice_from_list, set_logging_dest
 
 gi.require_version("Gimp", "3.0")
 gi.require_version("GimpUi", "3.0")
@@ -47,6 +50,13 @@ class ConfigPlugin(PluginBase):
             "http://127.0.0.1:7860/",
             GObject.ParamFlags.READWRITE,
         )
+        procedure.add_string_argument(
+            "api_backends",
+            _("Additional backends"),
+            _("URL bases of more backends, separated by spaces; generations are spread over all of them"),
+            "",
+            GObject.ParamFlags.READWRITE,
+        )
         procedure.add_boolean_argument(
             "debug_logging",
             _("Debug logging"),
@@ -68,6 +78,256 @@ class ConfigPlugin(PluginBase):
             True,
             GObject.ParamFlags.READWRITE,
         )
+        procedure.add_int_argument(
+            "tobase64_cache_max_mb",
+            _("toBase64 cache size, MB"),
+            _("Memory budget of the toBase64 cache, least recently used images are evicted first"),
+            16,
+            8192,
+            256,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_int_argument(
+            "tobase64_cache_max_entries",
+            _("toBase64 cache entries"),
+            _("Maximum number of images kept in the toBase64 cache"),
+            1,
+            1024,
+            32,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_int_argument(
+            "png_compress_level",
+            _("PNG compression level"),
+            _("zlib level used to encode images sent to the backend, lower is faster but larger"),
+            0,
+            9,
+            6,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_choice_argument(
+            "png_filter",
+            _("PNG row filter"),
+            _("PNG filter applied before compression, adaptive picks the best one per row"),
+            make_choice_from_list(PNG_FILTERS),
+            "up",
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_choice_argument(
+            "png_strategy",
+            _("PNG zlib strategy"),
+            _("zlib strategy used to encode images sent to the backend"),
+            make_choice_from_list(list(ZLIB_STRATEGIES)),
+            "default",
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_choice_argument(
+            "payload_format",
+            _("Init image format"),
+            _("Format of init images sent to the backend, auto picks the fastest to encode and upload"),
+            make_choice_from_list(PAYLOAD_FORMATS),
+            "png",
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_int_argument(
+            "jpeg_quality",
+            _("JPEG quality"),
+            _("Quality of init images sent as JPEG"),
+            50,
+            100,
+            95,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_int_argument(
+            "http_pool_size",
+            _("HTTP connection pool size"),
+            _("Number of keep-alive connections kept open to the backend"),
+            1,
+            32,
+            10,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_double_argument(
+            "http_connect_timeout",
+            _("HTTP connect timeout"),
+            _("Seconds to wait for a connection to the backend to be established"),
+            0.5,
+            60.0,
+            5.0,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_int_argument(
+            "http_retries",
+            _("HTTP retries"),
+            _("Times a request failing with a transient error (connection refused, 502, out of memory) is retried"),
+            0,
+            10,
+            2,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_double_argument(
+            "http_retry_backoff",
+            _("HTTP retry backoff"),
+            _("Longest wait in seconds before the first retry, doubled for each further one"),
+            0.0,
+            60.0,
+            0.5,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_int_argument(
+            "breaker_threshold",
+            _("Failures until backend is down"),
+            _("Failed requests in a row after which requests to the backend fail right away, 0 never"),
+            0,
+            100,
+            5,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_double_argument(
+            "breaker_reset",
+            _("Backend down for"),
+            _("Seconds requests to a backend that is down fail right away before it is tried again"),
+            1.0,
+            3600.0,
+            30.0,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_int_argument(
+            "options_cache_ttl",
+            _("Backend options cache TTL"),
+            _("Seconds the list of models and modules fetched from the backend is considered fresh"),
+            0,
+            7 * 24 * 3600,
+            600,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_double_argument(
+            "progress_min_interval",
+            _("Fastest progress poll"),
+            _("Minimum seconds between progress requests, used when the job is about to finish"),
+            0.05,
+            10.0,
+            0.25,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_double_argument(
+            "progress_max_interval",
+            _("Slowest progress poll"),
+            _("Maximum seconds between progress requests, used for long jobs"),
+            0.1,
+            60.0,
+            2.0,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_boolean_argument(
+            "progress_previews",
+            _("Show live previews"),
+            _("Show the in-progress image in a preview layer (live previews must be enabled in the backend)"),
+            False,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_double_argument(
+            "preview_interval",
+            _("Preview refresh interval"),
+            _("Minimum seconds between two preview frames"),
+            0.2,
+            60.0,
+            1.0,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_int_argument(
+            "preview_max_kbps",
+            _("Preview bandwidth"),
+            _("Maximum kB/s spent on downloading preview frames"),
+            10,
+            1000000,
+            4000,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_int_argument(
+            "preview_max_size",
+            _("Preview size"),
+            _("Preview frames are downscaled to at most this many pixels per side"),
+            64,
+            4096,
+            512,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_boolean_argument(
+            "worker_enabled",
+            _("Use background worker"),
+            _("Keep backend connections and encoded layers in a background process shared by all plug-in runs"),
+            False,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_int_argument(
+            "worker_idle_timeout",
+            _("Background worker idle timeout"),
+            _("Seconds without requests after which the background worker exits"),
+            10,
+            7 * 24 * 3600,
+            1800,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_int_argument(
+            "queue_concurrency",
+            _("Queued jobs at a time"),
+            _("Number of queued generations the background worker sends to each backend at once"),
+            1,
+            8,
+            1,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_int_argument(
+            "queue_affinity_max_skips",
+            _("Queued jobs overtaking"),
+            _("Times a queued job may be overtaken by jobs for the loaded model, 0 keeps the submission order"),
+            0,
+            100,
+            4,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_double_argument(
+            "batch_chunk_seconds",
+            _("Batch chunk duration"),
+            _("Large batches are generated in chunks of about this many seconds, 0 sends the whole batch at once"),
+            0.0,
+            3600.0,
+            15.0,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_double_argument(
+            "batch_max_megapixels",
+            _("Batch megapixels"),
+            _("Megapixels the backend generates in parallel, limits the batch size of large images"),
+            0.1,
+            256.0,
+            4.2,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_boolean_argument(
+            "response_cache_enabled",
+            _("Cache responses"),
+            _("Keep generated images on disk and reuse them when a request with a fixed seed is repeated"),
+            False,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_int_argument(
+            "response_cache_max_mb",
+            _("Response cache size, MB"),
+            _("Disk space used by cached responses, the least recently used ones are deleted beyond it"),
+            16,
+            1024 * 1024,
+            1024,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_boolean_argument(
+            "options_stale_while_revalidate",
+            _("Use stale backend options while refreshing"),
+            _("Open dialogs with the cached backend options and refresh them in background"),
+            True,
+            GObject.ParamFlags.READWRITE,
+        )
 
     def main(
         self,
@@ -95,7 +355,44 @@ class ConfigPlugin(PluginBase):
             add_textarea_to_container(procedure, config, "prompt", vbox)
             add_textarea_to_container(procedure, config, "negative-prompt", vbox)
 
-            dialog.fill(["api_base", "debug_logging", "file_logging", "cache_tobase64"])
+            dialog.fill(
+                [
+                    "api_base",
+                    "api_backends",
+                    "debug_logging",
+                    "file_logging",
+                    "cache_tobase64",
+                    "tobase64_cache_max_mb",
+                    "tobase64_cache_max_entries",
+                    "png_compress_level",
+                    "png_filter",
+                    "png_strategy",
+                    "payload_format",
+                    "jpeg_quality",
+                    "http_pool_size",
+                    "http_connect_timeout",
+                    "http_retries",
+                    "http_retry_backoff",
+                    "breaker_threshold",
+                    "breaker_reset",
+                    "options_cache_ttl",
+                    "options_stale_while_revalidate",
+                    "progress_min_interval",
+                    "progress_max_interval",
+                    "progress_previews",
+                    "preview_interval",
+                    "preview_max_kbps",
+                    "preview_max_size",
+                    "worker_enabled",
+                    "worker_idle_timeout",
+                    "queue_concurrency",
+                    "queue_affinity_max_skips",
+                    "batch_chunk_seconds",
+                    "batch_max_megapixels",
+                    "response_cache_enabled",
+                    "response_cache_max_mb",
+                ],
+            )
 
             if not dialog.run():
                 return procedure.new_return_values(Gimp.PDBStatusType.CANCEL, GLib.Error())
@@ -103,24 +400,89 @@ class ConfigPlugin(PluginBase):
         prompt = config.get_property("prompt")
         negative_prompt = config.get_property("negative_prompt")
         api_base = config.get_property("api_base")
+        api_backends = config.get_property("api_backends")
         debug_logging = config.get_property("debug_logging")
         file_logging = config.get_property("file_logging")
         cache_tobase64 = config.get_property("cache_tobase64")
+        tobase64_cache_max_mb = config.get_property("tobase64_cache_max_mb")
+        tobase64_cache_max_entries = config.get_property("tobase64_cache_max_entries")
+        png_compress_level = config.get_property("png_compress_level")
+        png_filter = config.get_property("png_filter")
+        png_strategy = config.get_property("png_strategy")
+        payload_format = config.get_property("payload_format")
+        jpeg_quality = config.get_property("jpeg_quality")
+        http_pool_size = config.get_property("http_pool_size")
+        http_connect_timeout = config.get_property("http_connect_timeout")
+        http_retries = config.get_property("http_retries")
+        http_retry_backoff = config.get_property("http_retry_backoff")
+        breaker_threshold = config.get_property("breaker_threshold")
+        breaker_reset = config.get_property("breaker_reset")
+        options_cache_ttl = config.get_property("options_cache_ttl")
+        options_stale_while_revalidate = config.get_property("options_stale_while_revalidate")
+        progress_min_interval = config.get_property("progress_min_interval")
+        progress_max_interval = config.get_property("progress_max_interval")
+        progress_previews = config.get_property("progress_previews")
+        preview_interval = config.get_property("preview_interval")
+        preview_max_kbps = config.get_property("preview_max_kbps")
+        preview_max_size = config.get_property("preview_max_size")
+        worker_enabled = config.get_property("worker_enabled")
+        worker_idle_timeout = config.get_property("worker_idle_timeout")
+        queue_concurrency = config.get_property("queue_concurrency")
+        queue_affinity_max_skips = config.get_property("queue_affinity_max_skips")
+        batch_chunk_seconds = config.get_property("batch_chunk_seconds")
+        batch_max_megapixels = config.get_property("batch_max_megapixels")
+        response_cache_enabled = config.get_property("response_cache_enabled")
+        response_cache_max_mb = config.get_property("response_cache_max_mb")
 
         logging.getLogger().setLevel(level=logging.DEBUG if debug_logging else logging.INFO)
         if file_logging != self.settings.get("file_logging"):
             set_logging_dest(file_logging)
 
+        api_base_changed = api_base.strip("/") != (self.settings.get("api_base") or "").strip("/")
+
         self.settings.save(
             {
                 "prompt": prompt,
                 "negative_prompt": negative_prompt,
                 "api_base": api_base,
+                "api_backends": api_backends,
                 "debug_logging": debug_logging,
                 "file_logging": file_logging,
                 "cache_tobase64": cache_tobase64,
+                "tobase64_cache_max_mb": tobase64_cache_max_mb,
+                "tobase64_cache_max_entries": tobase64_cache_max_entries,
+                "png_compress_level": png_compress_level,
+                "png_filter": png_filter,
+                "png_strategy": png_strategy,
+                "payload_format": payload_format,
+                "jpeg_quality": jpeg_quality,
+                "http_pool_size": http_pool_size,
+                "http_connect_timeout": http_connect_timeout,
+                "http_retries": http_retries,
+                "http_retry_backoff": http_retry_backoff,
+                "breaker_threshold": breaker_threshold,
+                "breaker_reset": breaker_reset,
+                "options_cache_ttl": options_cache_ttl,
+                "options_stale_while_revalidate": options_stale_while_revalidate,
+                "progress_min_interval": progress_min_interval,
+                "progress_max_interval": progress_max_interval,
+                "progress_previews": progress_previews,
+                "preview_interval": preview_interval,
+                "preview_max_kbps": preview_max_kbps,
+                "preview_max_size": preview_max_size,
+                "worker_enabled": worker_enabled,
+                "worker_idle_timeout": worker_idle_timeout,
+                "queue_concurrency": queue_concurrency,
+                "queue_affinity_max_skips": queue_affinity_max_skips,
+                "batch_chunk_seconds": batch_chunk_seconds,
+                "batch_max_megapixels": batch_max_megapixels,
+                "response_cache_enabled": response_cache_enabled,
+                "response_cache_max_mb": response_cache_max_mb,
             },
         )
+        if api_base_changed:
+            # cached models belong to the previous backend
+            OptionsCache(api=self.api, settings=self.settings).invalidate()
         return procedure.new_return_values(Gimp.PDBStatusType.SUCCESS, GLib.Error())
 
 
@@ -185,7 +547,14 @@ class ConfigModelPlugin(PluginBase):
             try:
                 # self.api.post("/sdapi/v1/options", {"sd_model_checkpoint": models[model]})
                 self.api.post("/sdapi/v1/options", data=data)
-                self.settings.set("sd_model_checkpoint", model)
+                # queued jobs are tagged with both (sg_affinity)
+                self.settings.save(
+                    {
+                        "sd_model_checkpoint": model,
+                        "forge_additional_modules": data.get("forge_additional_modules"),
+                    },
+                )
+                OptionsCache(api=self.api, settings=self.settings).invalidate()
             except Exception as e:
                 logging.exception(f"Error changing model: {e}")
 
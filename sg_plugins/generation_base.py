@@ -6,17 +6,34 @@ Contains common UI building and ControlNet handling logic.
 from __future__ import annotations
 
 import logging
-import threading
+import random
+import time
 
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Any
 
 import gi
 
-from sg_constants import INSERT_MODES, MAX_BATCH_SIZE, SAMPLERS
-from sg_gtk_utils import add_textarea_to_container, set_visibility_control_by
+from sg_affinity import DEFAULT_AFFINITY_MAX_SKIPS, model_requirement
+from sg_backends import backend_urls
+from sg_batch import LAYER_CHUNKS_IN_FLIGHT_PER_BACKEND, MAX_SEED, BatchChunk, BatchPlanner, LayerChunk
+from sg_constants import INSERT_MODES
+from sg_decode import decode_image
+from sg_generation import add_controlnet_units, available_samplers, build_base_data_dict
+from sg_gtk_utils import GenerationControls, add_textarea_to_container, set_visibility_control_by
+from sg_i18n import _
+from sg_jobs import DEFAULT_QUEUE_CONCURRENCY
+from sg_payload import PAYLOAD_INIT, PAYLOAD_POLICY
 from sg_plugins import PluginBase
-from sg_structures import ResponseLayers, getControlNetParams
-from sg_utils import get_progress_at_background, roundToMultiple
+from sg_progress import DEFAULT_PREVIEW_MAX_SIZE, CancelToken, ProgressTracker
+from sg_region import CONTROLNET_MULTIPLE, SIZE_MULTIPLE, CropRegion, crop_region
+from sg_response_cache import ResponseCache, deterministic, response_key
+from sg_stream import StreamedResponse
+from sg_structures import Layer, PreviewLayer, ResponseLayers, getControlNetParams, getLayerEncoder
+from sg_tiles import TILES_IN_FLIGHT_PER_BACKEND, Tile, TileGrid, blend_tile
+from sg_worker import WorkerClient, WorkerError
 
 gi.require_version("Gimp", "3.0")
 gi.require_version("GimpUi", "3.0")
@@ -26,6 +43,15 @@ from gi.repository import Gimp, GimpUi, Gtk
 class GenerationPluginBase(PluginBase):
     """Base class for image generation plugins with common UI and ControlNet handling"""
 
+    def get_samplers(self) -> list[str]:
+        """Samplers reported by the backend, falling back to the built-in list"""
+        return available_samplers(self.settings)
+
+    def get_selected_sampler(self) -> str:
+        samplers = self.get_samplers()
+        sampler_name = self.settings.get("sampler_name")
+        return sampler_name if sampler_name in samplers else samplers[0]
+
     def build_common_ui(
         self,
         procedure: Gimp.Procedure,
@@ -144,6 +170,7 @@ class GenerationPluginBase(PluginBase):
         cn1_layer: Gimp.Layer | None,
         cn2_enabled: bool,
         cn2_layer: Gimp.Layer | None,
+        region: CropRegion | None = None,
     ) -> list[dict[str, Any]]:
         """
         Build ControlNet units from configuration.
@@ -153,21 +180,53 @@ class GenerationPluginBase(PluginBase):
             cn1_layer: ControlNet 1 layer
             cn2_enabled: Whether ControlNet 2 is enabled
             cn2_layer: ControlNet 2 layer
+            region: send only this part of the layers, matching a cropped init image
 
         Returns:
             List of ControlNet unit dictionaries
         """
         controlnet_units = []
         if cn1_enabled and cn1_layer:
-            params = getControlNetParams(cn1_layer)
+            params = getControlNetParams(cn1_layer, region)
             if params:
                 controlnet_units.append(params)
         if cn2_enabled and cn2_layer:
-            params = getControlNetParams(cn2_layer)
+            params = getControlNetParams(cn2_layer, region)
             if params:
                 controlnet_units.append(params)
         return controlnet_units
 
+    def selection_region(
+        self,
+        image: Gimp.Image,
+        config_values: dict[str, Any],
+        padding: int,
+    ) -> CropRegion | None:
+        """
+        Part of the image to send instead of all of it: the selection plus ``padding`` pixels of context.
+
+        Returns:
+            The region, None without a selection or if the region would cover the whole image
+        """
+        success, non_empty, x1, y1, x2, y2 = Gimp.Selection.bounds(image)
+        if not non_empty:
+            return None
+        controlnet = (config_values["cn1_enabled"] and config_values["cn1_layer"]) or (
+            config_values["cn2_enabled"] and config_values["cn2_layer"]
+        )
+        region = crop_region(
+            (x1, y1, x2, y2),
+            (image.get_width(), image.get_height()),
+            padding,
+            multiple=CONTROLNET_MULTIPLE if controlnet else SIZE_MULTIPLE,
+            # the dialog size is the working size of the model, smaller regions are generated at it
+            min_side=min(config_values["width"], config_values["height"]),
+        )
+        if region.width >= image.get_width() and region.height >= image.get_height():
+            return None
+        logging.info(f"Cropping the request to {region} of {image.get_width()}x{image.get_height()}")
+        return region
+
     def build_base_data_dict(
         self,
         prompt: str,
@@ -184,25 +243,26 @@ class GenerationPluginBase(PluginBase):
         sampler_index: str,
     ) -> dict[str, Any]:
         """
-        Build base data dictionary with common parameters.
+        Build base data dictionary with common parameters, see ``sg_generation.build_base_data_dict``.
 
         Returns:
             Dictionary with common API parameters
         """
-        return {
-            "prompt": f"{prompt} {self.settings.get('prompt')}".strip(),
-            "negative_prompt": f"{negative_prompt} {self.settings.get('negative_prompt')}".strip(),
-            "seed": seed or -1,
-            "batch_size": min(MAX_BATCH_SIZE, max(1, batch_size)),
-            "steps": int(steps),
-            "cfg_scale": float(cfg_scale),
-            "width": roundToMultiple(width, 8),
-            "height": roundToMultiple(height, 8),
-            "restore_faces": restore_faces,
-            "tiling": tiling,
-            "denoising_strength": float(denoising_strength),
-            "sampler_index": sampler_index if sampler_index in SAMPLERS else SAMPLERS[0],
-        }
+        return build_base_data_dict(
+            self.settings,
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            seed=seed,
+            batch_size=batch_size,
+            steps=steps,
+            cfg_scale=cfg_scale,
+            width=width,
+            height=height,
+            restore_faces=restore_faces,
+            tiling=tiling,
+            denoising_strength=denoising_strength,
+            sampler_index=sampler_index,
+        )
 
     def add_controlnet_to_data(self, data: dict[str, Any], controlnet_units: list[dict[str, Any]]) -> None:
         """
@@ -212,69 +272,94 @@ class GenerationPluginBase(PluginBase):
             data: Data dictionary to modify
             controlnet_units: List of ControlNet unit dictionaries
         """
-        if controlnet_units:
-            data["alwayson_scripts"] = {
-                "controlnet": {
-                    "args": controlnet_units,
-                },
-            }
+        add_controlnet_units(data, controlnet_units)
 
     def call_api_with_progress(
         self,
         endpoint: str,
         data: dict[str, Any],
         progress_text: str | None = None,
-    ) -> dict[str, Any]:
+        image: Gimp.Image | None = None,
+        preview_area: tuple[int, int, int, int] | None = None,
+        cancellable: bool = False,
+        request: Callable[[], dict[str, Any] | StreamedResponse] | None = None,
+    ) -> dict[str, Any] | StreamedResponse:
         """
-        Call API endpoint with progress tracking in background thread.
+        Call API endpoint, tracking progress on the main thread while the request runs in background.
 
         Args:
             endpoint: API endpoint to call
             data: Data to send
             progress_text: Optional progress text
+            image: Image to show live previews in, if enabled in settings
+            preview_area: (x, y, width, height) the previews are placed at, the whole image by default
+            cancellable: show Skip / Cancel buttons (interactive runs only)
+            request: makes the call instead of POSTing ``data``, e.g. waits for a request already sent
 
         Returns:
-            API response dictionary
+            StreamedResponse, or the error dictionary if the call failed
+
+        Raises:
+            GenerationCancelled: the user cancelled, the backend has been interrupted
         """
         if progress_text:
             Gimp.progress_init(progress_text)
         else:
             Gimp.progress_init("")
 
-        logging.debug("starting thread")
-        thread = threading.Thread(target=get_progress_at_background, args=(self.api,), daemon=True)
-        thread.start()
-
-        logging.debug("requesting")
-        response = self.api.post(endpoint, data)
-
-        thread.join()
+        def on_progress(result: dict[str, Any]) -> None:
+            progress = result.get("progress") or 0
+            eta = result.get("eta_relative") or 0
+            Gimp.progress_update(progress)
+            Gimp.progress_set_text(f"Progress: {round(progress * 100, 2)}%, ETA: {round(eta)}s")
+
+        preview = None
+        if image is not None and self.settings.get("progress_previews"):
+            x, y, width, height = preview_area or (0, 0, image.get_width(), image.get_height())
+            max_size = int(self.settings.get("preview_max_size") or DEFAULT_PREVIEW_MAX_SIZE)
+            preview = PreviewLayer(image, x, y, width, height, max_size)
+
+        tracker = ProgressTracker.fromSettings(
+            self.api,
+            self.settings,
+            on_progress=on_progress,
+            on_preview=preview.update if preview is not None else None,
+        )
+        token = CancelToken() if cancellable else None
+        controls = GenerationControls(token, progress_text) if token is not None else None
+        try:
+            # headers arrive once generation is done, the images are read later while layers are created
+            response = tracker.run(
+                request or (lambda: self.api.post_stream(endpoint, data)),
+                cancel=token,
+                on_idle=controls.pump if controls is not None else None,
+            )
+        finally:
+            if controls is not None:
+                controls.destroy()
+            if preview is not None:
+                preview.remove()
+
+        # keep encode and upload measurements for the next run of the plug-in
+        self.settings.save(PAYLOAD_POLICY.export_stats())
 
         return response
 
-    def handle_api_response(
+    def insert_response(
         self,
         image: Gimp.Image,
-        response: dict[str, Any],
-        cn_skip_annotator_layers: bool,
-        selection_width: int,
-        selection_height: int,
-        selection_x: int,
-        selection_y: int,
-        insert_mode: str = INSERT_MODES[0],
+        response: dict[str, Any] | StreamedResponse,
+        placement: dict[str, Any],
     ) -> ResponseLayers:
         """
-        Handle API response and create ResponseLayers.
+        Insert the layers of a response into the image.
 
         Args:
             image: GIMP image
-            response: API response
-            cn_skip_annotator_layers: Whether to skip annotator layers
-            selection_width: Selection width
-            selection_height: Selection height
-            selection_x: Selection X coordinate
-            selection_y: Selection Y coordinate
-            insert_mode: Insert mode strategy
+            response: API response, direct or collected from the job queue
+            placement: ``skip_annotator_layers``, optional ``resize`` ([width, height, insert mode]) and
+                ``translate`` ([x, y]), ``selection_mask`` to mask the layers with the current selection, and
+                ``above``, ids of the layers to insert each image above
 
         Returns:
             ResponseLayers instance
@@ -285,13 +370,451 @@ class GenerationPluginBase(PluginBase):
         response_layers = ResponseLayers(
             image,
             response,
-            {"skip_annotator_layers": cn_skip_annotator_layers},
+            {"skip_annotator_layers": placement.get("skip_annotator_layers", True), "above": placement.get("above")},
         )
-
-        response_layers.resize(
-            selection_width,
-            selection_height,
-            strategy=insert_mode if insert_mode in INSERT_MODES else INSERT_MODES[0],
-        ).translate((selection_x, selection_y)).addSelectionAsMask()
+        if placement.get("resize"):
+            width, height, insert_mode = placement["resize"]
+            strategy = insert_mode if insert_mode in INSERT_MODES else INSERT_MODES[0]
+            response_layers.resize(width, height, strategy=strategy)
+        if placement.get("translate"):
+            response_layers.translate(tuple(placement["translate"]))
+        if placement.get("selection_mask"):
+            response_layers.addSelectionAsMask()
 
         return response_layers
+
+    @staticmethod
+    def denoising_steps(data: dict[str, Any]) -> int:
+        """Steps the backend runs per image, img2img only runs the denoising part of the schedule"""
+        if data.get("init_images"):
+            return max(1, round(data["steps"] * data.get("denoising_strength", 1.0)))
+        return data["steps"]
+
+    def plan_batch(self, data: dict[str, Any]) -> tuple[BatchPlanner, list[BatchChunk]]:
+        """Chunks generating the ``batch_size`` images requested in ``data``"""
+        planner = BatchPlanner.fromSettings(self.settings)
+        steps = self.denoising_steps(data)
+        chunks = planner.plan(
+            data["batch_size"],
+            data["seed"],
+            data["width"],
+            data["height"],
+            steps,
+            # one chunk per backend at least, so they all work on the batch
+            min_chunks=len(backend_urls(self.settings)),
+        )
+        return planner, chunks
+
+    def generate(
+        self,
+        image: Gimp.Image,
+        endpoint: str,
+        data: dict[str, Any],
+        placement: dict[str, Any],
+        progress_text: str,
+        preview_area: tuple[int, int, int, int] | None = None,
+        cancellable: bool = False,
+    ) -> list[ResponseLayers]:
+        """
+        Generate the requested images chunk by chunk, inserting the layers of each chunk as soon as it is done.
+
+        Args:
+            image: GIMP image
+            endpoint: API endpoint to call
+            data: request payload, ``batch_size`` is the total number of images
+            placement: see ``insert_response``
+            progress_text: progress text, the chunk number is appended
+            preview_area: see ``call_api_with_progress``
+            cancellable: see ``call_api_with_progress``
+
+        Returns:
+            ResponseLayers of every chunk
+
+        Raises:
+            GenerationCancelled: the user cancelled, layers of finished chunks stay in the image
+        """
+        # with a fixed seed a repeated request is answered from the response cache, if enabled
+        cache = ResponseCache.fromSettings(self.settings)
+        model = model_requirement(self.settings)
+        batch_key = response_key(endpoint, data, model) if cache is not None else None
+        cached = cache.get_batch(batch_key) if batch_key is not None else None
+        if cached is not None:
+            logging.info(f"Inserting {len(cached)} cached responses, batch {batch_key[:12]}")
+            Gimp.progress_init(_("Inserting layers from response"))
+            inserted = [self.insert_response(image, response, placement) for response in cached]
+            Gimp.displays_flush()
+            return inserted
+
+        planner, chunks = self.plan_batch(data)
+        steps = self.denoising_steps(data)
+        keys = [response_key(endpoint, chunk.apply(data), model) if batch_key else None for chunk in chunks]
+
+        def send(chunk: BatchChunk) -> dict[str, Any] | StreamedResponse:
+            key = keys[chunk.index]
+            # chunks of an interrupted run with the same plan are stored already
+            cached = cache.get(key) if key is not None else None
+            if cached is not None:
+                return cached
+            start = time.perf_counter()
+            response = self.api.post_stream(endpoint, chunk.apply(data))
+            if isinstance(response, StreamedResponse):
+                # the response headers arrive once the backend is done, the images are read while inserting
+                planner.record(chunk.count, data["width"], data["height"], steps, time.perf_counter() - start)
+                if key is not None:
+                    response = cache.store(key, response)
+            return response
+
+        # with several backends the chunks run side by side, their layers are still inserted in seed order
+        parallel = min(len(chunks), len(backend_urls(self.settings)))
+        executor = ThreadPoolExecutor(parallel, thread_name_prefix="chunk") if parallel > 1 else None
+        futures: list[Future] = [executor.submit(send, chunk) for chunk in chunks] if executor is not None else []
+        inserted = []
+        try:
+            for chunk in chunks:
+                suffix = f" ({chunk.index + 1}/{len(chunks)})" if len(chunks) > 1 else ""
+                response = self.call_api_with_progress(
+                    endpoint,
+                    chunk.apply(data),
+                    progress_text=progress_text + suffix,
+                    image=image,
+                    preview_area=preview_area,
+                    cancellable=cancellable,
+                    request=futures[chunk.index].result if futures else lambda chunk=chunk: send(chunk),
+                )
+
+                Gimp.progress_set_text(_("Inserting layers from response"))
+                inserted.append(self.insert_response(image, response, placement))
+                Gimp.displays_flush()
+            if batch_key is not None:
+                cache.store_batch(batch_key, keys)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+                # responses of chunks that are not inserted any more
+                for future in futures[len(inserted) :]:
+                    future.add_done_callback(_close_response)
+            self.settings.save(planner.export_stats())
+        return inserted
+
+    def generate_layers(
+        self,
+        image: Gimp.Image,
+        layers: list[Gimp.Layer],
+        endpoint: str,
+        data: dict[str, Any],
+        placement: dict[str, Any],
+        progress_text: str,
+        region: CropRegion | None = None,
+        preview_area: tuple[int, int, int, int] | None = None,
+        cancellable: bool = False,
+    ) -> list[ResponseLayers]:
+        """
+        Generate from each of ``layers`` as the init image, inserting the results above their source layer.
+
+        Layers of the same size share requests (see ``BatchPlanner.plan_layers``). The layers of a request are read
+        on the main thread when it is submitted and encoded and sent by a worker thread, a few requests per backend
+        ahead of the one being inserted.
+
+        Args:
+            layers: the source layers, top to bottom
+            data: request payload without the init images, ``batch_size`` is the number of images per layer
+            region: send only this part of the layers
+            placement, progress_text, preview_area, cancellable: see ``generate``
+
+        Returns:
+            ResponseLayers of every request
+
+        Raises:
+            GenerationCancelled: the user cancelled, layers of finished requests stay in the image
+        """
+        cache = ResponseCache.fromSettings(self.settings)
+        # planning replaces a random seed with a concrete one, whether to cache is decided on the caller's seed
+        cacheable = cache is not None and deterministic(data)
+        model = model_requirement(self.settings) if cacheable else None
+        planner = BatchPlanner.fromSettings(self.settings)
+        steps = self.denoising_steps({**data, "init_images": layers})
+        sizes = [
+            (layer.get_width(), layer.get_height()) if region is None else (region.width, region.height)
+            for layer in layers
+        ]
+        backends = len(backend_urls(self.settings))
+        chunks = planner.plan_layers(
+            sizes,
+            data["batch_size"],
+            data["seed"],
+            data["width"],
+            data["height"],
+            steps,
+            min_chunks=backends,
+        )
+
+        def send(chunk: LayerChunk, encoders: list[Callable[[], Any]]) -> dict[str, Any] | StreamedResponse:
+            payload = {**chunk.apply(data), "init_images": [encode() for encode in encoders]}
+            key = response_key(endpoint, payload, model) if cacheable else None
+            cached = cache.get(key) if key is not None else None
+            if cached is not None:
+                return cached
+            start = time.perf_counter()
+            response = self.api.post_stream(endpoint, payload)
+            if isinstance(response, StreamedResponse):
+                planner.record(chunk.count, data["width"], data["height"], steps, time.perf_counter() - start)
+                if key is not None:
+                    response = cache.store(key, response)
+            return response
+
+        in_flight = LAYER_CHUNKS_IN_FLIGHT_PER_BACKEND * backends
+        executor = ThreadPoolExecutor(min(in_flight, len(chunks)), thread_name_prefix="layers")
+        futures: deque[Future] = deque()
+        pending = iter(chunks)
+
+        def submit_next() -> None:
+            chunk = next(pending, None)
+            if chunk is not None:
+                # GIMP is only called from the main thread
+                encoders = [getLayerEncoder(layers[source], region) for source in chunk.sources]
+                futures.append(executor.submit(send, chunk, encoders))
+
+        inserted = []
+        try:
+            for _chunk in range(in_flight):
+                submit_next()
+            for chunk in chunks:
+                suffix = f" ({chunk.index + 1}/{len(chunks)})" if len(chunks) > 1 else ""
+                response = self.call_api_with_progress(
+                    endpoint,
+                    chunk.apply(data),
+                    progress_text=progress_text + suffix,
+                    image=image,
+                    preview_area=preview_area,
+                    cancellable=cancellable,
+                    request=futures.popleft().result,
+                )
+                # the next request encodes and uploads while this one is inserted
+                submit_next()
+
+                Gimp.progress_set_text(_("Inserting layers from response"))
+                above = [layers[source].get_id() for source in chunk.targets()]
+                inserted.append(self.insert_response(image, response, {**placement, "above": above}))
+                Gimp.displays_flush()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            # requests sent but not inserted any more
+            for future in futures:
+                future.add_done_callback(_close_response)
+            self.settings.save(planner.export_stats())
+        return inserted
+
+    def upscaled_copy(
+        self,
+        layer: Gimp.Layer,
+        area: tuple[int, int, int, int],
+        factor: float,
+    ) -> tuple[Gimp.Image, Gimp.Layer]:
+        """
+        New image holding ``area`` of ``layer`` scaled by ``factor``, the base a tiled upscale is generated from.
+
+        Returns:
+            The image, shown in a new display, and its only layer
+        """
+        x, y, width, height = area
+        new_image = Gimp.Image.new(width, height, Gimp.ImageBaseType.RGB)
+        new_image.undo_disable()
+        copy = Gimp.Layer.new_from_drawable(layer, new_image)
+        new_image.insert_layer(copy, None, -1)
+        _, offset_x, offset_y = layer.get_offsets()
+        copy.set_offsets(offset_x - x, offset_y - y)
+        copy.resize_to_image_size()
+        new_image.scale(max(1, round(width * factor)), max(1, round(height * factor)))
+        new_image.undo_enable()
+        Gimp.Display.new(new_image)
+        return new_image, copy
+
+    def generate_tiled(
+        self,
+        image: Gimp.Image,
+        source: Gimp.Layer,
+        area: tuple[int, int, int, int],
+        endpoint: str,
+        data: dict[str, Any],
+        grid: TileGrid,
+        progress_text: str,
+        controlnet: Callable[[CropRegion], list[dict[str, Any]]] | None = None,
+        cancellable: bool = False,
+    ) -> Gimp.Layer:
+        """
+        Generate ``area`` of ``source`` tile by tile into a new layer on top of ``image``, see sg_tiles.
+
+        Each tile is read on the main thread and encoded and sent by a worker thread, a few tiles per backend ahead
+        of the one being blended, so encoding, uploads and decoding overlap the generation of other tiles.
+
+        Args:
+            image: image the new layer is added to
+            source: layer of ``image`` the tiles are read from
+            area: (x, y, width, height) in image coordinates, covered by ``grid``
+            endpoint: API endpoint to call
+            data: request payload without the init images, the size is set per tile
+            grid: tiles covering the area
+            progress_text: progress text, the tile number is appended
+            controlnet: ControlNet units for a rectangle of the image, None without ControlNet
+            cancellable: see ``call_api_with_progress``
+
+        Returns:
+            The new layer
+
+        Raises:
+            GenerationCancelled: the user cancelled, the layer keeps the tiles finished so far
+        """
+        x0, y0 = area[:2]
+        # one seed for every tile, random seeds per tile show as a patchwork
+        seed = data["seed"] if data.get("seed", -1) >= 0 else random.randrange(MAX_SEED)
+        output = Gimp.Layer.new(
+            image,
+            _("Tiled, seed {seed}").format(seed=seed),
+            grid.width,
+            grid.height,
+            Gimp.ImageType.RGBA_IMAGE,
+            100,
+            Gimp.LayerMode.NORMAL,
+        )
+        image.undo_group_start()
+        image.insert_layer(output, None, 0)
+        output.set_offsets(x0, y0)
+        reader, writer = Layer(source), Layer(output)
+        logging.info(f"Generating {grid} at {x0},{y0}, seed {seed}")
+
+        def send(tile: Tile, pixels: bytes, units: list[dict[str, Any]]) -> dict[str, Any] | StreamedResponse:
+            channels = len(pixels) // (tile.width * tile.height)
+            image_format = PAYLOAD_POLICY.choose(PAYLOAD_INIT, tile.width, tile.height)
+            payload = {
+                **tile.apply(data),
+                "seed": seed,
+                "init_images": [PAYLOAD_POLICY.encode(pixels, tile.width, tile.height, channels, image_format)],
+            }
+            if units:
+                payload["alwayson_scripts"] = {**data.get("alwayson_scripts", {}), "controlnet": {"args": units}}
+            return self.api.post_stream(endpoint, payload)
+
+        in_flight = TILES_IN_FLIGHT_PER_BACKEND * len(backend_urls(self.settings))
+        executor = ThreadPoolExecutor(in_flight, thread_name_prefix="tile")
+        futures: deque[Future] = deque()
+        pending = iter(grid)
+
+        def submit_next() -> None:
+            tile = next(pending, None)
+            if tile is None:
+                return
+            # GIMP is only called from the main thread
+            rect = (x0 + tile.x, y0 + tile.y, tile.width, tile.height)
+            pixels = reader.readRegion(*rect)
+            units = controlnet(CropRegion(*rect, tile.width, tile.height)) if controlnet is not None else []
+            futures.append(executor.submit(send, tile, pixels, units))
+
+        try:
+            for _tile in range(in_flight):
+                submit_next()
+            for tile in grid:
+                width, height = grid.visible(tile)
+                response = self.call_api_with_progress(
+                    endpoint,
+                    tile.apply(data),
+                    progress_text=f"{progress_text} ({tile.index + 1}/{len(grid)})",
+                    image=image,
+                    preview_area=(x0 + tile.x, y0 + tile.y, width, height),
+                    cancellable=cancellable,
+                    request=futures.popleft().result,
+                )
+                # the next tile uploads while this one is decoded and blended
+                submit_next()
+                if "error" in response:
+                    raise ValueError(f"{response['error']}: {response.get('message', '')}")
+                try:
+                    generated = next(iter(response.images()), None)
+                finally:
+                    response.close()
+                if generated is None:
+                    raise ValueError(f"No image returned for {tile}")
+                decoded = decode_image(generated)
+                if (decoded.width, decoded.height) != (tile.width, tile.height):
+                    raise ValueError(f"{tile} came back as {decoded.width}x{decoded.height}")
+
+                rect = (x0 + tile.x, y0 + tile.y, width, height)
+                written = writer.readRegion(*rect) if tile.overlap_left or tile.overlap_top else None
+                writer.writeRegion(*rect, blend_tile(grid, tile, decoded.pixels, decoded.channels, written))
+                Gimp.displays_flush()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            # tiles sent but not blended any more
+            for future in futures:
+                future.add_done_callback(_close_response)
+            image.undo_group_end()
+        return output
+
+    def queue_client(self) -> WorkerClient:
+        """The job queue lives in the background worker, which is started for it even if requests go direct"""
+        return self.api if isinstance(self.api, WorkerClient) else WorkerClient.fromSettings(self.settings)
+
+    def submit_job(
+        self,
+        image: Gimp.Image,
+        endpoint: str,
+        data: dict[str, Any],
+        placement: dict[str, Any],
+    ) -> bool:
+        """
+        Queue the generation instead of waiting for it, one job per chunk; the results are inserted by the Collect
+        procedure.
+
+        Returns:
+            False if the background worker is not available and the generation has to run now, or its response is
+                cached and inserted right away
+        """
+        cache = ResponseCache.fromSettings(self.settings)
+        batch_key = response_key(endpoint, data, model_requirement(self.settings)) if cache is not None else None
+        if batch_key is not None and cache.get_batch(batch_key) is not None:
+            logging.info("Response is cached, inserting it right away instead of queueing")
+            return False
+        _planner, chunks = self.plan_batch(data)
+        client = self.queue_client()
+        # per backend, the worker spreads the jobs over all of them
+        concurrency = int(self.settings.get("queue_concurrency") or DEFAULT_QUEUE_CONCURRENCY)
+        max_skips = self.settings.get("queue_affinity_max_skips")
+        max_skips = DEFAULT_AFFINITY_MAX_SKIPS if max_skips is None else int(max_skips)
+        # the worker loads this model before running the jobs, whatever is loaded by then
+        model = model_requirement(self.settings)
+        title = data.get("prompt", "")[:80]
+        for chunk in chunks:
+            meta = {
+                "image_id": image.get_id(),
+                "placement": placement,
+                "title": title if len(chunks) == 1 else f"{title} ({chunk.index + 1}/{len(chunks)})",
+            }
+            try:
+                job = client.submit_job(
+                    endpoint,
+                    chunk.apply(data),
+                    meta=meta,
+                    concurrency=concurrency,
+                    model=model,
+                    max_skips=max_skips,
+                )
+            except (WorkerError, OSError) as ex:
+                if not chunk.index:
+                    logging.warning(f"Queueing failed, generating right away: {ex}")
+                    return False
+                # the chunks queued so far run anyway, don't generate them twice
+                logging.exception("ERROR: GenerationPluginBase.submit_job")
+                Gimp.message(
+                    _("Queued {queued} of {total} chunks: {error}").format(
+                        queued=chunk.index,
+                        total=len(chunks),
+                        error=str(ex),
+                    ),
+                )
+                return True
+            logging.info(f"Queued job {job['job_id']} ({chunk}) for image {image.get_id()}")
+        return True
+
+
+def _close_response(future: Future) -> None:
+    if not future.cancelled() and future.exception() is None and isinstance(future.result(), StreamedResponse):
+        future.result().close()
@@ -6,12 +6,23 @@ from typing import Any
 
 import gi
 
-from sg_constants import RESIZE_MODES, SAMPLERS
+from sg_constants import RESIZE_MODES
 from sg_gtk_utils import set_visibility_of
 from sg_i18n import _
 from sg_plugins.generation_base import GenerationPluginBase
-from sg_proc_arguments import PLUGIN_FIELDS_COMMON, PLUGIN_FIELDS_CONTROLNET_OPTIONS, PLUGIN_FIELDS_RESIZE_MODE
-from sg_structures import ResponseLayers, getActiveLayerAsBase64
+from sg_proc_arguments import (
+    PLUGIN_FIELDS_COMMON,
+    PLUGIN_FIELDS_CONTROLNET_OPTIONS,
+    PLUGIN_FIELDS_CROP,
+    PLUGIN_FIELDS_LAYERS,
+    PLUGIN_FIELDS_QUEUE,
+    PLUGIN_FIELDS_RESIZE_MODE,
+    PLUGIN_FIELDS_TILES,
+)
+from sg_progress import GenerationCancelled
+from sg_region import CropRegion
+from sg_structures import expandLayerGroups, getActiveLayerEncoded, getLayerRegionEncoded
+from sg_tiles import TileGrid
 
 gi.require_version("Gimp", "3.0")
 gi.require_version("GimpUi", "3.0")
@@ -22,12 +33,59 @@ class Image2imagePlugin(GenerationPluginBase):
     menu_path = "<Image>/GimpFusion"
     menu_label = _("Image to image")
     description = _("Generate image based on other image")
+    sensitivity_mask = Gimp.ProcedureSensitivityMask.DRAWABLE | Gimp.ProcedureSensitivityMask.DRAWABLES
 
     def add_arguments(self, procedure: Gimp.Procedure) -> None:
         # PLUGIN_FIELDS_IMG2IMG(procedure)
         PLUGIN_FIELDS_RESIZE_MODE(procedure, resize_modes=RESIZE_MODES)
-        PLUGIN_FIELDS_COMMON(procedure, samplers=SAMPLERS, selected_sampler=self.settings.get("sampler_name"))
+        PLUGIN_FIELDS_COMMON(procedure, samplers=self.get_samplers(), selected_sampler=self.get_selected_sampler())
         PLUGIN_FIELDS_CONTROLNET_OPTIONS(procedure)
+        PLUGIN_FIELDS_LAYERS(procedure)
+        PLUGIN_FIELDS_CROP(procedure)
+        PLUGIN_FIELDS_TILES(procedure)
+        PLUGIN_FIELDS_QUEUE(procedure)
+
+    def generate_tiles(
+        self,
+        image: Gimp.Image,
+        area: tuple[int, int, int, int],
+        data: dict[str, Any],
+        config: Gimp.ProcedureConfig,
+        config_values: dict[str, Any],
+        cancellable: bool,
+    ) -> None:
+        """Generate ``area`` of the active layer in tiles, scaled into a new image first if ``tile_upscale`` > 1"""
+        layer = image.get_selected_layers()[0]
+        factor = config.get_property("tile_upscale")
+        controlnet = None
+        if factor > 1:
+            image, layer = self.upscaled_copy(layer, area, factor)
+            area = (0, 0, image.get_width(), image.get_height())
+            if config_values["cn1_enabled"] or config_values["cn2_enabled"]:
+                logging.warning("ControlNet layers are not scaled with the image, upscaling without them")
+        elif config_values["cn1_enabled"] or config_values["cn2_enabled"]:
+
+            def controlnet(region: CropRegion) -> list[dict[str, Any]]:
+                return self.build_controlnet_units(
+                    config_values["cn1_enabled"],
+                    config_values["cn1_layer"],
+                    config_values["cn2_enabled"],
+                    config_values["cn2_layer"],
+                    region,
+                )
+
+        grid = TileGrid(area[2], area[3], config.get_property("tile_size"), config.get_property("tile_overlap"))
+        self.generate_tiled(
+            image,
+            layer,
+            area,
+            "/sdapi/v1/img2img",
+            data,
+            grid,
+            progress_text=_("Calling Stable Diffusion /sdapi/v1/img2img"),
+            controlnet=controlnet,
+            cancellable=cancellable,
+        )
 
     def main(
         self,
@@ -102,6 +160,13 @@ class Image2imagePlugin(GenerationPluginBase):
             dialog.fill(
                 [
                     "cn_skip_annotator_layers",
+                    "all_selected_layers",
+                    "crop_to_selection",
+                    "crop_padding",
+                    "tile_size",
+                    "tile_overlap",
+                    "tile_upscale",
+                    "queue_job",
                 ],
             )
 
@@ -114,6 +179,22 @@ class Image2imagePlugin(GenerationPluginBase):
 
         success, non_empty, x1, y1, x2, y2 = Gimp.Selection.bounds(image)
         selectionWidth, selectionHeight = x2 - x1, y2 - y1
+        width, height = selectionWidth, selectionHeight
+        preview_area = (x1, y1, selectionWidth, selectionHeight)
+        # selections larger than a tile, or upscaled, are generated in tiles
+        tile_size = config.get_property("tile_size")
+        tiled = tile_size > 0 and (config.get_property("tile_upscale") > 1 or max(width, height) > tile_size)
+        layers = expandLayerGroups(drawables) if config.get_property("all_selected_layers") else []
+        if tiled and layers:
+            logging.warning("Tiled generations use the active layer only")
+            layers = []
+
+        region = None
+        if config.get_property("crop_to_selection") and not tiled:
+            region = self.selection_region(image, config_values, config.get_property("crop_padding"))
+        if region is not None:
+            width, height = region.generation_width, region.generation_height
+            preview_area = region.bounds
 
         Gimp.progress_init(_("Saving active layer as base64"))
 
@@ -124,8 +205,8 @@ class Image2imagePlugin(GenerationPluginBase):
             batch_size=config_values["batch_size"],
             steps=config_values["steps"],
             cfg_scale=config_values["cfg_scale"],
-            width=selectionWidth,
-            height=selectionHeight,
+            width=width,
+            height=height,
             restore_faces=config_values["restore_faces"],
             tiling=config_values["tiling"],
             denoising_strength=config_values["denoising_strength"],
@@ -133,19 +214,27 @@ class Image2imagePlugin(GenerationPluginBase):
         )
         data.update(
             {
-                "init_images": [getActiveLayerAsBase64(image)],
                 "resize_mode": RESIZE_MODES.index(resize_mode) if resize_mode in RESIZE_MODES else 0,
                 "mask_blur": mask_blur,
             },
         )
-
-        controlnet_units = self.build_controlnet_units(
-            config_values["cn1_enabled"],
-            config_values["cn1_layer"],
-            config_values["cn2_enabled"],
-            config_values["cn2_layer"],
-        )
-        self.add_controlnet_to_data(data, controlnet_units)
+        if not tiled:
+            # tiles are read and sent one by one, with ControlNet units of their own
+            if not layers:
+                # with several layers, each one is read when its request is sent
+                data["init_images"] = [
+                    getActiveLayerEncoded(image)
+                    if region is None
+                    else getLayerRegionEncoded(image.get_selected_layers()[0], region),
+                ]
+            controlnet_units = self.build_controlnet_units(
+                config_values["cn1_enabled"],
+                config_values["cn1_layer"],
+                config_values["cn2_enabled"],
+                config_values["cn2_layer"],
+                region,
+            )
+            self.add_controlnet_to_data(data, controlnet_units)
 
         # Merge with existing alwayson_scripts if any
         base_scripts = {
@@ -157,27 +246,56 @@ class Image2imagePlugin(GenerationPluginBase):
             base_scripts.update(data["alwayson_scripts"])
         data["alwayson_scripts"] = base_scripts
 
+        placement = {"skip_annotator_layers": config_values["cn_skip_annotator_layers"]}
+        if region is not None:
+            # back onto the region, the padding only gives context
+            placement.update({**region.placement(), "selection_mask": True})
+        if config.get_property("queue_job") and (tiled or layers):
+            logging.info("Tiled and multi-layer generations are not queued, generating right away")
+        elif config.get_property("queue_job") and self.submit_job(image, "/sdapi/v1/img2img", data, placement):
+            return procedure.new_return_values(Gimp.PDBStatusType.SUCCESS, GLib.Error())
+
         try:
-            response = self.call_api_with_progress(
+            if tiled:
+                self.generate_tiles(
+                    image,
+                    (x1, y1, selectionWidth, selectionHeight),
+                    data,
+                    config,
+                    config_values,
+                    cancellable=run_mode == Gimp.RunMode.INTERACTIVE,
+                )
+                return procedure.new_return_values(Gimp.PDBStatusType.SUCCESS, GLib.Error())
+            if layers:
+                self.generate_layers(
+                    image,
+                    layers,
+                    "/sdapi/v1/img2img",
+                    data,
+                    placement,
+                    progress_text=_("Calling Stable Diffusion /sdapi/v1/img2img"),
+                    region=region,
+                    preview_area=preview_area,
+                    cancellable=run_mode == Gimp.RunMode.INTERACTIVE,
+                )
+                return procedure.new_return_values(Gimp.PDBStatusType.SUCCESS, GLib.Error())
+
+            self.generate(
+                image,
                 "/sdapi/v1/img2img",
                 data,
+                placement,
                 progress_text=_("Calling Stable Diffusion /sdapi/v1/img2img"),
+                preview_area=preview_area,
+                cancellable=run_mode == Gimp.RunMode.INTERACTIVE,
             )
-
-            Gimp.progress_set_text(_("Inserting layers from response"))
-
-            if "error" in response:
-                return procedure.new_return_values(
-                    Gimp.PDBStatusType.CALLING_ERROR,
-                    GLib.Error(message=f"{response['error']}: {response.get('message')}"),
-                )
-
-            ResponseLayers(image, response, {"skip_annotator_layers": config_values["cn_skip_annotator_layers"]})
-            # .resize(selectionWidth, selectionHeight).translate((x1, y1)).addSelectionAsMask()
             # Note: img2img doesn't resize/translate by default, but can be added if needed
 
             return procedure.new_return_values(Gimp.PDBStatusType.SUCCESS, GLib.Error())
 
+        except GenerationCancelled:
+            logging.info("Generation cancelled")
+            return procedure.new_return_values(Gimp.PDBStatusType.CANCEL, GLib.Error())
         except Exception as ex:
             logging.exception("ERROR: StableGimpfusionPlugin.imageToImage")
             Gimp.message(_("Error occurred: {error}").format(error=str(ex)))
@@ -7,16 +7,26 @@ from typing import Any
 
 import gi
 
-from sg_constants import GENERATION_MESSAGES, INPAINT_FILL_MODES, RESIZE_MODES, SAMPLERS
+from sg_constants import GENERATION_MESSAGES, INPAINT_FILL_MODES, INSERT_MODES, RESIZE_MODES
 from sg_i18n import _
 from sg_plugins.generation_base import GenerationPluginBase
 from sg_proc_arguments import (
     PLUGIN_FIELDS_COMMON,
     PLUGIN_FIELDS_CONTROLNET_OPTIONS,
+    PLUGIN_FIELDS_CROP,
     PLUGIN_FIELDS_INPAINTING,
+    PLUGIN_FIELDS_LAYERS,
+    PLUGIN_FIELDS_QUEUE,
     PLUGIN_FIELDS_RESIZE_MODE,
 )
-from sg_structures import ResponseLayers, getActiveLayerAsBase64, getActiveMaskAsBase64
+from sg_progress import GenerationCancelled
+from sg_structures import (
+    expandLayerGroups,
+    getActiveLayerEncoded,
+    getActiveMaskEncoded,
+    getLayerRegionEncoded,
+    getSelectionRegionEncoded,
+)
 
 gi.require_version("Gimp", "3.0")
 gi.require_version("GimpUi", "3.0")
@@ -27,14 +37,18 @@ class InpaintingPlugin(GenerationPluginBase):
     menu_path = "<Image>/GimpFusion"
     menu_label = _("Inpainting")
     description = _("Inpainting in existing image")
+    sensitivity_mask = Gimp.ProcedureSensitivityMask.DRAWABLE | Gimp.ProcedureSensitivityMask.DRAWABLES
 
     def add_arguments(self, procedure: Gimp.Procedure) -> None:
         # PLUGIN_FIELDS_IMG2IMG
         PLUGIN_FIELDS_RESIZE_MODE(procedure, resize_modes=RESIZE_MODES)
         # PLUGIN_FIELDS_TXT2IMG(procedure)
-        PLUGIN_FIELDS_COMMON(procedure, samplers=SAMPLERS, selected_sampler=self.settings.get("sampler_name"))
+        PLUGIN_FIELDS_COMMON(procedure, samplers=self.get_samplers(), selected_sampler=self.get_selected_sampler())
         PLUGIN_FIELDS_CONTROLNET_OPTIONS(procedure)
         PLUGIN_FIELDS_INPAINTING(procedure, inpaint_fill_modes=INPAINT_FILL_MODES)
+        PLUGIN_FIELDS_LAYERS(procedure)
+        PLUGIN_FIELDS_CROP(procedure)
+        PLUGIN_FIELDS_QUEUE(procedure)
 
     def main(
         self,
@@ -74,6 +88,10 @@ class InpaintingPlugin(GenerationPluginBase):
                     "invert_mask",
                     "inpaint_full_res",
                     "inpainting_fill",
+                    "all_selected_layers",
+                    "crop_to_selection",
+                    "crop_padding",
+                    "queue_job",
                 ],
             )
 
@@ -90,10 +108,30 @@ class InpaintingPlugin(GenerationPluginBase):
 
         success, non_empty, x1, y1, x2, y2 = Gimp.Selection.bounds(image)
         origWidth, origHeight = x2 - x1, y2 - y1
+        width, height = config_values["width"], config_values["height"]
+        preview_area = (x1, y1, origWidth, origHeight)
+        layers = expandLayerGroups(drawables) if config.get_property("all_selected_layers") else []
+        if layers and not non_empty:
+            # the layer masks differ from layer to layer, the selection is shared by all requests
+            return procedure.new_return_values(
+                Gimp.PDBStatusType.CALLING_ERROR,
+                GLib.Error(message=_("Inpainting several layers must use a selection")),
+            )
 
-        init_images = [getActiveLayerAsBase64(image)]
-        mask = getActiveMaskAsBase64(image)
-        if not mask:
+        region = None
+        if config.get_property("crop_to_selection"):
+            region = self.selection_region(image, config_values, config.get_property("crop_padding"))
+        if region is not None:
+            # only the selection and its surroundings are uploaded and diffused
+            init_images = [] if layers else [getLayerRegionEncoded(image.get_selected_layers()[0], region)]
+            mask = getSelectionRegionEncoded(image, region)
+            width, height = region.generation_width, region.generation_height
+            preview_area = region.bounds
+        else:
+            # with several layers, each one is read when its request is sent
+            init_images = [] if layers else [getActiveLayerEncoded(image)]
+            mask = getActiveMaskEncoded(image)
+        if mask is None:
             return procedure.new_return_values(
                 Gimp.PDBStatusType.CALLING_ERROR,
                 GLib.Error(message=_("Inpainting must use either a selection or layer mask")),
@@ -106,8 +144,8 @@ class InpaintingPlugin(GenerationPluginBase):
             batch_size=config_values["batch_size"],
             steps=config_values["steps"],
             cfg_scale=config_values["cfg_scale"],
-            width=config_values["width"],
-            height=config_values["height"],
+            width=width,
+            height=height,
             restore_faces=config_values["restore_faces"],
             tiling=config_values["tiling"],
             denoising_strength=config_values["denoising_strength"],
@@ -134,24 +172,56 @@ class InpaintingPlugin(GenerationPluginBase):
                 config_values["cn1_layer"],
                 config_values["cn2_enabled"],
                 config_values["cn2_layer"],
+                region,
             )
             self.add_controlnet_to_data(data, controlnet_units)
 
-            response = self.call_api_with_progress(
+            placement = {
+                "skip_annotator_layers": config_values["cn_skip_annotator_layers"],
+                "resize": [
+                    image.get_width() if inpaint_full_res else origWidth,
+                    image.get_height() if inpaint_full_res else origHeight,
+                    INSERT_MODES[0],
+                ],
+            }
+            if region is not None:
+                placement.update(region.placement())
+                # the inverted mask regenerates around the selection, masking the layers would hide it
+                placement["selection_mask"] = not invert_mask
+            if config.get_property("queue_job") and layers:
+                logging.info("Multi-layer generations are not queued, generating right away")
+            elif config.get_property("queue_job") and self.submit_job(image, "/sdapi/v1/img2img", data, placement):
+                return procedure.new_return_values(Gimp.PDBStatusType.SUCCESS, GLib.Error())
+
+            if layers:
+                self.generate_layers(
+                    image,
+                    layers,
+                    "/sdapi/v1/img2img",
+                    data,
+                    placement,
+                    progress_text=random.choice(GENERATION_MESSAGES),
+                    region=region,
+                    preview_area=preview_area,
+                    cancellable=run_mode == Gimp.RunMode.INTERACTIVE,
+                )
+                return procedure.new_return_values(Gimp.PDBStatusType.SUCCESS, GLib.Error())
+
+            self.generate(
+                image,
                 "/sdapi/v1/img2img",
                 data,
+                placement,
                 progress_text=random.choice(GENERATION_MESSAGES),
-            )
-
-            ResponseLayers(
-                image, response, {"skip_annotator_layers": config_values["cn_skip_annotator_layers"]}
-            ).resize(
-                image.get_width() if inpaint_full_res else origWidth,
-                image.get_height() if inpaint_full_res else origHeight,
+                preview_area=preview_area,
+                cancellable=run_mode == Gimp.RunMode.INTERACTIVE,
             )
 
             return procedure.new_return_values(Gimp.PDBStatusType.SUCCESS, GLib.Error())
 
+        except GenerationCancelled:
+            logging.info("Generation cancelled")
+            return procedure.new_return_values(Gimp.PDBStatusType.CANCEL, GLib.Error())
         except Exception as ex:
             logging.exception("ERROR: StableGimpfusionPlugin.inpainting")
             Gimp.message(_("Error occurred: {error}").format(error=str(ex)))
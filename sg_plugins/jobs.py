@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import logging
+import time
+
+from typing import Any
+
+import gi
+
+from sg_i18n import _
+from sg_jobs import FINISHED_STATES, JOB_DONE, JOB_FAILED, PENDING_STATES
+from sg_plugins.generation_base import GenerationPluginBase
+
+gi.require_version("Gimp", "3.0")
+gi.require_version("GimpUi", "3.0")
+from gi.repository import Gimp, GLib, GObject
+
+# Seconds between looks at the queue while waiting for pending jobs
+JOB_POLL_INTERVAL = 1.0
+
+
+class JobsCollectPlugin(GenerationPluginBase):
+    menu_path = "<Image>/GimpFusion/Jobs"
+    menu_label = _("Collect results")
+    description = _("Insert the results of generations queued for this image")
+    sensitivity_mask = Gimp.ProcedureSensitivityMask.ALWAYS
+
+    def add_arguments(self, procedure: Gimp.Procedure) -> None:
+        procedure.add_boolean_argument(
+            "wait",
+            _("Wait for pending jobs"),
+            _("Keep collecting until every job queued for this image has finished"),
+            True,
+            GObject.ParamFlags.READWRITE,
+        )
+
+    def main(
+        self,
+        procedure: Gimp.Procedure,
+        run_mode: Gimp.RunMode,
+        image: Gimp.Image,
+        drawables: list[Gimp.Drawable],
+        config: Gimp.ProcedureConfig,
+        data: Any,
+    ) -> Gimp.ProcedureReturn:
+        client = self.queue_client()
+        wait = config.get_property("wait")
+        collected = 0
+        failed = []
+
+        Gimp.progress_init(_("Collecting queued generations"))
+        try:
+            while True:
+                jobs = client.jobs(image.get_id())
+                for job in jobs:
+                    if job["status"] == JOB_DONE:
+                        Gimp.progress_set_text(_("Inserting layers of {title}").format(title=job["meta"].get("title")))
+                        self.insert_response(image, client.collect_job(job["job_id"]), job["meta"]["placement"])
+                        Gimp.displays_flush()
+                        collected += 1
+                    elif job["status"] == JOB_FAILED:
+                        failed.append(f"{job['meta'].get('title')}: {job['error']}")
+                    if job["status"] in FINISHED_STATES:
+                        client.forget_job(job["job_id"])
+
+                pending = sum(job["status"] in PENDING_STATES for job in jobs)
+                if not pending or not wait:
+                    break
+                Gimp.progress_set_text(_("Waiting for {count} queued generations").format(count=pending))
+                Gimp.progress_pulse()
+                time.sleep(JOB_POLL_INTERVAL)
+
+            if failed:
+                Gimp.message(_("Queued generations failed:") + "\n" + "\n".join(failed))
+            elif not collected:
+                Gimp.message(_("No queued generations for this image"))
+            logging.info(f"Collected {collected} jobs, {len(failed)} failed, for image {image.get_id()}")
+            return procedure.new_return_values(Gimp.PDBStatusType.SUCCESS, GLib.Error())
+
+        except Exception as ex:
+            logging.exception("ERROR: StableGimpfusionPlugin.collectJobs")
+            Gimp.message(_("Error occurred: {error}").format(error=str(ex)))
+            return procedure.new_return_values(
+                Gimp.PDBStatusType.CALLING_ERROR,
+                GLib.Error(message=repr(ex)),
+            )
+        finally:
+            Gimp.progress_end()
+
+
+class JobsCancelPlugin(GenerationPluginBase):
+    menu_path = "<Image>/GimpFusion/Jobs"
+    menu_label = _("Cancel queued")
+    description = _("Cancel the generations queued for this image")
+    sensitivity_mask = Gimp.ProcedureSensitivityMask.ALWAYS
+
+    def add_arguments(self, procedure: Gimp.Procedure) -> None: ...
+
+    def main(
+        self,
+        procedure: Gimp.Procedure,
+        run_mode: Gimp.RunMode,
+        image: Gimp.Image,
+        drawables: list[Gimp.Drawable],
+        config: Gimp.ProcedureConfig,
+        data: Any,
+    ) -> Gimp.ProcedureReturn:
+        client = self.queue_client()
+        cancelled = 0
+        for job in client.jobs(image.get_id()):
+            if job["status"] in PENDING_STATES and client.cancel_job(job["job_id"]):
+                client.forget_job(job["job_id"])
+                cancelled += 1
+
+        Gimp.message(_("Cancelled {count} queued generations").format(count=cancelled))
+        return procedure.new_return_values(Gimp.PDBStatusType.SUCCESS, GLib.Error())
@@ -6,11 +6,12 @@ from typing import Any
 
 import gi
 
-from sg_constants import INSERT_MODES, SAMPLERS
+from sg_constants import INSERT_MODES
 from sg_gtk_utils import set_visibility_of
 from sg_i18n import _
 from sg_plugins.generation_base import GenerationPluginBase
-from sg_proc_arguments import PLUGIN_FIELDS_COMMON, PLUGIN_FIELDS_CONTROLNET_OPTIONS
+from sg_proc_arguments import PLUGIN_FIELDS_COMMON, PLUGIN_FIELDS_CONTROLNET_OPTIONS, PLUGIN_FIELDS_QUEUE
+from sg_progress import GenerationCancelled
 
 gi.require_version("Gimp", "3.0")
 gi.require_version("GimpUi", "3.0")
@@ -24,8 +25,9 @@ class Txt2imagePlugin(GenerationPluginBase):
 
     def add_arguments(self, procedure: Gimp.Procedure) -> None:
         # PLUGIN_FIELDS_TXT2IMG =
-        PLUGIN_FIELDS_COMMON(procedure, samplers=SAMPLERS, selected_sampler=self.settings.get("sampler_name"))
+        PLUGIN_FIELDS_COMMON(procedure, samplers=self.get_samplers(), selected_sampler=self.get_selected_sampler())
         PLUGIN_FIELDS_CONTROLNET_OPTIONS(procedure)
+        PLUGIN_FIELDS_QUEUE(procedure)
 
     def main(
         self,
@@ -92,6 +94,7 @@ class Txt2imagePlugin(GenerationPluginBase):
                 [
                     "cn_skip_annotator_layers",
                     "insert_mode",
+                    "queue_job",
                 ],
             )
 
@@ -133,28 +136,31 @@ class Txt2imagePlugin(GenerationPluginBase):
         )
         self.add_controlnet_to_data(data, controlnet_units)
 
+        placement = {
+            "skip_annotator_layers": config_values["cn_skip_annotator_layers"],
+            "resize": [selectionWidth, selectionHeight, insert_mode],
+            "translate": [x1, y1],
+            "selection_mask": True,
+        }
+        if config.get_property("queue_job") and self.submit_job(image, "/sdapi/v1/txt2img", data, placement):
+            return procedure.new_return_values(Gimp.PDBStatusType.SUCCESS, GLib.Error())
+
         try:
-            response = self.call_api_with_progress(
+            self.generate(
+                image,
                 "/sdapi/v1/txt2img",
                 data,
+                placement,
                 progress_text=_("Calling Stable Diffusion /sdapi/v1/txt2img"),
-            )
-
-            Gimp.progress_set_text(_("Inserting layers from response"))
-
-            self.handle_api_response(
-                image,
-                response,
-                config_values["cn_skip_annotator_layers"],
-                selectionWidth,
-                selectionHeight,
-                x1,
-                y1,
-                insert_mode,
+                preview_area=(x1, y1, selectionWidth, selectionHeight),
+                cancellable=run_mode == Gimp.RunMode.INTERACTIVE,
             )
 
             return procedure.new_return_values(Gimp.PDBStatusType.SUCCESS, GLib.Error())
 
+        except GenerationCancelled:
+            logging.info("Generation cancelled")
+            return procedure.new_return_values(Gimp.PDBStatusType.CANCEL, GLib.Error())
         except Exception as ex:
             logging.exception("ERROR: StableGimpfusionPlugin.textToImage")
             Gimp.message(_("Error occurred: {error}").format(error=str(ex)))
@@ -0,0 +1,164 @@
+"""
+Minimal in-memory PNG encoder for 8-bit pixel buffers read from GEGL.
+
+NumPy is optional: without it only the ``none`` row filter is available, which is still a valid (if larger)
+PNG. With NumPy every filter type is computed for whole blocks of rows at once.
+"""
+
+from __future__ import annotations
+
+import logging
+import struct
+import zlib
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - depends on the GIMP Python environment
+    np = None
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# channels -> PNG color type
+COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+PNG_FILTERS = ["none", "sub", "up", "average", "paeth", "adaptive"]
+
+ZLIB_STRATEGIES = {
+    "default": zlib.Z_DEFAULT_STRATEGY,
+    "filtered": zlib.Z_FILTERED,
+    "huffman": zlib.Z_HUFFMAN_ONLY,
+    "rle": zlib.Z_RLE,
+    "fixed": zlib.Z_FIXED,
+}
+
+DEFAULT_PNG_COMPRESS_LEVEL = 6
+DEFAULT_PNG_FILTER = "up"
+DEFAULT_ZLIB_STRATEGY = "default"
+
+# Size of a block of rows filtered at once
+BLOCK_BYTES = 1 << 20
+
+
+def has_numpy() -> bool:
+    return np is not None
+
+
+def _chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+
+def _filter_none(view: memoryview, stride: int, height: int) -> bytes:
+    return b"".join(b"\x00" + view[y * stride : (y + 1) * stride] for y in range(height))
+
+
+def _filter_rows(rows: np.ndarray, previous: np.ndarray | None, bpp: int, png_filter: str) -> np.ndarray:
+    """
+    Apply a PNG row filter to a block of rows at once.
+
+    Args:
+        rows: uint8 array of shape (block_height, stride)
+        previous: the row above the block, None for the first block
+        bpp: bytes per pixel
+        png_filter: one of PNG_FILTERS
+
+    Returns:
+        uint8 array of shape (block_height, stride + 1), each row prefixed with its filter type byte
+    """
+    x = rows.astype(np.int16)
+    left = np.zeros_like(x)
+    left[:, bpp:] = x[:, :-bpp]
+    up = np.zeros_like(x)
+    up[1:] = x[:-1]
+    if previous is not None:
+        up[0] = previous
+
+    def paeth() -> np.ndarray:
+        upper_left = np.zeros_like(x)
+        upper_left[:, bpp:] = up[:, :-bpp]
+        p = left + up - upper_left
+        pa = np.abs(p - left)
+        pb = np.abs(p - up)
+        pc = np.abs(p - upper_left)
+        return np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, upper_left))
+
+    predictors = {
+        "none": lambda: 0,
+        "sub": lambda: left,
+        "up": lambda: up,
+        "average": lambda: (left + up) >> 1,
+        "paeth": paeth,
+    }
+
+    if png_filter != "adaptive":
+        filter_type = PNG_FILTERS.index(png_filter)
+        filtered = (x - predictors[png_filter]()).astype(np.uint8)
+        types = np.full((x.shape[0], 1), filter_type, dtype=np.uint8)
+        return np.hstack([types, filtered])
+
+    # libpng heuristic: per row, pick the filter with the minimal sum of absolute signed residuals
+    candidates = np.stack([(x - predictor()).astype(np.uint8) for predictor in predictors.values()])
+    scores = np.abs(candidates.view(np.int8).astype(np.int16)).sum(axis=2, dtype=np.int64)
+    best = scores.argmin(axis=0)
+    filtered = candidates[best, np.arange(x.shape[0])]
+    return np.hstack([best.astype(np.uint8)[:, None], filtered])
+
+
+def encode_png(
+    pixels: bytes,
+    width: int,
+    height: int,
+    channels: int,
+    level: int = DEFAULT_PNG_COMPRESS_LEVEL,
+    png_filter: str = DEFAULT_PNG_FILTER,
+    strategy: str = DEFAULT_ZLIB_STRATEGY,
+) -> bytes:
+    """
+    Encode packed 8-bit pixels as PNG.
+
+    Args:
+        pixels: packed rows, ``width * height * channels`` bytes (e.g. GEGL "R'G'B'A u8")
+        width: image width
+        height: image height
+        channels: 1 (gray), 2 (gray + alpha), 3 (RGB) or 4 (RGBA)
+        level: zlib compression level, 0-9
+        png_filter: PNG row filter, one of PNG_FILTERS
+        strategy: zlib strategy, one of ZLIB_STRATEGIES
+
+    Returns:
+        PNG file contents
+    """
+    stride = width * channels
+    if len(pixels) != stride * height:
+        raise ValueError(f"Expected {stride * height} bytes for {width}x{height}x{channels}, got {len(pixels)}")
+
+    if png_filter not in PNG_FILTERS:
+        png_filter = DEFAULT_PNG_FILTER
+    if png_filter != "none" and np is None:
+        logging.debug(f"NumPy is not available, PNG filter {png_filter} replaced with none")
+        png_filter = "none"
+
+    compressor = zlib.compressobj(
+        max(0, min(9, int(level))),
+        zlib.DEFLATED,
+        zlib.MAX_WBITS,
+        9,
+        ZLIB_STRATEGIES.get(strategy, zlib.Z_DEFAULT_STRATEGY),
+    )
+    parts = []
+    # filter in blocks of rows so the temporaries stay a few MB even for huge canvases
+    block_height = max(1, BLOCK_BYTES // max(1, stride))
+    rows = None if png_filter == "none" else np.frombuffer(pixels, dtype=np.uint8).reshape(height, stride)
+    view = memoryview(pixels)
+    for start in range(0, height, block_height):
+        end = min(height, start + block_height)
+        if rows is None:
+            raw = _filter_none(view[start * stride : end * stride], stride, end - start)
+        else:
+            previous = rows[start - 1] if start else None
+            raw = _filter_rows(rows[start:end], previous, channels, png_filter).tobytes()
+        parts.append(compressor.compress(raw))
+    parts.append(compressor.flush())
+    compressed = b"".join(parts)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, COLOR_TYPES[channels], 0, 0, 0)
+    return PNG_SIGNATURE + _chunk(b"IHDR", header) + _chunk(b"IDAT", compressed) + _chunk(b"IEND", b"")
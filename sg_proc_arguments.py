@@ -2,8 +2,10 @@ from __future__ import annotations
 
 from gi.repository import Gimp, GObject
 
-from sg_constants import INSERT_MODES
+from sg_constants import INSERT_MODES, MAX_BATCH_IMAGES
 from sg_i18n import _
+from sg_region import DEFAULT_CROP_PADDING
+from sg_tiles import DEFAULT_TILE_OVERLAP
 from sg_utils import make_choice_from_list
 
 
@@ -86,7 +88,7 @@ def PLUGIN_FIELDS_COMMON(procedure: Gimp.Procedure, samplers: list[str], selecte
         _("Batch count"),
         _("Specifies the number of results you want to get."),
         1,
-        20,
+        MAX_BATCH_IMAGES,
         1,
         GObject.ParamFlags.READWRITE,
     )
@@ -241,6 +243,75 @@ def PLUGIN_FIELDS_CONTROLNET_OPTIONS(procedure: Gimp.Procedure) -> None:
     )
 
 
+def PLUGIN_FIELDS_QUEUE(procedure: Gimp.Procedure) -> None:
+    procedure.add_boolean_argument(
+        "queue_job",
+        _("Queue in background"),
+        _("Return right away and generate in the background; insert the results with GimpFusion > Jobs > Collect"),
+        False,
+        GObject.ParamFlags.READWRITE,
+    )
+
+
+def PLUGIN_FIELDS_LAYERS(procedure: Gimp.Procedure) -> None:
+    procedure.add_boolean_argument(
+        "all_selected_layers",
+        _("Every selected layer"),
+        _("Generate from every selected layer, and every layer in selected groups, each result above its source"),
+        False,
+        GObject.ParamFlags.READWRITE,
+    )
+
+
+def PLUGIN_FIELDS_CROP(procedure: Gimp.Procedure) -> None:
+    procedure.add_boolean_argument(
+        "crop_to_selection",
+        _("Crop to selection"),
+        _("Send only the selection plus some context instead of the whole image and put the result back in place"),
+        False,
+        GObject.ParamFlags.READWRITE,
+    )
+    procedure.add_int_argument(
+        "crop_padding",
+        _("Crop padding"),
+        _("Pixels of context around the selection sent along when cropping"),
+        0,
+        1024,
+        DEFAULT_CROP_PADDING,
+        GObject.ParamFlags.READWRITE,
+    )
+
+
+def PLUGIN_FIELDS_TILES(procedure: Gimp.Procedure) -> None:
+    procedure.add_int_argument(
+        "tile_size",
+        _("Tile size"),
+        _("Generate selections larger than this in overlapping tiles, one request each; 0 sends them at once"),
+        0,
+        4096,
+        0,
+        GObject.ParamFlags.READWRITE,
+    )
+    procedure.add_int_argument(
+        "tile_overlap",
+        _("Tile overlap"),
+        _("Pixels neighbouring tiles share, blended so no seams show"),
+        0,
+        512,
+        DEFAULT_TILE_OVERLAP,
+        GObject.ParamFlags.READWRITE,
+    )
+    procedure.add_double_argument(
+        "tile_upscale",
+        _("Tile upscale"),
+        _("Scale the selection into a new image by this factor before generating it in tiles"),
+        1.0,
+        8.0,
+        1.0,
+        GObject.ParamFlags.READWRITE,
+    )
+
+
 def PLUGIN_FIELDS_RESIZE_MODE(procedure: Gimp.Procedure, resize_modes: list[str]) -> None:
     procedure.add_choice_argument(
         "resize_mode",
@@ -0,0 +1,268 @@
+"""
+Progress tracking of generation requests.
+
+The request runs in a worker thread while the calling (main) thread polls ``/sdapi/v1/progress``, so every GIMP
+call stays on the main thread and the result is handed back the moment it arrives instead of after the next
+poll. The poll interval follows the ETA reported by the backend: short jobs are polled often, long ones rarely.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+import weakref
+
+from collections.abc import Callable
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import TYPE_CHECKING, Any, TypeVar
+
+if TYPE_CHECKING:
+    from sg_api import ApiClient
+
+PROGRESS_ENDPOINT = "/sdapi/v1/progress"
+
+DEFAULT_MIN_POLL_INTERVAL = 0.25
+DEFAULT_MAX_POLL_INTERVAL = 2.0
+# Poll interval while the job waits in the backend queue and has no ETA yet
+QUEUED_POLL_INTERVAL = 0.5
+# Fraction of the remaining time to wait before the next poll
+ETA_POLL_FRACTION = 0.2
+# A slow poll delays handing back the finished result, keep it short
+PROGRESS_READ_TIMEOUT = 2.0
+
+# How often the calling thread looks at the cancel token and runs ``on_idle`` between polls
+CANCEL_CHECK_INTERVAL = 0.1
+CANCEL_REQUEST_TIMEOUT = 2.0
+
+DEFAULT_PREVIEW_INTERVAL = 1.0
+DEFAULT_PREVIEW_MAX_KBPS = 4000
+DEFAULT_PREVIEW_MAX_SIZE = 512
+
+T = TypeVar("T")
+
+# Trackers with a request in flight, interrupted when the plug-in process is told to quit
+_running_trackers: weakref.WeakSet = weakref.WeakSet()
+
+
+class GenerationCancelled(Exception):
+    """The user cancelled a running generation, the backend was told to interrupt it"""
+
+
+class CancelToken:
+    """Cancel and skip requests from the UI, read by ProgressTracker on the thread running the request"""
+
+    def __init__(self) -> None:
+        self._cancelled = threading.Event()
+        self._skips = 0
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    def skip(self) -> None:
+        """Skip the image of the batch being generated, the rest of the batch continues"""
+        with self._lock:
+            self._skips += 1
+
+    def take_skip(self) -> bool:
+        with self._lock:
+            if not self._skips:
+                return False
+            self._skips -= 1
+            return True
+
+
+def interrupt_running() -> None:
+    """Interrupt every generation still in flight, e.g. when GIMP closes the plug-in"""
+    for tracker in list(_running_trackers):
+        tracker.interrupt()
+
+
+def next_poll_interval(
+    result: dict[str, Any] | None,
+    min_interval: float = DEFAULT_MIN_POLL_INTERVAL,
+    max_interval: float = DEFAULT_MAX_POLL_INTERVAL,
+) -> float:
+    """Seconds until the next progress poll, from the last progress response"""
+    if not result:
+        return max_interval
+    eta = result.get("eta_relative") or 0
+    if eta <= 0 or not result.get("progress"):
+        return max(min_interval, min(max_interval, QUEUED_POLL_INTERVAL))
+    return max(min_interval, min(max_interval, eta * ETA_POLL_FRACTION))
+
+
+class ProgressTracker:
+    """
+    Runs a request while polling the backend for progress.
+
+    ``on_progress`` gets every progress response. With ``on_preview`` set, the live preview (``current_image``)
+    is requested at most every ``preview_interval`` seconds and no faster than ``preview_max_bytes_per_second``
+    allows for the size of the previous one; other polls keep sending ``skip_current_image``.
+    """
+
+    def __init__(
+        self,
+        api: ApiClient,
+        on_progress: Callable[[dict[str, Any]], None] | None = None,
+        on_preview: Callable[[str], None] | None = None,
+        min_interval: float = DEFAULT_MIN_POLL_INTERVAL,
+        max_interval: float = DEFAULT_MAX_POLL_INTERVAL,
+        preview_interval: float = DEFAULT_PREVIEW_INTERVAL,
+        preview_max_bytes_per_second: float = DEFAULT_PREVIEW_MAX_KBPS * 1000,
+    ) -> None:
+        self.api = api
+        self.on_progress = on_progress
+        self.on_preview = on_preview
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.preview_interval = preview_interval
+        self.preview_max_bytes_per_second = preview_max_bytes_per_second
+        self.polls = 0
+        self.previews = 0
+        self.preview_bytes = 0
+        self._next_preview = 0.0
+        self._last_preview: str | None = None
+
+    @classmethod
+    def fromSettings(cls, api: ApiClient, settings: Any, **kwargs: Any) -> ProgressTracker:
+        return cls(
+            api,
+            min_interval=float(settings.get("progress_min_interval") or DEFAULT_MIN_POLL_INTERVAL),
+            max_interval=float(settings.get("progress_max_interval") or DEFAULT_MAX_POLL_INTERVAL),
+            preview_interval=float(settings.get("preview_interval") or DEFAULT_PREVIEW_INTERVAL),
+            preview_max_bytes_per_second=float(settings.get("preview_max_kbps") or DEFAULT_PREVIEW_MAX_KBPS) * 1000,
+            **kwargs,
+        )
+
+    def run(
+        self,
+        request: Callable[[], T],
+        cancel: CancelToken | None = None,
+        on_idle: Callable[[], None] | None = None,
+    ) -> T:
+        """
+        Run ``request`` in a worker thread and poll progress until it returns (or raises).
+
+        Args:
+            request: the generation call
+            cancel: checked every CANCEL_CHECK_INTERVAL; a skip is forwarded to the backend, a cancel interrupts
+                the backend, tears down the connection and raises GenerationCancelled without waiting for it
+            on_idle: called as often as the token is checked, e.g. to process pending UI events
+
+        Raises:
+            GenerationCancelled: the token was cancelled
+        """
+        future: Future = Future()
+
+        def worker() -> None:
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(request())
+            except BaseException as ex:
+                future.set_exception(ex)
+
+        start = time.perf_counter()
+        threading.Thread(target=worker, name="sg-request", daemon=True).start()
+        _running_trackers.add(self)
+        check_interval = CANCEL_CHECK_INTERVAL if cancel is not None or on_idle is not None else None
+        next_poll = time.monotonic() + QUEUED_POLL_INTERVAL
+        try:
+            while True:
+                wait = max(0.0, next_poll - time.monotonic())
+                try:
+                    return future.result(timeout=min(wait, check_interval) if check_interval else wait)
+                except FutureTimeoutError:
+                    pass
+                if on_idle is not None:
+                    on_idle()
+                if cancel is not None:
+                    if cancel.cancelled:
+                        self.interrupt()
+                        future.add_done_callback(_release_result)
+                        raise GenerationCancelled
+                    if cancel.take_skip():
+                        self._send(self.api.skip, "skip")
+                if time.monotonic() >= next_poll:
+                    result = self.poll()
+                    next_poll = time.monotonic() + next_poll_interval(result, self.min_interval, self.max_interval)
+        finally:
+            _running_trackers.discard(self)
+            logging.debug(
+                f"Request took {time.perf_counter() - start:.2f}s, {self.polls} progress polls, "
+                f"{self.previews} previews ({self.preview_bytes} bytes)",
+            )
+
+    def interrupt(self) -> None:
+        """Stop the generation on the backend and drop the connections of requests in flight"""
+        start = time.perf_counter()
+        self._send(self.api.interrupt, "interrupt")
+        self.api.abort()
+        logging.info(f"Generation interrupted in {time.perf_counter() - start:.3f}s")
+
+    def _send(self, call: Callable[..., Any], name: str) -> None:
+        try:
+            call(timeout=CANCEL_REQUEST_TIMEOUT)
+        except Exception as ex:
+            logging.warning(f"Sending {name} to the backend failed: {ex}")
+
+    def poll(self) -> dict[str, Any] | None:
+        """One progress request, None if it failed"""
+        want_preview = self.on_preview is not None and time.monotonic() >= self._next_preview
+        try:
+            result = self.api.get(
+                PROGRESS_ENDPOINT,
+                params={"skip_current_image": "false" if want_preview else "true"},
+                timeout=PROGRESS_READ_TIMEOUT,
+                log_errors=False,
+            )
+        except Exception as ex:
+            logging.debug(f"Progress poll failed: {ex}")
+            return None
+        self.polls += 1
+        if not isinstance(result, dict) or "progress" not in result:
+            logging.debug(f"Invalid progress response: {result}")
+            return None
+        logging.debug(
+            f"progress {result.get('progress')}, eta {result.get('eta_relative')}, state {result.get('state')}",
+        )
+        if self.on_progress is not None:
+            self.on_progress(result)
+        if want_preview:
+            self._handle_preview(result.get("current_image"))
+        return result
+
+    def _handle_preview(self, image: str | None) -> None:
+        if not image:
+            # no preview rendered yet, ask again at the next poll
+            return
+        # the download is paid for even when the backend sends the same frame again
+        self.preview_bytes += len(image)
+        self._next_preview = time.monotonic() + max(
+            self.preview_interval,
+            len(image) / max(1.0, self.preview_max_bytes_per_second),
+        )
+        if image == self._last_preview:
+            return
+        self._last_preview = image
+        self.previews += 1
+        try:
+            self.on_preview(image)
+        except Exception as ex:
+            logging.warning(f"Showing the preview failed: {ex}")
+
+
+def _release_result(future: Future) -> None:
+    """Close a response that arrived after its request was cancelled"""
+    if future.cancelled() or future.exception() is not None:
+        return
+    close = getattr(future.result(), "close", None)
+    if close is not None:
+        close()
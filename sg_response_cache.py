@@ -0,0 +1,259 @@
+"""
+Disk cache of generation responses, for repeated requests with a fixed seed.
+
+With a fixed seed the backend returns the same images for the same payload and model, and re-running identical
+settings after an undo is common. Responses are stored under a hash of the endpoint, the payload (images enter it
+as the hash of their encoded bytes, not inlined) and the model options, so a repeated request is answered from disk
+without the backend. Requests with a random seed are neither looked up nor stored.
+
+Each entry is a directory like a finished job of the queue: one file per image and the other response members in
+one JSON file. It is written into a temporary directory while the layers are inserted and renamed into place once
+the whole response has been read, so an interrupted generation leaves no entry behind. A batch generated in chunks
+also gets an entry listing its chunks, the chunk sizes depend on the measured throughput and differ between runs.
+The cache is bounded in size, the least recently used entries are evicted first.
+
+Kept free of GIMP imports.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from collections.abc import Iterator
+from typing import Any
+
+from sg_payload import EncodedImage
+from sg_stream import StreamedResponse
+
+DEFAULT_RESPONSE_CACHE_MAX_MB = 1024
+# Bumped when the key or the entry layout changes, old entries are evicted as they age
+CACHE_VERSION = 1
+# Temporary directories older than this are left over by a crashed process
+STALE_TMP_SECONDS = 3600
+
+_ENTRY_FILE = "entry.json"
+_TMP_SUFFIX = ".tmp"
+
+
+def default_cache_dir() -> str:
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "gimpfusion", "responses")
+
+
+def deterministic(data: dict[str, Any]) -> bool:
+    """Whether the backend returns the same images for ``data`` every time: the seed, and subseed if used, is fixed"""
+    seed = data.get("seed")
+    if not isinstance(seed, int) or seed < 0:
+        return False
+    if data.get("subseed_strength"):
+        subseed = data.get("subseed")
+        return isinstance(subseed, int) and subseed >= 0
+    return True
+
+
+def _canonical(obj: Any) -> Any:
+    if isinstance(obj, EncodedImage):
+        return {"$image": hashlib.sha256(obj.data).hexdigest(), "format": obj.format}
+    if isinstance(obj, dict):
+        return {str(key): _canonical(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_canonical(value) for value in obj]
+    return obj
+
+
+def response_key(endpoint: str, data: dict[str, Any], model: dict[str, Any] | None) -> str | None:
+    """
+    Cache key of a request.
+
+    Returns:
+        Hex digest, None if the request must not be cached: random seed or unknown model
+    """
+    if not model or not deterministic(data):
+        return None
+    text = json.dumps(
+        {"version": CACHE_VERSION, "endpoint": endpoint, "model": model, "data": _canonical(data)},
+        sort_keys=True,
+        separators=(",", ":"),
+        allow_nan=False,
+    )
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Generation responses on disk, bounded by total size.
+
+    Args:
+        directory: where the entries live, ``$XDG_CACHE_HOME/gimpfusion/responses`` by default
+        max_bytes: total size of the entries, the least recently used ones are evicted beyond it
+    """
+
+    def __init__(self, directory: str | None = None, max_bytes: int = DEFAULT_RESPONSE_CACHE_MAX_MB << 20) -> None:
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    @classmethod
+    def fromSettings(cls, settings: Any) -> ResponseCache | None:
+        """The cache if enabled in settings, None otherwise"""
+        if not settings.get("response_cache_enabled"):
+            return None
+        max_mb = settings.get("response_cache_max_mb")
+        max_mb = DEFAULT_RESPONSE_CACHE_MAX_MB if max_mb is None else float(max_mb)
+        return cls(max_bytes=int(max_mb * (1 << 20)))
+
+    def _path(self, key: str, name: str = "") -> str:
+        return os.path.join(self.directory, key, name)
+
+    def _read_entry(self, key: str) -> dict[str, Any] | None:
+        try:
+            with open(self._path(key, _ENTRY_FILE)) as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as ex:
+            logging.warning(f"Dropping unreadable response cache entry {key}: {ex}")
+            self.delete(key)
+            return None
+        # the modification time of the directory orders entries for eviction
+        with contextlib.suppress(OSError):
+            os.utime(self._path(key))
+        return entry
+
+    def _response(self, key: str, entry: dict[str, Any]) -> StreamedResponse:
+        def events() -> Iterator[tuple[str, Any]]:
+            for index in range(entry["images"]):
+                with open(self._path(key, f"image-{index}"), "rb") as f:
+                    yield "image", f.read()
+            yield from entry["fields"].items()
+
+        return StreamedResponse(events())
+
+    def get(self, key: str) -> StreamedResponse | None:
+        """The stored response, its images are read from disk one at a time as they are consumed"""
+        entry = self._read_entry(key)
+        if entry is None or "images" not in entry:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._response(key, entry)
+
+    def get_batch(self, key: str) -> list[StreamedResponse] | None:
+        """Responses of the chunks of a batch, None unless all of them are stored"""
+        entry = self._read_entry(key)
+        parts = {part: self._read_entry(part) for part in entry["parts"]} if entry and "parts" in entry else {}
+        if not parts or any(part is None or "images" not in part for part in parts.values()):
+            # a chunk may have been evicted, the batch is generated and listed again
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [self._response(part, part_entry) for part, part_entry in parts.items()]
+
+    def store(self, key: str, response: StreamedResponse) -> StreamedResponse:
+        """
+        Pass ``response`` through, storing it while it is consumed.
+
+        The entry is committed when the response has been read to the end without errors; closing the returned
+        response reads what the consumer left unread (ResponseLayers stops after ``info``) first.
+        """
+        tmp_dir = tempfile.mkdtemp(prefix=f"{key}.", suffix=_TMP_SUFFIX, dir=self.directory)
+        entry: dict[str, Any] = {"images": 0, "fields": {}}
+
+        def events() -> Iterator[tuple[str, Any]]:
+            for name, value in response.events():
+                if name == "image":
+                    with open(os.path.join(tmp_dir, f"image-{entry['images']}"), "wb") as f:
+                        f.write(value)
+                    entry["images"] += 1
+                else:
+                    entry["fields"][name] = value
+                yield name, value
+            # read completely, without errors
+            if entry["images"]:
+                self._commit(key, tmp_dir, entry)
+
+        tee = events()
+
+        def close() -> None:
+            try:
+                for _ in tee:
+                    pass
+            except Exception as ex:
+                logging.debug(f"Not caching response {key}: {ex}")
+            finally:
+                response.close()
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        return StreamedResponse(tee, close=close)
+
+    def store_batch(self, key: str, parts: list[str]) -> None:
+        """Record the chunks a batch was generated in, once all of them are stored"""
+        if not all(os.path.exists(self._path(part, _ENTRY_FILE)) for part in parts):
+            return
+        tmp_dir = tempfile.mkdtemp(prefix=f"{key}.", suffix=_TMP_SUFFIX, dir=self.directory)
+        try:
+            self._commit(key, tmp_dir, {"parts": parts})
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _commit(self, key: str, tmp_dir: str, entry: dict[str, Any]) -> None:
+        with open(os.path.join(tmp_dir, _ENTRY_FILE), "w") as f:
+            json.dump(entry, f)
+        try:
+            os.rename(tmp_dir, self._path(key))
+        except OSError:
+            # stored meanwhile by another plug-in run
+            return
+        self.evict()
+
+    def delete(self, key: str) -> None:
+        shutil.rmtree(self._path(key), ignore_errors=True)
+
+    def evict(self) -> int:
+        """
+        Delete the least recently used entries until the cache fits into ``max_bytes``.
+
+        Returns:
+            Number of entries deleted
+        """
+        entries = []
+        total = 0
+        now = time.time()
+        for item in os.scandir(self.directory):
+            if not item.is_dir(follow_symlinks=False):
+                continue
+            try:
+                mtime = item.stat().st_mtime
+                if item.name.endswith(_TMP_SUFFIX):
+                    if now - mtime > STALE_TMP_SECONDS:
+                        shutil.rmtree(item.path, ignore_errors=True)
+                    continue
+                size = sum(file.stat().st_size for file in os.scandir(item.path) if file.is_file())
+            except FileNotFoundError:
+                # evicted by another plug-in run meanwhile
+                continue
+            entries.append((mtime, size, item.name))
+            total += size
+
+        deleted = 0
+        for _mtime, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.delete(key)
+            total -= size
+            deleted += 1
+        if deleted:
+            logging.info(f"Evicted {deleted} responses from the cache, {total / (1 << 20):.1f} MB left")
+        return deleted
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
@@ -0,0 +1,274 @@
+"""
+Retries and circuit breaking for backend calls.
+
+A reset connection, a 502 from the reverse proxy or the backend briefly running out of VRAM should not lose a
+whole generation. ApiClient runs every HTTP call through ``RetryPolicy.call``:
+
+- GETs are retried after connection errors, timeouts and 502/503/504;
+- POSTs only when the backend cannot have started on them: the connection could not be opened, or the proxy
+  answered 502/503. txt2img / img2img have no side effects and are also retried after an out of memory error;
+- attempts are spaced by exponential backoff with full jitter;
+- after ``breaker_threshold`` failures in a row the backend is considered down: calls fail right away for
+  ``breaker_reset`` seconds, then one call probes whether it is back.
+
+The payload is the same object on every attempt, encoded images are sent again as they are.
+
+Kept free of GIMP imports.
+"""
+
+from __future__ import annotations
+
+import logging
+import random
+import threading
+import time
+
+from collections.abc import Callable
+from typing import Any
+
+import requests
+
+from urllib3.exceptions import NewConnectionError
+
+DEFAULT_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 0.5
+MAX_RETRY_BACKOFF = 8.0
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_RESET = 30.0
+
+# Status codes a GET is retried after; a POST only after those the proxy answers without reaching the backend
+RETRY_STATUSES_GET = frozenset((502, 503, 504))
+RETRY_STATUSES_POST = frozenset((502, 503))
+# Endpoints without side effects, replayed after errors that leave nothing behind
+REPLAYABLE_ENDPOINTS = frozenset(("/sdapi/v1/txt2img", "/sdapi/v1/img2img"))
+REPLAYABLE_ERRORS = ("OutOfMemoryError",)
+# Polled anyway, or not safe to send twice
+NO_RETRY_ENDPOINTS = frozenset(("/sdapi/v1/progress", "/sdapi/v1/interrupt", "/sdapi/v1/skip"))
+
+
+class BackendUnavailable(requests.exceptions.ConnectionError):
+    """The circuit breaker is open: the backend failed repeatedly and is not called until it has had time"""
+
+
+def not_started(ex: BaseException) -> bool:
+    """Whether the request failed before the backend could receive it"""
+    if isinstance(ex, requests.exceptions.ConnectTimeout):
+        return True
+    # requests wraps urllib3's MaxRetryError, whose reason is the error of the connection attempt
+    pending: list[Any] = [ex]
+    seen: set[int] = set()
+    while pending:
+        cause = pending.pop()
+        if not isinstance(cause, BaseException) or id(cause) in seen:
+            continue
+        seen.add(id(cause))
+        if isinstance(cause, (NewConnectionError, ConnectionRefusedError)):
+            return True
+        pending.extend((cause.__cause__, cause.__context__, getattr(cause, "reason", None), *cause.args))
+    return False
+
+
+class CircuitBreaker:
+    """
+    Counts failures in a row of one backend and stops calling it once there are too many.
+
+    Args:
+        name: the backend, for messages
+        threshold: failures in a row that open the breaker, 0 never opens it
+        reset_seconds: how long calls fail right away before one is let through to probe the backend
+    """
+
+    def __init__(
+        self,
+        name: str = "",
+        threshold: int = DEFAULT_BREAKER_THRESHOLD,
+        reset_seconds: float = DEFAULT_BREAKER_RESET,
+    ) -> None:
+        self.name = name
+        self.threshold = max(0, int(threshold))
+        self.reset_seconds = float(reset_seconds)
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self.opened_at is not None
+
+    def check(self) -> None:
+        """Raise BackendUnavailable unless a call may go out now"""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.reset_seconds - time.monotonic()
+            if remaining <= 0 and not self._probing:
+                # half open: this call finds out whether the backend is back
+                self._probing = True
+                return
+        raise BackendUnavailable(f"Backend {self.name} failed {self.failures} times, next try in {remaining:.0f}s")
+
+    def success(self) -> None:
+        with self._lock:
+            if self.opened_at is not None:
+                logging.info(f"Backend {self.name} is back, closing the circuit breaker")
+            self.failures, self.opened_at, self._probing = 0, None, False
+
+    def abandon(self) -> None:
+        """The call ended without telling whether the backend works, another one may probe it"""
+        with self._lock:
+            self._probing = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.threshold and self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logging.warning(f"Backend {self.name} failed {self.failures} times in a row, failing fast")
+                self.opened_at = time.monotonic()
+
+
+# One breaker per backend, shared by every client of this process talking to it
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def circuit_breaker(base_url: str, threshold: int, reset_seconds: float) -> CircuitBreaker:
+    with _breakers_lock:
+        breaker = _breakers.get(base_url)
+        if breaker is None:
+            breaker = _breakers[base_url] = CircuitBreaker(base_url, threshold, reset_seconds)
+        breaker.threshold, breaker.reset_seconds = max(0, int(threshold)), float(reset_seconds)
+        return breaker
+
+
+class RetryPolicy:
+    """
+    How often and when backend calls are retried.
+
+    Args:
+        retries: attempts after the first one, 0 disables retries
+        backoff: upper bound of the first delay in seconds, doubled for every further attempt
+        breaker_threshold: see CircuitBreaker
+        breaker_reset: see CircuitBreaker
+    """
+
+    def __init__(
+        self,
+        retries: int = DEFAULT_RETRIES,
+        backoff: float = DEFAULT_RETRY_BACKOFF,
+        breaker_threshold: int = DEFAULT_BREAKER_THRESHOLD,
+        breaker_reset: float = DEFAULT_BREAKER_RESET,
+    ) -> None:
+        self.retries = max(0, int(retries))
+        self.backoff = max(0.0, float(backoff))
+        self.breaker_threshold = max(0, int(breaker_threshold))
+        self.breaker_reset = max(0.0, float(breaker_reset))
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "retries": self.retries,
+            "backoff": self.backoff,
+            "breaker_threshold": self.breaker_threshold,
+            "breaker_reset": self.breaker_reset,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any] | None) -> RetryPolicy:
+        return cls(**(data or {}))
+
+    @classmethod
+    def fromSettings(cls, settings: Any) -> RetryPolicy:
+        def setting(name: str, default: Any) -> Any:
+            value = settings.get(name)
+            return default if value is None else value
+
+        return cls(
+            retries=setting("http_retries", DEFAULT_RETRIES),
+            backoff=setting("http_retry_backoff", DEFAULT_RETRY_BACKOFF),
+            breaker_threshold=setting("breaker_threshold", DEFAULT_BREAKER_THRESHOLD),
+            breaker_reset=setting("breaker_reset", DEFAULT_BREAKER_RESET),
+        )
+
+    def delay(self, attempt: int) -> float:
+        """Full jitter: a random delay up to the exponentially growing bound, so clients don't retry in lockstep"""
+        return random.uniform(0, min(MAX_RETRY_BACKOFF, self.backoff * 2**attempt))
+
+    def retry_error(self, method: str, endpoint: str, ex: requests.exceptions.RequestException) -> bool:
+        if endpoint in NO_RETRY_ENDPOINTS:
+            return False
+        if method == "GET":
+            return isinstance(ex, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+        return not_started(ex)
+
+    def retry_response(self, method: str, endpoint: str, response: requests.Response) -> bool:
+        if endpoint in NO_RETRY_ENDPOINTS or response.ok:
+            return False
+        if response.status_code in (RETRY_STATUSES_GET if method == "GET" else RETRY_STATUSES_POST):
+            return True
+        if endpoint in REPLAYABLE_ENDPOINTS and response.status_code == 500:
+            # error bodies are small, requests keeps the content for the caller
+            try:
+                error = str(response.json().get("error") or "")
+            except ValueError:
+                return False
+            return any(name in error for name in REPLAYABLE_ERRORS)
+        return False
+
+    def call(
+        self,
+        method: str,
+        endpoint: str,
+        send: Callable[[], requests.Response],
+        breaker: CircuitBreaker,
+        aborted: threading.Event,
+    ) -> requests.Response:
+        """
+        Send a request, retrying it as the policy allows.
+
+        Args:
+            send: makes one attempt; builds the request body anew from the same payload each time
+            breaker: breaker of the backend
+            aborted: set when the client's connections are torn down, e.g. the generation was cancelled; stops
+                retrying and interrupts the wait between attempts
+
+        Returns:
+            The response of the last attempt, an error response if retries did not help
+
+        Raises:
+            BackendUnavailable: the breaker is open
+            requests.exceptions.RequestException: of the last attempt
+        """
+        attempt = 0
+        while True:
+            breaker.check()
+            try:
+                response = send()
+            except requests.exceptions.RequestException as ex:
+                # a slow generation running into the read timeout says nothing about the backend being down
+                if isinstance(ex, requests.exceptions.ConnectionError) and not aborted.is_set():
+                    breaker.failure()
+                else:
+                    breaker.abandon()
+                if aborted.is_set():
+                    raise
+                if attempt >= self.retries or not self.retry_error(method, endpoint, ex):
+                    raise
+                reason = f"{type(ex).__name__}: {ex}"
+            else:
+                if response.status_code not in RETRY_STATUSES_GET:
+                    breaker.success()
+                else:
+                    breaker.failure()
+                if attempt >= self.retries or not self.retry_response(method, endpoint, response):
+                    return response
+                reason = f"HTTP {response.status_code}"
+                response.close()
+
+            delay = self.delay(attempt)
+            attempt += 1
+            logging.warning(f"{method} {endpoint} failed ({reason}), attempt {attempt + 1} in {delay:.1f}s")
+            if aborted.wait(delay):
+                raise requests.exceptions.ConnectionError(f"{method} {endpoint} aborted while waiting to retry")
@@ -0,0 +1,371 @@
+"""
+Streaming JSON request bodies and responses.
+
+Images in a payload are EncodedImage objects; their base64 text is produced chunk by chunk from the raw encoded
+bytes while the body is written to the socket, so the base64 strings and the serialized body never exist as a
+whole in memory. Generation responses are parsed the other way round: each image is decoded while it is read,
+so at most one image is held at a time.
+"""
+
+from __future__ import annotations
+
+import base64
+import io
+import json
+import re
+import time
+
+from collections.abc import Callable, Iterable, Iterator
+from typing import Any
+
+from sg_payload import EncodedImage, LinkStats
+
+# Raw bytes per base64 chunk, a multiple of 3 so chunks concatenate without padding (64 KB of base64 text)
+BASE64_CHUNK_RAW = 3 * (1 << 14)
+# Small JSON fragments are merged up to this size before being sent
+JSON_CHUNK_SIZE = 1 << 16
+
+
+def base64_length(size: int) -> int:
+    return 4 * ((size + 2) // 3)
+
+
+def iter_base64(data: bytes, chunk_size: int = BASE64_CHUNK_RAW) -> Iterator[bytes]:
+    """Base64 text of ``data`` in chunks of ``chunk_size * 4 / 3`` bytes"""
+    view = memoryview(data)
+    for offset in range(0, len(view), chunk_size):
+        yield base64.b64encode(view[offset : offset + chunk_size])
+
+
+def _segments(obj: Any) -> Iterator[bytes | EncodedImage]:
+    """JSON text of ``obj`` as bytes fragments, with EncodedImage objects left in place"""
+    if isinstance(obj, EncodedImage):
+        yield obj
+    elif isinstance(obj, dict):
+        yield b"{"
+        for index, (key, value) in enumerate(obj.items()):
+            yield (b", " if index else b"") + json.dumps(str(key)).encode() + b": "
+            yield from _segments(value)
+        yield b"}"
+    elif isinstance(obj, (list, tuple)):
+        yield b"["
+        for index, value in enumerate(obj):
+            if index:
+                yield b", "
+            yield from _segments(value)
+        yield b"]"
+    else:
+        yield json.dumps(obj, allow_nan=False).encode()
+
+
+class StreamingJsonBody:
+    """
+    JSON request body written in chunks.
+
+    The JSON structure around the images is serialized up front (it is small), so the exact length is known and
+    the request goes out with a Content-Length header instead of chunked transfer encoding. Iterating it yields
+    the body; the time the socket takes to accept it feeds the upload throughput estimate.
+    """
+
+    def __init__(self, data: Any, link: LinkStats | None = None) -> None:
+        self.link = link
+        self.parts: list[bytes | EncodedImage] = []
+        pending = bytearray()
+        for segment in _segments(data):
+            if isinstance(segment, EncodedImage):
+                if pending:
+                    self.parts.append(bytes(pending))
+                    pending.clear()
+                self.parts.append(segment)
+            else:
+                pending += segment
+        if pending:
+            self.parts.append(bytes(pending))
+        self.length = sum(
+            base64_length(len(part)) + 2 if isinstance(part, EncodedImage) else len(part) for part in self.parts
+        )
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self) -> Iterator[bytes]:
+        start = time.perf_counter()
+        yield from self._chunks()
+        if self.link is not None:
+            self.link.record_upload(self.length, time.perf_counter() - start)
+
+    def getvalue(self) -> bytes:
+        """Whole body at once, for small payloads and tests"""
+        return b"".join(self._chunks())
+
+    def _chunks(self) -> Iterator[bytes]:
+        for part in self.parts:
+            if not isinstance(part, EncodedImage):
+                view = memoryview(part)
+                for offset in range(0, len(view), JSON_CHUNK_SIZE):
+                    yield view[offset : offset + JSON_CHUNK_SIZE]
+                continue
+            yield b'"'
+            yield from iter_base64(part.data)
+            yield b'"'
+
+
+# Response parsing: {"images": ["<base64>", ...], "parameters": {...}, "info": "..."} read off the socket
+# without holding the body. Images are decoded as they arrive, everything else is small and parsed with json.
+
+RESPONSE_CHUNK_SIZE = 1 << 18
+
+_WHITESPACE = b" \t\r\n"
+# end of a string segment
+_STRING_STOP = re.compile(rb'["\\]')
+# anything that changes nesting outside of strings
+_STRUCT_STOP = re.compile(rb'[{}\[\]",]')
+
+
+class _ByteReader:
+    """Pull-style reader over an iterator of byte chunks, keeping only the unread part of the current chunk"""
+
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self._chunks = iter(chunks)
+        self.buf = b""
+        self.pos = 0
+
+    def fill(self) -> bool:
+        for chunk in self._chunks:
+            if chunk:
+                self.buf = self.buf[self.pos :] + bytes(chunk)
+                self.pos = 0
+                return True
+        return False
+
+    def ensure(self, size: int) -> None:
+        while len(self.buf) - self.pos < size:
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON response")
+
+    def peek(self) -> int:
+        """Next non-whitespace byte, not consumed"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON response")
+
+    def at_end(self) -> bool:
+        try:
+            self.peek()
+        except ValueError:
+            return True
+        return False
+
+    def expect(self, char: bytes) -> None:
+        if self.peek() != char[0]:
+            raise ValueError(f"Expected {char!r} in JSON response, got {bytes([self.peek()])!r}")
+        self.pos += 1
+
+    def string_parts(self) -> Iterator[bytes]:
+        """Content of the string at the current position in pieces, escapes decoded to UTF-8"""
+        self.expect(b'"')
+        while True:
+            match = _STRING_STOP.search(self.buf, self.pos)
+            if match is None:
+                yield self.buf[self.pos :]
+                self.pos = len(self.buf)
+                self.ensure(1)
+                continue
+            yield self.buf[self.pos : match.start()]
+            self.pos = match.start()
+            if match.group() == b'"':
+                self.pos += 1
+                return
+            self.ensure(2)
+            size = 6 if self.buf[self.pos + 1 : self.pos + 2] == b"u" else 2
+            self.ensure(size)
+            yield json.loads(b'"' + self.buf[self.pos : self.pos + size] + b'"').encode("utf-8", "surrogatepass")
+            self.pos += size
+
+    def string(self) -> str:
+        return b"".join(self.string_parts()).decode("utf-8", "surrogatepass")
+
+    def raw_value(self) -> bytes:
+        """JSON text of the value at the current position"""
+        parts = []
+        depth = 0
+        first = self.peek()
+        while True:
+            match = _STRUCT_STOP.search(self.buf, self.pos)
+            if match is None:
+                parts.append(self.buf[self.pos :])
+                self.pos = len(self.buf)
+                if not self.fill():
+                    # a bare number at the very end of the input
+                    if depth == 0 and first not in b'{["':
+                        return b"".join(parts)
+                    raise ValueError("Unexpected end of JSON response")
+                continue
+            char = match.group()
+            if char == b'"':
+                parts.append(self.buf[self.pos : match.start()])
+                self.pos = match.start()
+                parts.append(json.dumps(self.string()).encode())
+            elif char in b"{[":
+                depth += 1
+                parts.append(self.buf[self.pos : match.end()])
+                self.pos = match.end()
+            elif depth == 0:
+                # "," or a closing bracket of the enclosing container ends a scalar
+                parts.append(self.buf[self.pos : match.start()])
+                self.pos = match.start()
+                return b"".join(parts)
+            else:
+                parts.append(self.buf[self.pos : match.end()])
+                self.pos = match.end()
+                if char in b"}]":
+                    depth -= 1
+            if depth == 0 and char in b'"}]':
+                return b"".join(parts)
+
+    def value(self) -> Any:
+        return json.loads(self.raw_value())
+
+
+def decode_base64_parts(parts: Iterable[bytes]) -> bytes:
+    """Decode base64 text given in arbitrary pieces, a ``data:<mime>;base64,`` prefix is skipped"""
+    output = io.BytesIO()
+    carry = b""
+    prefix_checked = False
+    for part in parts:
+        data = carry + part
+        if not prefix_checked:
+            if len(data) < 5 or (data.startswith(b"data:") and b"," not in data):
+                carry = data
+                continue
+            if data.startswith(b"data:"):
+                data = data[data.index(b",") + 1 :]
+            prefix_checked = True
+        usable = len(data) - len(data) % 4
+        output.write(base64.b64decode(data[:usable]))
+        carry = data[usable:]
+    if carry:
+        output.write(base64.b64decode(carry + b"=" * (-len(carry) % 4)))
+    return output.getvalue()
+
+
+def iter_response(chunks: Iterable[bytes]) -> Iterator[tuple[str, Any]]:
+    """
+    Parse a generation response incrementally.
+
+    Args:
+        chunks: the response body in pieces, e.g. ``response.iter_content()``
+
+    Yields:
+        ``("image", bytes)`` for every entry of ``images`` as soon as it is read, decoded from base64,
+        and ``(key, value)`` for every other member of the top-level object
+    """
+    reader = _ByteReader(chunks)
+    reader.expect(b"{")
+    if reader.peek() == ord("}"):
+        return
+    while True:
+        key = reader.string()
+        reader.expect(b":")
+        if key == "images" and reader.peek() == ord("["):
+            reader.expect(b"[")
+            while reader.peek() != ord("]"):
+                if reader.peek() == ord('"'):
+                    yield "image", decode_base64_parts(reader.string_parts())
+                else:
+                    reader.value()  # null entries carry no image
+                if reader.peek() == ord(","):
+                    reader.expect(b",")
+            reader.expect(b"]")
+        else:
+            yield key, reader.value()
+        if reader.peek() == ord("}"):
+            break
+        reader.expect(b",")
+    reader.expect(b"}")
+    if not reader.at_end():
+        raise ValueError("Extra data after JSON response")
+
+
+class StreamedResponse:
+    """
+    Generation response whose images are consumed one at a time.
+
+    ``images()`` yields the decoded images while they are read off the socket. Other members are available by key
+    once read; asking for one that comes later in the body reads ahead, keeping the images passed on the way.
+    ``in`` only looks at members read so far, so ``"error" in response`` does not buffer the images: errors
+    come with a non-2xx status and are returned as plain dicts by ``ApiClient.post_stream``.
+    """
+
+    def __init__(self, events: Iterable[tuple[str, Any]], close: Callable[[], None] | None = None) -> None:
+        self._events = iter(events)
+        self._close = close
+        self._pending_images: list[bytes] = []
+        self.fields: dict[str, Any] = {}
+        self.image_count = 0
+
+    @classmethod
+    def from_dict(cls, response: dict[str, Any]) -> StreamedResponse:
+        def events() -> Iterator[tuple[str, Any]]:
+            for key, value in response.items():
+                if key == "images":
+                    for image in value or []:
+                        yield "image", decode_base64_parts([image.encode()])
+                else:
+                    yield key, value
+
+        return cls(events())
+
+    def _next_event(self) -> tuple[str, Any] | None:
+        try:
+            key, value = next(self._events)
+        except StopIteration:
+            self.close()
+            return None
+        except BaseException:
+            self.close()
+            raise
+        if key == "image":
+            self.image_count += 1
+        else:
+            self.fields[key] = value
+        return key, value
+
+    def images(self) -> Iterator[bytes]:
+        while self._pending_images:
+            yield self._pending_images.pop(0)
+        while (event := self._next_event()) is not None:
+            if event[0] == "image":
+                yield event[1]
+
+    def events(self) -> Iterator[tuple[str, Any]]:
+        """Everything not consumed yet as ``("image", bytes)`` and ``(key, value)`` pairs, to pass the response on"""
+        while self._pending_images:
+            yield "image", self._pending_images.pop(0)
+        while (event := self._next_event()) is not None:
+            yield event
+
+    def _read_until(self, key: str) -> None:
+        while key not in self.fields and (event := self._next_event()) is not None:
+            if event[0] == "image":
+                self._pending_images.append(event[1])
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.fields
+
+    def __getitem__(self, key: str) -> Any:
+        self._read_until(key)
+        return self.fields[key]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        self._read_until(key)
+        return self.fields.get(key, default)
+
+    def close(self) -> None:
+        if self._close is not None:
+            self._close()
+            self._close = None
@@ -7,27 +7,49 @@ import json
 import logging
 import os
 import tempfile
+import threading
 import time
 
+from collections.abc import Callable
 from typing import Any
 
 import gi
-import requests
 
-from sg_constants import CONTROLNET_DEFAULT_SETTINGS, INSERT_MODES
+from sg_api import ApiClient  # noqa: F401 re-exported for plug-ins importing it from here
+from sg_cache import LRUCache
+from sg_constants import (
+    CONTROLNET_DEFAULT_SETTINGS,
+    INSERT_MODES,
+    SETTINGS_FILE,
+    TOBASE64_CACHE_MAX_ENTRIES,
+    TOBASE64_CACHE_MAX_MB,
+)
+from sg_decode import DecodedImage, decode_image, decode_in_order
+from sg_generation import ResponseInfo, controlnet_unit
+from sg_payload import PAYLOAD_INIT, PAYLOAD_LOSSLESS, PAYLOAD_POLICY, EncodedImage
+from sg_png import has_numpy, np
+from sg_region import CropRegion
+from sg_stream import StreamedResponse
 
 gi.require_version("Gimp", "3.0")
-from gi.repository import Gegl, Gimp, Gio, GLib
+from gi.repository import Gegl, Gimp, Gio
 
 from sg_utils import aspect_resize, roundToMultiple
 
 # Global reference to settings (set during plugin initialization)
 _global_settings = None
 
-# Cache for toBase64 results: key is (layer_id, width, height, hash), value is base64 string
-_toBase64_cache: dict[tuple[int, int, int, str], str] = {}
-_toBase64_cache_max_size = 10  # Limit cache size to prevent memory issues
-_toBase64_cache_pixel_count = 1024
+# Cache for encoded layers: key is the digest of the layer pixels plus the encoder settings, value is the
+# EncodedImage (base64 text is a third larger and cheap to recreate). Limits are replaced from settings.
+_toBase64_cache = LRUCache(
+    max_bytes=TOBASE64_CACHE_MAX_MB * 1024 * 1024,
+    max_entries=TOBASE64_CACHE_MAX_ENTRIES,
+)
+# Digest of sparsely sampled rows -> full pixel digest, lets a changed layer be rejected without hashing it all
+_toBase64_sample_index = LRUCache(max_entries=4 * TOBASE64_CACHE_MAX_ENTRIES, sizeof=lambda digest: 0)
+_toBase64_sample_rows = 16
+# Cache shared with other plug-in processes (sg_worker.WorkerClient), consulted when the in-process cache misses
+_shared_cache = None
 
 
 class TempFiles:
@@ -115,10 +137,32 @@ class Layer:
 
     @staticmethod
     def fromBase64(img, base64Data):
-        filepath = TempFiles().get("generated.png")
-        with open(filepath, "wb+") as imageFile:
-            imageFile.write(base64.b64decode(base64Data))
-        layer = Gimp.file_load_layer(Gimp.RunMode.NONINTERACTIVE, img, Gio.File.new_for_path(filepath))
+        return Layer.fromBytes(img, base64.b64decode(base64Data))
+
+    @staticmethod
+    def fromBytes(img: Gimp.Image, data: bytes) -> Layer:
+        """Load encoded image data through GIMP, for formats or image modes fromDecoded does not handle"""
+        fd, filepath = tempfile.mkstemp(prefix="gimpfusion_generated_", suffix=".png")
+        try:
+            with os.fdopen(fd, "wb") as imageFile:
+                imageFile.write(data)
+            layer = Gimp.file_load_layer(Gimp.RunMode.NONINTERACTIVE, img, Gio.File.new_for_path(filepath))
+        finally:
+            os.remove(filepath)
+        return Layer(layer)
+
+    @staticmethod
+    def fromDecoded(img: Gimp.Image, decoded: DecodedImage, name: str = "Generated Layer") -> Layer:
+        """New layer (not inserted yet) holding already decoded pixels, without any file round-trip"""
+        # GEGL converts the RGB pixels to the layer format, e.g. of a grayscale image
+        if img.get_base_type() == Gimp.ImageBaseType.GRAY:
+            image_type = Gimp.ImageType.GRAYA_IMAGE if decoded.channels == 4 else Gimp.ImageType.GRAY_IMAGE
+        else:
+            image_type = Gimp.ImageType.RGBA_IMAGE if decoded.channels == 4 else Gimp.ImageType.RGB_IMAGE
+        layer = Gimp.Layer.new(img, name, decoded.width, decoded.height, image_type, 100, Gimp.LayerMode.NORMAL)
+        buffer = layer.get_buffer()
+        buffer.set(Gegl.Rectangle.new(0, 0, decoded.width, decoded.height), decoded.gegl_format, decoded.pixels)
+        buffer.flush()
         return Layer(layer)
 
     def rename(self, name):
@@ -167,6 +211,12 @@ class Layer:
         image.insert_layer(self.layer, None, -1)
         return self
 
+    def insertAbove(self, layer: Gimp.Layer) -> Layer:
+        """Insert right above ``layer``, inside its group if it is in one"""
+        image = layer.get_image()
+        image.insert_layer(self.layer, layer.get_parent(), image.get_item_position(layer))
+        return self
+
     def addSelectionAsMask(self):
         mask = self.layer.create_mask(Gimp.AddMaskType.SELECTION)
         self.layer.add_mask(mask)
@@ -174,109 +224,241 @@ class Layer:
 
     def saveMaskAs(self, filepath):
         logging.debug(f"saveMaskAs {filepath=}")
-        new_image = Gimp.Image.new(self.layer.get_width(), self.layer.get_height(), Gimp.ImageBaseType.RGB)
-        layer = Gimp.Layer.new_from_drawable(self.layer.get_mask(), new_image)
-        new_image.insert_layer(layer, None, -1)
-        Gimp.file_save(Gimp.RunMode.NONINTERACTIVE, new_image, Gio.File.new_for_path(filepath), None)
+        with open(filepath, "wb") as file:
+            file.write(Layer(self.layer.get_mask()).encodePng())
         return self
 
     def saveAs(self, filepath):
         logging.debug(f"saveAs {filepath=}")
-        new_image = Gimp.Image.new(self.layer.get_width(), self.layer.get_height(), Gimp.ImageBaseType.RGB)
-        layer = Gimp.Layer.new_from_drawable(self.layer, new_image)
-        new_image.insert_layer(layer, None, -1)
-        Gimp.file_save(Gimp.RunMode.NONINTERACTIVE, new_image, Gio.File.new_for_path(filepath), None)
+        with open(filepath, "wb") as file:
+            file.write(self._save_to_memory_stream())
         return self
 
     def maskToBase64(self):
-        filepath = TempFiles().get(f"mask{self.id}.png")
-        self.saveMaskAs(filepath)
-        with open(filepath, "rb") as file:
-            return base64.b64encode(file.read()).decode()
+        return self.encodeMask().to_base64()
+
+    def encodeMask(self) -> EncodedImage:
+        """Layer mask as a grayscale PNG, masks never go through a lossy format"""
+        return Layer(self.layer.get_mask())._encode_pixels("png")
+
+    def encodePng(self, pixels: bytes | None = None) -> bytes:
+        """
+        Encode the drawable as PNG straight from its GEGL buffer.
+
+        A layer mask is applied to the alpha channel, the same way exporting the layer would do.
+        Compression level, row filter and zlib strategy come from settings.
+
+        Args:
+            pixels: pixels already read with ``_read_export_pixels``, to avoid reading them twice
+
+        Returns:
+            PNG image data as bytes
+        """
+        return self._encode_pixels("png", pixels).data
+
+    def encode(self, kind: str = PAYLOAD_INIT) -> EncodedImage:
+        """
+        Encode the layer for a request payload in the configured wire format.
+
+        Init images may use any format from settings (``auto`` picks the cheapest one for the measured link),
+        ``PAYLOAD_LOSSLESS`` restricts the choice to PNG and lossless WebP. Results are cached per pixel digest
+        and encoder settings, so any copy of unchanged pixels hits and any painted change misses.
+
+        Args:
+            kind: PAYLOAD_INIT or PAYLOAD_LOSSLESS
+
+        Returns:
+            EncodedImage, serialized to base64 by ApiClient
+        """
+        start = time.perf_counter()
+        image_format = PAYLOAD_POLICY.choose(kind, self.layer.get_width(), self.layer.get_height())
+
+        encoded = self.cachedEncoded(image_format)
+        if encoded is not None:
+            logging.debug(f"encode cache hit for layer {self.id}: {time.perf_counter() - start:.4f}s")
+            return encoded
+
+        try:
+            # the same pixels feed the encoder and the cache key
+            pixels = self._read_export_pixels()
+            digest = self._get_pixel_digest(pixels) if self._is_cache_enabled() else None
+            encoded = self._shared_encoded(digest, image_format)
+            if encoded is None:
+                encoded = self._encode_pixels(image_format, pixels)
+                if digest is not None and _shared_cache is not None:
+                    _shared_cache.put_encoded(self._cache_key(digest, image_format), encoded)
+            if digest is not None:
+                self._store_in_cache(encoded, digest=digest)
+        except Exception as ex:
+            logging.warning(f"Direct encoding failed for layer {self.id}, exporting through GIMP: {ex}")
+            encoded = EncodedImage(
+                self._export_with_file_save(),
+                "png",
+                self.layer.get_width(),
+                self.layer.get_height(),
+            )
+        logging.debug(f"encode time for layer {self.id}: {time.perf_counter() - start:.4f}s")
+        return encoded
+
+    def encoder(self, kind: str = PAYLOAD_INIT, region: CropRegion | None = None) -> Callable[[], EncodedImage]:
+        """
+        Read the pixels for ``encode`` (or ``encodeRegion``) now and return a function encoding them.
+
+        Only this call uses GIMP, the returned function may run on a worker thread, so encoding one layer overlaps
+        reading the next one and requests in flight. It fills the caches the way ``encode`` does.
+        """
+        if region is not None:
+            pixels = self.readRegion(*region.bounds)
+            image_format = PAYLOAD_POLICY.choose(kind, region.width, region.height)
+            channels = len(pixels) // (region.width * region.height)
+            return lambda: PAYLOAD_POLICY.encode(pixels, region.width, region.height, channels, image_format)
+
+        width, height = self.layer.get_width(), self.layer.get_height()
+        image_format = PAYLOAD_POLICY.choose(kind, width, height)
+        cached = self.cachedEncoded(image_format)
+        if cached is not None:
+            return lambda: cached
+        pixels = self._read_export_pixels()
+        digest = self._get_pixel_digest(pixels) if self._is_cache_enabled() else None
+        sample_digest = self._get_sample_digest() if digest is not None else None
+
+        def encode() -> EncodedImage:
+            encoded = self._shared_encoded(digest, image_format)
+            if encoded is None:
+                encoded = PAYLOAD_POLICY.encode(pixels, width, height, len(pixels) // (width * height), image_format)
+                if digest is not None and _shared_cache is not None:
+                    _shared_cache.put_encoded(self._cache_key(digest, image_format), encoded)
+            if digest is not None and _toBase64_cache.put(self._cache_key(digest, encoded.format), encoded):
+                _toBase64_sample_index.put(sample_digest, digest)
+            return encoded
+
+        return encode
+
+    def encodeRegion(
+        self,
+        region: CropRegion,
+        kind: str = PAYLOAD_INIT,
+        image_format: str | None = None,
+    ) -> EncodedImage:
+        """
+        Encode the pixels of the drawable inside a rectangle of the image, without a temporary layer.
+
+        Args:
+            region: the rectangle in image coordinates, parts outside the drawable repeat its edge pixels
+            kind: PAYLOAD_INIT or PAYLOAD_LOSSLESS
+            image_format: overrides the format chosen for ``kind``, e.g. ``png`` for masks
+
+        Returns:
+            EncodedImage of ``region.width`` x ``region.height`` pixels
+        """
+        start = time.perf_counter()
+        pixels = self.readRegion(region.x, region.y, region.width, region.height)
+        image_format = image_format or PAYLOAD_POLICY.choose(kind, region.width, region.height)
+        channels = len(pixels) // (region.width * region.height)
+        encoded = PAYLOAD_POLICY.encode(pixels, region.width, region.height, channels, image_format)
+        logging.debug(f"encode time for {region} of layer {self.id}: {time.perf_counter() - start:.4f}s")
+        return encoded
+
+    def readRegion(self, x: int, y: int, width: int, height: int) -> bytes:
+        """Pixels of a rectangle in image coordinates as exported, edge pixels repeat beyond the drawable"""
+        _, offset_x, offset_y = self.layer.get_offsets()
+        return self._read_export_pixels(x - offset_x, y - offset_y, width, height)
+
+    def writeRegion(self, x: int, y: int, width: int, height: int, pixels: bytes) -> Layer:
+        """Replace a rectangle in image coordinates with packed pixels in the format of the layer"""
+        _, offset_x, offset_y = self.layer.get_offsets()
+        buffer = self.layer.get_buffer()
+        buffer.set(Gegl.Rectangle.new(x - offset_x, y - offset_y, width, height), self._pixel_format(), pixels)
+        buffer.flush()
+        self.layer.update(x - offset_x, y - offset_y, width, height)
+        return self
 
     def toBase64(self):
         """
-        Convert layer to Base64 encoded PNG string.
+        Convert layer to Base64 encoded PNG (or lossless WebP) string.
         Uses caching and memory streams for optimization.
         Caching can be disabled via settings.
 
         Returns:
-            Base64 encoded PNG string
+            Base64 encoded image string
         """
+        return self.encode(PAYLOAD_LOSSLESS).to_base64()
 
-        start = time.perf_counter()
-        cache_enabled = self._is_cache_enabled()
+    def cachedEncoded(self, image_format: str) -> EncodedImage | None:
+        """Cached encoding of the current pixels of the layer in the given format, None on a miss"""
+        if not self._is_cache_enabled():
+            return None
+        try:
+            digest = _toBase64_sample_index.get(self._get_sample_digest())
+            key = self._cache_key(digest, image_format)
+            # unknown sampled rows: the layer changed (or was never encoded), skip hashing all pixels
+            if digest is None or key not in _toBase64_cache or self._get_pixel_digest() != digest:
+                _toBase64_cache.record_miss()
+                return None
+            encoded = _toBase64_cache.get(key)
+        except Exception as e:
+            logging.debug(f"Cache lookup failed: {e}")
+            return None
+        logging.debug(f"toBase64 cache stats: {_toBase64_cache.stats()}")
+        return encoded
 
-        if not cache_enabled:
-            # Caching disabled, use direct conversion
-            try:
-                png_data = self._save_to_memory_stream()
-                result = base64.b64encode(png_data).decode()
-                end_time = time.perf_counter()
-                logging.debug(f"toBase64 (no cache) time for layer {self.id}: {end_time - start:.4f}s")
-                return result
-            except Exception as ex:
-                logging.exception(f"Error in toBase64: {ex}")
-                # Fallback to original method
-                filepath = TempFiles().get(f"layer{self.id}.png")
-                self.saveAs(filepath)
-                with open(filepath, "rb") as file:
-                    return base64.b64encode(file.read()).decode()
-
-        # Caching enabled - generate cache key
+    @staticmethod
+    def _cache_key(digest: str, image_format: str) -> str:
+        return f"{digest}:{PAYLOAD_POLICY.format_key(image_format)}"
+
+    def _shared_encoded(self, digest: str | None, image_format: str) -> EncodedImage | None:
+        """Encoding left in the background worker by an earlier plug-in run, None on a miss"""
+        if digest is None or _shared_cache is None:
+            return None
+        encoded = _shared_cache.get_encoded(self._cache_key(digest, image_format))
+        if encoded is not None:
+            logging.debug(f"worker cache hit for layer {self.id}")
+        return encoded
+
+    def _store_in_cache(self, encoded: EncodedImage, pixels: bytes | None = None, digest: str | None = None) -> None:
         try:
-            width = self.layer.get_width()
-            height = self.layer.get_height()
-            layer_hash = self._get_layer_hash()
-            cache_key = (id(self.layer), width, height, layer_hash)
-
-            # Check cache
-            if cache_key in _toBase64_cache:
-                end_time = time.perf_counter()
-                logging.debug(f"toBase64 cache hit for layer {self.id}: {end_time - start:.4f}s")
-                return _toBase64_cache[cache_key]
+            sample_digest = self._get_sample_digest()
+            digest = digest or self._get_pixel_digest(pixels)
         except Exception as e:
             logging.debug(f"Cache key generation failed: {e}")
-            cache_key = None
+            return
 
-        # Not in cache, generate Base64
-        try:
-            # Use optimized method for better performance
-            png_data = self._save_to_memory_stream()
-            result = base64.b64encode(png_data).decode()
-
-            # Store in cache (with size limit)
-            if cache_key:
-                if len(_toBase64_cache) < _toBase64_cache_max_size:
-                    _toBase64_cache[cache_key] = result
-                elif _toBase64_cache:
-                    first_key = next(iter(_toBase64_cache))
-                    del _toBase64_cache[first_key]
-                    _toBase64_cache[cache_key] = result
-
-            end_time = time.perf_counter()
-            logging.debug(f"toBase64 time for layer {self.id}: {end_time - start:.4f}s")
-            return result
-        except Exception as ex:
-            logging.exception(f"Error in toBase64: {ex}")
-            # Fallback to original method
-            filepath = TempFiles().get(f"layer{self.id}.png")
-            self.saveAs(filepath)
-            with open(filepath, "rb") as file:
-                return base64.b64encode(file.read()).decode()
+        if _toBase64_cache.put(self._cache_key(digest, encoded.format), encoded):
+            _toBase64_sample_index.put(sample_digest, digest)
+        logging.debug(f"toBase64 cache stats: {_toBase64_cache.stats()}")
+
+    @staticmethod
+    def toBase64_cache_stats() -> dict[str, int]:
+        """Entries, bytes, hits, misses and evictions of the toBase64 cache"""
+        return _toBase64_cache.stats()
 
     @staticmethod
     def clear_toBase64_cache() -> None:
         """Clear the toBase64 cache. Useful for memory management."""
-        global _toBase64_cache
         _toBase64_cache.clear()
+        _toBase64_sample_index.clear()
         logging.debug("toBase64 cache cleared")
 
-
     @staticmethod
     def set_global_settings(settings) -> None:
         global _global_settings
         _global_settings = settings
+        max_entries = int(settings.get("tobase64_cache_max_entries") or TOBASE64_CACHE_MAX_ENTRIES)
+        max_mb = int(settings.get("tobase64_cache_max_mb") or TOBASE64_CACHE_MAX_MB)
+        _toBase64_cache.resize(max_bytes=max_mb * 1024 * 1024, max_entries=max_entries)
+        _toBase64_sample_index.resize(max_entries=4 * max_entries)
+        PAYLOAD_POLICY.configure(settings)
+
+    @staticmethod
+    def set_shared_cache(cache: Any) -> None:
+        """
+        Second-level cache of encoded layers that outlives the plug-in process, e.g. the background worker.
+
+        Args:
+            cache: object with ``get_encoded(key)`` and ``put_encoded(key, encoded)``, None to disable
+        """
+        global _shared_cache
+        _shared_cache = cache
 
     @staticmethod
     def _is_cache_enabled() -> bool:
@@ -289,41 +471,110 @@ class Layer:
         self.layer.get_image().remove_layer(self.layer)
         return self
 
-    def _get_layer_hash(self) -> str:
+    def _pixel_format(self) -> str:
+        if isinstance(self.layer, Gimp.Channel):
+            return "Y' u8"
+        return "R'G'B'A u8" if self.layer.has_alpha() else "R'G'B' u8"
+
+    def _read_pixels(self, x: int = 0, y: int = 0, width: int | None = None, height: int | None = None) -> bytes:
+        """Read a rectangle of the layer pixels as packed 8-bit bytes"""
+        width = self.layer.get_width() if width is None else width
+        height = self.layer.get_height() if height is None else height
+        buffer = self.layer.get_buffer()
+        return bytes(
+            buffer.get(Gegl.Rectangle.new(x, y, width, height), 1.0, self._pixel_format(), Gegl.AbyssPolicy.CLAMP),
+        )
+
+    def _get_pixel_digest(self, pixels: bytes | None = None) -> str:
         """
-        Generate a hash for the layer based on its properties.
-        This is used for caching toBase64 results.
+        Digest of the full pixel buffer, used as the toBase64 cache key.
+
+        Args:
+            pixels: result of ``_read_export_pixels`` if already at hand
 
         Returns:
-            Hash string representing the layer state
+            Hex digest of size, pixel format and pixel data
         """
-        try:
-            # Get basic properties
-            width = self.layer.get_width()
-            height = self.layer.get_height()
-            name = self.layer.get_name()
-
-            hash_obj = hashlib.md5()  # noqa: S324
-            hash_obj.update(f"{width}x{height}x{name}x{id(self.layer)}".encode())
-            return hash_obj.hexdigest()
-        except Exception:
-            # Ultimate fallback: use object ID
-            return str(id(self.layer))
-
-    def _save_to_memory_stream(self) -> bytes:
+        hash_obj = self._new_digest()
+        hash_obj.update(self._read_export_pixels() if pixels is None else pixels)
+        return hash_obj.hexdigest()
+
+    def _get_sample_digest(self) -> str:
         """
-        Save layer to PNG format directly to memory.
+        Cheap digest of a few evenly spaced pixel rows.
 
-        Uses file-based methods with /dev/shm (RAM filesystem) for optimal performance.
-        Direct pixel access via GEGL Buffer or get_pixels() is not available in GIMP 3.0 Python API.
+        Different sampled rows prove the pixels changed; equal ones still need the full digest to confirm.
+        """
+        width = self.layer.get_width()
+        height = self.layer.get_height()
+        rows = min(height, _toBase64_sample_rows)
+        mask = self.layer.get_mask()
+        hash_obj = self._new_digest()
+        for row in range(rows):
+            y = (row * height) // rows
+            hash_obj.update(self._read_pixels(0, y, width, 1))
+            if mask:
+                hash_obj.update(Layer(mask)._read_pixels(0, y, width, 1))
+        return hash_obj.hexdigest()
+
+    def _new_digest(self) -> hashlib.blake2b:
+        """Digest seeded with everything besides pixels that changes the exported PNG"""
+        hash_obj = hashlib.blake2b(digest_size=20)
+        _, offset_x, offset_y = self.layer.get_offsets()
+        hash_obj.update(
+            f"{self.layer.get_width()}x{self.layer.get_height()}x{self._pixel_format()}"
+            f"+{offset_x}+{offset_y}x{self.layer.get_opacity()}x{bool(self.layer.get_mask())}".encode(),
+        )
+        return hash_obj
+
+    def _read_export_pixels(
+        self,
+        x: int = 0,
+        y: int = 0,
+        width: int | None = None,
+        height: int | None = None,
+    ) -> bytes:
+        """Pixels (of a rectangle) as they would be exported: the layer mask, if any, multiplied into alpha"""
+        width = self.layer.get_width() if width is None else width
+        height = self.layer.get_height() if height is None else height
+        pixels = self._read_pixels(x, y, width, height)
+        mask = self.layer.get_mask() if not isinstance(self.layer, Gimp.Channel) else None
+        if not mask:
+            return pixels
+        if not has_numpy():
+            raise RuntimeError("Applying a layer mask without NumPy is not supported")
+        rgba = np.frombuffer(pixels, dtype=np.uint8).reshape(height, width, -1)
+        opaque = np.full((height, width), 255, dtype=np.uint8)
+        rgba = np.dstack([rgba, opaque]) if rgba.shape[2] == 3 else rgba.copy()
+        alpha = np.frombuffer(Layer(mask)._read_pixels(x, y, width, height), dtype=np.uint8).reshape(height, width)
+        rgba[:, :, 3] = (rgba[:, :, 3].astype(np.uint16) * alpha // 255).astype(np.uint8)
+        return rgba.tobytes()
+
+    def _encode_pixels(self, image_format: str, pixels: bytes | None = None) -> EncodedImage:
+        if pixels is None:
+            pixels = self._read_export_pixels()
+        width = self.layer.get_width()
+        height = self.layer.get_height()
+        return PAYLOAD_POLICY.encode(pixels, width, height, len(pixels) // (width * height), image_format)
+
+    def _save_to_memory_stream(self, pixels: bytes | None = None) -> bytes:
+        """
+        Save layer to PNG format directly to memory.
 
-        Note: GIMP 3.0 file_save requires Gio.File, not Gio.OutputStream directly.
-        Using /dev/shm provides near-memory-stream performance while using the file API.
+        Pixels are read from the GEGL buffer and encoded in-process, without a temporary image,
+        file-png PDB call or filesystem round-trip. Falls back to exporting through GIMP if that fails.
 
         Returns:
             PNG image data as bytes
         """
-        # Create a new image with the layer
+        try:
+            return self.encodePng(pixels)
+        except Exception as e:
+            logging.warning(f"Direct PNG encoding failed, exporting through GIMP: {e}")
+            return self._export_with_file_save()
+
+    def _export_with_file_save(self) -> bytes:
+        """Slow path: export a temporary single-layer image with Gimp.file_save and read it back"""
         new_image = Gimp.Image.new(
             self.layer.get_width(),
             self.layer.get_height(),
@@ -332,54 +583,29 @@ class Layer:
         layer = Gimp.Layer.new_from_drawable(self.layer, new_image)
         new_image.insert_layer(layer, None, -1)
 
-
-        # Method: Use /dev/shm (RAM filesystem) - file in RAM, very fast
-        # This is preferred when /dev/shm is available
-        temp_path = None
+        shm_dir = "/dev/shm"  # noqa: S108
+        temp_dir = shm_dir if os.path.exists(shm_dir) else tempfile.gettempdir()
+        temp_path = os.path.join(temp_dir, f"gimpfusion_layer_{self.id}_{time.time()}.png")
         try:
-            if os.path.exists("/dev/shm"):  # noqa: S108
-                temp_path = os.path.join("/dev/shm", f"gimpfusion_layer_{self.id}_{time.time()}.png")  # noqa: S108
-            else:
-                # Fallback to regular temp directory
-                temp_path = os.path.join(tempfile.gettempdir(), f"gimpfusion_layer_{self.id}_{time.time()}.png")
-
-            temp_file = Gio.File.new_for_path(temp_path)
-
-            Gimp.file_save(Gimp.RunMode.NONINTERACTIVE, new_image, temp_file, None)
-
+            Gimp.file_save(Gimp.RunMode.NONINTERACTIVE, new_image, Gio.File.new_for_path(temp_path), None)
             with open(temp_path, "rb") as f:
-                data = f.read()
-
-            return data
-        except Exception as e:
-            logging.warning(f"Failed to save to memory filesystem, using fallback: {e}")
-            temp_path = None
-            try:
-                temp_path = os.path.join(tempfile.gettempdir(), f"gimpfusion_layer_{self.id}_{time.time()}.png")
-                temp_file = Gio.File.new_for_path(temp_path)
-                Gimp.file_save(Gimp.RunMode.NONINTERACTIVE, new_image, temp_file, None)
-                with open(temp_path, "rb") as f:
-                    data = f.read()
-                return data
-            finally:
-                # Clean up temp file immediately
-                if temp_path and os.path.exists(temp_path):
-                    try:
-                        os.remove(temp_path)
-                    except Exception as e:
-                        logging.debug(f"Failed to remove temp file {temp_path}: {e}")
+                return f.read()
         finally:
-            # Clean up temp file immediately (for /dev/shm case)
-            if temp_path and os.path.exists(temp_path):
+            new_image.delete()
+            if os.path.exists(temp_path):
                 try:
                     os.remove(temp_path)
                 except Exception as e:
                     logging.debug(f"Failed to remove temp file {temp_path}: {e}")
 
 
-
 class ResponseLayers:
-    def __init__(self, img: Gimp.Image, response: dict[str, Any], options: dict[str, Any] | None = None) -> None:
+    def __init__(
+        self,
+        img: Gimp.Image,
+        response: dict[str, Any] | StreamedResponse,
+        options: dict[str, Any] | None = None,
+    ) -> None:
         if options is None:
             options = {}
         self.image = img
@@ -412,41 +638,54 @@ class ResponseLayers:
             'args': [True, True]}, 'multidiffusion integrated': {'args': [True, 'MultiDiffusion', 768, 768, 64, 64]}},
             'infotext': None}
             """
-            info = json.loads(response["info"])
-            infotexts = info["infotexts"]
-            seeds = info["all_seeds"]
-            self.generated_width = info["width"]
-            self.generated_height = info["height"]
-            logging.debug(f"{infotexts=}")
-            logging.debug(f"{seeds=}")
-            total_images = len(seeds)
-            for index, image in enumerate(response["images"]):
-                layer = None
+            # images come before "info" in the body: load each one as soon as it is decoded and name the layers
+            # once the seeds are known
+            if isinstance(response, dict):
+                response = StreamedResponse.from_dict(response)
+            loaded = [self._load_layer(img, data, decoded) for data, decoded in decode_in_order(response.images())]
+
+            info = ResponseInfo.parse(response["info"])
+            self.generated_width = info.width
+            self.generated_height = info.height
+            logging.debug(f"{info.infotexts=}")
+            logging.debug(f"{info.seeds=}")
+            total_images = len(info)
+            # ids of the layers to insert the images above, e.g. their init images
+            above = [Gimp.Layer.get_by_id(layer_id) for layer_id in options.get("above") or []]
+            for index, layer in enumerate(loaded):
                 if index < total_images:
-                    layer_data = {"info": infotexts[index], "seed": seeds[index]}
-                    layer = (
-                        Layer.fromBase64(img, image)
-                        .rename(f"Generated Layer {seeds[index]}")
-                        .saveData(layer_data)
-                        .insertTo(img)
-                        .saveAs(TempFiles().get(f"result{index}.png"))
-                    )
+                    layer_data = info.image_data(index)
+                    layer = layer.rename(f"Generated Layer {layer_data['seed']}").saveData(layer_data)
+                    if index < len(above) and above[index] is not None:
+                        layer = layer.insertAbove(above[index])
+                    else:
+                        layer = layer.insertTo(img)
                 elif "skip_annotator_layers" in options and not options["skip_annotator_layers"]:
                     # annotator layers
-                    layer = (
-                        Layer.fromBase64(img, image)
-                        .rename("Annotator Layer")
-                        .insertTo(img)
-                        .saveAs(TempFiles().get("AnnotatorLayer.png"))
-                    )
+                    layer = layer.rename("Annotator Layer").insertTo(img)
+                else:
+                    layer.layer.delete()
+                    layer = None
                 if layer:
                     layers.append(layer.layer)
         except Exception as e:
             logging.exception(f"ResponseLayers: {e}")
+        finally:
+            if isinstance(response, StreamedResponse):
+                response.close()
 
         Gimp.context_set_foreground(color)
         self.layers = layers
 
+    @staticmethod
+    def _load_layer(img: Gimp.Image, data: bytes, decoded: DecodedImage | None) -> Layer:
+        if decoded is not None and img.get_base_type() != Gimp.ImageBaseType.INDEXED:
+            try:
+                return Layer.fromDecoded(img, decoded)
+            except Exception as e:
+                logging.warning(f"Creating a layer from decoded pixels failed, loading it through GIMP: {e}")
+        return Layer.fromBytes(img, data)
+
     def scale(self, new_scale: float = 1.0) -> ResponseLayers:
         if new_scale != 1.0:
             for layer in self.layers:
@@ -501,13 +740,56 @@ class ResponseLayers:
         return self
 
 
+class PreviewLayer:
+    """Single top layer showing the live preview of a running generation over the target area"""
+
+    def __init__(self, image: Gimp.Image, x: int, y: int, width: int, height: int, max_size: int) -> None:
+        self.image = image
+        self.x, self.y, self.width, self.height = x, y, width, height
+        self.max_size = max_size
+        self.layer: Gimp.Layer | None = None
+
+    def update(self, image_base64: str) -> None:
+        # frames are downscaled while decoding and scaled back up by GIMP, a preview does not need the detail
+        decoded = decode_image(base64.b64decode(image_base64), max_side=self.max_size)
+        self.image.undo_freeze()
+        try:
+            layer = Layer.fromDecoded(self.image, decoded, name="Preview")
+            layer.layer.scale(self.width, self.height, False)
+            layer.translate((self.x, self.y))
+            self.image.insert_layer(layer.layer, None, 0)
+            self._remove_layer()
+            self.layer = layer.layer
+        finally:
+            self.image.undo_thaw()
+        Gimp.displays_flush()
+
+    def remove(self) -> None:
+        if self.layer is None:
+            return
+        self.image.undo_freeze()
+        try:
+            self._remove_layer()
+        finally:
+            self.image.undo_thaw()
+        Gimp.displays_flush()
+
+    def _remove_layer(self) -> None:
+        if self.layer is not None and self.layer.is_valid():
+            self.image.remove_layer(self.layer)
+        self.layer = None
+
+
 class MyShelf:
     """GimpShelf is not available at init time, so we keep our persistent data in a json file"""
 
+    # background threads (options refresh) save concurrently with the procedure itself
+    _save_lock = threading.Lock()
+
     def __init__(self, default_shelf: dict[str, Any] | None = None) -> None:
         if default_shelf is None:
             default_shelf = {}
-        self.file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "stable_gimpfusion.json")
+        self.file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), SETTINGS_FILE)
         self.load(default_shelf)
 
     def load(self, default_shelf=None):
@@ -527,10 +809,14 @@ class MyShelf:
         if data is None:
             data = {}
         try:
-            self.data.update(data)
-            logging.info(f"Saving shelf to {self.file_path}")
-            with open(self.file_path, "w") as f:
-                json.dump(self.data, f)
+            with self._save_lock:
+                self.data.update(data)
+                logging.info(f"Saving shelf to {self.file_path}")
+                # write-then-rename so a concurrently starting plug-in never reads a truncated file
+                tmp_path = f"{self.file_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(self.data, f)
+                os.replace(tmp_path, self.file_path)
             logging.info("Successfully saved shelf")
 
         except Exception as e:
@@ -545,78 +831,74 @@ class MyShelf:
         self.save()
 
 
-class ApiClient:
-    """Simple API client used to interface with StableDiffusion JSON endpoints"""
+def getLayerEncoded(layer: Gimp.Layer, kind: str = PAYLOAD_INIT) -> EncodedImage:
+    # unchanged pixels were already encoded, no need for a temporary copy
+    wrapped = Layer(layer)
+    cached = wrapped.cachedEncoded(PAYLOAD_POLICY.choose(kind, layer.get_width(), layer.get_height()))
+    if cached is not None:
+        return cached
 
-    def __init__(self, base_url, timeout=300):
-        self.setBaseUrl(base_url)
-        self.timeout = timeout
+    # store active_layer
+    active_layers = layer.get_image().get_selected_layers()
+    copy = wrapped.copy().insert()
+    try:
+        return copy.encode(kind)
+    finally:
+        copy.remove()
+        # restore active_layer
+        layer.get_image().set_selected_layers(active_layers)
 
-    def setBaseUrl(self, base_url):
-        self.base_url = base_url.strip("/")
 
-    def post(self, endpoint, data=None, params=None, headers=None):
-        try:
-            url = self.base_url + endpoint
-            headers = headers or {"Content-Type": "application/json", "Accept": "application/json"}
-
-            logging.debug(f"POST {url}, data {data.keys() if data else None}")
-
-            response = requests.post(url=url, params=params, headers=headers, json=data, timeout=self.timeout)
-
-            data = response.json()
-            # response.raise_for_status()
-            return data
-        except requests.exceptions.Timeout:
-            logging.error(f"Timeout while POSTing to {endpoint}")
-            raise
-        except requests.exceptions.RequestException as ex:
-            logging.exception(f"ERROR: ApiClient.post to {endpoint}: {ex}")
-            raise
-        except Exception as ex:
-            logging.exception(f"ERROR: ApiClient.post unexpected error to {endpoint}: {ex}")
-            raise
+def getLayerRegionEncoded(layer: Gimp.Layer, region: CropRegion, kind: str = PAYLOAD_INIT) -> EncodedImage:
+    return Layer(layer).encodeRegion(region, kind)
 
-    def get(self, endpoint, params=None, headers=None):
-        try:
-            url = self.base_url + endpoint
-            logging.debug(f"GET {url}")
-            headers = headers or {"Content-Type": "application/json", "Accept": "application/json"}
-
-            response = requests.get(url=url, params=params, headers=headers, timeout=self.timeout)
-            # response.raise_for_status()
-            return response.json()
-        except requests.exceptions.Timeout:
-            logging.error(f"Timeout while GETting {endpoint}")
-            raise
-        except requests.exceptions.RequestException as ex:
-            logging.exception(f"ERROR: ApiClient.get from {endpoint}: {ex}")
-            raise
-        except Exception as ex:
-            logging.exception(f"ERROR: ApiClient.get unexpected error to {endpoint}: {ex}")
-            raise
+
+def getLayerEncoder(
+    layer: Gimp.Layer,
+    region: CropRegion | None = None,
+    kind: str = PAYLOAD_INIT,
+) -> Callable[[], EncodedImage]:
+    """
+    Read ``layer``, or ``region`` of it, on the main thread and return a function encoding it on any thread.
+
+    Layers that cannot be read directly are encoded right away, through GIMP if needed.
+    """
+    try:
+        return Layer(layer).encoder(kind, region)
+    except Exception as ex:
+        logging.warning(f"Reading layer {layer.get_name()} failed, encoding it now: {ex}")
+        encoded = getLayerEncoded(layer, kind) if region is None else getLayerRegionEncoded(layer, region, kind)
+        return lambda: encoded
 
 
 def getLayerAsBase64(layer: Gimp.Layer) -> str:
-    # store active_layer
-    active_layers = layer.get_image().get_selected_layers()
-    copy = Layer(layer).copy().insert()
-    result = copy.toBase64()
-    copy.remove()
-    # restore active_layer
-    layer.get_image().set_selected_layers(active_layers)
-    return result
+    return getLayerEncoded(layer, PAYLOAD_LOSSLESS).to_base64()
+
+
+def expandLayerGroups(drawables: list[Gimp.Drawable]) -> list[Gimp.Layer]:
+    """The layers among ``drawables``, groups replaced by the layers inside them, top to bottom"""
+    layers = []
+    for drawable in drawables:
+        if drawable.is_group():
+            layers.extend(expandLayerGroups(drawable.get_children()))
+        elif isinstance(drawable, Gimp.Layer):
+            layers.append(drawable)
+    return layers
+
+
+def getActiveLayerEncoded(image: Gimp.Image, kind: str = PAYLOAD_INIT) -> EncodedImage:
+    return getLayerEncoded(image.get_selected_layers()[0], kind)
 
 
 def getActiveLayerAsBase64(image: Gimp.Image) -> str:
     return getLayerAsBase64(image.get_selected_layers()[0])
 
 
-def getLayerMaskAsBase64(layer):
+def getLayerMaskEncoded(layer: Gimp.Layer) -> EncodedImage | None:
     success, non_empty, x1, y1, x2, y2 = Gimp.Selection.bounds(layer.get_image())
 
     if non_empty:
-        # selection to base64
+        # selection to mask
 
         # store active_layer
         active_layers = layer.get_image().get_selected_layers()
@@ -634,37 +916,59 @@ def getLayerMaskAsBase64(layer):
         )
         tmp_layer.addSelectionAsMask().insert()
 
-        result = tmp_layer.maskToBase64()
-        tmp_layer.remove()
-        # enable = pdb.gimp_image_undo_enable(layer.image)
-
-        # restore active_layer
-        layer.get_image().set_selected_layers(active_layers)
+        try:
+            return tmp_layer.encodeMask()
+        finally:
+            tmp_layer.remove()
+            # enable = pdb.gimp_image_undo_enable(layer.image)
 
-        return result
+            # restore active_layer
+            layer.get_image().set_selected_layers(active_layers)
     elif layer.get_mask():
         # mask to file
         tmp_layer = Layer(layer)
-        return tmp_layer.maskToBase64()
+        return tmp_layer.encodeMask()
     else:
-        return ""
+        return None
+
+
+def getSelectionRegionEncoded(image: Gimp.Image, region: CropRegion) -> EncodedImage | None:
+    """The selection inside ``region`` as a grayscale PNG mask, read straight from the selection channel"""
+    success, non_empty, x1, y1, x2, y2 = Gimp.Selection.bounds(image)
+    if not non_empty:
+        return None
+    return Layer(image.get_selection()).encodeRegion(region, image_format="png")
+
+
+def getLayerMaskAsBase64(layer):
+    encoded = getLayerMaskEncoded(layer)
+    return encoded.to_base64() if encoded is not None else ""
+
+
+def getActiveMaskEncoded(image: Gimp.Image) -> EncodedImage | None:
+    return getLayerMaskEncoded(image.get_selected_layers()[0])
 
 
 def getActiveMaskAsBase64(image):
     return getLayerMaskAsBase64(image.get_selected_layers()[0])
 
 
-def getControlNetParams(cn_layer):
+def getControlNetParams(cn_layer, region: CropRegion | None = None):
     if not cn_layer:
         return None
 
     layer = Layer(cn_layer)
-    data = layer.loadData(CONTROLNET_DEFAULT_SETTINGS)
+    options = layer.loadData(CONTROLNET_DEFAULT_SETTINGS)
+    if region is not None:
+        # the part under the cropped init image, already aligned to multiples of 64
+        mask = Layer(cn_layer.get_mask()).encodeRegion(region, image_format="png") if cn_layer.get_mask() else None
+        return controlnet_unit(options, layer.encodeRegion(region, PAYLOAD_LOSSLESS), mask)
     # ControlNet image size need to be in multiples of 64
-    layer64 = layer.copy().insert().resizeToMultipleOf(64)
-    data.update({"input_image": layer64.toBase64()})
-    # if cn_layer.mask:
-    if cn_layer.get_mask():
-        data.update({"mask": layer64.maskToBase64()})
-    layer64.remove()
-    return data
+    layer64 = layer.copy().insert()
+    try:
+        layer64.resizeToMultipleOf(64)
+        # if cn_layer.mask:
+        mask = layer64.encodeMask() if cn_layer.get_mask() else None
+        return controlnet_unit(options, layer64.encode(PAYLOAD_LOSSLESS), mask)
+    finally:
+        layer64.remove()
@@ -0,0 +1,169 @@
+"""
+Tiled img2img for areas larger than the backend can generate at once.
+
+The area is cut into overlapping tiles whose sizes are multiples of 64, spread evenly so the last tile ends at the
+edge. Tiles are generated one request each and written back in raster order; the overlap with the tiles left of and
+above a tile, already written, is blended with a smoothstep feather so no seams show. Only a few tiles are held at a
+time: the plug-in reads a tile, sends it while earlier tiles are on the GPU, and blends each result into the output
+layer as it arrives.
+
+Kept free of GIMP imports.
+"""
+
+from __future__ import annotations
+
+from typing import Any
+
+from sg_png import has_numpy, np
+
+TILE_MULTIPLE = 64
+DEFAULT_TILE_OVERLAP = 64
+# Requests in flight per backend: one on the GPU, the next one uploading
+TILES_IN_FLIGHT_PER_BACKEND = 2
+
+
+def _floor_to(value: int, multiple: int) -> int:
+    return max(multiple, value // multiple * multiple)
+
+
+def _ceil_to(value: int, multiple: int) -> int:
+    return -(-value // multiple) * multiple
+
+
+def _positions(length: int, tile: int, overlap: int) -> list[int]:
+    """Start of each tile along one axis, overlapping by ``overlap`` at least, the last one ending at ``length``"""
+    if length <= tile:
+        return [0]
+    step = max(1, tile - overlap)
+    count = 1 + -(-(length - tile) // step)
+    return [round(index * (length - tile) / (count - 1)) for index in range(count)]
+
+
+class Tile:
+    """
+    One tile of the grid, ``width`` x ``height`` pixels generated at ``x``, ``y`` of the area.
+
+    ``overlap_left`` and ``overlap_top`` are the pixels shared with the tiles written before it.
+    """
+
+    def __init__(
+        self,
+        index: int,
+        x: int,
+        y: int,
+        width: int,
+        height: int,
+        overlap_left: int,
+        overlap_top: int,
+    ) -> None:
+        self.index = index
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.overlap_left = overlap_left
+        self.overlap_top = overlap_top
+
+    def __repr__(self) -> str:
+        return f"Tile({self.index}, {self.width}x{self.height}+{self.x}+{self.y})"
+
+    def apply(self, data: dict[str, Any]) -> dict[str, Any]:
+        """Request payload of this tile, ``data`` itself is left unchanged"""
+        return {**data, "width": self.width, "height": self.height, "batch_size": 1, "n_iter": 1}
+
+
+class TileGrid:
+    """
+    Overlapping tiles covering a ``width`` x ``height`` area.
+
+    Args:
+        tile_size: largest tile side, rounded down to a multiple of 64
+        overlap: least pixels neighbouring tiles share
+
+    Areas smaller than a tile along an axis get one tile rounded up to a multiple of 64 there; the pixels beyond
+    the area are sent as context and dropped.
+    """
+
+    def __init__(self, width: int, height: int, tile_size: int, overlap: int = DEFAULT_TILE_OVERLAP) -> None:
+        self.width = width
+        self.height = height
+        tile_width = min(_floor_to(tile_size, TILE_MULTIPLE), _ceil_to(width, TILE_MULTIPLE))
+        tile_height = min(_floor_to(tile_size, TILE_MULTIPLE), _ceil_to(height, TILE_MULTIPLE))
+        # the overlap stays below half a tile, so only neighbours overlap
+        overlap = max(0, min(int(overlap), tile_width // 2, tile_height // 2))
+        xs = _positions(width, tile_width, overlap)
+        ys = _positions(height, tile_height, overlap)
+        self.tiles = [
+            Tile(
+                row * len(xs) + column,
+                x,
+                y,
+                tile_width,
+                tile_height,
+                xs[column - 1] + tile_width - x if column else 0,
+                ys[row - 1] + tile_height - y if row else 0,
+            )
+            for row, y in enumerate(ys)
+            for column, x in enumerate(xs)
+        ]
+
+    def __len__(self) -> int:
+        return len(self.tiles)
+
+    def __iter__(self) -> Any:
+        return iter(self.tiles)
+
+    def __repr__(self) -> str:
+        tile = self.tiles[0]
+        return f"TileGrid({self.width}x{self.height}, {len(self.tiles)} tiles of {tile.width}x{tile.height})"
+
+    def visible(self, tile: Tile) -> tuple[int, int]:
+        """Width and height of the part of ``tile`` inside the area"""
+        return min(tile.width, self.width - tile.x), min(tile.height, self.height - tile.y)
+
+
+def _ramp(length: int, overlap: int) -> Any:
+    ramp = np.ones(length, dtype=np.float32)
+    if overlap:
+        t = (np.arange(overlap, dtype=np.float32) + 0.5) / overlap
+        ramp[:overlap] = t * t * (3 - 2 * t)
+    return ramp
+
+
+def feather_weights(grid: TileGrid, tile: Tile) -> Any:
+    """Weight of the new tile for every visible pixel, rising from 0 to 1 across the overlap with earlier tiles"""
+    width, height = grid.visible(tile)
+    return np.outer(_ramp(height, min(tile.overlap_top, height)), _ramp(width, min(tile.overlap_left, width)))
+
+
+def blend_tile(
+    grid: TileGrid,
+    tile: Tile,
+    generated: bytes,
+    channels: int,
+    written: bytes | None,
+) -> bytes:
+    """
+    Opaque RGBA pixels of the visible part of ``tile``.
+
+    Args:
+        generated: the generated tile, ``tile.width`` x ``tile.height`` RGB or RGBA pixels
+        channels: channels of ``generated``
+        written: RGBA pixels of the output under the visible part, None for the first tile
+
+    Raises:
+        RuntimeError: NumPy is not available
+    """
+    if not has_numpy():
+        raise RuntimeError("Blending tiles needs NumPy")
+    width, height = grid.visible(tile)
+    new = np.frombuffer(generated, dtype=np.uint8).reshape(tile.height, tile.width, channels)[:height, :width, :3]
+    rgba = np.empty((height, width, 4), dtype=np.uint8)
+    rgba[:, :, 3] = 255
+    if written is None or not (tile.overlap_left or tile.overlap_top):
+        rgba[:, :, :3] = new
+        return rgba.tobytes()
+    old = np.frombuffer(written, dtype=np.uint8).reshape(height, width, 4)[:, :, :3]
+    weights = feather_weights(grid, tile)[:, :, None]
+    rgba[:, :, :3] = (old * (1 - weights) + new * weights + 0.5).astype(np.uint8)
+    return rgba.tobytes()
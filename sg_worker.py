@@ -0,0 +1,1124 @@
+"""
+Optional background worker shared by plug-in processes.
+
+GIMP starts a new plug-in process for every procedure run, so connections to the backend, encoded layers and
+backend responses are thrown away after each run. With ``worker_enabled`` set, plug-in processes send their
+requests to one long-lived process over a Unix socket instead. It keeps the keep-alive connections to the backend,
+a cache of encoded images keyed by pixel digest and the capability responses, and exits after
+``worker_idle_timeout`` seconds without clients. Layer pixels are still read in the plug-in process, GIMP objects
+cannot leave it.
+
+The worker also runs the job queue (sg_jobs): generations submitted there continue after the submitting plug-in
+run has returned.
+
+Kept free of GIMP imports. The plug-in starts the worker on demand; it can also be run by hand:
+
+    python sg_worker.py [--socket PATH] [--idle-timeout SECONDS]
+    python sg_worker.py --status | --stop
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from collections.abc import Iterator
+from typing import Any, BinaryIO
+
+import requests
+
+from sg_api import DEFAULT_TIMEOUT, ApiClient
+from sg_backend_options import CAPABILITY_ENDPOINTS
+from sg_backends import BackendPool, backend_urls
+from sg_cache import LRUCache
+from sg_constants import TOBASE64_CACHE_MAX_ENTRIES, TOBASE64_CACHE_MAX_MB
+from sg_jobs import DEFAULT_QUEUE_CONCURRENCY, Job, JobQueue, JobStore, job_backends
+from sg_payload import PAYLOAD_POLICY, EncodedImage
+from sg_retry import BackendUnavailable, RetryPolicy
+from sg_stream import StreamedResponse
+
+# Bumped on incompatible protocol changes, a worker left running by an older plug-in version is replaced
+PROTOCOL_VERSION = 5
+
+DEFAULT_IDLE_TIMEOUT = 1800
+WORKER_START_TIMEOUT = 5.0
+# Added to the HTTP timeout of a request when waiting for the worker to answer it
+WORKER_TIMEOUT_MARGIN = 5.0
+CACHE_TIMEOUT = 10.0
+PING_TIMEOUT = 1.0
+
+WORKER_SCRIPT = os.path.abspath(__file__)
+
+# Capability endpoints whose responses the worker keeps between plug-in runs
+SNAPSHOT_ENDPOINTS = frozenset(CAPABILITY_ENDPOINTS.values())
+OPTIONS_ENDPOINT = "/sdapi/v1/options"
+
+_FRAME_HEADER = struct.Struct("!I")
+# pid, uid, gid of the process on the other end of a Unix socket (Linux)
+_PEER_CREDENTIALS = struct.Struct("3i")
+
+
+class WorkerError(RuntimeError):
+    """The worker failed a request for a reason other than the backend connection"""
+
+
+class MissingCachedImage(KeyError):
+    """A request referenced an encoded image the worker no longer holds"""
+
+
+def worker_directory() -> str:
+    """Per-user directory of the worker's socket and log, see ``private_directory``"""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "gimpfusion")
+    return os.path.join(tempfile.gettempdir(), f"gimpfusion-{_uid()}")
+
+
+def default_socket_path() -> str:
+    return os.path.join(worker_directory(), "worker.sock")
+
+
+def default_log_path() -> str:
+    return os.path.join(worker_directory(), "worker.log")
+
+
+def private_directory(directory: str) -> str:
+    """
+    Create ``directory`` accessible by the current user only, or check that an existing one is.
+
+    The worker's socket lives there: another user able to bind it first would receive every prompt, init image
+    and backend URL, and could answer with forged images.
+
+    Raises:
+        WorkerError: the directory is a symlink, owned by another user or open to other users
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    status = os.lstat(directory)
+    if not stat.S_ISDIR(status.st_mode):
+        raise WorkerError(f"Worker directory {directory} is not a directory")
+    if status.st_uid != _uid():
+        raise WorkerError(f"Worker directory {directory} is owned by user {status.st_uid}")
+    if status.st_mode & 0o077:
+        raise WorkerError(f"Worker directory {directory} is open to other users (mode {status.st_mode & 0o777:o})")
+    return directory
+
+
+def _peer_uid(sock: socket.socket) -> int | None:
+    """User of the process on the other end of a Unix socket, None where the platform does not tell"""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _PEER_CREDENTIALS.size)
+    _pid, uid, _gid = _PEER_CREDENTIALS.unpack(credentials)
+    return uid
+
+
+def _check_peer(sock: socket.socket, socket_path: str) -> None:
+    """Refuse a worker run by another user, it would see the requests and answer them"""
+    uid = _peer_uid(sock)
+    if uid is None:
+        uid = os.stat(socket_path).st_uid
+    if uid != _uid():
+        raise PermissionError(f"Worker socket {socket_path} is served by user {uid}")
+
+
+def _uid() -> int:
+    return os.getuid() if hasattr(os, "getuid") else 0
+
+
+def is_supported() -> bool:
+    return hasattr(socket, "AF_UNIX")
+
+
+# Wire format: a 4-byte length, a JSON header, then the binary blobs whose sizes the header lists in "blobs".
+# Images travel as raw bytes this way instead of as base64 text inside the JSON.
+
+
+def send_frame(sock: socket.socket, header: dict[str, Any], blobs: list[bytes] | tuple[bytes, ...] = ()) -> None:
+    if blobs:
+        header = {**header, "blobs": [len(blob) for blob in blobs]}
+    text = json.dumps(header).encode()
+    sock.sendall(_FRAME_HEADER.pack(len(text)) + text)
+    for blob in blobs:
+        sock.sendall(blob)
+
+
+def recv_frame(stream: BinaryIO) -> tuple[dict[str, Any], list[bytes]] | None:
+    """Next frame, None when the peer closed the connection between frames"""
+    prefix = stream.read(_FRAME_HEADER.size)
+    if not prefix:
+        return None
+    (size,) = _FRAME_HEADER.unpack(_read_exact(stream, _FRAME_HEADER.size, prefix))
+    header = json.loads(_read_exact(stream, size))
+    return header, [_read_exact(stream, blob_size) for blob_size in header.get("blobs", ())]
+
+
+def _read_exact(stream: BinaryIO, size: int, data: bytes = b"") -> bytes:
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise ConnectionError("Worker connection closed in the middle of a frame")
+        data += chunk
+    return data
+
+
+def _image_meta(encoded: EncodedImage) -> dict[str, Any]:
+    return {
+        "format": encoded.format,
+        "width": encoded.width,
+        "height": encoded.height,
+        "encode_seconds": encoded.encode_seconds,
+    }
+
+
+def _image_from_meta(data: bytes, meta: dict[str, Any]) -> EncodedImage:
+    return EncodedImage(data, meta["format"], meta["width"], meta["height"], meta.get("encode_seconds", 0.0))
+
+
+def _pack(obj: Any, blobs: list[bytes], known_keys: set[str]) -> Any:
+    """Payload with EncodedImage objects replaced by blob references, or cache references if the worker has them"""
+    if isinstance(obj, EncodedImage):
+        if obj.cache_key is not None and obj.cache_key in known_keys:
+            return {"$cached": obj.cache_key}
+        blobs.append(obj.data)
+        return {"$image": len(blobs) - 1, **_image_meta(obj)}
+    if isinstance(obj, dict):
+        return {key: _pack(value, blobs, known_keys) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_pack(value, blobs, known_keys) for value in obj]
+    return obj
+
+
+def _unpack(obj: Any, blobs: list[bytes], cache: LRUCache) -> Any:
+    if isinstance(obj, dict):
+        if "$image" in obj:
+            return _image_from_meta(blobs[obj["$image"]], obj)
+        if "$cached" in obj:
+            encoded = cache.get(obj["$cached"])
+            if encoded is None:
+                raise MissingCachedImage(obj["$cached"])
+            return encoded
+        return {key: _unpack(value, blobs, cache) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_unpack(value, blobs, cache) for value in obj]
+    return obj
+
+
+def _remote_error(reply: dict[str, Any]) -> Exception:
+    """Exception matching what ApiClient would have raised in-process"""
+    name, message = reply.get("type") or "", reply.get("message") or "worker request failed"
+    if name == BackendUnavailable.__name__:
+        return BackendUnavailable(message)
+    if "Timeout" in name:
+        return requests.exceptions.Timeout(message)
+    if "Connection" in name:
+        return requests.exceptions.ConnectionError(message)
+    return WorkerError(f"{name}: {message}")
+
+
+# Worker process
+
+
+class WorkerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    # plug-ins open one connection per request, e.g. all capability requests at once
+    request_queue_size = 128
+
+    def __init__(
+        self,
+        socket_path: str,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+        cache_max_mb: int = TOBASE64_CACHE_MAX_MB,
+        cache_max_entries: int = TOBASE64_CACHE_MAX_ENTRIES,
+        jobs_dir: str | None = None,
+        queue_concurrency: int = DEFAULT_QUEUE_CONCURRENCY,
+    ) -> None:
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self.cache = LRUCache(max_bytes=cache_max_mb * 1024 * 1024, max_entries=cache_max_entries)
+        self.started = time.monotonic()
+        self.requests = 0
+        self._clients: dict[tuple[Any, ...], ApiClient] = {}
+        self._pools: dict[tuple[Any, ...], BackendPool] = {}
+        # (base_url, endpoint) -> (monotonic time, response)
+        self._snapshots: dict[tuple[str, str], tuple[float, Any]] = {}
+        self._active = 0
+        self._last_activity = time.monotonic()
+        self._lock = threading.Lock()
+        super().__init__(socket_path, WorkerHandler)
+        # jobs left queued by a previous worker start running right away
+        self.jobs = JobQueue(
+            JobStore(jobs_dir),
+            self.api,
+            queue_concurrency,
+            eligible=self.eligible_backends,
+            on_model_load=self.model_loaded,
+        )
+
+    def server_bind(self) -> None:
+        # the worker talks to the backend on behalf of whoever can connect: no moment where others can
+        old_umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(old_umask)
+
+    def verify_request(self, request: Any, client_address: Any) -> bool:
+        # the socket's directory keeps other users out already, their connections are refused where the platform
+        # tells who connected
+        uid = _peer_uid(request)
+        if uid is not None and uid != _uid():
+            logging.warning(f"Refused a worker connection from user {uid}")
+            return False
+        return True
+
+    def api(self, header: dict[str, Any]) -> ApiClient | BackendPool:
+        """Pooled client per backend and connection settings, reused by every plug-in process"""
+        if len(header.get("backends") or ()) > 1:
+            return self.backend_pool(header)
+        return self._client(header, header["base_url"])
+
+    def _client(self, header: dict[str, Any], base_url: str) -> ApiClient:
+        retry = RetryPolicy.from_dict(header.get("retry"))
+        key = (
+            base_url,
+            header.get("timeout"),
+            header.get("pool_size"),
+            header.get("connect_timeout"),
+            tuple(retry.to_dict().values()),
+        )
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = ApiClient(
+                    base_url,
+                    timeout=header.get("timeout") or DEFAULT_TIMEOUT,
+                    pool_size=header.get("pool_size"),
+                    connect_timeout=header.get("connect_timeout"),
+                    retry=retry,
+                )
+                self._clients[key] = client
+            return client
+
+    def backend_pool(self, header: dict[str, Any]) -> BackendPool:
+        """One pool per set of backends, so the load of every plug-in process and queued job is counted together"""
+        key = (tuple(header["backends"]), header.get("timeout"), header.get("pool_size"), header.get("connect_timeout"))
+        clients = [self._client(header, url) for url in header["backends"]]
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = BackendPool(clients)
+                self._pools[key] = pool
+            return pool
+
+    def eligible_backends(self, job: Job) -> list[str]:
+        """Backends of the job that answer and have the ControlNet models it uses"""
+        urls = job_backends(job)
+        if len(urls) < 2:
+            return urls
+        pool = self.backend_pool(job.api)
+        pool.refresh()
+        models = set(job.controlnet_models)
+        return [
+            backend.client.base_url
+            for backend in pool.backends
+            if backend.healthy and pool.has_controlnet_models(backend, models)
+        ] or urls[:1]
+
+    def model_loaded(self, base_url: str) -> None:
+        """The job queue switched the model of a backend, what is known about its options is outdated"""
+        self.invalidate_snapshots(base_url)
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            for backend in pool.backends:
+                if backend.client.base_url == base_url.strip("/"):
+                    backend.capabilities_checked = 0.0
+
+    def snapshot(self, base_url: str, endpoint: str, max_age: float) -> Any | None:
+        with self._lock:
+            item = self._snapshots.get((base_url.strip("/"), endpoint))
+        if item is None or time.monotonic() - item[0] > max_age:
+            return None
+        return item[1]
+
+    def store_snapshot(self, base_url: str, endpoint: str, data: Any) -> None:
+        with self._lock:
+            self._snapshots[(base_url.strip("/"), endpoint)] = (time.monotonic(), data)
+
+    def invalidate_snapshots(self, base_url: str) -> None:
+        with self._lock:
+            for key in [key for key in self._snapshots if key[0] == base_url.strip("/")]:
+                del self._snapshots[key]
+
+    @contextlib.contextmanager
+    def activity(self) -> Iterator[None]:
+        with self._lock:
+            self._active += 1
+            self.requests += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._last_activity = time.monotonic()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "uptime": time.monotonic() - self.started,
+                "requests": self.requests,
+                "active": self._active,
+                "backends": len(self._clients),
+                "pools": [pool.stats() for pool in self._pools.values()],
+                "snapshots": len(self._snapshots),
+                "cache": self.cache.stats(),
+                "jobs_pending": self.jobs.pending(),
+                "models": self.jobs.stats(),
+            }
+
+    def serve_until_idle(self) -> None:
+        threading.Thread(target=self._watch_idle, name="worker-idle", daemon=True).start()
+        self.serve_forever(poll_interval=0.5)
+
+    def _watch_idle(self) -> None:
+        while True:
+            time.sleep(min(5.0, max(0.1, self.idle_timeout / 4)))
+            with self._lock:
+                idle = self._active == 0 and time.monotonic() - self._last_activity > self.idle_timeout
+            if idle and not self.jobs.pending():
+                logging.info(f"Worker idle for {self.idle_timeout}s, exiting")
+                self.shutdown()
+                return
+
+
+class WorkerHandler(socketserver.StreamRequestHandler):
+    server: WorkerServer
+
+    def handle(self) -> None:
+        while (frame := recv_frame(self.rfile)) is not None:
+            header, blobs = frame
+            operation = getattr(self, f"op_{header.get('op')}", None)
+            with self.server.activity():
+                try:
+                    if operation is None:
+                        raise ValueError(f"Unknown worker operation {header.get('op')!r}")
+                    operation(header, blobs)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the plug-in went away, e.g. its generation was cancelled
+                    return
+                except Exception as ex:
+                    if not isinstance(ex, (MissingCachedImage, requests.exceptions.RequestException)):
+                        logging.exception(f"Worker operation {header.get('op')} failed")
+                    self.reply({"ok": False, "type": type(ex).__name__, "message": str(ex)})
+
+    def reply(self, header: dict[str, Any], blobs: list[bytes] | tuple[bytes, ...] = ()) -> None:
+        send_frame(self.connection, header, blobs)
+
+    def op_ping(self, header: dict[str, Any], blobs: list[bytes]) -> None:
+        self.reply({"ok": True, "protocol": PROTOCOL_VERSION, "pid": os.getpid()})
+
+    def op_stats(self, header: dict[str, Any], blobs: list[bytes]) -> None:
+        self.reply({"ok": True, "stats": self.server.stats()})
+
+    def op_shutdown(self, header: dict[str, Any], blobs: list[bytes]) -> None:
+        self.reply({"ok": True})
+        threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+    def op_get(self, header: dict[str, Any], blobs: list[bytes]) -> None:
+        endpoint, max_age = header["endpoint"], header.get("max_age") or 0
+        cacheable = endpoint in SNAPSHOT_ENDPOINTS and not header.get("params")
+        if cacheable and max_age > 0:
+            data = self.server.snapshot(header["base_url"], endpoint, max_age)
+            if data is not None:
+                self.reply({"ok": True, "data": data, "snapshot": True})
+                return
+        data = self.server.api(header).get(
+            endpoint,
+            params=header.get("params"),
+            headers=header.get("headers"),
+            timeout=header.get("read_timeout"),
+            log_errors=False,
+        )
+        # error bodies are not worth keeping
+        if cacheable and not (isinstance(data, dict) and ("detail" in data or "error" in data)):
+            self.server.store_snapshot(header["base_url"], endpoint, data)
+        self.reply({"ok": True, "data": data})
+
+    def op_post(self, header: dict[str, Any], blobs: list[bytes]) -> None:
+        api = self.server.api(header)
+        data = _unpack(header.get("data"), blobs, self.server.cache)
+        if header["endpoint"] == OPTIONS_ENDPOINT:
+            # e.g. a checkpoint change, cached capability responses are outdated
+            self.server.invalidate_snapshots(header["base_url"])
+            # and queued jobs for the new model need not load it again
+            self.server.jobs.affinity.observe(api.base_url, data)
+        if header.get("link_bytes_per_second"):
+            api.link.bytes_per_second = float(header["link_bytes_per_second"])
+        kwargs = {
+            "params": header.get("params"),
+            "headers": header.get("headers"),
+            "timeout": header.get("read_timeout"),
+        }
+        if not header.get("stream"):
+            result = api.post(header["endpoint"], data, **kwargs)
+            self.reply({"ok": True, "data": result, "link_bytes_per_second": api.link.bytes_per_second})
+            return
+        response = api.post_stream(header["endpoint"], data, **kwargs)
+        if not isinstance(response, StreamedResponse):
+            self.reply({"ok": True, "data": response})
+            return
+        self.forward(response, {"link_bytes_per_second": api.link.bytes_per_second})
+
+    def forward(self, response: StreamedResponse, end: dict[str, Any] | None = None) -> None:
+        """Pass a response on event by event, images as raw bytes"""
+        try:
+            self.reply({"ok": True, "stream": True})
+            for key, value in response.events():
+                if key == "image":
+                    self.reply({"event": "image"}, [value])
+                else:
+                    self.reply({"event": "field", "key": key, "value": value})
+            self.reply({"event": "end", **(end or {})})
+        finally:
+            response.close()
+
+    def op_job_submit(self, header: dict[str, Any], blobs: list[bytes]) -> None:
+        if header.get("concurrency"):
+            self.server.jobs.set_concurrency(header["concurrency"])
+        if header.get("max_skips") is not None:
+            self.server.jobs.set_max_skips(header["max_skips"])
+        job = self.server.jobs.submit(
+            header["endpoint"],
+            _unpack(header.get("data"), blobs, self.server.cache),
+            {
+                key: header.get(key)
+                for key in ("base_url", "backends", "timeout", "pool_size", "connect_timeout", "retry")
+            },
+            header.get("meta"),
+            header.get("model"),
+        )
+        self.reply({"ok": True, "job": job.to_dict()})
+
+    def op_job_list(self, header: dict[str, Any], blobs: list[bytes]) -> None:
+        jobs = self.server.jobs.list(header.get("image_id"))
+        self.reply({"ok": True, "jobs": [job.to_dict() for job in jobs]})
+
+    def op_job_cancel(self, header: dict[str, Any], blobs: list[bytes]) -> None:
+        self.reply({"ok": True, "cancelled": self.server.jobs.cancel(header["job_id"])})
+
+    def op_job_collect(self, header: dict[str, Any], blobs: list[bytes]) -> None:
+        self.forward(self.server.jobs.result(header["job_id"]))
+
+    def op_job_forget(self, header: dict[str, Any], blobs: list[bytes]) -> None:
+        self.server.jobs.forget(header["job_id"])
+        self.reply({"ok": True})
+
+    def op_cache_get(self, header: dict[str, Any], blobs: list[bytes]) -> None:
+        encoded = self.server.cache.get(header["key"])
+        if encoded is None:
+            self.reply({"ok": True, "hit": False})
+            return
+        self.reply({"ok": True, "hit": True, "image": _image_meta(encoded)}, [encoded.data])
+
+    def op_cache_put(self, header: dict[str, Any], blobs: list[bytes]) -> None:
+        stored = self.server.cache.put(header["key"], _image_from_meta(blobs[0], header["image"]))
+        self.reply({"ok": True, "stored": stored})
+
+
+def serve(
+    socket_path: str,
+    idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+    cache_max_mb: int = TOBASE64_CACHE_MAX_MB,
+    cache_max_entries: int = TOBASE64_CACHE_MAX_ENTRIES,
+    jobs_dir: str | None = None,
+    queue_concurrency: int = DEFAULT_QUEUE_CONCURRENCY,
+) -> None:
+    """
+    Run the worker until it is idle for ``idle_timeout`` seconds (with no pending jobs) or told to shut down.
+
+    Raises:
+        WorkerError: the directory of ``socket_path`` is not private to the user
+    """
+    private_directory(os.path.dirname(socket_path))
+    if _ping(socket_path) is not None:
+        logging.info(f"A worker is already listening on {socket_path}")
+        return
+    # left behind by a worker that did not exit cleanly
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(socket_path)
+    server = WorkerServer(socket_path, idle_timeout, cache_max_mb, cache_max_entries, jobs_dir, queue_concurrency)
+    logging.info(f"Worker {os.getpid()} listening on {socket_path}")
+    try:
+        server.serve_until_idle()
+    finally:
+        server.server_close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(socket_path)
+        logging.info(f"Worker {os.getpid()} stopped after {server.requests} requests")
+
+
+def _ping(socket_path: str, timeout: float = PING_TIMEOUT) -> dict[str, Any] | None:
+    try:
+        connection = _Connection.open(socket_path, timeout)
+    except OSError:
+        return None
+    try:
+        connection.send({"op": "ping"})
+        reply, _ = connection.recv()
+    except Exception:
+        return None
+    finally:
+        connection.close()
+    return reply
+
+
+# Plug-in side
+
+
+class _Connection:
+    """One request to the worker; a streamed response keeps it open until the response is closed"""
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.stream = sock.makefile("rb")
+        self.on_close: Any = None
+
+    @classmethod
+    def open(cls, socket_path: str, timeout: float | None) -> _Connection:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(socket_path)
+            _check_peer(sock, socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return cls(sock)
+
+    def send(self, header: dict[str, Any], blobs: list[bytes] | tuple[bytes, ...] = ()) -> None:
+        with self._transport_errors():
+            send_frame(self.sock, header, blobs)
+
+    def recv(self) -> tuple[dict[str, Any], list[bytes]]:
+        with self._transport_errors():
+            frame = recv_frame(self.stream)
+        if frame is None:
+            raise requests.exceptions.ConnectionError("Worker closed the connection")
+        return frame
+
+    @contextlib.contextmanager
+    def _transport_errors(self) -> Iterator[None]:
+        try:
+            yield
+        except TimeoutError as ex:
+            raise requests.exceptions.Timeout(f"Worker did not answer in time: {ex}") from ex
+        except OSError as ex:
+            raise requests.exceptions.ConnectionError(f"Worker connection failed: {ex}") from ex
+
+    def abort(self) -> None:
+        with contextlib.suppress(OSError):
+            self.sock.shutdown(socket.SHUT_RDWR)
+
+    def close(self) -> None:
+        self.stream.close()
+        self.sock.close()
+        if self.on_close is not None:
+            self.on_close(self)
+            self.on_close = None
+
+
+class WorkerClient:
+    """
+    ApiClient stand-in that sends requests through the background worker.
+
+    The worker is started on first use. If it cannot be reached or started, every call goes directly to the
+    backend through a regular ApiClient, so enabling the worker never makes the plug-in unusable. Besides the
+    ApiClient methods it serves as the shared cache of encoded layers (``get_encoded``/``put_encoded``).
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        socket_path: str | None = None,
+        timeout: float = DEFAULT_TIMEOUT,
+        pool_size: int | None = None,
+        connect_timeout: float | None = None,
+        snapshot_ttl: float = 0,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+        cache_max_mb: int = TOBASE64_CACHE_MAX_MB,
+        cache_max_entries: int = TOBASE64_CACHE_MAX_ENTRIES,
+        autostart: bool = True,
+        backends: list[str] | None = None,
+        retry: RetryPolicy | None = None,
+    ) -> None:
+        # all backends including ``base_url`` when requests are spread over several
+        self.backends = backends if backends and len(backends) > 1 else None
+        if self.backends:
+            self.direct = BackendPool.fromUrls(
+                self.backends,
+                timeout=timeout,
+                pool_size=pool_size,
+                connect_timeout=connect_timeout,
+                retry=retry,
+            )
+        else:
+            self.direct = ApiClient(
+                base_url,
+                timeout=timeout,
+                pool_size=pool_size,
+                connect_timeout=connect_timeout,
+                retry=retry,
+            )
+        self.socket_path = socket_path or default_socket_path()
+        self.snapshot_ttl = float(snapshot_ttl or 0)
+        self.idle_timeout = idle_timeout
+        self.cache_max_mb = cache_max_mb
+        self.cache_max_entries = cache_max_entries
+        self.autostart = autostart
+        self._available: bool | None = None
+        self._lock = threading.Lock()
+        self._connections: set[_Connection] = set()
+        # encoded images this process knows the worker holds
+        self._known_keys: set[str] = set()
+
+    @property
+    def base_url(self) -> str:
+        return self.direct.base_url
+
+    def setBaseUrl(self, base_url: str) -> None:
+        self.direct.setBaseUrl(base_url)
+
+    @property
+    def available(self) -> bool:
+        """Whether the worker answers, starting it if needed. Decided once per plug-in process."""
+        with self._lock:
+            if self._available is None:
+                start = time.perf_counter()
+                self._available = self._start()
+                logging.debug(f"Worker available: {self._available} ({time.perf_counter() - start:.3f}s)")
+            return self._available
+
+    def _start(self) -> bool:
+        if not is_supported():
+            return False
+        try:
+            private_directory(os.path.dirname(self.socket_path))
+        except (OSError, WorkerError) as ex:
+            logging.warning(f"Not using the background worker, sending requests directly: {ex}")
+            return False
+        reply = _ping(self.socket_path)
+        if reply is not None and reply.get("protocol") == PROTOCOL_VERSION:
+            return True
+        if not self.autostart:
+            return False
+        if reply is not None:
+            logging.info(f"Replacing worker {reply.get('pid')} speaking protocol {reply.get('protocol')}")
+            self.stop_worker()
+        try:
+            self._spawn()
+        except OSError as ex:
+            logging.warning(f"Starting the background worker failed, sending requests directly: {ex}")
+            return False
+        deadline = time.monotonic() + WORKER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            reply = _ping(self.socket_path)
+            if reply is not None and reply.get("protocol") == PROTOCOL_VERSION:
+                return True
+            time.sleep(0.05)
+        logging.warning(f"Background worker did not come up in {WORKER_START_TIMEOUT}s, sending requests directly")
+        return False
+
+    def _spawn(self) -> None:
+        command = [
+            sys.executable,
+            WORKER_SCRIPT,
+            "--socket",
+            self.socket_path,
+            "--idle-timeout",
+            str(self.idle_timeout),
+            "--cache-mb",
+            str(self.cache_max_mb),
+            "--cache-entries",
+            str(self.cache_max_entries),
+        ]
+        logging.info(f"Starting background worker: {' '.join(command)}")
+        # a session of its own: the worker outlives this plug-in process and is not killed with it
+        subprocess.Popen(  # noqa: S603 our own script with the running interpreter
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(WORKER_SCRIPT),
+            start_new_session=True,
+        )
+
+    def stop_worker(self) -> None:
+        """Ask the running worker to exit and wait until it is gone"""
+        with contextlib.suppress(Exception):
+            self._call({"op": "shutdown"}, timeout=PING_TIMEOUT)
+        deadline = time.monotonic() + WORKER_START_TIMEOUT
+        while _ping(self.socket_path) is not None and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def _open(self, timeout: float | None) -> _Connection:
+        try:
+            connection = _Connection.open(self.socket_path, timeout)
+        except OSError as ex:
+            raise requests.exceptions.ConnectionError(f"Worker is not reachable: {ex}") from ex
+        with self._lock:
+            self._connections.add(connection)
+        connection.on_close = self._forget
+        return connection
+
+    def _forget(self, connection: _Connection) -> None:
+        with self._lock:
+            self._connections.discard(connection)
+
+    def _call(
+        self,
+        header: dict[str, Any],
+        blobs: list[bytes] | tuple[bytes, ...] = (),
+        timeout: float | None = None,
+    ) -> tuple[dict[str, Any], list[bytes]]:
+        connection = self._open(timeout)
+        try:
+            connection.send(header, blobs)
+            return connection.recv()
+        finally:
+            connection.close()
+
+    def _request(self, op: str, endpoint: str, params: Any, headers: Any, timeout: float | None) -> dict[str, Any]:
+        return {
+            "op": op,
+            "base_url": self.direct.base_url,
+            "backends": self.backends,
+            "timeout": self.direct.timeout,
+            "pool_size": self.direct.pool_size,
+            "connect_timeout": self.direct.connect_timeout,
+            "retry": self.direct.retry.to_dict(),
+            "endpoint": endpoint,
+            "params": params,
+            "headers": headers,
+            "read_timeout": timeout,
+        }
+
+    def _socket_timeout(self, endpoint: str, method: str, timeout: float | None) -> float:
+        connect_timeout, read_timeout = self.direct.getTimeout(endpoint, method, timeout)
+        return connect_timeout + read_timeout + WORKER_TIMEOUT_MARGIN
+
+    @staticmethod
+    def _data(reply: dict[str, Any]) -> Any:
+        if not reply.get("ok"):
+            raise _remote_error(reply)
+        if reply.get("link_bytes_per_second"):
+            PAYLOAD_POLICY.link.bytes_per_second = float(reply["link_bytes_per_second"])
+        return reply.get("data")
+
+    def getTimeout(self, endpoint: str, method: str = "GET", read_timeout: float | None = None) -> tuple[float, float]:
+        return self.direct.getTimeout(endpoint, method, read_timeout)
+
+    def get(self, endpoint, params=None, headers=None, timeout=None, log_errors=True):
+        if not self.available:
+            return self.direct.get(endpoint, params=params, headers=headers, timeout=timeout, log_errors=log_errors)
+        try:
+            header = self._request("get", endpoint, params, headers, timeout)
+            if endpoint in SNAPSHOT_ENDPOINTS:
+                header["max_age"] = self.snapshot_ttl
+            reply, _ = self._call(header, timeout=self._socket_timeout(endpoint, "GET", timeout))
+            return self._data(reply)
+        except Exception as ex:
+            if log_errors:
+                logging.error(f"ERROR: WorkerClient.get from {endpoint}: {ex}")
+            raise
+
+    def post(self, endpoint, data=None, params=None, headers=None, timeout=None):
+        if not self.available:
+            return self.direct.post(endpoint, data=data, params=params, headers=headers, timeout=timeout)
+        try:
+            connection, reply = self._send_post(endpoint, data, params, headers, timeout, stream=False)
+            connection.close()
+            return self._data(reply)
+        except Exception as ex:
+            logging.error(f"ERROR: WorkerClient.post to {endpoint}: {ex}")
+            raise
+
+    def post_stream(
+        self,
+        endpoint: str,
+        data: dict[str, Any] | None = None,
+        params: dict[str, Any] | None = None,
+        headers: dict[str, str] | None = None,
+        timeout: float | None = None,
+    ) -> StreamedResponse | dict[str, Any]:
+        """Same as ApiClient.post_stream; the worker forwards images as raw bytes while they are read"""
+        if not self.available:
+            return self.direct.post_stream(endpoint, data=data, params=params, headers=headers, timeout=timeout)
+        try:
+            connection, reply = self._send_post(endpoint, data, params, headers, timeout, stream=True)
+        except Exception as ex:
+            logging.error(f"ERROR: WorkerClient.post_stream to {endpoint}: {ex}")
+            raise
+        if not reply.get("ok") or not reply.get("stream"):
+            connection.close()
+            return self._data(reply)
+        return StreamedResponse(self._events(connection), close=connection.close)
+
+    def _send_post(
+        self,
+        endpoint: str,
+        data: Any,
+        params: Any,
+        headers: Any,
+        timeout: float | None,
+        stream: bool,
+    ) -> tuple[_Connection, dict[str, Any]]:
+        # images cached in the worker are sent by key; if one got evicted meanwhile, resend with all images inline
+        known_keys = set(self._known_keys)
+        while True:
+            blobs: list[bytes] = []
+            header = {
+                **self._request("post", endpoint, params, headers, timeout),
+                "data": _pack(data, blobs, known_keys),
+                "stream": stream,
+                "link_bytes_per_second": PAYLOAD_POLICY.link.bytes_per_second,
+            }
+            connection = self._open(self._socket_timeout(endpoint, "POST", timeout))
+            try:
+                connection.send(header, blobs)
+                reply, _ = connection.recv()
+            except BaseException:
+                connection.close()
+                raise
+            if reply.get("type") != MissingCachedImage.__name__ or not known_keys:
+                return connection, reply
+            connection.close()
+            logging.debug(f"Worker evicted a cached image, resending {endpoint} with images inline")
+            known_keys = set()
+            with self._lock:
+                self._known_keys.clear()
+
+    def _events(self, connection: _Connection) -> Iterator[tuple[str, Any]]:
+        while True:
+            reply, blobs = connection.recv()
+            if reply.get("ok") is False:
+                raise _remote_error(reply)
+            event = reply.get("event")
+            if event == "image":
+                yield "image", blobs[0]
+            elif event == "field":
+                yield reply["key"], reply["value"]
+            elif event == "end":
+                self._data({"ok": True, **reply})
+                return
+
+    def interrupt(self, timeout: float | None = None) -> None:
+        """Ask the backend to stop the current generation, images finished so far are returned"""
+        self.post("/sdapi/v1/interrupt", timeout=timeout)
+
+    def skip(self, timeout: float | None = None) -> None:
+        """Ask the backend to skip the image of the batch being generated"""
+        self.post("/sdapi/v1/skip", timeout=timeout)
+
+    def abort(self) -> None:
+        """Drop the connections of requests in flight, they raise ConnectionError"""
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            connection.abort()
+        self.direct.abort()
+
+    def close(self) -> None:
+        self.direct.close()
+
+    def get_encoded(self, key: str) -> EncodedImage | None:
+        """Encoded image cached by this or an earlier plug-in process, None on a miss"""
+        if not self.available:
+            return None
+        try:
+            reply, blobs = self._call({"op": "cache_get", "key": key}, timeout=CACHE_TIMEOUT)
+        except Exception as ex:
+            logging.debug(f"Worker cache lookup failed: {ex}")
+            return None
+        if not reply.get("hit"):
+            return None
+        encoded = _image_from_meta(blobs[0], reply["image"])
+        self._remember(encoded, key)
+        return encoded
+
+    def put_encoded(self, key: str, encoded: EncodedImage) -> bool:
+        if not self.available:
+            return False
+        try:
+            reply, _ = self._call(
+                {"op": "cache_put", "key": key, "image": _image_meta(encoded)},
+                [encoded.data],
+                timeout=CACHE_TIMEOUT,
+            )
+        except Exception as ex:
+            logging.debug(f"Storing in the worker cache failed: {ex}")
+            return False
+        if reply.get("stored"):
+            self._remember(encoded, key)
+        return bool(reply.get("stored"))
+
+    def submit_job(
+        self,
+        endpoint: str,
+        data: dict[str, Any],
+        meta: dict[str, Any] | None = None,
+        concurrency: int | None = None,
+        model: dict[str, Any] | None = None,
+        max_skips: int | None = None,
+    ) -> dict[str, Any]:
+        """
+        Queue a generation in the worker and return without waiting for it.
+
+        Args:
+            concurrency: jobs the worker runs at a time on each backend
+            model: model options the job needs loaded (sg_affinity.model_requirement)
+            max_skips: times a job may be overtaken by jobs for an already loaded model
+
+        Returns:
+            The job record, ``job_id`` identifies it in later calls
+
+        Raises:
+            WorkerError: the worker is not available, the job has to run in-process
+        """
+        if not self.available:
+            raise WorkerError("Background worker is not available")
+        blobs: list[bytes] = []
+        with self._lock:
+            known_keys = set(self._known_keys)
+        header = {
+            **self._request("job_submit", endpoint, None, None, None),
+            "data": _pack(data, blobs, known_keys),
+            "meta": meta,
+            "concurrency": concurrency,
+            "model": model,
+            "max_skips": max_skips,
+        }
+        reply, _ = self._call(header, blobs, timeout=CACHE_TIMEOUT)
+        if reply.get("type") == MissingCachedImage.__name__:
+            with self._lock:
+                self._known_keys.clear()
+            blobs = []
+            header["data"] = _pack(data, blobs, set())
+            reply, _ = self._call(header, blobs, timeout=CACHE_TIMEOUT)
+        return self._data({**reply, "data": reply.get("job")})
+
+    def jobs(self, image_id: int | None = None) -> list[dict[str, Any]]:
+        """Records of all queued, running and finished jobs, oldest first; only those of ``image_id`` if given"""
+        if not self.available:
+            return []
+        reply, _ = self._call({"op": "job_list", "image_id": image_id}, timeout=CACHE_TIMEOUT)
+        return self._data({**reply, "data": reply.get("jobs")})
+
+    def cancel_job(self, job_id: str) -> bool:
+        reply, _ = self._call({"op": "job_cancel", "job_id": job_id}, timeout=CACHE_TIMEOUT)
+        return bool(self._data({**reply, "data": reply.get("cancelled")}))
+
+    def collect_job(self, job_id: str) -> StreamedResponse:
+        """Result of a finished job, images are read from the worker as they are consumed"""
+        connection = self._open(CACHE_TIMEOUT)
+        try:
+            connection.send({"op": "job_collect", "job_id": job_id})
+            reply, _ = connection.recv()
+        except BaseException:
+            connection.close()
+            raise
+        if not reply.get("stream"):
+            connection.close()
+            raise _remote_error(reply)
+        return StreamedResponse(self._events(connection), close=connection.close)
+
+    def forget_job(self, job_id: str) -> None:
+        """Delete a job and its stored result"""
+        reply, _ = self._call({"op": "job_forget", "job_id": job_id}, timeout=CACHE_TIMEOUT)
+        self._data(reply)
+
+    def _remember(self, encoded: EncodedImage, key: str) -> None:
+        encoded.cache_key = key
+        with self._lock:
+            self._known_keys.add(key)
+
+    def stats(self) -> dict[str, Any] | None:
+        """Counters of the running worker, None if it is not running"""
+        if not is_supported() or _ping(self.socket_path) is None:
+            return None
+        reply, _ = self._call({"op": "stats"}, timeout=PING_TIMEOUT)
+        return reply.get("stats")
+
+    @classmethod
+    def fromSettings(cls, settings: Any) -> WorkerClient:
+        return cls(
+            settings.get("api_base"),
+            pool_size=settings.get("http_pool_size"),
+            connect_timeout=settings.get("http_connect_timeout"),
+            snapshot_ttl=settings.get("options_cache_ttl") or 0,
+            idle_timeout=settings.get("worker_idle_timeout") or DEFAULT_IDLE_TIMEOUT,
+            cache_max_mb=int(settings.get("tobase64_cache_max_mb") or TOBASE64_CACHE_MAX_MB),
+            cache_max_entries=int(settings.get("tobase64_cache_max_entries") or TOBASE64_CACHE_MAX_ENTRIES),
+            backends=backend_urls(settings),
+            retry=RetryPolicy.fromSettings(settings),
+        )
+
+
+def connect_api(settings: Any) -> ApiClient | BackendPool | WorkerClient:
+    """
+    Client for the plug-in: through the background worker when enabled and supported, directly otherwise;
+    spread over several backends if more than one is configured
+    """
+    if settings.get("worker_enabled") and is_supported():
+        return WorkerClient.fromSettings(settings)
+    if len(backend_urls(settings)) > 1:
+        return BackendPool.fromSettings(settings)
+    return ApiClient.fromSettings(settings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Background worker shared by GimpFusion plug-in processes")
+    parser.add_argument("--socket", default=default_socket_path(), help="Unix socket path in a private directory")
+    parser.add_argument("--idle-timeout", type=float, default=DEFAULT_IDLE_TIMEOUT, help="exit after idle seconds")
+    parser.add_argument("--cache-mb", type=int, default=TOBASE64_CACHE_MAX_MB, help="encoded image cache budget")
+    parser.add_argument("--cache-entries", type=int, default=TOBASE64_CACHE_MAX_ENTRIES, help="encoded images kept")
+    parser.add_argument("--jobs-dir", default=None, help="directory of the job queue")
+    parser.add_argument("--queue-concurrency", type=int, default=DEFAULT_QUEUE_CONCURRENCY, help="jobs per backend")
+    parser.add_argument("--log-file", default=default_log_path(), help="log file, '-' for stderr")
+    parser.add_argument("--debug", action="store_true", help="debug logging")
+    parser.add_argument("--status", action="store_true", help="print the counters of the running worker and exit")
+    parser.add_argument("--stop", action="store_true", help="stop the running worker and exit")
+    args = parser.parse_args()
+
+    if args.status or args.stop:
+        client = WorkerClient("http://127.0.0.1", socket_path=args.socket, autostart=False)
+        stats = client.stats()
+        print(json.dumps(stats, indent=2) if stats is not None else "No worker is running")  # noqa: T201
+        if args.stop and stats is not None:
+            client.stop_worker()
+        return
+
+    if args.log_file == default_log_path():
+        private_directory(worker_directory())
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s",
+        filename=None if args.log_file == "-" else args.log_file,
+    )
+    serve(args.socket, args.idle_timeout, args.cache_mb, args.cache_entries, args.jobs_dir, args.queue_concurrency)
+
+
+if __name__ == "__main__":
+    main()
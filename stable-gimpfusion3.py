@@ -13,6 +13,7 @@ from sg_plugins.config import ConfigModelPlugin, ConfigPlugin
 from sg_plugins.config_controlnet import ConfigControlnetLayerPlugin
 from sg_plugins.img2img import Image2imagePlugin
 from sg_plugins.inpainting import InpaintingPlugin
+from sg_plugins.jobs import JobsCancelPlugin, JobsCollectPlugin
 from sg_plugins.layerinfo import LayerInfoPlugin
 from sg_plugins.txt2img import Txt2imagePlugin
 
@@ -22,16 +23,19 @@ from gi.repository import Gimp
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+from sg_backend_options import OptionsCache
 from sg_constants import (
     AUTHOR,
     STABLE_GIMPFUSION_DEFAULT_SETTINGS,
 )
-from sg_structures import Layer
-from sg_structures import ApiClient, MyShelf
-from sg_utils import fetch_stablediffusion_options, set_logging_dest
+from sg_progress import interrupt_running
+from sg_structures import Layer, MyShelf
+from sg_utils import set_logging_dest
+from sg_worker import WorkerClient, connect_api
 
 settings = MyShelf(STABLE_GIMPFUSION_DEFAULT_SETTINGS)
-api = ApiClient(settings.get("api_base"))
+# with worker_enabled, requests go through the background worker shared by all plug-in processes
+api = connect_api(settings)
 
 logging.basicConfig(level=logging.DEBUG if settings.get("debug_logging") else logging.INFO)
 set_logging_dest(settings.get("file_logging") or False)
@@ -54,6 +58,8 @@ MODULES: dict[str, PluginBase] = {
     # "stable-gimpfusion-img2img-context": Image2imageContextPlugin(api=api, settings=settings),
     "stable-gimpfusion-inpainting": InpaintingPlugin(api=api, settings=settings),
     # "stable-gimpfusion-inpainting-context": InpaintingContextPlugin(api=api, settings=settings),
+    "stable-gimpfusion-jobs-collect": JobsCollectPlugin(api=api, settings=settings),
+    "stable-gimpfusion-jobs-cancel": JobsCancelPlugin(api=api, settings=settings),
     "stable-gimpfusion-config-controlnet-layer": ConfigControlnetLayerPlugin(api=api, settings=settings),
     # "stable-gimpfusion-config-controlnet-layer-context": ConfigControlnetLayerContextPlugin(api=api, settings=settings),
     "stable-gimpfusion-layer-info": LayerInfoPlugin(api=api, settings=settings),
@@ -65,15 +71,18 @@ class GimpfusionPlugin(Gimp.PlugIn):
     def __init__(self):
         super().__init__()
 
-        try:
-            options = fetch_stablediffusion_options(api=api)
-            settings.save(options)
-        except Exception:
-            logging.exception("ERROR: DynamicDropdownData.fetch")
-            settings.save({"is_server_running": False})
+        # GIMP starts a new plug-in process for menu registration and for every procedure run,
+        # serve the cached backend options instead of querying the backend each time
+        OptionsCache(api=api, settings=settings).ensure()
 
         # Set global settings reference for Layer class cache control
         Layer.set_global_settings(settings)
+        # encoded layers kept by the worker survive this process
+        Layer.set_shared_cache(api if isinstance(api, WorkerClient) else None)
+
+    def do_quit(self) -> None:
+        # GIMP closes the plug-in when its progress is cancelled, stop the generation on the backend as well
+        interrupt_running()
 
     def do_set_i18n(self, name: str) -> str:
         return DOMAIN